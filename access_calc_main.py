@@ -6,12 +6,16 @@
 # tool help can be found at https://github.com/higgicd/Accessibility_Toolbox
 
 import os, sys
-import math
 import datetime
 import time
 import arcpy
 import multiprocessing
 from arcpy import env
+from shared_inputs import SharedInputs, attach_lookup, batch_lookup
+from worker_stats import pickled_size, current_rss_mb, format_mb
+import telemetry
+from access_core import cpu_count, batch_plan, unique_in_order, write_id_table, value_dtype, impedance_lookup, is_measure, main_arguments, reload_parameters
+from memory_budget import restores_budget
 env.overwriteOutput = True
 arcpy.CheckOutExtension("Network")
 
@@ -19,6 +23,8 @@ arcpy.CheckOutExtension("Network")
 # open Start Menu > ArcGIS > Python Command Prompt
 # run this: C:\Progra~1\ArcGIS\Pro\bin\Python\scripts\propy.bat D:\access_calc_main.py
 # change file path of the access_calc_main.py in the code above^
+# or pass a json scenario config instead of uncommenting the parameters below:
+# propy.bat D:\access_calc_main.py D:\scenarios.json  (see scenario_runner.py)
 
 # ----- parameters ----- # change all these as you see fit
 # --- origins ---
@@ -116,32 +122,26 @@ def field_map_x(input_fc, field_name, output_field_name):
     return field_map_x
 
 def list_unique(input_fc, field):
-    unique_list = []
     with arcpy.da.SearchCursor(input_fc, field) as cursor:
-        for row in cursor:
-            if row[0] not in unique_list:
-                unique_list.append(row[0])
-    return unique_list
-    
-def cpu_count(cpu_tot):
-    if cpu_tot == 1:
-        cpu_num = 1
-    else:
-        cpu_num = cpu_tot - 1
-    return cpu_num
-
-def batch_size_f(input_fc, batch_size_factor):
+        return unique_in_order(row[0] for row in cursor)
+    
+def batch_size_f(input_fc, batch_size_factor, destinations_fc = None, reachable_fraction = 1.0):
+    from memory_budget import active_budget
     cpu_num = cpu_count(multiprocessing.cpu_count())
     arcpy.AddMessage("There are "+str(multiprocessing.cpu_count())+" cpu cores on this machine, using "+str(cpu_num))
     origins_i_count = int(arcpy.management.GetCount(input_fc).getOutput(0))
     
-    if int(math.ceil(origins_i_count/cpu_num)) <= batch_size_factor:
-        batch_size = int(math.ceil(origins_i_count/cpu_num)+1)
-        batch_count = int(math.ceil(origins_i_count/batch_size))
+    # under a memory budget a batch is at most the origins whose od lines fit a worker's share
+    budget = active_budget(cpu_num)
+    if budget is not None:
+        n_destinations = int(arcpy.management.GetCount(destinations_fc).getOutput(0))
+        arcpy.AddMessage("Memory budget: "+budget.describe(n_destinations, reachable_fraction))
+        batch_size_factor = min(batch_size_factor, budget.origin_batch_size(n_destinations, reachable_fraction))
+    
+    batch_size, batch_count, optimized = batch_plan(origins_i_count, cpu_num, batch_size_factor)
+    if optimized:
         arcpy.AddMessage("Batching is optimized with "+str(batch_count)+" chunks of origins")
     else:
-        batch_size = batch_size_factor
-        batch_count = int(math.ceil(origins_i_count/batch_size_factor))
         arcpy.AddMessage("Batching "+str(batch_count)+" chunks of origins")
     return batch_size
 
@@ -161,18 +161,31 @@ def batch_i_setup(input_fc, batch_size):
 def calculate_nax_locations(input_fc, input_type, input_network, search_tolerance, search_criteria, search_query, travel_mode):
     arcpy.AddMessage("Calculating "+input_type+" Network Locations...")
     print("Calculating "+input_type+" Network Locations...")
-    arcpy.nax.CalculateLocations(input_fc, input_network, 
-                                 search_tolerance = search_tolerance, 
-                                 search_criteria = search_criteria, 
-                                 search_query = search_query,
-                                 travel_mode = travel_mode,
-                                 exclude_restricted_elements = "EXCLUDE")
+    with telemetry.stage("locations", input_type = input_type) as record:
+        arcpy.nax.CalculateLocations(input_fc, input_network, 
+                                     search_tolerance = search_tolerance, 
+                                     search_criteria = search_criteria, 
+                                     search_query = search_query,
+                                     travel_mode = travel_mode,
+                                     exclude_restricted_elements = "EXCLUDE")
+        record["rows"] = int(arcpy.management.GetCount(input_fc).getOutput(0))
 
 def create_dict(input_fc, key_field, value_field):
     valueDict = {r[0]:r[1] for r in arcpy.da.SearchCursor(input_fc, [key_field, value_field])}
     return valueDict
 
-def preprocess_x(input_fc, input_type, id_field, o_j_field, input_network, search_tolerance, search_criteria, search_query, travel_mode, batch_size):
+def preprocess_x(input_fc, input_type, id_field, o_j_field, input_network, search_tolerance, search_criteria, search_query, travel_mode, batch_size,
+                 all_destinations = False, location_cache_dir = None):
+    from location_cache import preprocess_flags, restore_preprocessed
+    stage_start = time.time()
+    
+    # located inputs from an earlier run? skip straight to batching
+    location_cache, signature, output_fc = restore_preprocessed(location_cache_dir, input_fc, input_type, [id_field, o_j_field],
+                                                                preprocess_flags(input_type, all_destinations), batch_i_setup, batch_size,
+                                                                input_network, travel_mode, search_tolerance,
+                                                                search_criteria, search_query)
+    if output_fc is not None:
+        return output_fc
     
     # add field mappings
     if input_type == "origins_i":
@@ -206,22 +219,29 @@ def preprocess_x(input_fc, input_type, id_field, o_j_field, input_network, searc
         arcpy.management.CalculateField(r"in_memory/"+input_type, "j_id_text", "!j_id!", "PYTHON3")
         
         layer = arcpy.management.MakeFeatureLayer(r"in_memory/"+input_type, input_type+"_view")
-        arcpy.management.SelectLayerByAttribute(layer, "NEW_SELECTION", "o_j > 0")
+        if not all_destinations:
+            arcpy.management.SelectLayerByAttribute(layer, "NEW_SELECTION", "o_j > 0")
         
         arcpy.conversion.FeatureClassToFeatureClass(layer, arcpy.env.workspace, input_type)
         output_fc = os.path.join(arcpy.env.workspace+"/"+input_type)
     
-    # calculate network locations
-    calculate_nax_locations(output_fc, input_type, input_network, search_tolerance, search_criteria, search_query, travel_mode)
+    telemetry.emit("preprocess", stage_start, time.time(), input_type = input_type,
+                   rows = int(arcpy.management.GetCount(output_fc).getOutput(0)))
+    
+    # calculate network locations; with the cache only for new or moved points
+    if location_cache is not None:
+        location_cache.locate(output_fc, input_type)
+        location_cache.store(signature, output_fc)
+    else:
+        calculate_nax_locations(output_fc, input_type, input_network, search_tolerance, search_criteria, search_query, travel_mode)
     arcpy.AddMessage("Finished pre-processing "+input_type)
     arcpy.management.Delete(r"in_memory")
     return output_fc
 
 def access_multi(jobs):
-    from importlib import reload
-    import parameters
-    reload(parameters)
-    from parameters import impedance_f
+    from memory_budget import fits
+    from odcm_cache import open_cache, store_result, restore_lines_table
+    reload_parameters()
     
     batch_id = jobs[0]
     scratchworkspace = jobs[1]
@@ -232,69 +252,112 @@ def access_multi(jobs):
     cutoff = jobs[6]
     time_of_day = jobs[7]
     selected_impedance_function = jobs[8]
-    o_j_dict = jobs[9]
+    o_j_dict = attach_lookup(jobs[9]) # zero-copy view of the shared o_j lookup
     del_i_eq_j = jobs[10]
+    telemetry.setup(jobs[11])
+    cache, cache_key = open_cache(jobs[12])
+    n_j_dict = attach_lookup(jobs[13]) if jobs[13] is not None else None # co-located destinations per solved one
+    precision = jobs[14]
+    zoned = jobs[15] # o_j_dict and n_j_dict are this batch's destination zones
+    stage_start = time.time()
     
     arcpy.management.CreateFileGDB(scratchworkspace, "batch_"+str(batch_id)+".gdb")
     worker_gdb = os.path.join(scratchworkspace+"/batch_"+str(batch_id)+".gdb")
-        
-    network_layer = "network_layer"+str(batch_id)
-    arcpy.nax.MakeNetworkDatasetLayer(input_network, network_layer)
-    odcm = arcpy.nax.OriginDestinationCostMatrix(network_layer)
-        
-    # nax layer properties
-    odcm.travelMode = travel_mode
-    odcm.timeUnits = arcpy.nax.TimeUnits.Minutes
-    odcm.defaultImpedanceCutoff = cutoff
-    odcm.lineShapeType = arcpy.nax.LineShapeType.NoLine
-    if time_of_day != None:
-        odcm.timeOfDay = time_of_day
-    else:
-        odcm.timeOfDay = None
-    
-    # 1 DESTINATIONS
-    # map j_id field
-    candidate_fields_j = arcpy.ListFields(destinations_j)
-    field_mappings_j = odcm.fieldMappings(arcpy.nax.OriginDestinationCostMatrixInputDataType.Destinations,
-                                              True, candidate_fields_j)
-    field_mappings_j["Name"].mappedFieldName = "j_id"
-    
-    # load destinations
-    odcm.load(arcpy.nax.OriginDestinationCostMatrixInputDataType.Destinations, 
-              features = destinations_j, 
-              field_mappings = field_mappings_j,
-              append = False)
-    
-    # 2 ORIGINS
-    # map i_id field
-    temp_origins_i = arcpy.management.MakeFeatureLayer(origins_i, "origins_i"+str(batch_id), '"batch_id" = ' + str(batch_id))
-    arcpy.conversion.FeatureClassToFeatureClass(temp_origins_i, "in_memory", "origins"+str(batch_id))
-    
-    origins_i = r"in_memory/origins"+str(batch_id)
-    
-    candidate_fields_i = arcpy.ListFields(origins_i)
-    field_mappings_i = odcm.fieldMappings(arcpy.nax.OriginDestinationCostMatrixInputDataType.Origins, 
-                                          True, candidate_fields_i)
-    field_mappings_i["Name"].mappedFieldName = "i_id"
-    
-    # load origins
-    odcm.load(arcpy.nax.OriginDestinationCostMatrixInputDataType.Origins,
-              features = origins_i, 
-              field_mappings = field_mappings_i, 
-              append = False)
-    
-    # 3 SOLVE
-    arcpy.AddMessage("Solving OD Matrix...")
-    result = odcm.solve()
-
-    # 4 EXPORT results to a feature class
-    # fail? skip
-    if not result.solveSucceeded:
-        return
-
-    result.export(arcpy.nax.OriginDestinationCostMatrixOutputDataType.Lines,
-                  os.path.join(r"in_memory", "od_lines_"+str(batch_id)))
     od_lines = os.path.join(r"in_memory", "od_lines_"+str(batch_id))
+    
+    # 0 CACHE
+    # batch already solved by an earlier run? restore it and skip steps 1-4
+    entry = None
+    if cache is not None:
+        entry = cache.get(cache_key)
+        telemetry.emit("cache", stage_start, time.time(), batch_id = batch_id,
+                       status = "hit" if entry is not None else "miss")
+        if entry is not None:
+            with telemetry.stage("export", batch_id = batch_id, cached = True) as record:
+                restore_lines_table(entry, od_lines)
+                record["rows"] = int(arcpy.management.GetCount(od_lines).getOutput(0))
+        stage_start = time.time()
+    
+    if entry is None:
+        network_layer = "network_layer"+str(batch_id)
+        arcpy.nax.MakeNetworkDatasetLayer(input_network, network_layer)
+        odcm = arcpy.nax.OriginDestinationCostMatrix(network_layer)
+        
+        # nax layer properties
+        odcm.travelMode = travel_mode
+        odcm.timeUnits = arcpy.nax.TimeUnits.Minutes
+        odcm.defaultImpedanceCutoff = cutoff
+        odcm.lineShapeType = arcpy.nax.LineShapeType.NoLine
+        if time_of_day != None:
+            odcm.timeOfDay = time_of_day
+        else:
+            odcm.timeOfDay = None
+    
+        # 1 DESTINATIONS
+        # map j_id field
+        candidate_fields_j = arcpy.ListFields(destinations_j)
+        field_mappings_j = odcm.fieldMappings(arcpy.nax.OriginDestinationCostMatrixInputDataType.Destinations,
+                                                  True, candidate_fields_j)
+        field_mappings_j["Name"].mappedFieldName = "j_id"
+    
+        # zones: only the representatives of this batch are solved
+        if zoned:
+            arcpy.management.CopyFeatures(destinations_j, r"in_memory/destinations"+str(batch_id))
+            destinations_j = r"in_memory/destinations"+str(batch_id)
+            zone_o_j = batch_lookup(o_j_dict, list_unique(destinations_j, "j_id_text"))
+            with arcpy.da.UpdateCursor(destinations_j, ["j_id_text"]) as updateRows:
+                for updateRow in updateRows:
+                    if updateRow[0] not in zone_o_j:
+                        updateRows.deleteRow()
+    
+        # load destinations
+        odcm.load(arcpy.nax.OriginDestinationCostMatrixInputDataType.Destinations, 
+                  features = destinations_j, 
+                  field_mappings = field_mappings_j,
+                  append = False)
+    
+        # 2 ORIGINS
+        # map i_id field
+        temp_origins_i = arcpy.management.MakeFeatureLayer(origins_i, "origins_i"+str(batch_id), '"batch_id" = ' + str(batch_id))
+        arcpy.conversion.FeatureClassToFeatureClass(temp_origins_i, "in_memory", "origins"+str(batch_id))
+    
+        origins_i = r"in_memory/origins"+str(batch_id)
+    
+        candidate_fields_i = arcpy.ListFields(origins_i)
+        field_mappings_i = odcm.fieldMappings(arcpy.nax.OriginDestinationCostMatrixInputDataType.Origins, 
+                                              True, candidate_fields_i)
+        field_mappings_i["Name"].mappedFieldName = "i_id"
+    
+        # load origins
+        odcm.load(arcpy.nax.OriginDestinationCostMatrixInputDataType.Origins,
+                  features = origins_i, 
+                  field_mappings = field_mappings_i, 
+                  append = False)
+        telemetry.emit("load", stage_start, time.time(), batch_id = batch_id,
+                       rows = odcm.count(arcpy.nax.OriginDestinationCostMatrixInputDataType.Origins))
+    
+        # 3 SOLVE
+        arcpy.AddMessage("Solving OD Matrix...")
+        with telemetry.stage("solve", batch_id = batch_id) as record:
+            result = odcm.solve()
+            record["status"] = "ok" if result.solveSucceeded else "failed"
+
+        # 4 EXPORT results to a feature class
+        # fail? skip
+        if not result.solveSucceeded:
+            return
+
+        with telemetry.stage("export", batch_id = batch_id) as record:
+            # more lines than a worker's share of the memory budget? keep them on disk
+            if not fits(result.count(arcpy.nax.OriginDestinationCostMatrixOutputDataType.Lines), "od_lines"):
+                od_lines = os.path.join(worker_gdb, "od_lines_"+str(batch_id))
+                record["spilled"] = True
+            if cache is not None:
+                entry = store_result(cache, cache_key, result, {"tool": "access_calc", "batch_id": batch_id})
+                restore_lines_table(entry, od_lines)
+            else:
+                result.export(arcpy.nax.OriginDestinationCostMatrixOutputDataType.Lines, od_lines)
+            record["rows"] = result.count(arcpy.nax.OriginDestinationCostMatrixOutputDataType.Lines)
         
     # ----- un-comment this and comment-out the above if you want to store the od_lines on disk -----
     #result.export(arcpy.nax.OriginDestinationCostMatrixOutputDataType.Lines, 
@@ -306,37 +369,414 @@ def access_multi(jobs):
     i_id_text = 'OriginName'
     j_id_text = 'DestinationName'
     
+    # the o_j (and n_j) of the batch's destinations, looked up once for the cursors below
+    batch_j_ids = list_unique(od_lines, j_id_text)
+    o_j_batch = batch_lookup(o_j_dict, batch_j_ids)
+    n_j_batch = batch_lookup(n_j_dict, batch_j_ids) if n_j_dict is not None else None
+    
+    # cached batches are solved to every destination so the cache does not
+    # depend on the opportunities; drop the lines to destinations without any
+    if cache is not None:
+        with arcpy.da.UpdateCursor(od_lines, [j_id_text]) as updateRows:
+            for updateRow in updateRows:
+                if not o_j_batch.get(updateRow[0], 0) > 0:
+                    updateRows.deleteRow()
+    
     # 6 DELETE rows where i == j:
+    stage_start = time.time()
     if del_i_eq_j == "true":
-        arcpy.management.MakeFeatureLayer(od_lines, "od_lines_view")
+        arcpy.management.MakeTableView(od_lines, "od_lines_view")
         arcpy.management.SelectLayerByAttribute("od_lines_view", "NEW_SELECTION", "OriginName <> DestinationName")
         arcpy.management.SelectLayerByAttribute("od_lines_view", "SWITCH_SELECTION")
         if int(arcpy.management.GetCount("od_lines_view").getOutput(0)) > 0:
             arcpy.management.DeleteRows("od_lines_view")
         else:
             arcpy.AddMessage("Can't delete where i = j: inputs don't match")
+        telemetry.emit("delete_i_eq_j", stage_start, time.time(), batch_id = batch_id)
     
     # 7 CALCULATE ACCESSIBILITY
+    stage_start = time.time()
+    # each measure is evaluated once over the batch's distinct travel times
+    t_values = [row[0] for row in arcpy.da.SearchCursor(od_lines, [t_ij])]
     for f in selected_impedance_function:
         f_name = f
-        arcpy.management.AddField(od_lines, "Ai_"+f_name, "DOUBLE")
+        # per-row contributions in FLOAT when precision is "single"; the SUM in step 8 is a DOUBLE either way
+        arcpy.management.AddField(od_lines, "Ai_"+f_name, "FLOAT" if precision == "single" else "DOUBLE")
         access_fields = [j_id_text, t_ij, "Ai_"+f_name]
+        f_ij = impedance_lookup(t_values, f_name)
         with arcpy.da.UpdateCursor(od_lines, access_fields) as updateRows:
             for updateRow in updateRows:
-                updateRow[2] = o_j_dict.get(updateRow[0])*parameters.impedance_f(updateRow[1], f_name)
+                updateRow[2] = o_j_batch.get(updateRow[0])*f_ij[updateRow[1]]
                 updateRows.updateRow(updateRow)
+    # deduplicated destinations stand for n_j of the input ones; summed for FREQUENCY
+    if n_j_batch is not None:
+        arcpy.management.AddField(od_lines, "N_J", "LONG")
+        with arcpy.da.UpdateCursor(od_lines, [j_id_text, "N_J"]) as updateRows:
+            for updateRow in updateRows:
+                updateRow[1] = int(n_j_batch.get(updateRow[0], 1))
+                updateRows.updateRow(updateRow)
+    telemetry.emit("accessibility", stage_start, time.time(), batch_id = batch_id,
+                   rows = int(arcpy.management.GetCount(od_lines).getOutput(0)),
+                   measures = len(selected_impedance_function))
     
     # 8 CALCULATE SUMMARY STATISTICS
     arcpy.AddMessage("Summarizing accessibility...")
-    sum_fields = ["Ai_"+f_field+" SUM" for f_field in selected_impedance_function]
-    sum_fields_str = ";".join(sum_fields)
-    arcpy.analysis.Statistics(od_lines, os.path.join(worker_gdb+"\\output_batch_"+str(batch_id)), sum_fields_str, "OriginName")
-    output_table = os.path.join(worker_gdb+"\\output_batch_"+str(batch_id))
+    with telemetry.stage("summary", batch_id = batch_id) as record:
+        sum_fields = ["Ai_"+f_field+" SUM" for f_field in selected_impedance_function]
+        if n_j_dict is not None:
+            sum_fields.append("N_J SUM")
+        sum_fields_str = ";".join(sum_fields)
+        arcpy.analysis.Statistics(od_lines, os.path.join(worker_gdb+"\\output_batch_"+str(batch_id)), sum_fields_str, "OriginName")
+        output_table = os.path.join(worker_gdb+"\\output_batch_"+str(batch_id))
+        record["rows"] = int(arcpy.management.GetCount(output_table).getOutput(0))
+        record["bytes"] = telemetry.file_bytes(worker_gdb)
     arcpy.management.Delete(r"in_memory")
     return output_table
 
+# ----- incremental update -----
+
+def o_j_snapshot_path(output_dir, output_gdb):
+    return os.path.join(output_dir, output_gdb+"_o_j.parquet")
+
+def id_caster(table, field_name):
+    # text ids from the od matrix back to the type of the output's id field
+    field_type = field_type_x(table, field_name)
+    if field_type == "TEXT":
+        return str
+    if field_type in ("DOUBLE", "FLOAT"):
+        return float
+    return int
+
+def update_main(od_dataset, destinations_j_input, j_id_field, o_j_field,
+                selected_impedance_function, output_dir, output_gdb, del_i_eq_j,
+                origins_i_input = None, i_id_field = None, join_back_i = "false",
+                index_path = None, telemetry_on = True):
+    # patches a previous accessibility output for changed opportunities
+    # without re-solving the network. od_dataset is a parquet od matrix of the
+    # same origins and destinations (od cost matrix to parquet tool or r5r)
+    # solved with the same network settings as the previous run
+    import pandas as pd
+    from incremental_access import build_destination_index, load_destination_index, opportunity_changes, update_accessibility
+    run_start = time.time()
+    telemetry_dir = telemetry.telemetry_dir_setup(output_dir, output_gdb) if telemetry_on else None
+    telemetry.setup(telemetry_dir)
+    
+    access_output = os.path.join(output_dir+"/"+output_gdb+".gdb", "output_"+output_gdb)
+    snapshot = o_j_snapshot_path(output_dir, output_gdb)
+    if not arcpy.Exists(access_output) or not os.path.exists(snapshot):
+        raise Exception(str(output_gdb)+" has no previous accessibility output and opportunity snapshot to update")
+    
+    # --- destination index of the od matrix, built once ---
+    if index_path is None:
+        index_path = od_dataset.rstrip("/\\")+"_by_destination"
+    if not os.path.exists(index_path):
+        arcpy.AddMessage("Indexing the od matrix by destination...")
+        with telemetry.stage("index"):
+            build_destination_index(od_dataset, index_path)
+    index = load_destination_index(index_path)
+    
+    # --- what changed ---
+    old_o_j = dict(pd.read_parquet(snapshot).itertuples(index = False))
+    with arcpy.da.SearchCursor(destinations_j_input, [j_id_field, o_j_field]) as cursor:
+        new_o_j = {str(r[0]):r[1] for r in cursor if r[1] is not None and r[1] > 0}
+    changes = opportunity_changes(old_o_j, new_o_j)
+    arcpy.AddMessage(str(len(changes))+" of "+str(len(new_o_j))+" destinations changed")
+    
+    # --- patch the previous sums ---
+    sum_fields = ["SUM_Ai_"+f_field for f_field in selected_impedance_function]
+    with arcpy.da.SearchCursor(access_output, ["i_id", "FREQUENCY"] + sum_fields) as cursor:
+        previous = pd.DataFrame(list(cursor), columns = ["i_id", "FREQUENCY"] + sum_fields)
+    with telemetry.stage("incremental") as record:
+        updated, stats = update_accessibility(previous, index, changes, selected_impedance_function,
+                                              del_i_eq_j == "true")
+        record.update(stats)
+    arcpy.AddMessage("Read "+str(stats["rows_read"])+" of "+str(stats["rows_total"])+" od rows, "+
+                     str(stats["origins_touched"])+" origins affected")
+    
+    # --- write back: update, drop origins that no longer reach anything, add new ones ---
+    with telemetry.stage("write_back") as record:
+        updated_rows = dict([(str(r[0]), r[1:]) for r in updated.itertuples(index = False)])
+        with arcpy.da.UpdateCursor(access_output, ["i_id", "FREQUENCY"] + sum_fields) as updateRows:
+            for updateRow in updateRows:
+                values = updated_rows.pop(str(updateRow[0]), None)
+                if values is None:
+                    updateRows.deleteRow()
+                else:
+                    updateRows.updateRow([updateRow[0]] + list(values))
+        cast_id = id_caster(access_output, "i_id")
+        with arcpy.da.InsertCursor(access_output, ["OriginName", "i_id", "FREQUENCY"] + sum_fields) as insertRows:
+            for i_id, values in updated_rows.items():
+                insertRows.insertRow([i_id, cast_id(i_id)] + list(values))
+        record["rows"] = len(updated)
+    write_id_table(list(new_o_j.items()), ["j_id", "o_j"], snapshot)
+    
+    if join_back_i == "true":
+        join_fields = ["FREQUENCY"] + sum_fields
+        arcpy.AddMessage("Joining accessibility output to origins_i...")
+        existing_fields = [f.name for f in arcpy.ListFields(origins_i_input) if f.name in join_fields]
+        if existing_fields:
+            arcpy.management.DeleteField(origins_i_input, existing_fields)
+        arcpy.management.JoinField(origins_i_input, i_id_field, access_output, "i_id", join_fields)
+    telemetry.emit("run", run_start, time.time(), tool = "access_calc_update")
+
+def multi_main(od_dataset, destinations_j_input, j_id_field, o_j_fields,
+               selected_impedance_function, output_dir, output_gdb,
+               del_i_eq_j = "false", telemetry_on = True, precision = "double"):
+    # accessibility to several opportunity types (one o_j field each) from a
+    # parquet od matrix in one read; writes a wide table with FREQUENCY_<field>
+    # and SUM_Ai_<measure>_<field> per origin
+    import numpy as np
+    from multi_access import SparseOD, multi_accessibility
+    run_start = time.time()
+    telemetry_dir = telemetry.telemetry_dir_setup(output_dir, output_gdb) if telemetry_on else None
+    telemetry.setup(telemetry_dir)
+    if not arcpy.Exists(os.path.join(output_dir+"/"+output_gdb+".gdb")):
+        arcpy.management.CreateFileGDB(output_dir, output_gdb+".gdb")
+
+    opportunities = dict([(o_j_field, {}) for o_j_field in o_j_fields])
+    with arcpy.da.SearchCursor(destinations_j_input, [j_id_field] + list(o_j_fields)) as cursor:
+        for r in cursor:
+            for o_j_field, value in zip(o_j_fields, r[1:]):
+                if value is not None and value > 0:
+                    opportunities[o_j_field][str(r[0])] = value
+
+    arcpy.AddMessage("Reading the od matrix...")
+    with telemetry.stage("read_od") as record:
+        od = SparseOD(od_dataset, del_i_eq_j == "true", precision)
+        record["rows"] = od.nnz
+    arcpy.AddMessage(str(od.nnz)+" od pairs, "+str(od.shape[0])+" origins x "+str(od.shape[1])+" destinations")
+    with telemetry.stage("multi_access", types = len(o_j_fields)) as record:
+        wide = multi_accessibility(od, opportunities, selected_impedance_function)
+        record["rows"] = len(wide)
+
+    multi_output = os.path.join(output_dir+"/"+output_gdb+".gdb", "output_"+output_gdb+"_multi")
+    if arcpy.Exists(multi_output):
+        arcpy.management.Delete(multi_output)
+    array = wide.to_records(index = False).astype([("i_id", "U"+str(max(wide["i_id"].str.len().max(), 1)))] +
+                                                  [(c, np.float64) for c in wide.columns if c != "i_id"])
+    arcpy.da.NumPyArrayToTable(array, multi_output)
+    arcpy.AddMessage("Wrote "+str(len(wide))+" origins to "+multi_output)
+    telemetry.emit("run", run_start, time.time(), tool = "access_calc_multi")
+
+def metrics_main(od_dataset, destinations_j_input, j_id_field, o_j_field,
+                 selected_impedance_function, output_dir, output_gdb,
+                 k_values = (1,), opportunity_thresholds = (), del_i_eq_j = "false",
+                 telemetry_on = True, precision = "double"):
+    # travel time metrics next to the accessibility sums from a parquet od
+    # matrix in one streaming pass; writes FREQUENCY, SUM_Ai_<measure>,
+    # T_K<k> (k-th nearest destination with opportunities), T_OPP<n> (until n
+    # opportunities are reached) and T_MEAN_OJ per origin
+    import numpy as np
+    from travel_time_metrics import travel_time_metrics
+    run_start = time.time()
+    telemetry_dir = telemetry.telemetry_dir_setup(output_dir, output_gdb) if telemetry_on else None
+    telemetry.setup(telemetry_dir)
+    if not arcpy.Exists(os.path.join(output_dir+"/"+output_gdb+".gdb")):
+        arcpy.management.CreateFileGDB(output_dir, output_gdb+".gdb")
+
+    with arcpy.da.SearchCursor(destinations_j_input, [j_id_field, o_j_field]) as cursor:
+        o_j = {str(r[0]):r[1] for r in cursor if r[1] is not None and r[1] > 0}
+
+    arcpy.AddMessage("Streaming the od matrix...")
+    with telemetry.stage("travel_time_metrics") as record:
+        metrics, stats = travel_time_metrics(od_dataset, o_j, selected_impedance_function, k_values,
+                                             opportunity_thresholds, del_i_eq_j == "true", precision)
+        record.update(stats)
+    arcpy.AddMessage(str(stats["rows"])+" od pairs in "+str(stats["passes"])+" passes, "+
+                     str(round(stats["buffer_mb"], 1))+" MB of per-origin buffers")
+
+    metrics_output = os.path.join(output_dir+"/"+output_gdb+".gdb", "output_"+output_gdb+"_metrics")
+    if arcpy.Exists(metrics_output):
+        arcpy.management.Delete(metrics_output)
+    # never reached metrics are nan and become null
+    array = metrics.to_records(index = False).astype([("i_id", "U"+str(max(metrics["i_id"].str.len().max(), 1)))] +
+                                                     [(c, np.float64) for c in metrics.columns if c != "i_id"])
+    arcpy.da.NumPyArrayToTable(array, metrics_output)
+    arcpy.AddMessage("Wrote "+str(len(metrics))+" origins to "+metrics_output)
+    telemetry.emit("run", run_start, time.time(), tool = "access_calc_metrics")
+
+def curves_path(output_dir, output_gdb):
+    return os.path.join(output_dir, output_gdb+"_curves.parquet")
+
+def curves_main(od_dataset, destinations_j_input, j_id_field, o_j_field, cutoff,
+                output_dir, output_gdb, del_i_eq_j = "false", telemetry_on = True, parquet_profile = None):
+    # cumulative opportunities within every whole minute up to the cutoff from
+    # a parquet od matrix in one pass; writes <output gdb>_curves.parquet with
+    # i_id and CUM0 ... CUM<cutoff>. opportunity_curves.cumr_from_curves and
+    # curve_accessibility turn it into any CUMR, CUML or other measure
+    from opportunity_curves import opportunity_curves, write_curves
+    run_start = time.time()
+    telemetry_dir = telemetry.telemetry_dir_setup(output_dir, output_gdb) if telemetry_on else None
+    telemetry.setup(telemetry_dir)
+
+    with arcpy.da.SearchCursor(destinations_j_input, [j_id_field, o_j_field]) as cursor:
+        o_j = {str(r[0]):r[1] for r in cursor if r[1] is not None and r[1] > 0}
+
+    arcpy.AddMessage("Streaming the od matrix...")
+    with telemetry.stage("opportunity_curves") as record:
+        curves, stats = opportunity_curves(od_dataset, o_j, cutoff, del_i_eq_j == "true")
+        record.update(stats)
+    write_curves(curves, curves_path(output_dir, output_gdb), parquet_profile)
+    arcpy.AddMessage("Wrote "+str(len(curves))+" origins x "+str(int(cutoff) + 1)+" minutes to "+
+                     curves_path(output_dir, output_gdb))
+    telemetry.emit("run", run_start, time.time(), tool = "access_calc_curves")
+
+def diff_path(output_dir, output_gdb):
+    return os.path.join(output_dir, output_gdb+"_diff.parquet")
+
+def diff_main(base_od_dataset, alt_od_dataset, destinations_j_input, j_id_field, o_j_field,
+              selected_impedance_function, output_dir, output_gdb, cutoff = None,
+              del_i_eq_j = "false", telemetry_on = True, processes = None, parquet_profile = None):
+    # compares a base and an alternative parquet od matrix (a network change)
+    # one partition at a time; writes <output gdb>_diff.parquet and a table
+    # with FREQUENCY and SUM_Ai_<measure> of both runs and their difference
+    # (D_*), pairs and opportunities gained and lost within the cutoff and the
+    # travel time change per origin. the summary with the travel time change
+    # histogram goes next to the parquet file
+    import numpy as np
+    import pandas as pd
+    from scenario_diff import scenario_diff
+    run_start = time.time()
+    telemetry_dir = telemetry.telemetry_dir_setup(output_dir, output_gdb) if telemetry_on else None
+    telemetry.setup(telemetry_dir)
+    if not arcpy.Exists(os.path.join(output_dir+"/"+output_gdb+".gdb")):
+        arcpy.management.CreateFileGDB(output_dir, output_gdb+".gdb")
+
+    with arcpy.da.SearchCursor(destinations_j_input, [j_id_field, o_j_field]) as cursor:
+        o_j = {str(r[0]):r[1] for r in cursor if r[1] is not None and r[1] > 0}
+
+    # workers are spawned from the arcgis pro python
+    multiprocessing.set_executable(os.path.join(sys.exec_prefix, 'pythonw.exe'))
+    arcpy.AddMessage("Comparing the od matrices...")
+    with telemetry.stage("scenario_diff") as record:
+        summary = scenario_diff(base_od_dataset, alt_od_dataset, diff_path(output_dir, output_gdb), o_j = o_j,
+                                selected_impedance_function = selected_impedance_function, cutoff = cutoff,
+                                del_i_eq_j = del_i_eq_j == "true", processes = processes, parquet_profile = parquet_profile)
+        record.update(dict([(k, summary[k]) for k in ("rows_base", "rows_alt", "jobs", "spilled_rows", "largest_job_rows")]))
+    pairs = summary["totals"]
+    arcpy.AddMessage(str(summary["rows_base"])+" base and "+str(summary["rows_alt"])+" alternative od pairs in "+
+                     str(summary["jobs"])+" jobs: "+str(int(pairs["PAIRS_GAINED"]["sum"]))+" pairs gained, "+
+                     str(int(pairs["PAIRS_LOST"]["sum"]))+" lost")
+
+    diff = pd.read_parquet(diff_path(output_dir, output_gdb))
+    diff_output = os.path.join(output_dir+"/"+output_gdb+".gdb", "output_"+output_gdb+"_diff")
+    if arcpy.Exists(diff_output):
+        arcpy.management.Delete(diff_output)
+    array = diff.to_records(index = False).astype([("i_id", "U"+str(max(diff["i_id"].str.len().max(), 1)))] +
+                                                  [(c, np.float64) for c in diff.columns if c != "i_id"])
+    arcpy.da.NumPyArrayToTable(array, diff_output)
+    arcpy.AddMessage("Wrote "+str(len(diff))+" origins to "+diff_output)
+    telemetry.emit("run", run_start, time.time(), tool = "access_calc_diff")
+
+def sample_features(input_fc, id_field, ids, output_fc):
+    # copy of input_fc with only the given ids
+    ids = set([str(x) for x in ids])
+    if arcpy.Exists(output_fc):
+        arcpy.management.Delete(output_fc)
+    arcpy.management.CopyFeatures(input_fc, output_fc)
+    with arcpy.da.UpdateCursor(output_fc, [id_field]) as updateRows:
+        for updateRow in updateRows:
+            if str(updateRow[0]) not in ids:
+                updateRows.deleteRow()
+    return output_fc
+
+def preview_main(input_network, travel_mode, cutoff,
+                 time_of_day, selected_impedance_function,
+                 origins_i_input, i_id_field,
+                 search_tolerance_i, search_criteria_i, search_query_i,
+                 destinations_j_input, j_id_field, o_j_field,
+                 search_tolerance_j, search_criteria_j, search_query_j,
+                 batch_size_factor, output_dir, output_gdb,
+                 del_i_eq_j = "false", target_rse = 0.05, time_budget = None,
+                 pilot_fraction = 0.02, seed = 1, telemetry_on = True):
+    # accessibility preview from a stratified sample of destinations: a pilot
+    # sample is solved with the od cost matrix to parquet tool, then grown to
+    # the size that reaches target_rse (median SE/A_i of the worst measure)
+    # within time_budget seconds. writes FREQUENCY, SUM_Ai_<measure>,
+    # SE_Ai_<measure> and NEFF_Ai_<measure> (effective sampled destinations)
+    # estimates per origin; measures steep for the sample are left out of
+    # target_rse and their understated standard errors are flagged
+    import numpy as np
+    import odcm_to_pq_main
+    from sampled_access import SamplingDesign, sample_estimates, relative_errors, preview_size, steep_measures, effective_sizes, MIN_NEFF
+    run_start = time.time()
+    telemetry_dir = telemetry.telemetry_dir_setup(output_dir, output_gdb) if telemetry_on else None
+    telemetry.setup(telemetry_dir)
+    preview_gdb = os.path.join(output_dir+"/"+output_gdb+"_preview.gdb")
+    if not arcpy.Exists(preview_gdb):
+        arcpy.management.CreateFileGDB(output_dir, output_gdb+"_preview.gdb")
+
+    with arcpy.da.SearchCursor(destinations_j_input, [j_id_field, o_j_field, "SHAPE@XY"]) as cursor:
+        rows = [r for r in cursor if r[1] is not None and r[1] > 0]
+    design = SamplingDesign([r[0] for r in rows], [r[1] for r in rows], [r[2] for r in rows], seed = seed)
+    arcpy.AddMessage(str(len(rows))+" destinations with opportunities in "+str(design.n_strata)+" strata")
+
+    od_paths = []
+    def solve(n_h, previous, part):
+        # solves the destinations of the sample n_h that previous did not have
+        sample_fc = sample_features(destinations_j_input, j_id_field, design.sampled_ids(n_h, previous),
+                                    os.path.join(preview_gdb, "destinations_j_"+part))
+        # the nested run sets up (and here switches off) telemetry; the
+        # preview's own events go on to its folder afterwards
+        log_dir = telemetry.current()
+        try:
+            odcm_to_pq_main.main(input_network, travel_mode, cutoff, time_of_day,
+                                 origins_i_input, i_id_field,
+                                 search_tolerance_i, search_criteria_i, search_query_i,
+                                 sample_fc, j_id_field,
+                                 search_tolerance_j, search_criteria_j, search_query_j,
+                                 batch_size_factor, output_dir, output_gdb+"_"+part, telemetry_on = False)
+        finally:
+            telemetry.setup(log_dir)
+        od_paths.append(os.path.join(output_dir, output_gdb+"_"+part+"_output"))
+
+    n_pilot = design.allocation(max(int(pilot_fraction*len(rows)), 2*design.n_strata))
+    arcpy.AddMessage("Solving a pilot sample of "+str(int(n_pilot.sum()))+" destinations...")
+    with telemetry.stage("preview_pilot", destinations = int(n_pilot.sum())):
+        pilot_start = time.time()
+        solve(n_pilot, None, "pilot")
+        pilot_s = time.time() - pilot_start
+        estimates = sample_estimates(od_paths, design, n_pilot, selected_impedance_function, del_i_eq_j == "true")
+    n_h = n_pilot
+    if target_rse is not None:
+        steep = steep_measures(estimates, selected_impedance_function)
+        if steep:
+            arcpy.AddWarning("target_rse is not used for "+", ".join(steep)+": fewer than "+str(MIN_NEFF)+
+                             " effective destinations per origin in the pilot, so their standard errors understate the error; "+
+                             "a larger pilot_fraction or a time_budget grows the sample")
+    n = preview_size(design, int(n_pilot.sum()), estimates, pilot_s, selected_impedance_function, target_rse, time_budget)
+    if n > n_pilot.sum():
+        n_h = np.maximum(design.allocation(n), n_pilot)
+        arcpy.AddMessage("Extending the sample to "+str(int(n_h.sum()))+" destinations...")
+        with telemetry.stage("preview_extend", destinations = int(n_h.sum() - n_pilot.sum())):
+            solve(n_h, n_pilot, "extend")
+            estimates = sample_estimates(od_paths, design, n_h, selected_impedance_function, del_i_eq_j == "true")
+    for f_name, rse in relative_errors(estimates, selected_impedance_function).items():
+        arcpy.AddMessage(f_name+": median standard error "+str(round(100*rse, 1))+"% of A_i")
+    # steep measures: their standard errors are understated, which the
+    # output's SE_Ai field aliases say as well as the messages
+    understated = {}
+    for f_name, neff in effective_sizes(estimates, selected_impedance_function).items():
+        if neff < MIN_NEFF:
+            understated[f_name] = ("SE_Ai_"+f_name+" understated: median "+str(round(neff, 1))+" effective destinations per "+
+                                   "origin, 95% intervals may cover half the origins")
+            arcpy.AddWarning(f_name+": "+understated[f_name]+"; use a larger sample or the full calculation")
+
+    preview_output = os.path.join(output_dir+"/"+output_gdb+"_preview.gdb", "output_"+output_gdb+"_preview")
+    if arcpy.Exists(preview_output):
+        arcpy.management.Delete(preview_output)
+    array = estimates.to_records(index = False).astype([("i_id", "U"+str(max(estimates["i_id"].str.len().max(), 1)))] +
+                                                       [(c, np.float64) for c in estimates.columns if c != "i_id"])
+    arcpy.da.NumPyArrayToTable(array, preview_output)
+    for f_name, warning in understated.items():
+        arcpy.management.AlterField(preview_output, "SE_Ai_"+f_name, new_field_alias = warning)
+    arcpy.AddMessage("Wrote the preview of "+str(len(estimates))+" origins from "+str(int(n_h.sum()))+" of "+
+                     str(len(rows))+" destinations to "+preview_output)
+    telemetry.emit("run", run_start, time.time(), tool = "access_calc_preview")
+
 # ----- execute -----
 
+@restores_budget
 def main(input_network, travel_mode, cutoff,
          time_of_day, selected_impedance_function,
          origins_i_input, i_id_field, 
@@ -345,7 +785,32 @@ def main(input_network, travel_mode, cutoff,
          search_tolerance_j, search_criteria_j, search_query_j,
          batch_size_factor,
          output_dir, output_gdb,
-         del_i_eq_j, join_back_i):
+         del_i_eq_j, join_back_i, telemetry_on = True, profile = None,
+         cache_dir = None, max_cache_gb = 20, location_cache_dir = None, dedup = None,
+         precision = "double", zone_tolerance = None, measures_file = None,
+         memory_budget = None, reachable_fraction = 1.0):
+    from profiling import check_mode, profile_dir_setup, profiled_worker, maybe_profiled, merge_profiles
+    from memory_budget import use_budget, governed_map
+    from odcm_cache import BatchKeys, cache_spec, clear_stats, cache_stats, format_stats
+    from endpoint_dedup import dedup_features, fan_out_rows, matrix_reduction, format_reduction
+    from destination_zones import zone_lookups, format_zones
+    
+    run_start = time.time()
+    check_mode(profile)
+    value_dtype(precision) # unknown precision? fail before any work
+    # expression measures (see impedance_kernels.py) are validated here, once;
+    # the workers load the compiled kernels
+    if measures_file is not None:
+        from impedance_kernels import load_measures
+        load_measures(measures_file)
+    unknown = [f_name for f_name in selected_impedance_function if not is_measure(f_name)]
+    if unknown:
+        raise Exception(", ".join(unknown)+" not in parameters.py or the measures file")
+    if cutoff == "support":
+        # the smallest cutoff every measure has dropped off by
+        from impedance_kernels import effective_cutoff
+        cutoff = effective_cutoff(selected_impedance_function)
+        arcpy.AddMessage("Cutoff from the measures' support: "+(str(cutoff) if cutoff is not None else "none, a measure never drops off"))
     
     # --- check opportunities_j field type compatibility ---
     o_j_field_type = field_type_x(destinations_j_input, o_j_field)
@@ -355,9 +820,17 @@ def main(input_network, travel_mode, cutoff,
     # --- setup workspace ---
     arcpy.env.workspace = workspace_setup(output_dir, output_gdb)
     arcpy.env.scratchWorkspace = scratchWorkspace_setup(output_dir, output_gdb)
+    telemetry_dir = telemetry.telemetry_dir_setup(output_dir, output_gdb) if telemetry_on else None
+    telemetry.setup(telemetry_dir)
+    telemetry.emit("workspace", run_start, time.time())
+    profile_dir = profile_dir_setup(output_dir, output_gdb) if profile is not None else None
+    
+    # --- memory budget: batch and scan sizes, spilling and pool concurrency (see memory_budget.py) ---
+    use_budget(memory_budget, cpu_count(multiprocessing.cpu_count()), reachable_fraction)
     
     # --- setup batching ---
-    batch_size = batch_size_f(origins_i_input, batch_size_factor)
+    with telemetry.stage("batching"):
+        batch_size = batch_size_f(origins_i_input, batch_size_factor, destinations_j_input, reachable_fraction)
     
     # --- pre-process origins ---
     origins_i = preprocess_x(input_fc = origins_i_input,
@@ -369,7 +842,8 @@ def main(input_network, travel_mode, cutoff,
                              search_criteria = search_criteria_i,
                              search_query = search_query_i,
                              travel_mode = travel_mode,
-                             batch_size = batch_size)
+                             batch_size = batch_size,
+                             location_cache_dir = location_cache_dir)
     #print(origins_i)
     origins_i_dict = create_dict(origins_i, key_field = "i_id_text", value_field = "i_id")
     
@@ -383,59 +857,159 @@ def main(input_network, travel_mode, cutoff,
                                   search_criteria = search_criteria_j,
                                   search_query = search_query_j,
                                   travel_mode = travel_mode,
-                                  batch_size = None)
+                                  batch_size = None,
+                                  all_destinations = cache_dir is not None,
+                                  location_cache_dir = location_cache_dir)
     #print(destinations_j)
     o_j_dict = create_dict(destinations_j, key_field = "j_id_text", value_field = "o_j")
+    if cache_dir is not None:
+        o_j_dict = {k:v for k, v in o_j_dict.items() if v is not None and v > 0}
+    # snapshot of the opportunities used, for later incremental updates
+    write_id_table(list(o_j_dict.items()), ["j_id", "o_j"], o_j_snapshot_path(output_dir, output_gdb))
+    
+    # --- co-located endpoints: solve each location once ---
+    # dedup is None, "network" (same network location) or a distance in the
+    # units of the inputs; origins fan back out after the merge, the
+    # opportunities of co-located destinations are summed
+    origins_solve, destinations_solve = origins_i, destinations_j
+    destination_sizes = None
+    if dedup is not None and del_i_eq_j == "true":
+        arcpy.AddMessage("Not deduplicating endpoints: deleting i = j needs every origin and destination")
+        dedup = None
+    if dedup is not None:
+        with telemetry.stage("dedup") as record:
+            origins_solve, origin_members, origin_sizes = dedup_features(origins_i, "origins_i", "i_id_text", dedup)
+            destinations_solve, destination_members, destination_sizes = dedup_features(destinations_j, "destinations_j", "j_id_text",
+                                                                                        dedup, value_field = "o_j")
+            reduction = matrix_reduction(sum(origin_sizes.values()), len(origin_sizes),
+                                         sum(destination_sizes.values()), len(destination_sizes))
+            record.update(reduction)
+        arcpy.AddMessage("Endpoint deduplication: "+format_reduction(reduction))
+        o_j_dict = create_dict(destinations_solve, key_field = "j_id_text", value_field = "o_j")
+        if cache_dir is not None:
+            o_j_dict = {k:v for k, v in o_j_dict.items() if v is not None and v > 0}
+    
+    # --- destination zones: fine near each batch, aggregated farther out ---
+    # zone_tolerance is the 95th percentile relative error of A_i allowed for
+    # the selected measures, measured on a sample of origins solved to every
+    # destination; batches then solve to their own zones, so the cache is off.
+    # zones that save too few od rows are not used
+    zones = None
+    if zone_tolerance is not None and del_i_eq_j == "true":
+        arcpy.AddMessage("Not using destination zones: deleting i = j needs every destination")
+        zone_tolerance = None
+    if zone_tolerance is not None:
+        with telemetry.stage("zones") as record:
+            zones, theta, p95, reduction, n_sampled = zone_lookups(origins_solve, destinations_solve, o_j_dict, destination_sizes,
+                                                                   float(zone_tolerance), input_network, travel_mode, cutoff,
+                                                                   time_of_day, selected_impedance_function)
+            record.update({"theta": theta, "reduction": reduction, "p95": p95, "sampled": n_sampled, "used": zones is not None,
+                           "zones": sum([len(o_j) for o_j, n_j in zones.values()]) if zones is not None else None})
+        arcpy.AddMessage("Destination zones: "+format_zones(len(o_j_dict), zones, theta, p95, reduction, n_sampled))
+        if zones is not None and cache_dir is not None:
+            arcpy.AddMessage("Not caching solved batches: destination zones differ by batch")
+            cache_dir = None
     
     # worker iterator
-    batch_list = list_unique(os.path.join(arcpy.env.workspace+"/origins_i"), "batch_id")
-    
-    jobs = []
-    # adds tuples of the parameters that need to be given to the worker function to the jobs list
-    for batch_id in batch_list:
-        jobs.append((batch_id, arcpy.env.scratchWorkspace, 
-                     origins_i, destinations_j, 
-                     input_network, travel_mode, 
-                     cutoff, time_of_day,
-                     selected_impedance_function, 
-                     o_j_dict, del_i_eq_j))
-    
-    # multiprocessing
-    multiprocessing.set_executable(os.path.join(sys.exec_prefix, 'pythonw.exe'))
-    arcpy.AddMessage("Sending batch to multiprocessing pool...")
-    pool = multiprocessing.Pool(processes = cpu_count(multiprocessing.cpu_count()))
-    #result = pool.map(access_multi, jobs)
-    result = [x for x in pool.map(access_multi, jobs) if x is not None]
-    pool.close()
-    pool.join()
+    batch_list = list_unique(origins_solve, "batch_id")
+    
+    # solved batch cache keys; with the cache on every destination is solved,
+    # so the keys do not change with the opportunities
+    batch_keys = None
+    if cache_dir is not None:
+        with telemetry.stage("cache_keys"):
+            batch_keys = BatchKeys(input_network, travel_mode, cutoff,
+                                   [search_tolerance_i, search_criteria_i, search_query_i,
+                                    search_tolerance_j, search_criteria_j, search_query_j],
+                                   origins_solve, destinations_solve)
+        clear_stats(cache_dir)
+    
+    # publish o_j once in shared memory instead of pickling it into every job
+    with SharedInputs() as shared_inputs:
+        o_j_lookup = shared_inputs.publish_lookup("o_j", o_j_dict)
+        n_j_lookup = shared_inputs.publish_lookup("n_j", destination_sizes) if destination_sizes is not None else None
+        
+        jobs = []
+        # adds tuples of the parameters that need to be given to the worker function to the jobs list
+        for batch_id in batch_list:
+            batch_o_j, batch_n_j = o_j_lookup, n_j_lookup
+            if zones is not None:
+                batch_o_j = shared_inputs.publish_lookup("o_j_"+str(batch_id), zones[batch_id][0])
+                batch_n_j = shared_inputs.publish_lookup("n_j_"+str(batch_id), zones[batch_id][1])
+            jobs.append((batch_id, arcpy.env.scratchWorkspace, 
+                         origins_solve, destinations_solve, 
+                         input_network, travel_mode, 
+                         cutoff, time_of_day,
+                         selected_impedance_function, 
+                         batch_o_j, del_i_eq_j, telemetry_dir,
+                         cache_spec(cache_dir, max_cache_gb, batch_keys, batch_id, time_of_day),
+                         batch_n_j, precision, zones is not None))
+        
+        arcpy.AddMessage("Shared inputs: "+format_mb(shared_inputs.nbytes()/1048576)+" published once, "+
+                         str(round(pickled_size(jobs[0])/1024, 1))+" KB pickled per job (o_j_dict alone is "+
+                         str(round(pickled_size(o_j_dict)/1024, 1))+" KB), parent RSS "+format_mb(current_rss_mb()))
+        
+        # multiprocessing
+        multiprocessing.set_executable(os.path.join(sys.exec_prefix, 'pythonw.exe'))
+        arcpy.AddMessage("Sending batch to multiprocessing pool...")
+        with telemetry.stage("pool", processes = cpu_count(multiprocessing.cpu_count()), batches = len(jobs)) as record:
+            pool = multiprocessing.Pool(processes = cpu_count(multiprocessing.cpu_count()))
+            #result = pool.map(access_multi, jobs)
+            result = [x for x in governed_map(pool, profiled_worker(access_multi, profile_dir, profile), jobs,
+                                              cpu_count(multiprocessing.cpu_count()), record) if x is not None]
+            pool.close()
+            pool.join()
     arcpy.AddMessage("Multiprocessing complete, merging results...")
-    access_output = arcpy.management.Merge(result, arcpy.env.workspace+"/output_"+output_gdb)
+    with telemetry.stage("merge") as record, maybe_profiled(profile_dir, profile, "merge"):
+        access_output = arcpy.management.Merge(result, arcpy.env.workspace+"/output_"+output_gdb)
+        record["rows"] = int(arcpy.management.GetCount(access_output).getOutput(0))
+    
+    # FREQUENCY counts input destinations, not solved ones
+    if dedup is not None or zones is not None:
+        arcpy.management.CalculateField(access_output, "FREQUENCY", "!SUM_N_J!", "PYTHON3")
+        arcpy.management.DeleteField(access_output, "SUM_N_J")
+    
+    # co-located origins get the results of the one that was solved
+    if dedup is not None:
+        with telemetry.stage("fan_out") as record:
+            record["rows"] = fan_out_rows(access_output, "OriginName", origin_members)
     
     # add back original i_id
-    turbo_joiner(target_fc = access_output, 
-                 target_id_field = 'OriginName', 
-                 join_fc = origins_i, 
-                 join_id_field = 'i_id_text', 
-                 join_value_field = 'i_id')
+    with telemetry.stage("join_ids"), maybe_profiled(profile_dir, profile, "join_ids"):
+        turbo_joiner(target_fc = access_output, 
+                     target_id_field = 'OriginName', 
+                     join_fc = origins_i, 
+                     join_id_field = 'i_id_text', 
+                     join_value_field = 'i_id')
     
     if join_back_i == "true":
         # join accessibility output back to origins input
         join_fields = ["SUM_Ai_"+f_field for f_field in selected_impedance_function]
         join_fields.insert(0, "FREQUENCY")
         arcpy.AddMessage("Joining accessibility output to origins_i...")
-        arcpy.management.JoinField(origins_i_input, i_id_field, access_output, "i_id", join_fields)
+        with telemetry.stage("join_back"):
+            arcpy.management.JoinField(origins_i_input, i_id_field, access_output, "i_id", join_fields)
     
     # ----- clean up: this deletes the workers directory. comment-out if you want to keep -----
     arcpy.management.Delete(arcpy.env.scratchWorkspace)
+    if cache_dir is not None:
+        arcpy.AddMessage("ODCM cache: "+format_stats(cache_stats(cache_dir)))
+    telemetry.emit("run", run_start, time.time(), tool = "access_calc")
+    if telemetry_dir is not None:
+        arcpy.AddMessage("Run telemetry written to "+telemetry_dir+"; summarize with telemetry_report.py")
+    if profile_dir is not None:
+        report_path = merge_profiles(profile_dir)
+        if report_path is not None:
+            arcpy.AddMessage("Profile report written to "+report_path)
 
 if __name__ == '__main__':
     start_time = time.time()
-    main(input_network, travel_mode, cutoff,
-         time_of_day, selected_impedance_function,
-         origins_i_input, i_id_field, 
-         search_tolerance_i, search_criteria_i, search_query_i,
-         destinations_j_input, j_id_field, o_j_field,
-         search_tolerance_j, search_criteria_j, search_query_j,
-         batch_size_factor, output_dir, output_gdb, del_i_eq_j, join_back_i)
+    if len(sys.argv) > 1:
+        # headless: scenarios from a json config (see scenario_runner.py)
+        # instead of the commented module parameters above
+        from scenario_runner import run_config
+        run_config(sys.argv[1])
+        sys.exit()
+    main(**main_arguments(main, [], globals()))
     elapsed_time = time.time() - start_time
     arcpy.AddMessage("ODCM calculation took "+str(elapsed_time/60)+" minutes...")
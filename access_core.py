@@ -0,0 +1,311 @@
+# Accessibility Core Computations
+# Christopher D. Higgins
+# Department of Human Geography
+# University of Toronto Scarborough
+# https://higgicd.github.io
+# tool help can be found at https://github.com/higgicd/Accessibility_Toolbox
+
+# arcpy-free computations shared by the tools, helpers and benchmarks. the
+# tools are a thin arcpy layer on top of this module. numpy, pandas and
+# pyarrow are imported inside the functions that need them, so importing the
+# core (in the parent or in every spawned worker) costs next to nothing
+
+import os
+import math
+import parameters
+
+# ----- batching -----
+
+def cpu_count(cpu_tot):
+    # leave one core for the parent
+    if cpu_tot == 1:
+        cpu_num = 1
+    else:
+        cpu_num = cpu_tot - 1
+    return cpu_num
+
+def batch_plan(origins_i_count, cpu_num, batch_size_factor):
+    # small inputs are split evenly across the cores, larger ones into chunks
+    # of batch_size_factor origins; returns batch_size, batch_count, optimized
+    if int(math.ceil(origins_i_count/cpu_num)) <= batch_size_factor:
+        batch_size = int(math.ceil(origins_i_count/cpu_num)+1)
+        batch_count = int(math.ceil(origins_i_count/batch_size))
+        return batch_size, batch_count, True
+    batch_size = batch_size_factor
+    batch_count = int(math.ceil(origins_i_count/batch_size_factor))
+    return batch_size, batch_count, False
+
+def batch_id(rec, batch_size):
+    # batch of the rec-th origin (1-based) in sorted order, as the batch_id field calculation does
+    return int(math.ceil(rec/batch_size))
+
+def unique_in_order(values):
+    # distinct values in order of first appearance
+    seen = set()
+    unique_list = []
+    for value in values:
+        if value not in seen:
+            seen.add(value)
+            unique_list.append(value)
+    return unique_list
+
+# ----- precision -----
+# "double" keeps every value in float64. "single" keeps travel times and the
+# per-row contributions o_j * f(t_ij) in float32, half the memory and disk,
+# while per-origin sums still accumulate in float64 so the totals keep their
+# accuracy; A_i is off by float32 rounding of each row, ~1e-7 relative
+
+PRECISIONS = {"double": "float64", "single": "float32"}
+
+def value_dtype(precision = "double"):
+    import numpy as np
+    if precision not in PRECISIONS:
+        raise Exception(str(precision)+" is not a precision, use one of "+", ".join(PRECISIONS))
+    return np.dtype(PRECISIONS[precision])
+
+def downcast_frame(df, precision = "double"):
+    # float columns of an od lines frame (Total_Time) in the storage precision
+    dtype = value_dtype(precision)
+    for name in df.columns:
+        if df[name].dtype.kind == "f" and df[name].dtype != dtype:
+            df[name] = df[name].astype(dtype)
+    return df
+
+# ----- impedance -----
+
+def impedance_array(t_ij, f_name, precision = "double"):
+    # evaluates parameters.impedance_f over an array of travel times; travel
+    # times repeat heavily (integer minutes from r5, rounded minutes from
+    # arcgis) so the python function only runs once per unique value.
+    # measures of the measures file run as compiled numpy kernels instead
+    import numpy as np
+    from impedance_kernels import kernel_for
+    kernel = kernel_for(f_name)
+    if kernel is not None:
+        return kernel(t_ij).astype(value_dtype(precision))
+    t_ij = np.asarray(t_ij)
+    if t_ij.dtype.kind != "f":
+        t_ij = t_ij.astype(np.float64)
+    unique_t, inverse = np.unique(t_ij, return_inverse = True)
+    unique_f = np.array([parameters.impedance_f(t, f_name) for t in unique_t.tolist()], dtype = np.float64)
+    return unique_f.astype(value_dtype(precision), copy = False)[inverse].reshape(t_ij.shape)
+
+def impedance_lookup(t_ij, f_name):
+    # {travel time: f(t)} over the distinct travel times of a column, for the
+    # per-row cursor of the accessibility tool: the measure is evaluated once
+    # over the column instead of once per row
+    import numpy as np
+    unique_t = np.unique(np.asarray(t_ij, dtype = np.float64))
+    return dict(zip(unique_t.tolist(), impedance_array(unique_t, f_name).tolist()))
+
+_parameters_pid = None
+
+def reload_parameters():
+    # workers pick up edits made to parameters.py since it was imported (an
+    # open ArcGIS Pro session keeps it), once per process rather than on
+    # every batch
+    global _parameters_pid
+    if _parameters_pid != os.getpid():
+        from importlib import reload
+        reload(parameters)
+        _parameters_pid = os.getpid()
+
+def is_measure(f_name):
+    # a parameters.py measure or one of the measures file
+    from impedance_kernels import kernel_for
+    if kernel_for(f_name) is not None:
+        return True
+    try:
+        parameters.impedance_f(1.0, f_name)
+        return True
+    except KeyError:
+        return False
+
+# the function families of parameters.py with a free parameter (b0 or t_bar),
+# for measures that are not in its table
+IMPEDANCE_FAMILIES = ("power", "neg_exp", "mgaus", "cumr", "cuml")
+
+def impedance_family(t_ij, family, b0, precision = "double"):
+    import numpy as np
+    t_ij = np.asarray(t_ij, dtype = np.float64)
+    b0 = float(b0)
+    if family == "power":
+        f = np.where(t_ij < 1, 1.0, np.maximum(t_ij, 1)**-b0)
+    elif family == "neg_exp":
+        f = np.exp(-b0*t_ij)
+    elif family == "mgaus":
+        f = np.exp(-t_ij**2/b0)
+    elif family == "cumr":
+        f = (t_ij <= b0).astype(np.float64)
+    elif family == "cuml":
+        f = np.where(t_ij <= b0, 1 - t_ij/b0, 0.0)
+    else:
+        raise Exception(str(family)+" is not an impedance family, use one of "+", ".join(IMPEDANCE_FAMILIES))
+    return f.astype(value_dtype(precision), copy = False)
+
+# ----- accessibility -----
+
+def origin_sums(i_codes, values, n_origins):
+    # per-origin sums accumulated in float64, whatever the precision of values
+    import numpy as np
+    return np.bincount(i_codes, weights = values, minlength = n_origins)
+
+def accessibility(i_codes, t_ij, o_j, selected_impedance_function, n_origins, precision = "double"):
+    # A_i = sum_j o_j * f(t_ij) for each selected measure
+    import numpy as np
+    o_j = np.asarray(o_j).astype(value_dtype(precision), copy = False)
+    results = {}
+    for f_name in selected_impedance_function:
+        results[f_name] = origin_sums(i_codes, o_j*impedance_array(t_ij, f_name, precision), n_origins)
+    return results
+
+def encode_ids(ids):
+    # integer codes for an id column plus the unique ids in code order
+    import numpy as np
+    unique_ids, codes = np.unique(np.asarray(ids), return_inverse = True)
+    return unique_ids, codes
+
+# ----- id joins -----
+
+def dict_join(target_ids, join_ids, join_values):
+    # the turbo_joiner pattern without the cursors: build the dictionary once,
+    # then one lookup per target row
+    value_dict = dict(zip(join_ids, join_values))
+    return [value_dict.get(key) for key in target_ids]
+
+# ----- parquet finalization -----
+
+def batch_file_parts(file):
+    # worker output is <dir>/batch_<id>[_<time tag>].arrow
+    dir_name = os.path.dirname(file)
+    file_name = os.path.basename(file).split('.')[0]
+    batch_num = file_name.split("_")[1]
+    return dir_name, file_name, batch_num
+
+def read_id_tables(file):
+    # the solver ObjectID -> input id tables written next to a worker's lines
+    import pandas as pd
+    dir_name, file_name, batch_num = batch_file_parts(file)
+    i_ids = pd.read_parquet(dir_name+"/i_ids_"+file_name+".parquet")
+    i_ids.rename(columns={'ObjectID':'OriginOID'}, inplace=True)
+    j_ids = pd.read_parquet(dir_name+"/j_ids_"+file_name+".parquet")
+    j_ids.rename(columns={'ObjectID':'DestinationOID'}, inplace=True)
+    return i_ids, j_ids
+
+def join_line_ids(df, i_ids, j_ids):
+    # merge ids into df
+    import pandas as pd
+    df = pd.merge(df, i_ids, how='left', left_on=['OriginOID'], right_on=['OriginOID'])
+    df = pd.merge(df, j_ids, how='left', left_on=['DestinationOID'], right_on=['DestinationOID'])
+    df.drop(columns=['OriginOID', 'DestinationOID'], inplace=True)
+    return df
+
+def read_batch_lines(file):
+    # od lines from a worker with the solver's OriginOID/DestinationOID
+    # swapped for the input i_id/j_id
+    import pyarrow.feather as ft
+    # read arrow file in to pd df
+    df = ft.read_feather(file)
+    return join_line_ids(df, *read_id_tables(file))
+
+def iter_batch_lines(file, batch_rows = None):
+    # read_batch_lines in frames of batch_rows lines (the last one shorter);
+    # the arrow file is memory mapped and its record batches are sliced or
+    # gathered into frames
+    import pyarrow as pa
+    if batch_rows is None:
+        yield read_batch_lines(file)
+        return
+    i_ids, j_ids = read_id_tables(file)
+    with pa.memory_map(file) as source:
+        reader = pa.ipc.open_file(source)
+        pending, pending_rows = [], 0
+        for k in range(reader.num_record_batches):
+            batch = reader.get_batch(k)
+            offset = 0
+            while offset < batch.num_rows:
+                piece = batch.slice(offset, batch_rows - pending_rows)
+                pending.append(piece)
+                pending_rows += piece.num_rows
+                offset += piece.num_rows
+                if pending_rows == batch_rows:
+                    yield join_line_ids(pa.Table.from_batches(pending).to_pandas(), i_ids, j_ids)
+                    pending, pending_rows = [], 0
+        if pending:
+            yield join_line_ids(pa.Table.from_batches(pending).to_pandas(), i_ids, j_ids)
+
+def write_id_table(rows, fields, path):
+    # solver ObjectID -> input id lookup written next to each worker's lines
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    columns = [list(column) for column in zip(*rows)] or [[] for field in fields]
+    pq.write_table(pa.table(dict(zip(fields, [pa.array(column) for column in columns]))), path)
+
+def read_opportunities(path):
+    # {j_id: o_j} from a parquet or csv file with j_id and o_j columns, such
+    # as the <output gdb>_o_j.parquet snapshot of the accessibility calculator
+    import pandas as pd
+    df = pd.read_csv(path) if path.lower().endswith(".csv") else pd.read_parquet(path)
+    if "j_id" not in df.columns or "o_j" not in df.columns:
+        raise Exception(str(path)+" has no j_id and o_j columns")
+    return dict(zip(df["j_id"].astype(str), df["o_j"].astype("float64")))
+
+def remove_batch_files(file):
+    dir_name, file_name, batch_num = batch_file_parts(file)
+    os.remove(file) # for arrow
+    os.remove(dir_name+"/i_ids_"+file_name+".parquet")
+    os.remove(dir_name+"/j_ids_"+file_name+".parquet")
+
+def finalize_lines(file, partition_cols, precision = "double", reduce = None, profile = None, **columns):
+    # worker arrow file -> partition of the parquet dataset next to it; extra
+    # constant columns (batch_id, start_datetime) are added before writing
+    # and Total_Time is stored in the given precision, encoded with the
+    # parquet profile (parquet_profiles.py). under a memory budget the lines
+    # are joined and written in parts of the parent's share. returns the
+    # number of lines and the sum over the parts of reduce (frame -> series
+    # by i_id), if given
+    import pyarrow as pa
+    from memory_budget import spill_rows
+    from parquet_profiles import write_to_dataset
+    dir_name, file_name, batch_num = batch_file_parts(file)
+    rows, reduced = 0, None
+    for df in iter_batch_lines(file, spill_rows("finalize")):
+        df = downcast_frame(df, precision)
+        for name, value in columns.items():
+            df[name] = value
+        write_to_dataset(pa.Table.from_pandas(df), dir_name, partition_cols, profile)
+        rows += len(df)
+        if reduce is not None:
+            part = reduce(df)
+            reduced = part if reduced is None else reduced.add(part, fill_value = 0)
+    remove_batch_files(file)
+    return rows, reduced
+
+# ----- running a tool as a script -----
+
+TIME_ARGUMENTS = ("time_of_day", "start_time", "end_time")
+
+def main_arguments(main, argv, namespace):
+    # keyword arguments of a tool's main when it runs from the command line:
+    # a json file of them named on the command line (times as "YYYY-MM-DD
+    # HH:MM"), or else the parameters uncommented at the top of the tool
+    import json
+    import inspect
+    import datetime
+    parameters = inspect.signature(main).parameters
+    if len(argv) > 1:
+        with open(argv[1]) as f:
+            arguments = json.load(f)
+        unknown = [name for name in arguments if name not in parameters]
+        if unknown:
+            raise Exception(str(argv[1])+": "+", ".join(unknown)+" not arguments of this tool")
+        for name in TIME_ARGUMENTS:
+            if isinstance(arguments.get(name), str):
+                arguments[name] = datetime.datetime.strptime(arguments[name], "%Y-%m-%d %H:%M")
+    else:
+        arguments = dict([(name, namespace[name]) for name in parameters if name in namespace])
+    missing = [name for name, p in parameters.items() if p.default is p.empty and name not in arguments]
+    if missing:
+        raise Exception("Missing "+", ".join(missing)+": uncomment the parameters at the top of the tool "+
+                        "or pass a json file of them")
+    return arguments
@@ -0,0 +1,624 @@
+# Local Accessibility Query Service
+# Christopher D. Higgins
+# Department of Human Geography
+# University of Toronto Scarborough
+# https://higgicd.github.io
+# tool help can be found at https://github.com/higgicd/Accessibility_Toolbox
+
+# a small offline http service (asyncio, standard library only) that answers
+# "what if" accessibility questions from stored parquet od matrices (od cost
+# matrix to parquet tool or r5r) or from cumulative opportunity curves
+# (opportunity_curves.py) without re-running the arcgis tools.
+# the od matrix is regrouped by origin once into an origin index next to it
+# (<od_path>_by_origin, rebuilt when the partition files change), so the rows
+# of an origin are one small row group read. origins are kept in an lru cache
+# bounded by rows and computed responses in a second lru cache.
+#
+# endpoints (GET with a query string or POST with a json body, json out):
+#   /accessibility  origins, measures (parameters.py or measures file names), custom
+#                   (family:b0, e.g. neg_exp:0.2 or cumr:30), o_j, cutoff,
+#                   destinations, del_i_eq_j, od
+#   /reachability   origins, cutoff, o_j, destinations, od
+#   /travel_times   origins and destinations, or origins and k (nearest
+#                   destinations with opportunities), o_j, cutoff, od
+#   /metrics        latency percentiles, throughput and cache statistics
+#   /health
+# list parameters are comma separated in a query string or json lists.
+# o_j names an opportunity set given on start (a parquet or csv file of j_id
+# and o_j, such as the <output gdb>_o_j.parquet snapshot of every run);
+# without it every destination counts 1
+#
+# usage: python access_service.py r5_ttm [--od am=path ...] [--curves name=path ...]
+#            [--o_j jobs=path ...] [--port 8765] [--cache-rows 20000000]
+#        python benchmarks/load_test_service.py  (load test)
+
+import os
+import json
+import time
+import asyncio
+import argparse
+import threading
+from collections import OrderedDict, deque
+from urllib.parse import urlsplit, parse_qs
+import access_core
+from incremental_access import od_columns
+from parquet_profiles import ProfileWriter
+
+MAX_ORIGINS = 5000
+
+# ----- stored od matrix -----
+
+ROWS_FILE = "od_by_origin.parquet"
+ORIGINS_FILE = "origins.parquet"
+DESTINATIONS_FILE = "destinations.parquet"
+
+def fragment_signature(od_path):
+    # partition files and their sizes, to tell whether an index is stale
+    import pyarrow.dataset as ds
+    dataset = ds.dataset(od_path, format = "parquet", partitioning = "hive")
+    return [[os.path.relpath(f.path, od_path), os.path.getsize(f.path)] for f in dataset.get_fragments()]
+
+def build_origin_index(od_path, index_path, row_group_size = 8192, parquet_profile = None):
+    # the od rows regrouped by origin, a partition file at a time, into one
+    # parquet file of destination codes and travel times with small row
+    # groups; origins.parquet holds the row range of every origin, so the rows
+    # of one origin are a read of one or two row groups. memory is bounded by
+    # the largest partition file. the rows are encoded with parquet_profile,
+    # in their own row groups
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+    dataset = ds.dataset(od_path, format = "parquet", partitioning = "hive")
+    i_col, j_col, t_col = od_columns(dataset.schema)
+    fragments = list(dataset.get_fragments())
+    destinations = set()
+    for fragment in fragments:
+        destinations.update(pc.unique(fragment.to_table(columns = [j_col]).column(j_col).cast(pa.string())).to_pylist())
+    destination_ids = pa.array(sorted(destinations), pa.string())
+
+    os.makedirs(index_path, exist_ok = True)
+    t_type = dataset.schema.field(t_col).type
+    schema = pa.schema([("j", pa.int32()), ("t", t_type)])
+    writer = ProfileWriter(os.path.join(index_path, ROWS_FILE), schema, parquet_profile)
+    origin_ids, starts, stops = [], [], []
+    rows = 0
+    for fragment in fragments:
+        table = fragment.to_table(columns = [i_col, j_col, t_col])
+        i_ids = table.column(i_col).cast(pa.string()).combine_chunks().dictionary_encode()
+        i_codes = i_ids.indices.to_numpy(zero_copy_only = False)
+        order = np.argsort(i_codes, kind = "stable")
+        bounds = np.searchsorted(i_codes[order], np.arange(len(i_ids.dictionary) + 1))
+        j_codes = pc.index_in(table.column(j_col).cast(pa.string()), value_set = destination_ids).to_numpy(zero_copy_only = False)
+        origin_ids.extend(i_ids.dictionary.to_pylist())
+        starts.append(rows + bounds[:-1])
+        stops.append(rows + bounds[1:])
+        writer.write_table(pa.table({"j": pa.array(j_codes[order].astype(np.int32)),
+                                     "t": table.column(t_col).take(pa.array(order))}, schema = schema),
+                           row_group_size = row_group_size)
+        rows += table.num_rows
+    writer.close()
+    pq.write_table(pa.table({"i_id": pa.array(origin_ids, pa.string()),
+                             "start": pa.array(np.concatenate(starts).astype(np.int64)),
+                             "stop": pa.array(np.concatenate(stops).astype(np.int64))}),
+                   os.path.join(index_path, ORIGINS_FILE))
+    pq.write_table(pa.table({"j_id": destination_ids}), os.path.join(index_path, DESTINATIONS_FILE))
+    with open(os.path.join(index_path, "index.json"), "w") as f:
+        json.dump({"od_path": os.path.abspath(od_path), "fragments": fragment_signature(od_path), "rows": rows,
+                   "columns": [i_col, j_col, t_col], "row_group_size": row_group_size}, f, indent = 2)
+    return index_path
+
+def origin_index_path(od_path):
+    return od_path.rstrip("/\\")+"_by_origin"
+
+def load_origin_index(od_path, index_path = None):
+    # the origin index of an od matrix, (re)built when missing or stale
+    index_path = index_path or origin_index_path(od_path)
+    meta_path = os.path.join(index_path, "index.json")
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta["fragments"] == fragment_signature(od_path):
+            return index_path, False
+    return build_origin_index(od_path, index_path), True
+
+class ODStore(object):
+    # per-origin od rows of a parquet od matrix, read through its origin index:
+    # codes into destination_ids and travel times in the stored type
+    def __init__(self, od_path, cache_rows = 20000000, index_path = None):
+        import numpy as np
+        import pyarrow.parquet as pq
+        self.od_path = od_path
+        self.index_path, self.built = load_origin_index(od_path, index_path)
+        self.parquet_file = pq.ParquetFile(os.path.join(self.index_path, ROWS_FILE))
+        metadata = self.parquet_file.metadata
+        # first row of every row group; the last one of each partition is short
+        self.group_starts = np.cumsum([0] + [metadata.row_group(g).num_rows for g in range(metadata.num_row_groups)])
+        self.destination_ids = pq.read_table(os.path.join(self.index_path, DESTINATIONS_FILE)).column("j_id").combine_chunks()
+        origins = pq.read_table(os.path.join(self.index_path, ORIGINS_FILE)).to_pydict()
+        # an origin solved in more than one partition has one range per partition
+        self.ranges = {}
+        for i_id, start, stop in zip(origins["i_id"], origins["start"], origins["stop"]):
+            self.ranges.setdefault(i_id, []).append((start, stop))
+        self.cache_rows = cache_rows
+        self.cache = OrderedDict()
+        self.cached_rows = 0
+        self.lock = threading.Lock()
+        self.file_lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "row_groups_read": 0, "evicted": 0}
+
+    def destination_codes(self, j_ids):
+        # codes of destination ids; -1 where the id is not in the od matrix
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        codes = pc.index_in(pa.array([str(j) for j in j_ids], pa.string()), value_set = self.destination_ids)
+        return codes.fill_null(-1).to_numpy(zero_copy_only = False).astype("int64")
+
+    def read_rows(self, start, stop):
+        # (destination codes, travel times) of rows start:stop of the index
+        import numpy as np
+        first = int(np.searchsorted(self.group_starts, start, side = "right")) - 1
+        last = int(np.searchsorted(self.group_starts, stop - 1, side = "right")) - 1
+        with self.file_lock:
+            table = self.parquet_file.read_row_groups(list(range(first, last + 1)))
+        with self.lock:
+            self.stats["row_groups_read"] += last - first + 1
+        table = table.slice(start - int(self.group_starts[first]), stop - start)
+        return table.column("j").to_numpy(), table.column("t").to_numpy()
+
+    def origin_rows(self, i_id):
+        # (destination codes, travel times) of one origin; None if it is not
+        # in the od matrix
+        import numpy as np
+        i_id = str(i_id)
+        with self.lock:
+            if i_id in self.cache:
+                self.cache.move_to_end(i_id)
+                self.stats["hits"] += 1
+                return self.cache[i_id]
+            self.stats["misses"] += 1
+        ranges = self.ranges.get(i_id)
+        if ranges is None:
+            return None
+        parts = [self.read_rows(start, stop) for start, stop in ranges]
+        rows = (np.concatenate([p[0] for p in parts]), np.concatenate([p[1] for p in parts]))
+        with self.lock:
+            if i_id not in self.cache:
+                self.cache[i_id] = rows
+                self.cached_rows += len(rows[0])
+            while self.cached_rows > self.cache_rows and len(self.cache) > 1:
+                evicted, evicted_rows = self.cache.popitem(last = False)
+                self.cached_rows -= len(evicted_rows[0])
+                self.stats["evicted"] += 1
+        return rows
+
+    def info(self):
+        with self.lock:
+            return {"kind": "od", "path": self.od_path, "index": self.index_path, "origins": len(self.ranges),
+                    "destinations": len(self.destination_ids), "rows": self.parquet_file.metadata.num_rows,
+                    "cached_origins": len(self.cache), "cached_rows": self.cached_rows,
+                    "cache_rows": self.cache_rows, "cache": dict(self.stats)}
+
+class CurveStore(object):
+    # per-origin cumulative opportunity curves: answers accessibility and
+    # reachability for the opportunities the curves were built with
+    def __init__(self, curves_path):
+        from opportunity_curves import read_curves, curve_cutoff
+        curves = read_curves(curves_path)
+        self.curves_path = curves_path
+        self.cutoff = curve_cutoff(curves)
+        self.origin_index = dict([(i_id, k) for k, i_id in enumerate(curves["i_id"].astype(str))])
+        self.values = curves[["CUM"+str(m) for m in range(self.cutoff + 1)]].to_numpy().astype("float64")
+
+    def curve(self, i_id):
+        k = self.origin_index.get(str(i_id))
+        return None if k is None else self.values[k]
+
+    def info(self):
+        return {"kind": "curves", "path": self.curves_path, "origins": len(self.origin_index), "cutoff": self.cutoff}
+
+# ----- queries -----
+
+def list_param(params, name, default = None):
+    value = params.get(name)
+    if value is None or value == "":
+        return default
+    if isinstance(value, (list, tuple)):
+        return [str(v) for v in value]
+    return [v for v in str(value).split(",") if v != ""]
+
+def float_param(params, name, default = None):
+    value = params.get(name)
+    if value is None or value == "":
+        return default
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise Exception(str(name)+" must be a number, not "+str(value))
+
+def bool_param(params, name):
+    return str(params.get(name, "false")).lower() in ("1", "true", "yes")
+
+def measure_list(params):
+    # [(output name, impedance function of t_ij)] of the named and custom measures
+    measures = []
+    for f_name in list_param(params, "measures", []):
+        if not access_core.is_measure(f_name):
+            raise Exception(str(f_name)+" is not a measure in parameters.py or the measures file")
+        measures.append((f_name, lambda t, f_name = f_name: access_core.impedance_array(t, f_name)))
+    for spec in list_param(params, "custom", []):
+        family, sep, b0 = spec.partition(":")
+        if family not in access_core.IMPEDANCE_FAMILIES or sep == "":
+            raise Exception(str(spec)+" is not family:b0 with a family of "+", ".join(access_core.IMPEDANCE_FAMILIES))
+        b0 = float_param({"b0": b0}, "b0")
+        measures.append((family+"_"+format(b0, "g"),
+                         lambda t, family = family, b0 = b0: access_core.impedance_family(t, family, b0)))
+    if not measures:
+        raise Exception("no measures: give measures (parameters.py names) and/or custom (family:b0)")
+    return measures
+
+class QueryEngine(object):
+    def __init__(self, sources, opportunities, result_cache_size = 10000):
+        # sources: {name: ODStore or CurveStore}, the first is the default;
+        # opportunities: {name: {j_id: o_j}}
+        self.sources = sources
+        self.default_source = list(sources)[0]
+        self.opportunities = opportunities
+        self.o_j_arrays = {}
+        self.result_cache = OrderedDict()
+        self.result_cache_size = result_cache_size
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0}
+
+    def source(self, params):
+        name = params.get("od", self.default_source)
+        if name not in self.sources:
+            raise Exception(str(name)+" is not a loaded od matrix or curve set, use one of "+", ".join(self.sources))
+        return self.sources[name]
+
+    def o_j_array(self, store, name):
+        # o_j aligned with the destination codes of an od store, built once
+        import numpy as np
+        key = (id(store), name)
+        with self.lock:
+            if key in self.o_j_arrays:
+                return self.o_j_arrays[key]
+        if name is None:
+            values = np.ones(len(store.destination_ids))
+        else:
+            if name not in self.opportunities:
+                raise Exception(str(name)+" is not a loaded opportunity set, use one of "+", ".join(self.opportunities))
+            o_j = self.opportunities[name]
+            values = np.array([o_j.get(j_id) or 0.0 for j_id in store.destination_ids.to_pylist()], dtype = np.float64)
+        with self.lock:
+            self.o_j_arrays[key] = values
+        return values
+
+    def origins(self, params):
+        origins = list_param(params, "origins", [])
+        if not origins:
+            raise Exception("no origins")
+        if len(origins) > MAX_ORIGINS:
+            raise Exception(str(len(origins))+" origins in one query, the limit is "+str(MAX_ORIGINS))
+        return origins
+
+    def origin_rows(self, store, params, i_id, o_j):
+        # (destination codes, travel times) of an origin after the cutoff,
+        # destination subset, i == j and zero opportunity filters
+        rows = store.origin_rows(i_id)
+        if rows is None:
+            return None
+        j_codes, t_ij = rows
+        keep = o_j[j_codes] > 0
+        cutoff = float_param(params, "cutoff")
+        if cutoff is not None:
+            keep &= t_ij <= cutoff
+        subset = params.get("_subset")
+        if subset is not None:
+            keep &= subset[j_codes]
+        if bool_param(params, "del_i_eq_j"):
+            own = store.destination_codes([i_id])[0]
+            keep &= j_codes != own
+        return j_codes[keep], t_ij[keep]
+
+    def subset(self, store, params):
+        # destination subset as a mask over the destination codes
+        import numpy as np
+        destinations = list_param(params, "destinations")
+        if destinations is None:
+            return None
+        codes = store.destination_codes(destinations)
+        mask = np.zeros(len(store.destination_ids), dtype = bool)
+        mask[codes[codes >= 0]] = True
+        return mask
+
+    def run(self, endpoint, params):
+        # cached result of a query; the key is the endpoint and its parameters
+        key = endpoint+"?"+json.dumps(params, sort_keys = True, default = str)
+        with self.lock:
+            if key in self.result_cache:
+                self.result_cache.move_to_end(key)
+                self.stats["hits"] += 1
+                return self.result_cache[key], True
+            self.stats["misses"] += 1
+        if endpoint == "/accessibility":
+            result = self.accessibility(dict(params))
+        elif endpoint == "/reachability":
+            result = self.reachability(dict(params))
+        elif endpoint == "/travel_times":
+            result = self.travel_times(dict(params))
+        else:
+            raise KeyError(endpoint)
+        with self.lock:
+            self.result_cache[key] = result
+            while len(self.result_cache) > self.result_cache_size:
+                self.result_cache.popitem(last = False)
+        return result, False
+
+    def accessibility(self, params):
+        # FREQUENCY and SUM_Ai_<measure> per origin, as in the tool output
+        store = self.source(params)
+        measures = measure_list(params)
+        origins = self.origins(params)
+        if isinstance(store, CurveStore):
+            return self.curve_accessibility(store, params, origins, measures)
+        o_j = self.o_j_array(store, params.get("o_j"))
+        params["_subset"] = self.subset(store, params)
+        results, missing = {}, []
+        for i_id in origins:
+            rows = self.origin_rows(store, params, i_id, o_j)
+            if rows is None:
+                missing.append(i_id)
+                continue
+            j_codes, t_ij = rows
+            weights = o_j[j_codes]
+            result = {"FREQUENCY": int(len(j_codes))}
+            for name, f in measures:
+                result["SUM_Ai_"+name] = float(weights @ f(t_ij)) if len(j_codes) else 0.0
+            results[i_id] = result
+        return {"origins": results, "missing": missing}
+
+    def curve_accessibility(self, store, params, origins, measures):
+        import numpy as np
+        for name in ("o_j", "destinations", "del_i_eq_j"):
+            if params.get(name) not in (None, "", "false", False):
+                raise Exception(name+" needs an od matrix; curves hold the opportunities they were built with")
+        cutoff = min(int(float_param(params, "cutoff", store.cutoff)), store.cutoff)
+        minutes = np.arange(cutoff + 1, dtype = np.float64)
+        f = dict([(name, impedance(minutes)) for name, impedance in measures])
+        results, missing = {}, []
+        for i_id in origins:
+            curve = store.curve(i_id)
+            if curve is None:
+                missing.append(i_id)
+                continue
+            increments = np.diff(curve[:cutoff + 1], prepend = 0)
+            results[i_id] = dict([("SUM_Ai_"+name, float(increments @ values)) for name, values in f.items()])
+        return {"origins": results, "missing": missing, "cutoff": cutoff}
+
+    def reachability(self, params):
+        # destinations and opportunities within the cutoff per origin
+        store = self.source(params)
+        cutoff = float_param(params, "cutoff")
+        if cutoff is None:
+            raise Exception("reachability needs a cutoff")
+        origins = self.origins(params)
+        results, missing = {}, []
+        if isinstance(store, CurveStore):
+            minute = min(int(cutoff), store.cutoff)
+            for i_id in origins:
+                curve = store.curve(i_id)
+                if curve is None:
+                    missing.append(i_id)
+                else:
+                    results[i_id] = {"opportunities": float(curve[minute])}
+            return {"origins": results, "missing": missing}
+        o_j = self.o_j_array(store, params.get("o_j"))
+        params["_subset"] = self.subset(store, params)
+        for i_id in origins:
+            rows = self.origin_rows(store, params, i_id, o_j)
+            if rows is None:
+                missing.append(i_id)
+                continue
+            j_codes, t_ij = rows
+            results[i_id] = {"destinations": int(len(j_codes)), "opportunities": float(o_j[j_codes].sum())}
+        return {"origins": results, "missing": missing}
+
+    def travel_times(self, params):
+        # travel times to the given destinations, or the k nearest
+        # destinations with opportunities
+        import numpy as np
+        store = self.source(params)
+        if isinstance(store, CurveStore):
+            raise Exception("travel times need an od matrix")
+        origins = self.origins(params)
+        k = float_param(params, "k")
+        if k is None and list_param(params, "destinations") is None:
+            raise Exception("travel_times needs destinations or k")
+        o_j = self.o_j_array(store, params.get("o_j"))
+        params["_subset"] = self.subset(store, params)
+        ids = store.destination_ids
+        results, missing = {}, []
+        for i_id in origins:
+            rows = self.origin_rows(store, params, i_id, o_j)
+            if rows is None:
+                missing.append(i_id)
+                continue
+            j_codes, t_ij = rows
+            order = np.argsort(t_ij, kind = "stable")
+            if k is not None:
+                order = order[:int(k)]
+            results[i_id] = [{"j_id": ids[int(j)].as_py(), "t": float(t), "o_j": float(o_j[j])}
+                             for j, t in zip(j_codes[order], t_ij[order])]
+        return {"origins": results, "missing": missing}
+
+    def info(self):
+        with self.lock:
+            return {"results_cached": len(self.result_cache), "result_cache_size": self.result_cache_size,
+                    "result_cache": dict(self.stats),
+                    "sources": dict([(name, store.info()) for name, store in self.sources.items()]),
+                    "opportunities": dict([(name, len(o_j)) for name, o_j in self.opportunities.items()])}
+
+# ----- metrics -----
+
+class ServiceMetrics(object):
+    # request counts, errors and recent latencies per endpoint
+    def __init__(self, window = 10000):
+        self.started = time.time()
+        self.window = window
+        self.endpoints = {}
+        self.recent = deque(maxlen = 100000)
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, seconds, ok, cached = False):
+        with self.lock:
+            e = self.endpoints.setdefault(endpoint, {"requests": 0, "errors": 0, "cached": 0,
+                                                     "latency": deque(maxlen = self.window)})
+            e["requests"] += 1
+            e["errors"] += 0 if ok else 1
+            e["cached"] += 1 if cached else 0
+            e["latency"].append(seconds)
+            self.recent.append(time.time())
+
+    def snapshot(self):
+        import numpy as np
+        with self.lock:
+            now = time.time()
+            uptime = now - self.started
+            total = sum([e["requests"] for e in self.endpoints.values()])
+            last_minute = sum([1 for t in self.recent if t >= now - 60])
+            endpoints = {}
+            for name, e in self.endpoints.items():
+                latency = np.array(e["latency"])*1000
+                endpoints[name] = {"requests": e["requests"], "errors": e["errors"], "cached": e["cached"],
+                                   "p50_ms": float(np.percentile(latency, 50)), "p95_ms": float(np.percentile(latency, 95)),
+                                   "p99_ms": float(np.percentile(latency, 99)), "max_ms": float(latency.max())}
+        return {"uptime_s": uptime, "requests": total, "requests_per_s": total/max(uptime, 1e-9),
+                "requests_per_s_last_minute": last_minute/min(max(uptime, 1e-9), 60.0), "endpoints": endpoints}
+
+# ----- http -----
+
+STATUS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+class AccessService(object):
+    def __init__(self, engine):
+        self.engine = engine
+        self.metrics = ServiceMetrics()
+
+    async def handle(self, method, target, body):
+        # (status, json-able response) of one request
+        parts = urlsplit(target)
+        path = parts.path.rstrip("/") or "/"
+        if path == "/health":
+            return 200, {"status": "ok"}
+        if path == "/metrics":
+            return 200, dict(self.metrics.snapshot(), **self.engine.info())
+        if path not in ("/accessibility", "/reachability", "/travel_times"):
+            return 404, {"error": "unknown endpoint "+path}
+        if method not in ("GET", "POST"):
+            return 405, {"error": method+" is not supported"}
+        start = time.perf_counter()
+        try:
+            params = dict([(k, v[-1]) for k, v in parse_qs(parts.query).items()])
+            if body:
+                params.update(json.loads(body.decode("utf-8")))
+            # numpy and parquet work runs on the default thread pool so slow
+            # partition reads do not hold up cached answers
+            result, cached = await asyncio.get_running_loop().run_in_executor(None, self.engine.run, path, params)
+        except Exception as e:
+            self.metrics.record(path, time.perf_counter() - start, False)
+            return 400, {"error": str(e)}
+        elapsed = time.perf_counter() - start
+        self.metrics.record(path, elapsed, True, cached)
+        return 200, dict(result, elapsed_ms = elapsed*1000, cached = cached)
+
+    async def connection(self, reader, writer):
+        # http/1.1 with keep-alive: one request after another on a connection
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, sep, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0) or 0)
+                body = await reader.readexactly(length) if length else b""
+                try:
+                    status, response = await self.handle(method, target, body)
+                except Exception as e:
+                    status, response = 500, {"error": str(e)}
+                payload = json.dumps(response).encode("utf-8")
+                close = headers.get("connection", "").lower() == "close" or version == "HTTP/1.0"
+                writer.write(("HTTP/1.1 "+str(status)+" "+STATUS[status]+"\r\n"
+                              "Content-Type: application/json\r\n"
+                              "Content-Length: "+str(len(payload))+"\r\n"
+                              "Connection: "+("close" if close else "keep-alive")+"\r\n\r\n").encode("latin-1") + payload)
+                await writer.drain()
+                if close:
+                    break
+        except (ConnectionResetError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+async def serve(engine, host = "127.0.0.1", port = 8765):
+    service = AccessService(engine)
+    server = await asyncio.start_server(service.connection, host, port)
+    print("accessibility service on http://"+host+":"+str(port)+" ("+", ".join(engine.sources)+")", flush = True)
+    async with server:
+        await server.serve_forever()
+
+def named_paths(values):
+    # name=path pairs; a bare path is named after its file
+    named = OrderedDict()
+    for value in values or []:
+        name, sep, path = value.partition("=")
+        if sep == "":
+            name, path = os.path.splitext(os.path.basename(value.rstrip("/\\")))[0], value
+        named[name] = path
+    return named
+
+def build_engine(od_paths = (), curve_paths = (), o_j_paths = (), cache_rows = 20000000, result_cache_size = 10000):
+    sources = OrderedDict()
+    for name, path in named_paths(od_paths).items():
+        start = time.perf_counter()
+        sources[name] = ODStore(path, cache_rows)
+        print(("built" if sources[name].built else "loaded")+" the origin index of "+path+" as "+name+": "+
+              str(len(sources[name].ranges))+" origins in "+str(round(time.perf_counter() - start, 1))+" s", flush = True)
+    for name, path in named_paths(curve_paths).items():
+        sources[name] = CurveStore(path)
+    if not sources:
+        raise Exception("no od matrix or curves to serve")
+    opportunities = dict([(name, access_core.read_opportunities(path)) for name, path in named_paths(o_j_paths).items()])
+    return QueryEngine(sources, opportunities, result_cache_size)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Local accessibility query service over stored od matrices")
+    parser.add_argument("od_path", nargs = "*", help = "parquet od matrices, name=path or path")
+    parser.add_argument("--od", action = "append", default = [], help = "more od matrices, name=path")
+    parser.add_argument("--curves", action = "append", default = [], help = "opportunity curves, name=path")
+    parser.add_argument("--o_j", action = "append", default = [], help = "opportunity sets, name=path (parquet or csv of j_id, o_j)")
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = 8765)
+    parser.add_argument("--cache-rows", type = int, default = 20000000, help = "od rows kept in the origin cache")
+    parser.add_argument("--result-cache", type = int, default = 10000, help = "responses kept in the result cache")
+    parser.add_argument("--measures-file", help = "expression measures (see impedance_kernels.py)")
+    args = parser.parse_args()
+    if args.measures_file is not None:
+        from impedance_kernels import load_measures
+        load_measures(args.measures_file)
+    engine = build_engine(args.od_path + args.od, args.curves, args.o_j, args.cache_rows, args.result_cache)
+    try:
+        asyncio.run(serve(engine, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,167 @@
+# Distribution Summary Benchmark
+# Christopher D. Higgins
+# Department of Human Geography
+# University of Toronto Scarborough
+# https://higgicd.github.io
+# tool help can be found at https://github.com/higgicd/Accessibility_Toolbox
+
+# accuracy, memory and time of the streaming summaries of
+# distribution_summary.py against an exact computation that loads the whole
+# table and sorts every distribution. a synthetic scenario of --origins
+# origins in --regions regions with three demographic weights and four
+# measures (skewed, with ties and with zeros, as accessibility is) is written
+# as several parquet parts, with some origins left out as the tools do.
+# errors are reported over every region x group x measure distribution:
+# rank error of the deciles, absolute error of gini and of the share below
+# the mean, relative error of the palma ratio and of the mean
+#
+# usage: python benchmarks/bench_distribution.py --origins 2000000 --compression 100 200 500
+
+import os, sys
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from distribution_summary import DECILES, ALL_REGIONS, read_attributes, summarize
+
+MEASURES = ["SUM_Ai_HN1997", "SUM_Ai_CUMR45", "SUM_Ai_MGAUS180", "FREQUENCY"]
+GROUPS = ["pop", "pop_low_income", "pop_over_65"]
+
+def synthetic_scenario(work_dir, n_origins, n_regions, parts, seed = 1):
+    # attributes.parquet and access_<part>.parquet in work_dir
+    rng = np.random.default_rng(seed)
+    i_ids = np.array(["o"+str(k) for k in range(n_origins)])
+    region = rng.choice(n_regions, n_origins, p = np.arange(1, n_regions + 1)/np.arange(1, n_regions + 1).sum())
+    pop = np.floor(rng.lognormal(3.5, 1.0, n_origins))
+    low = rng.binomial(pop.astype(np.int64), rng.beta(2, 5, n_origins)).astype(np.float64)
+    old = rng.binomial(pop.astype(np.int64), 0.15).astype(np.float64)
+    pq.write_table(pa.table({"i_id": i_ids, "region": np.array(["r"+str(r) for r in region]),
+                             "pop": pop, "pop_low_income": low, "pop_over_65": old}),
+                   os.path.join(work_dir, "attributes.parquet"))
+    # accessibility improves with a latent centrality that differs by region
+    centrality = rng.normal(region/n_regions, 1.0, n_origins)
+    table = {"i_id": i_ids,
+             "SUM_Ai_HN1997": np.exp(4 + 1.2*centrality + rng.normal(0, 0.5, n_origins)),
+             "SUM_Ai_CUMR45": np.floor(np.exp(8 + 1.5*centrality + rng.normal(0, 0.8, n_origins))),
+             "SUM_Ai_MGAUS180": np.maximum(0, 500 + 300*centrality + rng.normal(0, 100, n_origins)),
+             "FREQUENCY": rng.poisson(np.exp(5 + centrality)).astype(np.float64)}
+    # origins that reach nothing are left out of the table
+    reached = rng.random(n_origins) > 0.03
+    order = rng.permutation(np.flatnonzero(reached))
+    paths = []
+    for k, rows in enumerate(np.array_split(order, parts)):
+        path = os.path.join(work_dir, "access_"+str(k)+".parquet")
+        pq.write_table(pa.table(dict([(name, values[rows]) for name, values in table.items()])), path)
+        paths.append(path)
+    return paths
+
+def exact_distributions(paths, attributes_path, thresholds):
+    # everything in memory: join, then sort each distribution
+    attributes = pd.read_parquet(attributes_path)
+    table = pd.concat([pd.read_parquet(path) for path in paths])
+    df = attributes.merge(table, on = "i_id", how = "left").fillna(dict([(m, 0.0) for m in MEASURES]))
+    results = {}
+    for region, frame in [(ALL_REGIONS, df)] + list(df.groupby("region")):
+        for group in GROUPS:
+            for measure in MEASURES:
+                values, weights = frame[measure].to_numpy(), frame[group].to_numpy()
+                keep = weights > 0
+                values, weights = values[keep], weights[keep]
+                order = np.argsort(values, kind = "stable")
+                results[(region, group, measure)] = (values[order], weights[order])
+    return results, df
+
+def exact_row(values, weights, thresholds):
+    total = weights.sum()
+    cum_w = np.concatenate([[0.0], np.cumsum(weights)])/total
+    cum_v = np.concatenate([[0.0], np.cumsum(values*weights)])
+    cum_v /= cum_v[-1]
+    mean = (values*weights).sum()/total
+    row = {"MEAN": mean,
+           "GINI": 1 - (np.diff(cum_w)*(cum_v[1:] + cum_v[:-1])).sum(),
+           "PALMA": (1 - np.interp(0.9, cum_w, cum_v))/np.interp(0.4, cum_w, cum_v),
+           "BELOW_MEAN": weights[values < mean].sum()/total}
+    for t in thresholds:
+        row["BELOW_"+str(int(t))] = weights[values < t].sum()/total
+    return row
+
+def rank_error(values, weights, x, q):
+    # distance from q to the range of cumulative weight shares at value x
+    total = weights.sum()
+    below = weights[values < x].sum()/total
+    at_or_below = weights[values <= x].sum()/total
+    return max(below - q, q - at_or_below, 0.0)
+
+def run(n_origins, n_regions, parts, compressions, processes, thresholds):
+    work_dir = tempfile.mkdtemp(prefix = "bench_distribution_")
+    try:
+        paths = synthetic_scenario(work_dir, n_origins, n_regions, parts)
+        attributes_path = os.path.join(work_dir, "attributes.parquet")
+        table_mb = sum([os.path.getsize(p) for p in paths])/1048576
+        print(str(n_origins)+" origins, "+str(n_regions)+" regions, "+str(len(GROUPS))+" groups, "+str(len(MEASURES))+
+              " measures in "+str(parts)+" parquet parts ("+str(round(table_mb, 1))+" MB)")
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        exact, df = exact_distributions(paths, attributes_path, thresholds)
+        exact_rows = dict([(key, exact_row(v, w, thresholds)) for key, (v, w) in exact.items()])
+        exact_s = time.perf_counter() - start
+        exact_peak = tracemalloc.get_traced_memory()[1]/1048576
+        tracemalloc.stop()
+        print("exact: "+str(len(exact))+" distributions in "+str(round(exact_s, 1))+" s, peak "+
+              str(round(exact_peak))+" MB traced")
+
+        attributes = read_attributes(attributes_path, "i_id", "region", GROUPS)
+        for compression in compressions:
+            tracemalloc.start()
+            start = time.perf_counter()
+            distributions, stats = summarize({"bench": paths}, attributes, MEASURES, thresholds, compression,
+                                             processes = processes)
+            stream_s = time.perf_counter() - start
+            stream_peak = tracemalloc.get_traced_memory()[1]/1048576
+            tracemalloc.stop()
+            ranks, gini, palma, mean, below_mean, below = [], [], [], [], [], []
+            for (region, group, measure), (values, weights) in exact.items():
+                summary = distributions.summaries[("bench", region, group, measure)]
+                row, truth = summary.row(), exact_rows[(region, group, measure)]
+                for q in DECILES:
+                    ranks.append(rank_error(values, weights, row["P"+str(q)], q/100.0))
+                gini.append(abs(row["GINI"] - truth["GINI"]))
+                palma.append(abs(row["PALMA"] - truth["PALMA"])/truth["PALMA"])
+                mean.append(abs(row["MEAN"] - truth["MEAN"])/truth["MEAN"])
+                below_mean.append(abs(float(summary.digest.share_below(truth["MEAN"])) - truth["BELOW_MEAN"]))
+                below += [abs(row["BELOW_"+str(int(t))] - truth["BELOW_"+str(int(t))]) for t in thresholds]
+            print("compression "+str(compression)+": "+str(round(stream_s, 1))+" s ("+str(stats["processes"])+
+                  " processes), peak "+str(round(stream_peak))+" MB traced in this process, sketches "+
+                  str(round(stats["sketch_mb"]*1024, 1))+" KB for "+str(stats["distributions"])+" distributions ("+
+                  str(round(stats["sketch_mb"]*1048576/stats["distributions"]))+" bytes each), "+
+                  str(stats["filled_origins"])+" origins filled with 0")
+            print("  decile rank error   median "+format(np.median(ranks), ".1e")+"  max "+format(max(ranks), ".1e"))
+            print("  gini abs error      median "+format(np.median(gini), ".1e")+"  max "+format(max(gini), ".1e"))
+            print("  palma rel error     median "+format(np.median(palma), ".1e")+"  max "+format(max(palma), ".1e"))
+            print("  share below mean    median "+format(np.median(below_mean), ".1e")+"  max "+format(max(below_mean), ".1e")+
+                  "  (digest)")
+            print("  mean rel error      max "+format(max(mean), ".1e")+", declared thresholds max "+
+                  format(max(below + [0.0]), ".1e")+"  (exact)")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors = True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Streaming distribution summaries against exact computation")
+    parser.add_argument("--origins", type = int, default = 2000000)
+    parser.add_argument("--regions", type = int, default = 8)
+    parser.add_argument("--parts", type = int, default = 4)
+    parser.add_argument("--compression", type = int, nargs = "*", default = [100, 200, 500])
+    parser.add_argument("--processes", type = int)
+    parser.add_argument("--thresholds", type = float, nargs = "*", default = [100, 10000])
+    args = parser.parse_args()
+    run(args.origins, args.regions, args.parts, args.compression, args.processes, args.thresholds)
@@ -0,0 +1,118 @@
+# Import Time and Worker Spawn Latency
+# Christopher D. Higgins
+# Department of Human Geography
+# University of Toronto Scarborough
+# https://higgicd.github.io
+# tool help can be found at https://github.com/higgicd/Accessibility_Toolbox
+
+# every spawned pool worker re-imports the tool module, so module-level imports
+# are paid once per worker. this measures, in fresh interpreters, the
+# module-level imports of each tool (arcpy excluded so it runs anywhere) and
+# of the helper modules, and the latency of a spawn pool whose workers do the
+# same imports
+#
+# usage:
+#   python benchmarks/bench_import.py
+#   python benchmarks/bench_import.py --repo D:/old_checkout --output before.json
+
+import os, sys
+import ast
+import json
+import argparse
+import statistics
+import subprocess
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TOOL_MODULES = ["access_calc_main", "odcm_main", "odcm_to_pq_main", "odcm_to_pq_by_time_main"]
+CORE_MODULES = ["access_core", "parameters", "telemetry", "time_sweep", "shared_inputs"]
+
+def module_imports(repo, module):
+    # module-level import statements of a tool, without arcpy
+    with open(os.path.join(repo, module+".py")) as f:
+        tree = ast.parse(f.read())
+    statements = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            names = [a for a in node.names if a.name.split(".")[0] != "arcpy"]
+            if names:
+                statements.append("import "+", ".join([a.name+(" as "+a.asname if a.asname else "") for a in names]))
+        elif isinstance(node, ast.ImportFrom):
+            if (node.module or "").split(".")[0] == "arcpy":
+                continue
+            statements.append("from "+("."*node.level)+(node.module or "")+" import "+
+                              ", ".join([a.name+(" as "+a.asname if a.asname else "") for a in node.names]))
+    return statements
+
+def import_statements(repo, module):
+    if module in TOOL_MODULES:
+        return module_imports(repo, module)
+    return ["import "+module]
+
+def time_imports(repo, statements, repeats):
+    code = ("import time\nt = time.perf_counter()\n"+"\n".join(statements)+
+            "\nimport sys\nprint(time.perf_counter() - t, len(sys.modules))")
+    times = []
+    for repeat in range(repeats):
+        out = subprocess.check_output([sys.executable, "-c", code], cwd = repo).decode().split()
+        times.append(float(out[0]))
+        modules = int(out[1])
+    return statistics.median(times), modules
+
+SPAWN_CODE = """
+import time, multiprocessing
+def init(statements):
+    exec(statements)
+def ready(x):
+    return x
+if __name__ == '__main__':
+    t = time.perf_counter()
+    pool = multiprocessing.get_context('spawn').Pool(%d, initializer = init, initargs = (%r,))
+    pool.map(ready, range(%d), chunksize = 1)
+    print(time.perf_counter() - t)
+    pool.close()
+    pool.join()
+"""
+
+def time_spawn(repo, statements, processes, repeats):
+    # pool start until every worker has done its imports and answered once
+    path = os.path.join(repo, "_bench_spawn.py")
+    with open(path, "w") as f:
+        f.write(SPAWN_CODE % (processes, "\n".join(statements), processes))
+    try:
+        times = []
+        for repeat in range(repeats):
+            times.append(float(subprocess.check_output([sys.executable, path], cwd = repo).decode().split()[0]))
+    finally:
+        os.remove(path)
+    return statistics.median(times)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Module import time and spawn pool latency")
+    parser.add_argument("--repo", default = repo_dir, help = "checkout to measure")
+    parser.add_argument("--repeats", type = int, default = 5)
+    parser.add_argument("--processes", type = int, default = 2)
+    parser.add_argument("--output", help = "json file for the results")
+    args = parser.parse_args(argv)
+
+    baseline, baseline_modules = time_imports(args.repo, ["pass"], args.repeats)
+    baseline_spawn = time_spawn(args.repo, ["pass"], args.processes, args.repeats)
+    print("interpreter: "+str(round(1000*baseline, 1))+" ms, "+str(baseline_modules)+" modules; "+
+          "empty spawn pool ("+str(args.processes)+" processes): "+str(round(1000*baseline_spawn))+" ms")
+    print("module".ljust(26)+"import ms".rjust(11)+"modules".rjust(9)+"spawn ms".rjust(10))
+    results = {"interpreter": {"import_s": baseline, "modules": baseline_modules, "spawn_s": baseline_spawn}}
+    for module in TOOL_MODULES + CORE_MODULES:
+        if not os.path.exists(os.path.join(args.repo, module+".py")):
+            continue
+        statements = import_statements(args.repo, module)
+        import_s, modules = time_imports(args.repo, statements, args.repeats)
+        spawn_s = time_spawn(args.repo, statements, args.processes, args.repeats)
+        results[module] = {"import_s": import_s, "modules": modules, "spawn_s": spawn_s}
+        print(module.ljust(26)+str(round(1000*import_s, 1)).rjust(11)+str(modules).rjust(9)+str(round(1000*spawn_s)).rjust(10))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"repo": args.repo, "processes": args.processes, "results": results}, f, indent = 2)
+    return results
+
+if __name__ == '__main__':
+    main()
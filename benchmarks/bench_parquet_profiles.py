@@ -0,0 +1,127 @@
+# Parquet Encoding Profiles
+# Christopher D. Higgins
+# Department of Human Geography
+# University of Toronto Scarborough
+# https://higgicd.github.io
+# tool help can be found at https://github.com/higgicd/Accessibility_Toolbox
+
+# writes the bundled r5_ttm od matrix with every encoding profile of
+# parquet_profiles.py, one batch at a time as the parquet tools finalize
+# them, and reports the size on disk, the write throughput, the throughput of
+# a full scan of every column and the time to read the rows of single origins
+# (a filter the row group statistics can answer). with --schema arcgis the
+# matrix is written like the arcgis tools do, with double Total_Time in
+# fractional minutes (--decimals rounds them), where byte stream split
+# applies to the times. scans run right after the write, so the files are in
+# the os cache; cold reads favour the smaller profiles
+#
+# usage:
+#   python benchmarks/bench_parquet_profiles.py
+#   python benchmarks/bench_parquet_profiles.py --partitions 10 --schema arcgis [--decimals 2] --profiles default smallest
+
+import os, sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+sys.path.insert(0, os.path.join(repo_dir, "benchmarks"))
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from parquet_profiles import PROFILES, write_to_dataset
+from incremental_access import od_columns
+from run_benchmarks import r5_dataset
+
+def batches(r5_path, n_partitions, schema, decimals = None, seed = 1):
+    # (batch_id, table) of every partition, in the r5r or the arcgis schema
+    rng = np.random.default_rng(seed)
+    dataset = r5_dataset(r5_path, n_partitions)
+    for fragment in dataset.get_fragments():
+        batch_id = ds.get_partition_keys(fragment.partition_expression)["batch_id"]
+        table = fragment.to_table(columns = ["fromId", "toId", "travel_time"])
+        if schema == "arcgis":
+            t_ij = table.column("travel_time").to_numpy().astype(np.float64)
+            t_ij = np.maximum(t_ij + rng.random(len(t_ij)) - 0.5, 0)
+            if decimals is not None:
+                t_ij = np.round(t_ij, decimals)
+            table = pa.table({"i_id": table.column("fromId"), "j_id": table.column("toId"), "Total_Time": t_ij})
+        yield batch_id, table.append_column("batch_id", pa.array([str(batch_id)]*table.num_rows))
+
+def folder_bytes(path):
+    return sum([os.path.getsize(os.path.join(d, f)) for d, dirs, files in os.walk(path) for f in files])
+
+def run_profile(name, tables, work_dir, origins, repeats):
+    output = os.path.join(work_dir, name)
+    rows, seconds = 0, 0.0
+    for batch_id, table in tables:
+        start = time.perf_counter()
+        write_to_dataset(table, output, ["batch_id"], name)
+        seconds += time.perf_counter() - start
+        rows += table.num_rows
+    dataset = ds.dataset(output, format = "parquet", partitioning = "hive")
+    i_col, j_col, t_col = od_columns(dataset.schema)
+    scan = None
+    for repeat in range(repeats):
+        start = time.perf_counter()
+        scanned, total = 0, 0.0
+        for batch in dataset.to_batches(columns = [i_col, j_col, t_col]):
+            scanned += batch.num_rows
+            total += float(pc.sum(batch.column(t_col)).as_py() or 0)
+        scan = min(scan or np.inf, time.perf_counter() - start)
+    start = time.perf_counter()
+    origin_rows = sum([dataset.count_rows(filter = pc.field(i_col) == origin) for origin in origins])
+    lookup = (time.perf_counter() - start)/len(origins)
+    files = [os.path.join(d, f) for d, dirs, fs in os.walk(output) for f in fs]
+    row_groups = sum([pq.ParquetFile(f).metadata.num_row_groups for f in files])
+    return {"rows": rows, "mb": folder_bytes(output)/1048576, "files": len(files), "row_groups": row_groups,
+            "write_s": seconds, "write_rows_per_s": rows/seconds, "scan_s": scan, "scan_rows_per_s": scanned/scan,
+            "origin_ms": lookup*1000, "origin_rows": origin_rows, "check": (scanned, total)}
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "size and throughput of the parquet encoding profiles")
+    parser.add_argument("--r5-path", default = os.path.join(repo_dir, "r5_ttm"))
+    parser.add_argument("--partitions", type = int, default = 75, help = "r5_ttm batches to use, 75 is all of them")
+    parser.add_argument("--schema", choices = ["r5", "arcgis"], default = "r5")
+    parser.add_argument("--decimals", type = int, help = "round the arcgis schema's travel times")
+    parser.add_argument("--profiles", nargs = "*", default = list(PROFILES))
+    parser.add_argument("--origins", type = int, default = 5, help = "single origin reads to time")
+    parser.add_argument("--repeats", type = int, default = 2)
+    parser.add_argument("--output", default = None)
+    args = parser.parse_args(argv)
+
+    # the batches are read once, so every profile writes the same tables
+    tables = list(batches(args.r5_path, args.partitions, args.schema, args.decimals))
+    n_rows = sum([table.num_rows for batch_id, table in tables])
+    i_col = tables[0][1].column_names[0]
+    rng = np.random.default_rng(1)
+    origins = [tables[k][1].column(i_col)[0].as_py() for k in rng.choice(len(tables), args.origins)]
+    print(str(n_rows)+" od rows in "+str(len(tables))+" batches, "+args.schema+" schema "+
+          ", ".join([field.name+" "+str(field.type) for field in tables[0][1].schema if field.name != "batch_id"]))
+    print("profile".ljust(14)+"size MB".rjust(9)+"row groups".rjust(12)+"write M rows/s".rjust(16)+
+          "scan M rows/s".rjust(15)+"origin ms".rjust(11))
+    report = {"rows": n_rows, "partitions": len(tables), "schema": args.schema, "decimals": args.decimals, "profiles": {}}
+    with tempfile.TemporaryDirectory() as work_dir:
+        for name in args.profiles:
+            result = run_profile(name, tables, work_dir, origins, args.repeats)
+            shutil.rmtree(os.path.join(work_dir, name))
+            report["profiles"][name] = result
+            print(name.ljust(14)+str(round(result["mb"], 1)).rjust(9)+str(result["row_groups"]).rjust(12)+
+                  str(round(result["write_rows_per_s"]/1e6, 2)).rjust(16)+str(round(result["scan_rows_per_s"]/1e6, 2)).rjust(15)+
+                  str(round(result["origin_ms"], 1)).rjust(11))
+    checks = [r.pop("check") for r in report["profiles"].values()]
+    print("same rows and travel time sum in every profile: "+
+          str(all([c[0] == checks[0][0] and abs(c[1] - checks[0][1]) <= 1e-9*abs(checks[0][1]) for c in checks])))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent = 1)
+    return report
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+# Single versus Double Precision
+# Christopher D. Higgins
+# Department of Human Geography
+# University of Toronto Scarborough
+# https://higgicd.github.io
+# tool help can be found at https://github.com/higgicd/Accessibility_Toolbox
+
+# the tools take precision = "single" to keep travel times and per-row
+# contributions in float32 (access_core.PRECISIONS). this runs the
+# accessibility computation on the bundled r5_ttm data in both precisions and
+# reports the largest relative error of A_i against float64, the memory of the
+# od values, the peak memory and throughput of the computation and the parquet
+# size of Total_Time. r5 travel times are whole minutes, which float32 holds
+# exactly, so the run is repeated with fractional minutes like the arcgis tools
+# write (to 0.01 min: impedance_array calls parameters.impedance_f once per
+# distinct travel time)
+#
+# usage:
+#   python benchmarks/bench_precision.py
+#   python benchmarks/bench_precision.py --partitions 75 --output precision.json
+
+import os, sys
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+sys.path.insert(0, os.path.join(repo_dir, "benchmarks"))
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import access_core
+import synthetic_ttm
+from run_benchmarks import r5_dataset, od_arrays, MEASURES
+
+def run_precision(i_codes, t_ij, o_j, n_origins, precision, repeats):
+    # best time and peak traced memory of the accessibility computation
+    t_ij = t_ij.astype(access_core.value_dtype(precision))
+    best = None
+    for repeat in range(repeats):
+        tracemalloc.start()
+        start = time.perf_counter()
+        results = access_core.accessibility(i_codes, t_ij, o_j, MEASURES, n_origins, precision)
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        if best is None or seconds < best[0]:
+            best = (seconds, peak)
+    # travel times plus one array of per-row contributions
+    return results, best[0], best[1], 2*t_ij.nbytes
+
+def relative_error(results, reference):
+    # largest per-origin |A_i - A_i(float64)| / A_i(float64)
+    errors = {}
+    for f_name in MEASURES:
+        reached = reference[f_name] > 0
+        errors[f_name] = float(np.max(np.abs(results[f_name][reached] - reference[f_name][reached])/reference[f_name][reached]))
+    return errors
+
+def parquet_bytes(i_codes, j_codes, t_ij, work_dir, precision):
+    path = os.path.join(work_dir, "lines_"+precision+".parquet")
+    pq.write_table(pa.table({"i_id": i_codes.astype(np.int32), "j_id": j_codes.astype(np.int32),
+                             "Total_Time": t_ij.astype(access_core.value_dtype(precision))}), path)
+    return os.path.getsize(path)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "float32 versus float64 accessibility")
+    parser.add_argument("--r5-path", default = os.path.join(repo_dir, "r5_ttm"))
+    parser.add_argument("--partitions", type = int, default = 25, help = "r5_ttm batches to use, 75 is all of them")
+    parser.add_argument("--repeats", type = int, default = 2)
+    parser.add_argument("--seed", type = int, default = 1)
+    parser.add_argument("--output", default = None)
+    args = parser.parse_args(argv)
+
+    od = od_arrays(r5_dataset(args.r5_path, args.partitions).to_table())
+    n_rows = len(od["t_ij"])
+    n_origins = len(od["i_ids"])
+    o_j = synthetic_ttm.synthetic_opportunities(len(od["j_ids"]), args.seed)[od["j_codes"]]
+    i_codes = od["i_codes"]
+    print(str(n_rows)+" od rows, "+str(n_origins)+" origins, measures "+", ".join(MEASURES))
+
+    rng = np.random.default_rng(args.seed)
+    variants = {"whole minutes": od["t_ij"],
+                "fractional minutes": np.round(od["t_ij"] + rng.random(n_rows) - 0.5, 2)}
+    report = {"rows": n_rows, "origins": n_origins, "partitions": args.partitions, "variants": {}}
+    with tempfile.TemporaryDirectory() as work_dir:
+        for label, t_ij in variants.items():
+            reference, double_s, double_peak, double_bytes = run_precision(i_codes, t_ij, o_j, n_origins, "double", args.repeats)
+            single, single_s, single_peak, single_bytes = run_precision(i_codes, t_ij, o_j, n_origins, "single", args.repeats)
+            errors = relative_error(single, reference)
+            entry = {"max_relative_error": errors,
+                     "double": {"seconds": double_s, "rows_per_s": n_rows/double_s, "peak_mb": double_peak/1048576,
+                                "values_mb": double_bytes/1048576,
+                                "parquet_mb": parquet_bytes(od["i_codes"], od["j_codes"], t_ij, work_dir, "double")/1048576},
+                     "single": {"seconds": single_s, "rows_per_s": n_rows/single_s, "peak_mb": single_peak/1048576,
+                                "values_mb": single_bytes/1048576,
+                                "parquet_mb": parquet_bytes(od["i_codes"], od["j_codes"], t_ij, work_dir, "single")/1048576}}
+            report["variants"][label] = entry
+            print(label+":")
+            print("  max relative error of A_i: "+", ".join([f_name+" "+format(e, ".1e") for f_name, e in errors.items()]))
+            for precision in ("double", "single"):
+                r = entry[precision]
+                print("  "+precision.ljust(7)+str(round(r["seconds"], 2)).rjust(7)+" s  "+
+                      str(round(r["rows_per_s"]/1e6, 1)).rjust(6)+" M rows/s  peak "+str(round(r["peak_mb"])).rjust(5)+
+                      " MB  t_ij + contributions "+str(round(r["values_mb"])).rjust(5)+" MB  parquet "+
+                      str(round(r["parquet_mb"], 1)).rjust(6)+" MB")
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent = 1)
+    return report
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+# Accessibility Query Service Load Test
+# Christopher D. Higgins
+# Department of Human Geography
+# University of Toronto Scarborough
+# https://higgicd.github.io
+# tool help can be found at https://github.com/higgicd/Accessibility_Toolbox
+
+# drives access_service.py with concurrent keep-alive clients for a fixed
+# time and reports throughput and client-side latency percentiles per
+# endpoint along with the service's own metrics and cache statistics.
+# queries mix accessibility (parameters.py and custom measures), reachability
+# and travel time requests; most hit a small set of hot origins, the rest are
+# drawn from every origin. without --url a service is started on the od
+# matrix and stopped afterwards, all on the local machine
+#
+# usage:
+#   python benchmarks/load_test_service.py --od-path r5_ttm --concurrency 16 --duration 30
+#   python benchmarks/load_test_service.py --url http://127.0.0.1:8765 --od-path r5_ttm
+
+import os, sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import subprocess
+from urllib.parse import urlsplit, urlencode
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+from incremental_access import od_columns
+
+MEASURES = ["HN1997", "CUMR30", "CUMR45", "MGAUS180", "POW1_0", "CUML40", "EXP0_12"]
+CUSTOM = ["neg_exp:0.05", "neg_exp:0.1", "neg_exp:0.2", "mgaus:250", "cumr:25", "cuml:50"]
+CUTOFFS = ["", "30", "45", "60"]
+
+def origin_ids(od_path):
+    dataset = ds.dataset(od_path, format = "parquet", partitioning = "hive")
+    i_col = od_columns(dataset.schema)[0]
+    return sorted(set(pc.unique(dataset.to_table(columns = [i_col]).column(i_col).cast(pa.string())).to_pylist()))
+
+def make_query(rng, hot, origins, hot_share):
+    pool = hot if rng.random() < hot_share else origins
+    picked = rng.sample(pool, rng.randint(1, 5))
+    kind = rng.random()
+    if kind < 0.6:
+        params = {"origins": ",".join(picked), "measures": ",".join(rng.sample(MEASURES, rng.randint(1, 3))),
+                  "cutoff": rng.choice(CUTOFFS)}
+        if rng.random() < 0.5:
+            params["custom"] = rng.choice(CUSTOM)
+        return "/accessibility", params
+    if kind < 0.8:
+        return "/reachability", {"origins": ",".join(picked), "cutoff": rng.choice(CUTOFFS[1:])}
+    return "/travel_times", {"origins": picked[0], "k": rng.choice(["1", "5", "10"])}
+
+async def request(reader, writer, host, path, params = None):
+    target = path + ("?"+urlencode(params) if params else "")
+    writer.write(("GET "+target+" HTTP/1.1\r\nHost: "+host+"\r\n\r\n").encode("latin-1"))
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, sep, value = line.decode("latin-1").partition(":")
+        if name.lower() == "content-length":
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length))
+
+async def client(host, port, queries, stop_at, latencies, errors):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while time.perf_counter() < stop_at:
+            path, params = next(queries)
+            start = time.perf_counter()
+            status, response = await request(reader, writer, host, path, params)
+            latencies.setdefault(path, []).append(time.perf_counter() - start)
+            if status != 200:
+                errors.append(response.get("error"))
+    finally:
+        writer.close()
+
+async def wait_ready(host, port, timeout):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+            status, response = await request(reader, writer, host, "/health")
+            writer.close()
+            if status == 200:
+                return
+        except OSError:
+            await asyncio.sleep(0.5)
+    raise Exception("service on "+host+":"+str(port)+" did not come up in "+str(timeout)+" s")
+
+async def load_test(host, port, origins, concurrency, duration, hot_origins, hot_share, seed):
+    rng = random.Random(seed)
+    hot = rng.sample(origins, min(hot_origins, len(origins)))
+    def queries():
+        while True:
+            yield make_query(rng, hot, origins, hot_share)
+    stream = queries()
+    latencies, errors = {}, []
+    start = time.perf_counter()
+    await asyncio.gather(*[client(host, port, stream, start + duration, latencies, errors) for c in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    reader, writer = await asyncio.open_connection(host, port)
+    status, server = await request(reader, writer, host, "/metrics")
+    writer.close()
+    return latencies, errors, elapsed, server
+
+def report(latencies, errors, elapsed, server, concurrency):
+    total = sum([len(v) for v in latencies.values()])
+    print(str(total)+" requests from "+str(concurrency)+" clients in "+str(round(elapsed, 1))+" s: "+
+          str(round(total/elapsed, 1))+" requests/s, "+str(len(errors))+" errors")
+    for path, values in sorted(latencies.items()):
+        ms = np.array(values)*1000
+        print("  "+path.ljust(16)+str(len(values)).rjust(7)+" requests  p50 "+format(np.percentile(ms, 50), ".1f")+
+              " ms  p95 "+format(np.percentile(ms, 95), ".1f")+" ms  p99 "+format(np.percentile(ms, 99), ".1f")+" ms")
+    for name, source in server["sources"].items():
+        if source["kind"] == "od":
+            cache = source["cache"]
+            print("  origin cache "+name+": "+str(cache["hits"])+" hits, "+str(cache["misses"])+" misses, "+
+                  str(cache["row_groups_read"])+" row groups read, "+str(source["cached_rows"])+" rows held")
+    result_cache = server["result_cache"]
+    print("  result cache: "+str(result_cache["hits"])+" hits, "+str(result_cache["misses"])+" misses")
+    if errors:
+        print("  first error: "+str(errors[0]))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Load test for access_service.py")
+    parser.add_argument("--url", help = "a running service; without it one is started on --od-path")
+    parser.add_argument("--od-path", default = os.path.join(repo_dir, "r5_ttm"), help = "od matrix served, for the origin ids")
+    parser.add_argument("--port", type = int, default = 8765)
+    parser.add_argument("--concurrency", type = int, default = 16)
+    parser.add_argument("--duration", type = float, default = 30)
+    parser.add_argument("--hot-origins", type = int, default = 200)
+    parser.add_argument("--hot-share", type = float, default = 0.8, help = "share of queries to the hot origins")
+    parser.add_argument("--cache-rows", type = int, default = 20000000)
+    parser.add_argument("--seed", type = int, default = 1)
+    parser.add_argument("--output", help = "json file for the results")
+    args = parser.parse_args()
+
+    origins = origin_ids(args.od_path)
+    service = None
+    if args.url is None:
+        host, port = "127.0.0.1", args.port
+        service = subprocess.Popen([sys.executable, os.path.join(repo_dir, "access_service.py"), args.od_path,
+                                    "--port", str(port), "--cache-rows", str(args.cache_rows)])
+    else:
+        parts = urlsplit(args.url)
+        host, port = parts.hostname, parts.port or 80
+    try:
+        asyncio.run(wait_ready(host, port, 600))
+        latencies, errors, elapsed, server = asyncio.run(load_test(host, port, origins, args.concurrency, args.duration,
+                                                                   args.hot_origins, args.hot_share, args.seed))
+    finally:
+        if service is not None:
+            service.terminate()
+            service.wait()
+    report(latencies, errors, elapsed, server, args.concurrency)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"concurrency": args.concurrency, "duration": elapsed,
+                       "latency_ms": dict([(k, [v*1000 for v in values]) for k, values in latencies.items()]),
+                       "errors": errors, "server": server}, f)
@@ -0,0 +1,393 @@
+# Accessibility Toolbox Benchmarks
+# Christopher D. Higgins
+# Department of Human Geography
+# University of Toronto Scarborough
+# https://higgicd.github.io
+# tool help can be found at https://github.com/higgicd/Accessibility_Toolbox
+
+# times the arcpy-free hot paths of the tools on the bundled r5_ttm dataset or
+# on a synthetic od matrix, and records the results as json so runs from
+# different versions can be compared
+#
+# usage:
+#   python benchmarks/run_benchmarks.py --tier small
+#   python benchmarks/run_benchmarks.py --tier medium --source synthetic --time-distribution distance
+#   python benchmarks/run_benchmarks.py --compare benchmarks/results/old.json benchmarks/results/new.json
+
+import os, sys
+import json
+import glob
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+from datetime import datetime
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.feather as ft
+import parameters
+import access_core
+import synthetic_ttm
+
+BENCHMARK_FORMAT = 1
+TOOLBOX_VERSION = "2.3"
+
+# ----- tiers -----
+# r5_partitions: batches of the bundled r5_ttm dataset to use (None = all)
+# origins/destinations/density: synthetic od matrix when --source synthetic
+# scalar_rows: rows for the per-row impedance_f loop, which is slow by design
+# finalize_batches: worker arrow files finalized into a parquet dataset
+
+TIERS = {
+    "small": {"r5_partitions": 10, "origins": 1000, "destinations": 4000, "density": 0.1,
+              "scalar_rows": 100000, "finalize_batches": 4, "repeats": 3},
+    "medium": {"r5_partitions": 25, "origins": 5000, "destinations": 20000, "density": 0.1,
+               "scalar_rows": 500000, "finalize_batches": 10, "repeats": 3},
+    "large": {"r5_partitions": None, "origins": 10000, "destinations": 40000, "density": 0.1,
+              "scalar_rows": 2000000, "finalize_batches": 20, "repeats": 2}}
+
+MEASURES = ["HN1997", "CUMR45", "MGAUS180"]
+
+# ----- od inputs -----
+
+def r5_dataset(r5_path, n_partitions):
+    partitions = sorted(glob.glob(os.path.join(r5_path, "batch_id=*")),
+                        key = lambda p: int(p.split("=")[-1]))
+    if n_partitions is not None:
+        partitions = partitions[:n_partitions]
+    files = []
+    for partition in partitions:
+        files += sorted(glob.glob(os.path.join(partition, "*.parquet")))
+    return ds.dataset(files, format = "parquet", partitioning = "hive", partition_base_dir = r5_path)
+
+def od_arrays(table):
+    # both schemas -> integer origin/destination codes and travel times
+    if "fromId" in table.column_names:
+        i_col, j_col, t_col = "fromId", "toId", "travel_time"
+    else:
+        i_col, j_col, t_col = "i_id", "j_id", "Total_Time"
+    i_codes = table.column(i_col).combine_chunks().dictionary_encode()
+    j_codes = table.column(j_col).combine_chunks().dictionary_encode()
+    return {"i_codes": i_codes.indices.to_numpy(zero_copy_only = False).astype(np.int64),
+            "j_codes": j_codes.indices.to_numpy(zero_copy_only = False).astype(np.int64),
+            "i_ids": i_codes.dictionary,
+            "j_ids": j_codes.dictionary,
+            "t_ij": table.column(t_col).to_numpy().astype(np.float64),
+            "columns": (i_col, j_col, t_col)}
+
+def prepare_inputs(args, tier, work_dir):
+    if args.source == "r5":
+        dataset = r5_dataset(args.r5_path, tier["r5_partitions"])
+        dataset_path = dataset
+        table = dataset.to_table()
+    else:
+        table = synthetic_ttm.synthetic_od(tier["origins"], tier["destinations"], tier["density"],
+                                           args.time_distribution, args.max_time, args.schema,
+                                           seed = args.seed)
+        dataset_path = synthetic_ttm.write_od_dataset(table, os.path.join(work_dir, "od_dataset"))
+    od = od_arrays(table)
+    od["table"] = table
+    od["dataset"] = dataset_path
+    od["o_j"] = synthetic_ttm.synthetic_opportunities(len(od["j_ids"]), args.seed)[od["j_codes"]]
+    return od
+
+# ----- cases -----
+# each case is setup(od, tier, work_dir) -> state and run(state) -> rows
+
+def case_impedance_f_scalar(od, tier, work_dir):
+    # the per-row pattern of the access_multi cursor loop
+    t_ij = od["t_ij"][:tier["scalar_rows"]].tolist()
+    def run():
+        impedance_f = parameters.impedance_f
+        for f_name in MEASURES:
+            [impedance_f(t, f_name) for t in t_ij]
+        return len(t_ij)*len(MEASURES)
+    return run
+
+def case_impedance_array(od, tier, work_dir):
+    def run():
+        for f_name in MEASURES:
+            access_core.impedance_array(od["t_ij"], f_name)
+        return len(od["t_ij"])*len(MEASURES)
+    return run
+
+def case_accessibility_bincount(od, tier, work_dir):
+    def run():
+        access_core.accessibility(od["i_codes"], od["t_ij"], od["o_j"], MEASURES, len(od["i_ids"]))
+        return len(od["t_ij"])*len(MEASURES)
+    return run
+
+def case_accessibility_groupby(od, tier, work_dir):
+    # the pandas pattern used for summaries and in the r notebook
+    df = pd.DataFrame({"i_id": od["i_codes"], "t_ij": od["t_ij"], "o_j": od["o_j"]})
+    def run():
+        for f_name in MEASURES:
+            df["Ai"] = df["o_j"]*access_core.impedance_array(df["t_ij"].to_numpy(), f_name)
+            df.groupby("i_id")["Ai"].sum()
+        return len(df)*len(MEASURES)
+    return run
+
+def arcgis_batches(od, n_batches):
+    # split the matrix into worker-style outputs: lines with solver oids plus
+    # the i_ids/j_ids lookups the parquet tools write next to them
+    i_codes, j_codes, t_ij = od["i_codes"], od["j_codes"], od["t_ij"]
+    edges = np.linspace(0, len(od["i_ids"]), n_batches + 1).astype(np.int64)
+    batches = []
+    for batch_id in range(n_batches):
+        mask = (i_codes >= edges[batch_id]) & (i_codes < edges[batch_id + 1])
+        lines = pd.DataFrame({"Total_Time": t_ij[mask],
+                              "OriginOID": i_codes[mask] - edges[batch_id] + 1,
+                              "DestinationOID": j_codes[mask] + 1})
+        i_ids = pd.DataFrame({"ObjectID": np.arange(1, edges[batch_id + 1] - edges[batch_id] + 1),
+                              "i_id": od["i_ids"].to_pandas().iloc[edges[batch_id]:edges[batch_id + 1]].to_numpy()})
+        batches.append((batch_id + 1, lines, i_ids))
+    j_ids = pd.DataFrame({"ObjectID": np.arange(1, len(od["j_ids"]) + 1), "j_id": od["j_ids"].to_pandas().to_numpy()})
+    return batches, j_ids
+
+def case_finalize_lines(od, tier, work_dir):
+    # the parquet finalization of the od matrix to parquet tool
+    batches, j_ids = arcgis_batches(od, tier["finalize_batches"])
+    out_dir = os.path.join(work_dir, "finalize")
+    def setup():
+        if os.path.exists(out_dir):
+            shutil.rmtree(out_dir)
+        os.makedirs(out_dir)
+        files = []
+        for batch_id, lines, i_ids in batches:
+            file = os.path.join(out_dir, "batch_"+str(batch_id)+".arrow")
+            ft.write_feather(lines, file)
+            i_ids.to_parquet(os.path.join(out_dir, "i_ids_batch_"+str(batch_id)+".parquet"))
+            j_ids.to_parquet(os.path.join(out_dir, "j_ids_batch_"+str(batch_id)+".parquet"))
+            files.append(file)
+        return files
+    def run(files):
+        rows = 0
+        for file in files:
+            dir_name, file_name, batch_num = access_core.batch_file_parts(file)
+            rows += access_core.finalize_lines(file, ['batch_id'], batch_id = batch_num)[0]
+        return rows
+    return setup, run
+
+def case_id_join_dict(od, tier, work_dir):
+    # turbo_joiner: dictionary of origin id -> accessibility, one lookup per row
+    n_origins = len(od["i_ids"])
+    join_ids = od["i_ids"].to_pylist()
+    join_values = np.arange(n_origins, dtype = np.float64).tolist()
+    target_ids = [join_ids[i] for i in np.random.default_rng(1).integers(0, n_origins, size = max(n_origins, 200000))]
+    def run():
+        access_core.dict_join(target_ids, join_ids, join_values)
+        return len(target_ids)
+    return run
+
+def case_id_join_merge(od, tier, work_dir):
+    # the pandas merge used to join ids back onto the od lines
+    lines = pd.DataFrame({"OriginOID": od["i_codes"] + 1, "Total_Time": od["t_ij"]})
+    i_ids = pd.DataFrame({"OriginOID": np.arange(1, len(od["i_ids"]) + 1), "i_id": od["i_ids"].to_pandas().to_numpy()})
+    def run():
+        pd.merge(lines, i_ids, how = 'left', left_on = ['OriginOID'], right_on = ['OriginOID'])
+        return len(lines)
+    return run
+
+def dataset_of(od):
+    if isinstance(od["dataset"], ds.Dataset):
+        return od["dataset"]
+    return ds.dataset(od["dataset"], format = "parquet", partitioning = "hive")
+
+def case_scan_full(od, tier, work_dir):
+    def run():
+        return dataset_of(od).to_table(columns = list(od["columns"])).num_rows
+    return run
+
+def case_scan_filtered(od, tier, work_dir):
+    # pushdown of a travel time cutoff
+    t_col = od["columns"][2]
+    def run():
+        return dataset_of(od).to_table(columns = list(od["columns"]), filter = ds.field(t_col) <= 30).num_rows
+    return run
+
+def case_scan_batches_accessibility(od, tier, work_dir):
+    # streaming record batches through the accessibility sum, the pattern for
+    # matrices larger than memory
+    i_col, j_col, t_col = od["columns"]
+    i_lookup = pa.array(od["i_ids"])
+    j_lookup = pa.array(od["j_ids"])
+    o_j_by_code = synthetic_ttm.synthetic_opportunities(len(od["j_ids"]), 1)
+    def run():
+        totals = np.zeros(len(od["i_ids"]))
+        rows = 0
+        for batch in dataset_of(od).to_batches(columns = [i_col, j_col, t_col]):
+            i_codes = pa.compute.index_in(batch.column(i_col), value_set = i_lookup).to_numpy(zero_copy_only = False)
+            j_codes = pa.compute.index_in(batch.column(j_col), value_set = j_lookup).to_numpy(zero_copy_only = False)
+            t_ij = batch.column(t_col).to_numpy(zero_copy_only = False).astype(np.float64)
+            values = o_j_by_code[j_codes]*access_core.impedance_array(t_ij, "CUMR45")
+            totals += access_core.origin_sums(i_codes, values, len(totals))
+            rows += batch.num_rows
+        return rows
+    return run
+
+CASES = [("impedance_f_scalar", case_impedance_f_scalar),
+         ("impedance_array", case_impedance_array),
+         ("accessibility_bincount", case_accessibility_bincount),
+         ("accessibility_groupby", case_accessibility_groupby),
+         ("finalize_lines", case_finalize_lines),
+         ("id_join_dict", case_id_join_dict),
+         ("id_join_merge", case_id_join_merge),
+         ("scan_full", case_scan_full),
+         ("scan_filtered", case_scan_filtered),
+         ("scan_batches_accessibility", case_scan_batches_accessibility)]
+
+# ----- runner -----
+
+def time_case(case, od, tier, work_dir, repeats):
+    prepared = case(od, tier, work_dir)
+    if isinstance(prepared, tuple):
+        setup, run = prepared
+    else:
+        setup, run = None, prepared
+    times = []
+    rows = 0
+    for repeat in range(repeats):
+        state = setup() if setup is not None else None
+        start = time.perf_counter()
+        rows = run(state) if setup is not None else run()
+        times.append(time.perf_counter() - start)
+    median = float(np.median(times))
+    return {"rows": int(rows),
+            "repeats": repeats,
+            "times_s": [round(t, 6) for t in times],
+            "median_s": round(median, 6),
+            "min_s": round(min(times), 6),
+            "rows_per_s": round(rows/median, 1) if median > 0 else None}
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd = repo_dir,
+                                       stderr = subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def environment():
+    return {"python": platform.python_version(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "cpu_count": multiprocessing.cpu_count(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "pyarrow": pa.__version__}
+
+def run_benchmarks(args):
+    tier = dict(TIERS[args.tier])
+    if args.repeats is not None:
+        tier["repeats"] = args.repeats
+    if args.source == "r5" and not os.path.exists(args.r5_path):
+        print("r5_ttm not found at "+args.r5_path+", using a synthetic matrix")
+        args.source = "synthetic"
+    selected = [c for c in CASES if not args.cases or c[0] in args.cases]
+
+    work_dir = tempfile.mkdtemp(prefix = "access_bench_")
+    try:
+        start = time.perf_counter()
+        od = prepare_inputs(args, tier, work_dir)
+        print("inputs: "+str(len(od["t_ij"]))+" od pairs, "+str(len(od["i_ids"]))+" origins, "+
+              str(len(od["j_ids"]))+" destinations ("+args.source+", "+str(round(time.perf_counter() - start, 1))+" s)")
+        results = {}
+        for name, case in selected:
+            results[name] = time_case(case, od, tier, work_dir, tier["repeats"])
+            r = results[name]
+            print(name.ljust(28)+str(round(r["median_s"], 3)).rjust(9)+" s"+
+                  str(r["rows"]).rjust(14)+" rows"+str(round(r["rows_per_s"]/1e6, 2)).rjust(10)+" M rows/s")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors = True)
+
+    config = {"tier": args.tier, "source": args.source, "measures": MEASURES}
+    config.update(tier)
+    if args.source == "synthetic":
+        config.update({"time_distribution": args.time_distribution, "schema": args.schema,
+                       "max_time": args.max_time, "seed": args.seed})
+    record = {"benchmark_format": BENCHMARK_FORMAT,
+              "toolbox_version": TOOLBOX_VERSION,
+              "commit": git_commit(),
+              "created": datetime.now().isoformat(timespec = "seconds"),
+              "total_s": round(time.perf_counter() - start, 2),
+              "config": config,
+              "environment": environment(),
+              "inputs": {"od_pairs": int(len(od["t_ij"])), "origins": len(od["i_ids"]), "destinations": len(od["j_ids"])},
+              "results": results}
+
+    output = args.output
+    if output is None:
+        results_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+        if not os.path.exists(results_dir):
+            os.makedirs(results_dir)
+        output = os.path.join(results_dir, args.tier+"_"+args.source+"_"+
+                              datetime.now().strftime("%Y%m%d_%H%M%S")+".json")
+    with open(output, "w") as f:
+        json.dump(record, f, indent = 2)
+    print("total "+str(record["total_s"])+" s, results written to "+output)
+    return record
+
+# ----- compare -----
+
+def compare(base_path, new_path, threshold = 0.10):
+    # median time ratio per case; cases more than threshold slower are flagged
+    with open(base_path) as f:
+        base = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    for key in ("tier", "source"):
+        if base["config"].get(key) != new["config"].get(key):
+            print("warning: "+key+" differs ("+str(base["config"].get(key))+" vs "+str(new["config"].get(key))+")")
+    if base["inputs"] != new["inputs"]:
+        print("warning: inputs differ, compare rows/s rather than times")
+    print("base "+str(base.get("commit"))+" ("+base["created"]+")  new "+str(new.get("commit"))+" ("+new["created"]+")")
+    print("case".ljust(28)+"base s".rjust(10)+"new s".rjust(10)+"ratio".rjust(8))
+    regressions = []
+    for name in base["results"]:
+        if name not in new["results"]:
+            continue
+        b = base["results"][name]["median_s"]
+        n = new["results"][name]["median_s"]
+        ratio = n/b if b > 0 else float("inf")
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  slower"
+            regressions.append(name)
+        elif ratio < 1 - threshold:
+            flag = "  faster"
+        print(name.ljust(28)+str(round(b, 3)).rjust(10)+str(round(n, 3)).rjust(10)+str(round(ratio, 2)).rjust(8)+flag)
+    return regressions
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Accessibility Toolbox benchmarks")
+    parser.add_argument("--tier", choices = sorted(TIERS), default = "small")
+    parser.add_argument("--source", choices = ["r5", "synthetic"], default = "r5")
+    parser.add_argument("--r5-path", default = os.path.join(repo_dir, "r5_ttm"))
+    parser.add_argument("--schema", choices = synthetic_ttm.SCHEMAS, default = "arcgis")
+    parser.add_argument("--time-distribution", choices = synthetic_ttm.TIME_DISTRIBUTIONS, default = "lognormal")
+    parser.add_argument("--max-time", type = float, default = 60)
+    parser.add_argument("--seed", type = int, default = 1)
+    parser.add_argument("--repeats", type = int)
+    parser.add_argument("--cases", nargs = "*", help = "only run these cases")
+    parser.add_argument("--output", help = "json file for the results")
+    parser.add_argument("--compare", nargs = 2, metavar = ("BASE", "NEW"), help = "compare two result files")
+    parser.add_argument("--threshold", type = float, default = 0.10)
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        regressions = compare(args.compare[0], args.compare[1], args.threshold)
+        if regressions:
+            sys.exit(1)
+        return
+    run_benchmarks(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+# Job Queue Stress Test
+# Christopher D. Higgins
+# Department of Human Geography
+# University of Toronto Scarborough
+# https://higgicd.github.io
+# tool help can be found at https://github.com/higgicd/Accessibility_Toolbox
+
+# runs the shared-folder job queue (job_queue.py) on one machine the way a
+# cluster would: the coordinator queues --batches od batches and
+# independent worker processes (python job_queue.py work <queue>, as they
+# would be started on other machines) claim and solve them. stub_job stands
+# in for odcm_to_pq_main's access_multi: it writes the arrow lines and id
+# tables a solve would and finalizes them with access_core.finalize_lines,
+# as queue_job does. the faulted run breaks things on purpose:
+#   crash   a worker dies in the middle of a batch; its lease expires and
+#           the batch is solved again by another worker
+#   error   a batch raises on its first attempt and is retried
+#   stall   a worker holding a lease is stopped (SIGSTOP) past its lease
+#           and resumed; the batch goes to another worker and the stalled
+#           one drops its output
+# every run checks the published dataset has every batch once: the lines
+# and travel time sum of the stub's solves and no duplicate od pairs
+#
+# usage: python benchmarks/stress_job_queue.py [--workers 4] [--batches 24] [--lease 3]
+
+import os, sys
+import json
+import time
+import signal
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+import numpy as np
+from job_queue import JobQueue, STAGING, job_parts, format_counts, describe
+from access_core import finalize_lines
+
+# ----- stub solver -----
+
+def stub_lines(batch_id, context):
+    # (origin codes, destination codes, minutes) of a batch, the same on every attempt
+    rng = np.random.default_rng([context["seed"], int(batch_id)])
+    i_codes, j_codes = np.nonzero(rng.random((context["origins"], context["destinations"])) < context["density"])
+    return i_codes, j_codes, rng.random(len(i_codes))*60
+
+def fault(context, batch_id, kind):
+    # True the first time a batch with a fault of kind runs
+    if context.get(kind) != batch_id:
+        return False
+    marker = os.path.join(context["marker_dir"], kind+"_"+str(batch_id))
+    if os.path.exists(marker):
+        return False
+    open(marker, "w").close()
+    return True
+
+def stub_job(job, context, staging_dir):
+    # stands in for odcm_to_pq_main.queue_job: a "solved" batch in the
+    # solver's format, finalized to its batch_id partition in staging_dir
+    import pyarrow as pa
+    import pyarrow.feather as ft
+    import pyarrow.parquet as pq
+    batch_id = job[0]
+    i_codes, j_codes, t_ij = stub_lines(batch_id, context)
+    file = os.path.join(staging_dir, "batch_"+str(batch_id)+".arrow")
+    ft.write_feather(pa.table({"OriginOID": (i_codes + 1).astype(np.int32), "DestinationOID": (j_codes + 1).astype(np.int32),
+                               "Total_Time": t_ij}), file)
+    pq.write_table(pa.table({"ObjectID": np.arange(1, context["origins"] + 1),
+                             "i_id": ["o"+str(batch_id)+"_"+str(k) for k in range(context["origins"])]}),
+                   os.path.join(staging_dir, "i_ids_batch_"+str(batch_id)+".parquet"))
+    pq.write_table(pa.table({"ObjectID": np.arange(1, context["destinations"] + 1),
+                             "j_id": ["d"+str(k) for k in range(context["destinations"])]}),
+                   os.path.join(staging_dir, "j_ids_batch_"+str(batch_id)+".parquet"))
+    time.sleep(context["solve_s"])
+    if fault(context, batch_id, "crash"):
+        os._exit(1)
+    if fault(context, batch_id, "error"):
+        raise Exception("stub solve of batch "+str(batch_id)+" failed on purpose")
+    rows, reduced = finalize_lines(file, ["batch_id"], context["precision"], profile = context["parquet_profile"],
+                                   batch_id = str(batch_id))
+    return {"rows": rows}
+
+# ----- runs -----
+
+def start_worker(queue_dir, log_dir, k):
+    log = open(os.path.join(log_dir, "worker_"+str(k)+".log"), "w")
+    return subprocess.Popen([sys.executable, os.path.join(repo_dir, "job_queue.py"), "work", queue_dir],
+                            stdout = log, stderr = subprocess.STDOUT)
+
+def stall_worker(queue, processes, lease_s, avoid, stalled):
+    # stops the first worker seen holding a lease (not on a batch in avoid)
+    # for 2.5 leases, then resumes it
+    pids = dict([(p.pid, p) for p in processes])
+    while not stalled.get("pid"):
+        for file_name in queue.files("leased"):
+            name, attempt, worker = job_parts(file_name)
+            pid = int(worker.split("-")[-1])
+            if pid in pids and pids[pid].poll() is None and int(name.split("_")[-1]) not in avoid:
+                os.kill(pid, signal.SIGSTOP)
+                stalled.update({"pid": pid, "job": name})
+                break
+        if queue.counts()["pending"] == 0:
+            return
+        time.sleep(0.05)
+    time.sleep(2.5*lease_s)
+    os.kill(stalled["pid"], signal.SIGCONT)
+
+def verify(output_dir, context, batch_ids):
+    import pyarrow.dataset as ds
+    table = ds.dataset(output_dir, format = "parquet", partitioning = "hive").to_table()
+    expected = [stub_lines(batch_id, context) for batch_id in batch_ids]
+    pairs = table.group_by(["i_id", "j_id"]).aggregate([]).num_rows
+    staged = os.listdir(os.path.join(output_dir, STAGING)) if os.path.exists(os.path.join(output_dir, STAGING)) else []
+    check = {"rows": table.num_rows, "expected_rows": sum([len(e[2]) for e in expected]),
+             "duplicate_pairs": table.num_rows - pairs,
+             "batches": len(set(table.column("batch_id").to_pylist())), "expected_batches": len(batch_ids),
+             "time_sum": float(np.sum(table.column("Total_Time").to_numpy())),
+             "expected_time_sum": float(sum([e[2].sum() for e in expected])), "left_staged": len(staged)}
+    check["ok"] = (check["rows"] == check["expected_rows"] and check["duplicate_pairs"] == 0 and
+                   check["batches"] == check["expected_batches"] and check["left_staged"] == 0 and
+                   abs(check["time_sum"] - check["expected_time_sum"]) <= 1e-9*check["expected_time_sum"])
+    return check
+
+def run(name, args, work_dir, workers, faults):
+    run_dir = os.path.join(work_dir, name)
+    queue_dir, output_dir, marker_dir = [os.path.join(run_dir, d) for d in ("queue", "output", "markers")]
+    os.makedirs(marker_dir)
+    os.makedirs(output_dir)
+    batch_ids = list(range(1, args.batches + 1))
+    context = {"seed": 1, "origins": args.origins, "destinations": args.destinations, "density": args.density,
+               "solve_s": args.solve_s, "precision": "double", "parquet_profile": None, "marker_dir": marker_dir}
+    if faults:
+        context.update({"crash": batch_ids[len(batch_ids)//3], "error": batch_ids[len(batch_ids)//2]})
+    start = time.time()
+    queue = JobQueue(queue_dir).create(stub_job, [(batch_id,) for batch_id in batch_ids], context, output_dir,
+                                       ["batch_"+str(batch_id).zfill(6) for batch_id in batch_ids], args.lease)
+    processes = [start_worker(queue_dir, run_dir, k) for k in range(workers)]
+    stalled = {}
+    if faults and hasattr(signal, "SIGSTOP") and workers > 1:
+        threading.Thread(target = stall_worker, args = (queue, processes, args.lease,
+                                                        [context["crash"], context["error"]], stalled), daemon = True).start()
+    summary = queue.wait(poll = 0.2, progress = lambda counts: print("  "+name+": "+format_counts(counts)))
+    for process in processes:
+        process.wait()
+    seconds = time.time() - start
+    check = verify(output_dir, context, batch_ids)
+    attempts = dict([(d["job"], d["attempts"]) for d in summary["done"]])
+    result = {"workers": workers, "seconds": seconds, "batches_per_s": len(batch_ids)/seconds,
+              "retried": sorted([job for job, n in attempts.items() if n > 1]),
+              "errors": [e["job"]+": "+str(e["error"]).strip().split("\n")[-1] for e in summary["errors"]],
+              "stalled": stalled, "lost": sum([w["lost"] for w in summary["workers"]]),
+              "exit_codes": [process.returncode for process in processes], "check": check}
+    print(describe(queue_dir))
+    return result
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "The shared-folder job queue with local workers and a stub solver")
+    parser.add_argument("--workers", type = int, default = 4, help = "worker processes, standing in for machines")
+    parser.add_argument("--batches", type = int, default = 24)
+    parser.add_argument("--origins", type = int, default = 40, help = "origins per batch")
+    parser.add_argument("--destinations", type = int, default = 3000)
+    parser.add_argument("--density", type = float, default = 0.2, help = "share of od pairs reached")
+    parser.add_argument("--solve-s", type = float, default = 0.5, help = "seconds each stub solve waits, as a network solve would")
+    parser.add_argument("--lease", type = float, default = 3.0, help = "lease seconds")
+    parser.add_argument("--output", default = None)
+    args = parser.parse_args(argv)
+    report = {}
+    work_dir = tempfile.mkdtemp(prefix = "job_queue_")
+    try:
+        report["one_worker"] = run("one_worker", args, work_dir, 1, False)
+        report["workers"] = run("workers", args, work_dir, args.workers, False)
+        report["faulted"] = run("faulted", args, work_dir, args.workers, True)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors = True)
+    print("")
+    print("run".ljust(12)+"workers".rjust(8)+"seconds".rjust(9)+"batches/s".rjust(11)+"  retried".ljust(28)+"lost".rjust(5)+"  dataset ok")
+    for name, result in report.items():
+        print(name.ljust(12)+str(result["workers"]).rjust(8)+str(round(result["seconds"], 1)).rjust(9)+
+              str(round(result["batches_per_s"], 2)).rjust(11)+("  "+", ".join(result["retried"])).ljust(28)+
+              str(result["lost"]).rjust(5)+"  "+str(result["check"]["ok"]))
+    for error in report["faulted"]["errors"]:
+        print("  "+error)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent = 1, default = str)
+    return report
+
+if __name__ == '__main__':
+    main()
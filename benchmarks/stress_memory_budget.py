@@ -0,0 +1,230 @@
+# Memory Budget Stress Test
+# Christopher D. Higgins
+# Department of Human Geography
+# University of Toronto Scarborough
+# https://higgicd.github.io
+# tool help can be found at https://github.com/higgicd/Accessibility_Toolbox
+
+# runs the arcpy-free stages of a large analysis with and without a memory
+# budget (memory_budget.py) and reports their peak memory against
+# the budget:
+#   finalize   one worker file of --lines od lines joined to its ids and
+#              written to a parquet partition, as odcm_to_pq_main does
+#   pool       --jobs jobs on --processes workers that grow to between half
+#              and twice a worker's share, like batches that reach more
+#              destinations than expected
+#   scan       travel_time_metrics over the od matrix
+#   diff       scenario_diff of the od matrix against a perturbed copy
+# every run is its own process, so peaks do not carry over; the memory of
+# the process and its workers is sampled every 10 ms and the process' own
+# peak is read from the os. outputs with and without the budget are compared
+#
+# usage: python benchmarks/stress_memory_budget.py --budget 1000 [--stages finalize pool scan diff] [--processes 3]
+
+import os, sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+from worker_stats import peak_rss_mb
+from memory_budget import MemoryBudget, ROW_BYTES, process_mb, worker_memory_mb, governed_map, spill_rows, scan_rows, scan_options
+
+STAGES = ["finalize", "pool", "scan", "diff"]
+
+class TreeSampler(object):
+    # peak memory of this process and its children (proportional set sizes)
+    def __init__(self, interval = 0.01):
+        self.interval = interval
+        self.peak_mb = 0.0
+        self.running = True
+        self.thread = threading.Thread(target = self.loop, daemon = True)
+        self.thread.start()
+
+    def loop(self):
+        while self.running:
+            self.peak_mb = max(self.peak_mb, (process_mb() or 0.0) + sum(worker_memory_mb()))
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        return max(self.peak_mb, own_peak_mb())
+
+def own_peak_mb():
+    # VmHWM starts over at exec on linux, where ru_maxrss keeps the peak of
+    # the stress process that started this one
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])/1024
+    except OSError:
+        pass
+    return peak_rss_mb()
+
+# ----- inputs -----
+
+def worker_file(work_dir, n_lines, n_origins = 500, n_destinations = 20000, seed = 1):
+    # batch_1.arrow with OriginOID, DestinationOID, Total_Time and the id tables next to it
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.feather as ft
+    import pyarrow.parquet as pq
+    rng = np.random.default_rng(seed)
+    batch_dir = os.path.join(work_dir, "workers")
+    os.makedirs(batch_dir, exist_ok = True)
+    ft.write_feather(pa.table({"OriginOID": rng.integers(1, n_origins + 1, n_lines).astype(np.int32),
+                               "DestinationOID": rng.integers(1, n_destinations + 1, n_lines).astype(np.int32),
+                               "Total_Time": rng.random(n_lines)*60}),
+                     os.path.join(batch_dir, "batch_1.arrow"), compression = "uncompressed")
+    pq.write_table(pa.table({"ObjectID": np.arange(1, n_origins + 1), "i_id": ["o"+str(k) for k in range(n_origins)]}),
+                   os.path.join(batch_dir, "i_ids_batch_1.parquet"))
+    pq.write_table(pa.table({"ObjectID": np.arange(1, n_destinations + 1), "j_id": ["d"+str(k) for k in range(n_destinations)]}),
+                   os.path.join(batch_dir, "j_ids_batch_1.parquet"))
+
+def copy_worker_file(work_dir, run_dir):
+    # finalize consumes its input, so every run finalizes a copy
+    shutil.copytree(os.path.join(work_dir, "workers"), run_dir)
+    return os.path.join(run_dir, "batch_1.arrow")
+
+def od_opportunities(od_path):
+    import pyarrow.dataset as ds
+    from incremental_access import od_columns
+    from synthetic_ttm import synthetic_opportunities
+    dataset = ds.dataset(od_path, format = "parquet", partitioning = "hive")
+    j_col = od_columns(dataset.schema)[1]
+    j_ids = set()
+    for batch in dataset.to_batches(columns = [j_col], **scan_options("scan")):
+        j_ids.update(batch.column(0).unique().cast("string").to_pylist())
+    j_ids = sorted(j_ids)
+    return dict(zip(j_ids, synthetic_opportunities(len(j_ids))))
+
+# ----- stages, one per process -----
+
+def grow(job):
+    # a worker job that allocates size_mb in steps over seconds
+    import numpy as np
+    size_mb, seconds = job
+    blocks = []
+    for step in range(10):
+        blocks.append(np.ones(int(size_mb*1048576/10), dtype = np.uint8))
+        time.sleep(seconds/10)
+    return size_mb
+
+def pool_jobs(budget_mb, processes, n_jobs, seed = 1):
+    import numpy as np
+    share = MemoryBudget(budget_mb, processes).share_mb()
+    rng = np.random.default_rng(seed)
+    return [(float(mb), 2.0) for mb in rng.uniform(0.5*share, 2.0*share, n_jobs).round(1)]
+
+def run_stage(stage, budget_mb, processes, work_dir, od_path, n_jobs):
+    import pandas as pd
+    if budget_mb:
+        MemoryBudget(budget_mb, processes).publish()
+    result = {}
+    sampler = TreeSampler()
+    start = time.perf_counter()
+    if stage == "finalize":
+        import access_core
+        run_dir = os.path.join(work_dir, "finalize_"+str(int(budget_mb)))
+        rows, reduced = access_core.finalize_lines(copy_worker_file(work_dir, run_dir), ["batch_id"], "double",
+                                                   lambda df: df.groupby("i_id")["Total_Time"].sum(), batch_id = "1")
+        result = {"rows": rows, "parts": len(os.listdir(os.path.join(run_dir, "batch_id=1"))),
+                  "part_rows": spill_rows("finalize"), "check": float(reduced.sum())}
+    elif stage == "pool":
+        pool = multiprocessing.Pool(processes = processes)
+        record = {}
+        sizes = governed_map(pool, grow, pool_jobs(budget_mb or 1000, processes, n_jobs), processes, record)
+        pool.close()
+        pool.join()
+        result = {"jobs": len(sizes), "job_mb": [min(sizes), max(sizes)], "governor": record.get("governor")}
+    elif stage == "scan":
+        from travel_time_metrics import travel_time_metrics
+        metrics, stats = travel_time_metrics(od_path, od_opportunities(od_path), ["CUMR45", "HN1997"], k_values = (1,))
+        result = {"rows": stats["rows"], "scan_rows": scan_rows("scan"),
+                  "check": float(metrics["SUM_Ai_HN1997"].sum())}
+    elif stage == "diff":
+        from scenario_diff import od_diff
+        output = os.path.join(work_dir, "diff_"+str(int(budget_mb))+".parquet")
+        summary = od_diff(os.path.join(work_dir, "alt_base"), os.path.join(work_dir, "alt"), output, o_j = od_opportunities(od_path),
+                          selected_impedance_function = ["CUMR45"], cutoff = 45, processes = processes)
+        result = {"jobs": summary["jobs"], "max_job_rows": summary["max_job_rows"], "spilled_rows": summary["spilled_rows"],
+                  "largest_job_rows": summary["largest_job_rows"],
+                  "check": float(pd.read_parquet(output, columns = ["D_SUM_Ai_CUMR45"])["D_SUM_Ai_CUMR45"].abs().sum())}
+    result["seconds"] = time.perf_counter() - start
+    result["peak_mb"] = sampler.stop()
+    return result
+
+def stage_process(stage, budget_mb, args, work_dir):
+    command = [sys.executable, os.path.abspath(__file__), "--run", stage, "--budget", str(budget_mb),
+               "--processes", str(args.processes), "--work-dir", work_dir, "--od", args.od, "--jobs", str(args.jobs)]
+    output = subprocess.run(command, check = True, capture_output = True, text = True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def report(stage, budget_mb, free, governed):
+    within = governed["peak_mb"] <= budget_mb
+    line = (stage.ljust(9)+" no budget: peak "+str(round(free["peak_mb"])).rjust(5)+" MB in "+str(round(free["seconds"], 1)).rjust(5)+
+            " s | budget "+str(round(budget_mb))+" MB: peak "+str(round(governed["peak_mb"])).rjust(5)+" MB in "+
+            str(round(governed["seconds"], 1)).rjust(5)+" s  "+("within" if within else "OVER"))
+    print(line)
+    if stage == "finalize":
+        print("          "+str(governed["rows"])+" lines in "+str(governed["parts"])+" parts of "+str(governed["part_rows"])+
+              " rows (1 part without), same output: "+str(free["rows"] == governed["rows"] and
+                                                          abs(free["check"] - governed["check"]) <= 1e-9*abs(free["check"])))
+    elif stage == "pool":
+        g = governed["governor"]
+        print("          "+str(governed["jobs"])+" jobs of "+str(governed["job_mb"][0])+" to "+str(governed["job_mb"][1])+
+              " MB: at most "+str(g["max_running"])+" running, down to "+str(g["min_running_throttled"])+" while "+
+              "throttled for "+str(round(g["throttled_seconds"], 1))+" s, governor peak "+str(round(g["peak_mb"]))+" MB")
+    elif stage == "scan":
+        print("          "+str(governed["rows"])+" rows in batches of "+str(governed["scan_rows"])+" (pyarrow default without), "
+              "same result: "+str(abs(free["check"] - governed["check"]) <= 1e-9*abs(free["check"])))
+    elif stage == "diff":
+        print("          "+str(governed["jobs"])+" jobs of at most "+str(governed["max_job_rows"])+" rows ("+
+              str(free["jobs"])+" of "+str(free["max_job_rows"])+" without), "+str(governed["spilled_rows"])+" rows spilled, "
+              "largest job "+str(governed["largest_job_rows"])+" rows, same result: "+
+              str(abs(free["check"] - governed["check"]) <= 1e-9*abs(free["check"])))
+    return within
+
+def stress(args):
+    work_dir = tempfile.mkdtemp(prefix = "stress_memory_")
+    try:
+        print("budget "+str(args.budget)+" MB over "+str(args.processes)+" workers and the parent, "+
+              str(round(MemoryBudget(args.budget, args.processes).share_mb()))+" MB each; bytes per row "+json.dumps(ROW_BYTES))
+        if "finalize" in args.stages:
+            worker_file(work_dir, args.lines)
+        if "diff" in args.stages:
+            from scenario_diff import perturbed_copy
+            perturbed_copy(args.od, os.path.join(work_dir, "alt"), None)
+        results = []
+        for stage in args.stages:
+            free = stage_process(stage, 0, args, work_dir)
+            governed = stage_process(stage, args.budget, args, work_dir)
+            results.append(report(stage, args.budget, free, governed))
+        print("all stages within the budget: "+str(all(results)))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors = True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Peak memory of large runs with and without a memory budget")
+    parser.add_argument("--budget", type = float, default = 1000)
+    parser.add_argument("--stages", nargs = "*", default = STAGES, choices = STAGES)
+    parser.add_argument("--processes", type = int, default = 3)
+    parser.add_argument("--lines", type = int, default = 8000000, help = "od lines in the worker file to finalize")
+    parser.add_argument("--jobs", type = int, default = 12, help = "pool jobs")
+    parser.add_argument("--od", default = os.path.join(repo_dir, "r5_ttm"))
+    parser.add_argument("--run", choices = STAGES, help = argparse.SUPPRESS)
+    parser.add_argument("--work-dir", help = argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run:
+        print(json.dumps(run_stage(args.run, args.budget, args.processes, args.work_dir, args.od, args.jobs)))
+    else:
+        stress(args)
@@ -0,0 +1,389 @@
+# Hierarchical Destination Zones
+# Christopher D. Higgins
+# Department of Human Geography
+# University of Toronto Scarborough
+# https://higgicd.github.io
+# tool help can be found at https://github.com/higgicd/Accessibility_Toolbox
+
+# solves each origin batch against fine destinations nearby and aggregated
+# zones farther out. destinations sit in a nested grid: level 0 is every
+# destination, level l >= 1 groups them into cells of cell_size*2**(l-1).
+# each cell is stood in for by its representative (the member closest to the
+# o_j-weighted centroid) carrying the summed o_j and the number of members.
+# for an origin batch every destination takes the coarsest cell whose spread
+# (largest member distance to the representative, plus the member's own
+# radius for areas) is at most theta times the representative's distance to
+# the nearest origin of the batch, so zones grow with distance like the cells
+# of a barnes-hut tree.
+# theta is calibrated on network travel times: a sample of origins spread
+# over the batches is solved to every destination, and for each theta the A_i
+# of the sampled origins over the zones of their batch is compared with A_i
+# over every destination. the largest theta whose 95th percentile relative
+# error of every selected measure is within the tolerance is used, or 0 (only
+# cells of co-located destinations) when none is. the error is measured on
+# the sample, so it estimates the error of the run rather than bounding it;
+# zones near the cutoff lose every member when the representative is just out
+# of reach, which the sample sees as it uses the same travel times
+# zones are only used when they save at least MIN_REDUCTION of the od rows
+# within the cutoff on the sample: below that, per-batch destinations and the
+# batch cache they turn off cost more than they save, and every batch solves
+# to every destination as without zones.
+# on the NYC transit matrix 256 sampled origins (3 per batch) put the sample
+# p95 within a few thousandths of the actual one, and a 0.05 tolerance saves
+# about 5% of the od rows, so zones are skipped: transit times follow lines,
+# not distance, so zones only pay off where they are far from every origin of
+# a batch
+#
+# usage: python destination_zones.py [od_path]  (actual versus sample error on the NYC data)
+
+import os, sys
+import time
+import access_core
+from endpoint_dedup import nearest_points
+
+THETAS = (2.0, 1.4, 1.0, 0.7, 0.5, 0.35, 0.25, 0.18, 0.12, 0.08, 0.05)
+# share of the od rows within the cutoff zones must save to be used
+MIN_REDUCTION = 0.2
+
+class DestinationZones(object):
+    def __init__(self, j_ids, o_j, xy, cell_size = None, levels = 8, radius = None):
+        # radius is the extent of each destination around its point (0 for
+        # points), for areas that share a point such as blocks placed at
+        # their block group
+        import numpy as np
+        self.j_ids = [str(j_id) for j_id in j_ids]
+        self.o_j = np.asarray(o_j, dtype = np.float64)
+        self.xy = np.asarray(xy, dtype = np.float64)
+        n = len(self.o_j)
+        radius = np.zeros(n) if radius is None else np.asarray(radius, dtype = np.float64)
+        if cell_size is None:
+            # about two destinations per finest cell
+            extent = self.xy.max(axis = 0) - self.xy.min(axis = 0)
+            cell_size = max(float(np.sqrt(extent[0]*extent[1]*2.0/max(n, 1))), 1e-9)
+        self.cell_size = cell_size
+        self.levels = []
+        origin = self.xy.min(axis = 0)
+        for l in range(1, levels + 1):
+            size = cell_size*2**(l - 1)
+            # nested cells: floor(x/2s) groups the cells of floor(x/s)
+            keys = np.floor((self.xy - origin)/size).astype(np.int64)
+            keys = keys[:, 0]*(int(keys[:, 1].max()) + 1) + keys[:, 1]
+            cells, inverse = np.unique(keys, return_inverse = True)
+            total = np.bincount(inverse, weights = self.o_j, minlength = len(cells))
+            weights = np.maximum(total, 1e-12)
+            centroid = np.stack([np.bincount(inverse, weights = self.o_j*self.xy[:, k], minlength = len(cells))/weights
+                                 for k in (0, 1)], axis = 1)
+            to_centroid = np.sqrt(((self.xy - centroid[inverse])**2).sum(axis = 1))
+            order = np.lexsort((to_centroid, inverse))
+            first = np.concatenate([[True], inverse[order][1:] != inverse[order][:-1]])
+            rep = order[first]
+            spread = np.zeros(len(cells))
+            np.maximum.at(spread, inverse, np.sqrt(((self.xy - self.xy[rep][inverse])**2).sum(axis = 1)) + radius)
+            self.levels.append({"inverse": inverse, "rep": rep, "o_j": total,
+                                "count": np.bincount(inverse, minlength = len(cells)), "spread": spread})
+            if len(cells) == 1:
+                break
+
+    def rep_distances(self, origin_xy):
+        # per level, distance from every representative to the nearest origin
+        import numpy as np
+        origin_xy = np.asarray(origin_xy, dtype = np.float64)
+        return [nearest_points(self.xy[cells["rep"]], origin_xy)[1] for cells in self.levels]
+
+    def destination_levels(self, origin_xy, theta, distances = None):
+        # coarsest accepted level of every destination (0: itself)
+        import numpy as np
+        if distances is None:
+            distances = self.rep_distances(origin_xy)
+        level = np.zeros(len(self.o_j), dtype = np.int64)
+        for l, (cells, distance) in enumerate(zip(self.levels, distances), 1):
+            accepted = (cells["count"] > 1) & (cells["spread"] <= theta*distance)
+            level[accepted[cells["inverse"]]] = l
+        return level
+
+    def batch_zones(self, origin_xy, theta, n_j = None, distances = None):
+        # (representative destination indices, summed o_j, destinations stood
+        # in for) of the reduced destination set of one origin batch; n_j
+        # counts what each destination already stands for (1 by default)
+        import numpy as np
+        n_j = np.ones(len(self.o_j)) if n_j is None else np.asarray(n_j, dtype = np.float64)
+        level = self.destination_levels(origin_xy, theta, distances)
+        single = np.flatnonzero(level == 0)
+        reps, o_j, counts = [single], [self.o_j[single]], [n_j[single]]
+        for l, cells in enumerate(self.levels, 1):
+            members = level == l
+            if not members.any():
+                continue
+            used = np.unique(cells["inverse"][members])
+            reps.append(cells["rep"][used])
+            o_j.append(cells["o_j"][used])
+            counts.append(np.bincount(cells["inverse"], weights = n_j, minlength = len(cells["rep"]))[used])
+        return np.concatenate(reps), np.concatenate(o_j), np.concatenate(counts)
+
+# ----- calibration on solved origins -----
+
+def sample_origins(batches, sample_size, seed = 1):
+    # {batch_id: positions of the sampled origins}: sample_size spread evenly
+    # over the batches, at least one origin in each sampled batch
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    batch_ids = list(batches)
+    if sample_size < len(batch_ids):
+        batch_ids = [batch_ids[k] for k in sorted(rng.choice(len(batch_ids), sample_size, replace = False))]
+    per_batch = max(sample_size // max(len(batch_ids), 1), 1)
+    return dict([(batch_id, sorted(rng.choice(len(batches[batch_id]), min(per_batch, len(batches[batch_id])), replace = False)))
+                 for batch_id in batch_ids])
+
+def sample_errors(zones, distances, times, cutoff, selected_impedance_function, thetas):
+    # one batch of the calibration: times are the network travel times from
+    # its sampled origins to every destination (inf where not reached).
+    # returns ({theta: ({measure: relative error per sampled origin that
+    # reaches opportunities}, od rows within the cutoff over the zones)}, od
+    # rows within the cutoff over every destination). times are rounded to
+    # 0.1 minute and kept as codes into the impedance of each distinct time;
+    # the last code is everything past the cutoff
+    import numpy as np
+    reached = times <= cutoff
+    unique_t, inverse = np.unique(np.round(times[reached], 1), return_inverse = True)
+    codes = np.full(times.shape, len(unique_t), dtype = np.int64)
+    codes[reached] = inverse
+    f = dict([(f_name, np.append(access_core.impedance_array(unique_t, f_name), 0.0)) for f_name in selected_impedance_function])
+    full = dict([(f_name, f_t[codes] @ zones.o_j) for f_name, f_t in f.items()])
+    results = {}
+    for theta in thetas:
+        level = zones.destination_levels(None, theta, distances)
+        rep_of = np.arange(len(zones.o_j))
+        for l, cells in enumerate(zones.levels, 1):
+            rep_of[level == l] = cells["rep"][cells["inverse"][level == l]]
+        zone_codes = codes[:, rep_of]
+        errors = {}
+        for f_name, f_t in f.items():
+            positive = full[f_name] > 0
+            errors[f_name] = (np.abs(f_t[zone_codes] @ zones.o_j - full[f_name])[positive]/full[f_name][positive])
+        results[theta] = (errors, int((codes[:, np.unique(rep_of)] < len(unique_t)).sum()))
+    return results, int(reached.sum())
+
+def choose_theta(zones, batches, sample, tolerance, cutoff, selected_impedance_function, thetas = THETAS):
+    # largest theta whose 95th percentile error on the solved sample is
+    # within tolerance for every measure, 0 if none is. batches is
+    # {batch_id: origin xy (n x 2)} and sample {batch_id: [(destination
+    # codes, travel times) of each sampled origin]}; one batch is held at a
+    # time and only the errors of the sampled origins are kept. returns
+    # (theta, {measure: p95 error}, share of od rows within the cutoff saved)
+    import numpy as np
+    thetas = sorted(thetas, reverse = True) + [0.0]
+    errors = dict([(theta, dict([(f_name, []) for f_name in selected_impedance_function])) for theta in thetas])
+    rows = dict([(theta, 0.0) for theta in thetas])
+    full_rows = 0.0
+    for batch_id, origins in sample.items():
+        times = np.full((len(origins), len(zones.o_j)), np.inf)
+        for k, (j_codes, t_ij) in enumerate(origins):
+            times[k, j_codes] = t_ij
+        distances = zones.rep_distances(np.asarray(batches[batch_id], dtype = np.float64))
+        batch_results, batch_full = sample_errors(zones, distances, times, cutoff, selected_impedance_function, thetas)
+        # od rows scale from the sampled origins to the whole batch
+        scale = len(batches[batch_id])/float(len(origins))
+        full_rows += batch_full*scale
+        for theta, (batch_errors, batch_rows) in batch_results.items():
+            rows[theta] += batch_rows*scale
+            for f_name, e in batch_errors.items():
+                errors[theta][f_name].append(e)
+    for theta in thetas:
+        p95 = {}
+        for f_name, e in errors[theta].items():
+            e = np.concatenate(e) if e else np.zeros(0)
+            p95[f_name] = float(np.quantile(e, 0.95)) if len(e) > 0 else 0.0
+        if max(p95.values()) <= tolerance or theta == 0.0:
+            return theta, p95, 1 - rows[theta]/max(full_rows, 1.0)
+
+# ----- tool -----
+
+def solve_sample(origins_fc, destinations_fc, i_ids, input_network, travel_mode, cutoff, time_of_day):
+    # network travel times from the sampled origins (by i_id_text) to every
+    # destination, in one solve by the parent: {i_id_text: ([j_id_text], [minutes])}
+    import arcpy
+    arcpy.nax.MakeNetworkDatasetLayer(input_network, "zone_sample_network")
+    odcm = arcpy.nax.OriginDestinationCostMatrix("zone_sample_network")
+    odcm.travelMode = travel_mode
+    odcm.timeUnits = arcpy.nax.TimeUnits.Minutes
+    odcm.defaultImpedanceCutoff = cutoff
+    odcm.lineShapeType = arcpy.nax.LineShapeType.NoLine
+    odcm.timeOfDay = time_of_day
+    destinations = arcpy.nax.OriginDestinationCostMatrixInputDataType.Destinations
+    field_mappings_j = odcm.fieldMappings(destinations, True, arcpy.ListFields(destinations_fc))
+    field_mappings_j["Name"].mappedFieldName = "j_id_text"
+    odcm.load(destinations, features = destinations_fc, field_mappings = field_mappings_j, append = False)
+    origins = arcpy.nax.OriginDestinationCostMatrixInputDataType.Origins
+    where = "i_id_text IN ("+", ".join(["'"+str(i_id).replace("'", "''")+"'" for i_id in i_ids])+")"
+    sample_layer = arcpy.management.MakeFeatureLayer(origins_fc, "zone_sample_origins", where)
+    field_mappings_i = odcm.fieldMappings(origins, True, arcpy.ListFields(origins_fc))
+    field_mappings_i["Name"].mappedFieldName = "i_id_text"
+    odcm.load(origins, features = sample_layer, field_mappings = field_mappings_i, append = False)
+    result = odcm.solve()
+    if not result.solveSucceeded:
+        raise Exception("Solving the destination zone sample failed: "+str(result.solverMessages(arcpy.nax.MessageSeverity.All)))
+    times = {}
+    with result.searchCursor(arcpy.nax.OriginDestinationCostMatrixOutputDataType.Lines,
+                             ["OriginName", "DestinationName", "Total_Time"]) as cursor:
+        for i_id, j_id, t_ij in cursor:
+            j_ids, t = times.setdefault(i_id, ([], []))
+            j_ids.append(j_id)
+            t.append(t_ij)
+    arcpy.management.Delete(sample_layer)
+    return times
+
+def worth_zoning(theta, reduction, min_reduction = MIN_REDUCTION):
+    # zones at theta 0 only merge co-located destinations, which endpoint
+    # deduplication does without turning off the cache
+    return theta > 0 and reduction >= min_reduction
+
+def zone_lookups(origins_fc, destinations_fc, o_j_dict, n_j_dict, tolerance, input_network, travel_mode, cutoff, time_of_day,
+                 selected_impedance_function, sample_size = 256, min_reduction = MIN_REDUCTION):
+    # reduced destination set of every origin batch for the accessibility
+    # calculator: ({batch_id: ({representative j_id_text: summed o_j},
+    # {representative j_id_text: destinations stood in for})}, theta,
+    # {measure: p95 error on the sample}, share of od rows within the cutoff
+    # saved, sampled origins). theta is calibrated on sample_size origins
+    # solved to every destination; the lookups are None when the zones are
+    # not worth using (worth_zoning)
+    import arcpy
+    import numpy as np
+    batches, i_ids = {}, {}
+    for batch_id, xy, i_id in arcpy.da.SearchCursor(origins_fc, ["batch_id", "SHAPE@XY", "i_id_text"]):
+        batches.setdefault(batch_id, []).append(xy)
+        i_ids.setdefault(batch_id, []).append(i_id)
+    j_ids, xy = [], []
+    for j_id, j_xy in arcpy.da.SearchCursor(destinations_fc, ["j_id_text", "SHAPE@XY"]):
+        if (o_j_dict.get(j_id) or 0) > 0:
+            j_ids.append(j_id)
+            xy.append(j_xy)
+    zones = DestinationZones(j_ids, [o_j_dict.get(j_id) for j_id in j_ids], xy)
+    picks = sample_origins(batches, sample_size)
+    times = solve_sample(origins_fc, destinations_fc, [i_ids[batch_id][k] for batch_id, pick in picks.items() for k in pick],
+                         input_network, travel_mode, cutoff, time_of_day)
+    j_codes = dict(zip(zones.j_ids, range(len(zones.j_ids))))
+    sample = {}
+    for batch_id, pick in picks.items():
+        sample[batch_id] = []
+        for k in pick:
+            reached, t_ij = times.get(i_ids[batch_id][k], ([], []))
+            keep = [n for n, j_id in enumerate(reached) if j_id in j_codes]
+            sample[batch_id].append((np.array([j_codes[reached[n]] for n in keep], dtype = np.int64),
+                                     np.array([t_ij[n] for n in keep], dtype = np.float64)))
+    theta, p95, reduction = choose_theta(zones, batches, sample, tolerance, np.inf if cutoff is None else float(cutoff),
+                                         selected_impedance_function)
+    n_sampled = sum([len(pick) for pick in picks.values()])
+    if not worth_zoning(theta, reduction, min_reduction):
+        return None, theta, p95, reduction, n_sampled
+    n_j = None if n_j_dict is None else [n_j_dict.get(j_id, 1) for j_id in j_ids]
+    lookups = {}
+    for batch_id, origin_xy in batches.items():
+        reps, o_j, counts = zones.batch_zones(origin_xy, theta, n_j)
+        rep_ids = [zones.j_ids[k] for k in reps]
+        lookups[batch_id] = (dict(zip(rep_ids, o_j.tolist())), dict(zip(rep_ids, counts.tolist())))
+    return lookups, theta, p95, reduction, n_sampled
+
+def format_zones(n_destinations, lookups, theta, p95, reduction, n_sampled):
+    errors = "p95 error on "+str(n_sampled)+" solved origins "+", ".join([f_name+" "+format(e, ".4f") for f_name, e in p95.items()])
+    if lookups is None:
+        if theta == 0:
+            reason = "no theta is within the tolerance"
+        else:
+            reason = ("theta "+str(theta)+" saves about "+str(round(100*reduction, 1))+"% of the od rows, less than "+
+                      str(round(100*MIN_REDUCTION))+"%")
+        return "not used, every batch solves to all "+str(n_destinations)+" destinations: "+reason+"; "+errors
+    sizes = [len(o_j) for o_j, n_j in lookups.values()]
+    return (str(n_destinations)+" destinations -> "+str(min(sizes))+" to "+str(max(sizes))+" zones per batch at theta "+
+            str(theta)+", about "+str(round(100*reduction, 1))+"% fewer od rows; "+errors)
+
+# ----- actual error on the NYC data -----
+
+def validate_nyc(od_path = "r5_ttm", tolerances = (0.01, 0.05), selected_impedance_function = ("CUMR45", "HN1997", "MGAUS180"),
+                 cutoff = 60, sample_size = 256):
+    # origins are the r5_ttm batches (blocks at their block group point);
+    # each batch is reduced to its zones and A_i recomputed from the r5 travel
+    # times to the representatives
+    import glob
+    import numpy as np
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyogrio
+    from endpoint_dedup import point_xy
+    from incremental_access import od_columns
+    from sampled_access import nyc_destinations
+    from travel_time_metrics import travel_time_metrics
+    selected_impedance_function = list(selected_impedance_function)
+    j_ids, o_j, xy = nyc_destinations(od_path)
+    meta, fids, geometry, fields = pyogrio.raw.read("data/Accessibility_Toolbox_NYC_Demo.gdb",
+                                                    sql = "SELECT GEOID10, ST_Area(Shape), ST_PointOnSurface(Shape) FROM NYC_SmartLocationDB",
+                                                    sql_dialect = "SQLITE")
+    group_xy = dict(zip(fields[0].tolist(), point_xy(geometry).tolist()))
+    # blocks sit at their block group point, so each stands for the group's area
+    group_radius = dict(zip(fields[0].tolist(), np.sqrt(fields[1]/np.pi).tolist()))
+    zones = DestinationZones(j_ids, o_j, xy, radius = [group_radius[j[:12]] for j in j_ids])
+    i_col, j_col, t_col = od_columns(ds.dataset(od_path, format = "parquet", partitioning = "hive").schema)
+    parts = sorted(glob.glob(os.path.join(od_path, "batch_id=*")), key = lambda p: int(p.split("=")[-1]))
+    batches = {}
+    for part in parts:
+        origins = ds.dataset(part, format = "parquet").to_table(columns = [i_col]).column(i_col).cast(pa.string()).unique().to_pylist()
+        origins = [i for i in origins if i[:12] in group_xy]
+        batches[part] = (origins, np.array([group_xy[i[:12]] for i in origins]))
+
+    print(str(len(j_ids))+" destinations, "+str(len(zones.levels))+" zone levels from "+str(round(zones.cell_size))+
+          " m cells, "+str(len(batches))+" origin batches")
+
+    # the solved sample: the r5 rows of the sampled origins
+    picks = sample_origins(dict([(k, v[0]) for k, v in batches.items()]), sample_size)
+    j_index = pa.array(zones.j_ids, pa.string())
+    sample = {}
+    for part, pick in picks.items():
+        origins = [batches[part][0][k] for k in pick]
+        table = ds.dataset(part, format = "parquet").to_table(columns = [i_col, j_col, t_col],
+                                                              filter = pc.field(i_col).isin(origins))
+        i_ids = table.column(i_col).cast(pa.string())
+        codes = pc.index_in(table.column(j_col).cast(pa.string()), value_set = j_index)
+        sample[part] = []
+        for i_id in origins:
+            keep = pc.and_(pc.equal(i_ids, i_id), pc.is_valid(codes))
+            sample[part].append((codes.filter(keep).to_numpy(zero_copy_only = False).astype(np.int64),
+                                 table.column(t_col).filter(keep).to_numpy(zero_copy_only = False).astype(np.float64)))
+
+    full, stats = travel_time_metrics(od_path, dict(zip(j_ids, o_j)), selected_impedance_function, k_values = ())
+    full = full.set_index("i_id")
+    for tolerance in tolerances:
+        start = time.perf_counter()
+        theta, p95, reduction = choose_theta(zones, dict([(k, v[1]) for k, v in batches.items()]), sample, tolerance,
+                                             cutoff, selected_impedance_function)
+        choose_s = time.perf_counter() - start
+        approx_parts, rows_full, rows_zones = [], 0, 0
+        for part, (origins, origin_xy) in batches.items():
+            reps, zone_o_j, counts = zones.batch_zones(origin_xy, theta)
+            rep_ids = pa.array([zones.j_ids[k] for k in reps], pa.string())
+            table = ds.dataset(part, format = "parquet").to_table(columns = [i_col, j_col, t_col])
+            rows_full += table.num_rows
+            codes = pc.index_in(table.column(j_col).cast(pa.string()), value_set = rep_ids)
+            table = table.filter(pc.is_valid(codes))
+            codes = codes.drop_null().to_numpy(zero_copy_only = False)
+            rows_zones += table.num_rows
+            df = pd.DataFrame({"i_id": table.column(i_col).to_pylist()})
+            t = table.column(t_col).to_numpy()
+            for f_name in selected_impedance_function:
+                df["SUM_Ai_"+f_name] = zone_o_j[codes]*access_core.impedance_array(t, f_name)
+            approx_parts.append(df.groupby("i_id").sum())
+        approx = pd.concat(approx_parts).reindex(full.index).fillna(0)
+        line = []
+        for f_name in selected_impedance_function:
+            a, e = full["SUM_Ai_"+f_name].to_numpy(), approx["SUM_Ai_"+f_name].to_numpy()
+            error = np.abs(e - a)[a > 0]/a[a > 0]
+            line.append(f_name+" p50 "+format(np.median(error), ".4f")+" p95 "+format(np.quantile(error, 0.95), ".4f")+
+                        " (sample p95 "+format(p95[f_name], ".4f")+")")
+        print("tolerance "+str(tolerance)+": theta "+str(theta)+" ("+str(round(choose_s, 1))+" s to choose on "+
+              str(sum([len(pick) for pick in picks.values()]))+" origins), od rows "+str(rows_zones)+" of "+str(rows_full)+
+              " ("+str(round(rows_full/max(rows_zones, 1), 2))+"x fewer; sample "+str(round(1/max(1 - reduction, 1e-9), 2))+
+              "x"+("" if worth_zoning(theta, reduction) else ", too few for the tool to use zones")+
+              "); actual error "+"; ".join(line))
+
+if __name__ == '__main__':
+    validate_nyc(sys.argv[1] if len(sys.argv) > 1 else "r5_ttm")
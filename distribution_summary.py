@@ -0,0 +1,480 @@
+# Distributional Summaries of Accessibility
+# Christopher D. Higgins
+# Department of Human Geography
+# University of Toronto Scarborough
+# https://higgicd.github.io
+# tool help can be found at https://github.com/higgicd/Accessibility_Toolbox
+
+# population weighted distributions of accessibility (deciles, gini, palma
+# ratio, share of people below a threshold) by region and demographic group
+# for every measure and scenario, without collecting the results in memory.
+# accessibility tables (i_id plus SUM_Ai_<measure> or any other per-origin
+# column) are read as a stream of record batches and joined to an origin
+# attribute table holding a region field and one weight field per
+# demographic group (people of that group living at the origin). every
+# scenario x region x group x measure keeps
+#   exact moments   total weight, origins, weighted mean and variance (merged
+#                   with the parallel formulas), min, max and the weight below
+#                   every declared threshold
+#   a digest        a merging t-digest of the weighted values: at most about
+#                   compression/2 centroids, small near both tails, so
+#                   quantiles, any other share below and the lorenz curve
+#                   (gini, palma) come from a few kilobytes per distribution
+# summaries of different files, batches or workers merge exactly for the
+# moments and approximately, with the same error bound, for the digests.
+# origins in the attribute table but not in an accessibility table (the tools
+# leave out origins that reach nothing) count with missing_value, 0 by default
+#
+# usage: python distribution_summary.py am.parquet pm.parquet --attributes origins.csv
+#            --region county --weights pop pop_low_income --thresholds 1000 10000 --output report.csv
+#        python benchmarks/bench_distribution.py  (accuracy and memory against exact computation)
+
+import os
+import json
+import time
+import argparse
+import multiprocessing
+import access_core
+from memory_budget import MemoryBudget, scan_rows, governed_map
+
+DECILES = (10, 20, 30, 40, 50, 60, 70, 80, 90)
+ALL_REGIONS = "ALL"
+
+# ----- weighted t-digest -----
+
+class WeightedDigest(object):
+    # centroids (mean, weight) sorted by mean plus a buffer of raw values,
+    # compressed with the k1 scale function of the merging t-digest
+    def __init__(self, compression = 200, buffer_size = None):
+        import numpy as np
+        self.compression = compression
+        self.buffer_size = buffer_size or 10*compression
+        self.means = np.zeros(0)
+        self.weights = np.zeros(0)
+        self.buffer = []
+        self.buffered = 0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add(self, values, weights):
+        # weighted values; zero weights and nan values are dropped
+        import numpy as np
+        values, weights = np.asarray(values, dtype = np.float64), np.asarray(weights, dtype = np.float64)
+        keep = (weights > 0) & ~np.isnan(values)
+        if not keep.all():
+            values, weights = values[keep], weights[keep]
+        if len(values) == 0:
+            return
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self.buffer.append((values, weights))
+        self.buffered += len(values)
+        if self.buffered >= self.buffer_size:
+            self.compress()
+
+    def compress(self):
+        import numpy as np
+        if not self.buffer:
+            return
+        means = np.concatenate([self.means] + [v for v, w in self.buffer])
+        weights = np.concatenate([self.weights] + [w for v, w in self.buffer])
+        self.buffer, self.buffered = [], 0
+        # a stable sort merges the already sorted runs quickly
+        order = np.argsort(means, kind = "stable")
+        means, weights = means[order], weights[order]
+        total = weights.sum()
+        q = (np.cumsum(weights) - weights/2)/total
+        k = self.compression/(2*np.pi)*np.arcsin(np.clip(2*q - 1, -1, 1))
+        groups = np.floor(k).astype(np.int64)
+        groups -= groups[0]
+        new_weights = np.bincount(groups, weights = weights)
+        used = new_weights > 0
+        self.means = (np.bincount(groups, weights = weights*means)[used]/new_weights[used])
+        self.weights = new_weights[used]
+
+    def merge(self, other):
+        other.compress()
+        if len(other.weights):
+            self.buffer.append((other.means, other.weights))
+            self.buffered += len(other.weights)
+            self.min, self.max = min(self.min, other.min), max(self.max, other.max)
+        self.compress()
+        return self
+
+    def total(self):
+        self.compress()
+        return float(self.weights.sum())
+
+    def knots(self):
+        # piecewise linear quantile function through (cumulative weight share,
+        # value): min at 0, each centroid mean at its centre, max at 1
+        import numpy as np
+        self.compress()
+        total = self.weights.sum()
+        centres = (np.cumsum(self.weights) - self.weights/2)/total
+        return np.concatenate([[0.0], centres, [1.0]]), np.concatenate([[self.min], self.means, [self.max]])
+
+    def quantile(self, q):
+        import numpy as np
+        if len(self.weights) == 0 and not self.buffer:
+            return np.full(np.shape(q), np.nan)
+        p, x = self.knots()
+        return np.interp(q, p, x)
+
+    def share_below(self, x):
+        # share of the weight with a value below x
+        import numpy as np
+        if len(self.weights) == 0 and not self.buffer:
+            return np.full(np.shape(x), np.nan)
+        p, values = self.knots()
+        return np.where(np.asarray(x) <= self.min, 0.0, np.where(np.asarray(x) > self.max, 1.0, np.interp(x, values, p)))
+
+    def lorenz(self):
+        # (weight share, value share) at the centroid boundaries. a centroid
+        # holds the exact sum of its values, so the lorenz curve is exact at
+        # its knots and only the spread inside a centroid is lost
+        import numpy as np
+        self.compress()
+        p = np.concatenate([[0.0], np.cumsum(self.weights)])/self.weights.sum()
+        value = np.concatenate([[0.0], np.cumsum(self.means*self.weights)])
+        return p, value/value[-1] if value[-1] > 0 else np.full(len(value), np.nan)
+
+    def gini(self):
+        import numpy as np
+        if len(self.weights) == 0 and not self.buffer:
+            return np.nan
+        p, value = self.lorenz()
+        return float(1 - (np.diff(p)*(value[1:] + value[:-1])).sum())
+
+    def palma(self):
+        # value share of the top 10% over the value share of the bottom 40%
+        import numpy as np
+        if len(self.weights) == 0 and not self.buffer:
+            return np.nan
+        p, value = self.lorenz()
+        bottom = np.interp(0.4, p, value)
+        return float((1 - np.interp(0.9, p, value))/bottom) if bottom > 0 else np.nan
+
+    def nbytes(self):
+        return self.means.nbytes + self.weights.nbytes + sum([v.nbytes + w.nbytes for v, w in self.buffer])
+
+    def to_dict(self):
+        self.compress()
+        return {"compression": self.compression, "min": self.min, "max": self.max,
+                "means": self.means.tolist(), "weights": self.weights.tolist()}
+
+    @classmethod
+    def from_dict(cls, d):
+        import numpy as np
+        digest = cls(d["compression"])
+        digest.min, digest.max = d["min"], d["max"]
+        digest.means, digest.weights = np.array(d["means"], dtype = np.float64), np.array(d["weights"], dtype = np.float64)
+        return digest
+
+# ----- one distribution -----
+
+class DistributionSummary(object):
+    # exact moments and threshold shares plus a digest of one weighted distribution
+    def __init__(self, thresholds = (), compression = 200):
+        import numpy as np
+        self.thresholds = tuple(thresholds)
+        self.weight = 0.0
+        self.origins = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.below = np.zeros(len(self.thresholds))
+        self.missing = 0.0
+        self.digest = WeightedDigest(compression)
+
+    def combine(self, weight, origins, mean, m2, below):
+        # parallel update of the weighted mean and sum of squared deviations
+        if weight <= 0:
+            return
+        total = self.weight + weight
+        delta = mean - self.mean
+        self.mean += delta*weight/total
+        self.m2 += m2 + delta**2*self.weight*weight/total
+        self.weight = total
+        self.origins += origins
+        self.below += below
+
+    def add(self, values, weights):
+        import numpy as np
+        values, weights = np.asarray(values, dtype = np.float64), np.asarray(weights, dtype = np.float64)
+        missing = np.isnan(values)
+        if missing.any():
+            self.missing += float(weights[missing].sum())
+            values, weights = values[~missing], weights[~missing]
+        keep = weights > 0
+        values, weights = values[keep], weights[keep]
+        weight = float(weights.sum())
+        if weight <= 0:
+            return
+        mean = float((weights*values).sum()/weight)
+        m2 = float((weights*(values - mean)**2).sum())
+        below = np.array([weights[values < t].sum() for t in self.thresholds])
+        self.combine(weight, len(values), mean, m2, below)
+        self.digest.add(values, weights)
+
+    def merge(self, other):
+        self.combine(other.weight, other.origins, other.mean, other.m2, other.below)
+        self.missing += other.missing
+        self.digest.merge(other.digest)
+        return self
+
+    def row(self):
+        import numpy as np
+        row = {"WEIGHT": self.weight, "ORIGINS": self.origins, "MISSING_WEIGHT": self.missing,
+               "MEAN": self.mean if self.weight > 0 else np.nan,
+               "SD": float(np.sqrt(self.m2/self.weight)) if self.weight > 0 else np.nan,
+               "MIN": self.digest.min if self.weight > 0 else np.nan,
+               "MAX": self.digest.max if self.weight > 0 else np.nan}
+        for q, value in zip(DECILES, self.digest.quantile(np.array(DECILES)/100.0).tolist()):
+            row["P"+str(q)] = value
+        row["GINI"] = self.digest.gini()
+        row["PALMA"] = self.digest.palma()
+        for t, below in zip(self.thresholds, self.below.tolist()):
+            row["BELOW_"+threshold_label(t)] = below/self.weight if self.weight > 0 else np.nan
+        return row
+
+    def to_dict(self):
+        return {"thresholds": list(self.thresholds), "weight": self.weight, "origins": self.origins, "mean": self.mean,
+                "m2": self.m2, "below": self.below.tolist(), "missing": self.missing, "digest": self.digest.to_dict()}
+
+    @classmethod
+    def from_dict(cls, d):
+        import numpy as np
+        summary = cls(d["thresholds"], d["digest"]["compression"])
+        summary.weight, summary.origins, summary.mean, summary.m2 = d["weight"], d["origins"], d["mean"], d["m2"]
+        summary.below, summary.missing = np.array(d["below"], dtype = np.float64), d["missing"]
+        summary.digest = WeightedDigest.from_dict(d["digest"])
+        return summary
+
+def threshold_label(t):
+    # BELOW_1000, BELOW_2_5
+    return str(int(t)) if float(t).is_integer() else str(t).replace(".", "_")
+
+# ----- scenario x region x group x measure -----
+
+class DistributionSet(object):
+    # DistributionSummary per (scenario, region, group, measure)
+    def __init__(self, thresholds = (), compression = 200):
+        self.thresholds = tuple(thresholds)
+        self.compression = compression
+        self.summaries = {}
+
+    def get(self, key):
+        if key not in self.summaries:
+            self.summaries[key] = DistributionSummary(self.thresholds, self.compression)
+        return self.summaries[key]
+
+    def merge(self, other):
+        for key, summary in other.summaries.items():
+            self.get(key).merge(summary)
+        return self
+
+    def nbytes(self):
+        return sum([s.digest.nbytes() for s in self.summaries.values()])
+
+    def report(self):
+        # one row per distribution, sorted by its key
+        import pandas as pd
+        rows = []
+        for key in sorted(self.summaries, key = lambda k: tuple([str(x) for x in k])):
+            rows.append(dict(zip(["SCENARIO", "REGION", "GROUP", "MEASURE"], key), **self.summaries[key].row()))
+        return pd.DataFrame(rows)
+
+    def save(self, path):
+        # json that can be merged with the sets of other runs
+        with open(path, "w") as f:
+            json.dump({"thresholds": list(self.thresholds), "compression": self.compression,
+                       "summaries": [{"key": list(key), "summary": s.to_dict()} for key, s in self.summaries.items()]}, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            d = json.load(f)
+        distributions = cls(d["thresholds"], d["compression"])
+        for item in d["summaries"]:
+            distributions.summaries[tuple(item["key"])] = DistributionSummary.from_dict(item["summary"])
+        return distributions
+
+# ----- origin attributes -----
+
+class OriginAttributes(object):
+    # region code and group weights of every origin, in i_id order
+    def __init__(self, i_ids, regions = None, weights = None):
+        import numpy as np
+        import pyarrow as pa
+        self.ids = pa.array([str(x) for x in i_ids], pa.string())
+        n = len(self.ids)
+        if regions is None:
+            self.region_names, self.region_codes = [], np.zeros(n, dtype = np.int64)
+        else:
+            names, codes = access_core.encode_ids([str(x) for x in regions])
+            self.region_names, self.region_codes = names.tolist(), codes.astype(np.int64)
+        if not weights:
+            weights = {"ORIGINS": np.ones(n)}
+        self.groups = list(weights.keys())
+        self.weights = np.column_stack([np.nan_to_num(np.asarray(w, dtype = np.float64)) for w in weights.values()])
+
+    def __len__(self):
+        return len(self.ids)
+
+def read_attributes(path, id_field = "i_id", region_field = None, weight_fields = ()):
+    # parquet or csv with an origin id, an optional region and weight fields
+    import pandas as pd
+    df = pd.read_csv(path, dtype = {id_field: str}) if path.lower().endswith(".csv") else pd.read_parquet(path)
+    missing = [f for f in [id_field, region_field] + list(weight_fields) if f is not None and f not in df.columns]
+    if missing:
+        raise Exception(str(path)+" has no "+", ".join(missing)+" field")
+    return OriginAttributes(df[id_field].astype(str), df[region_field] if region_field else None,
+                            dict([(f, df[f].to_numpy()) for f in weight_fields]))
+
+# ----- streaming -----
+
+_attributes = None
+
+def summary_setup(attributes):
+    # pool initializer: the origin attributes are sent once per worker
+    global _attributes
+    _attributes = attributes
+
+def add_batch(distributions, scenario, attributes, rows, columns):
+    # rows: attribute rows of the batch; columns: {measure: values}
+    import numpy as np
+    regions = attributes.region_codes[rows]
+    weights = attributes.weights[rows]
+    for measure, values in columns.items():
+        # sorted once by region and value; every slice then arrives sorted
+        order = np.lexsort((values, regions))
+        values_sorted, regions_sorted, weights_sorted = values[order], regions[order], weights[order]
+        bounds = np.searchsorted(regions_sorted, np.arange(len(attributes.region_names) + 1))
+        for g, group in enumerate(attributes.groups):
+            if attributes.region_names:
+                for r, region in enumerate(attributes.region_names):
+                    start, stop = bounds[r], bounds[r + 1]
+                    if stop > start:
+                        distributions.get((scenario, region, group, measure)).add(values_sorted[start:stop],
+                                                                                  weights_sorted[start:stop, g])
+            distributions.get((scenario, ALL_REGIONS, group, measure)).add(values[order], weights_sorted[:, g])
+
+def summarize_table(job):
+    # (path, scenario, measures, thresholds, compression, batch_size) ->
+    # (DistributionSet, packed bits of the attribute rows seen, unmatched rows)
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+    path, scenario, measures, thresholds, compression, batch_size = job
+    attributes = _attributes
+    distributions = DistributionSet(thresholds, compression)
+    seen = np.zeros(len(attributes), dtype = bool)
+    unmatched = 0
+    if path.lower().endswith(".csv"):
+        import pyarrow.csv as pcsv
+        batches = pcsv.open_csv(path, convert_options = pcsv.ConvertOptions(column_types = {"i_id": pa.string()}))
+    else:
+        batches = pq.ParquetFile(path).iter_batches(batch_size = batch_size, columns = ["i_id"] + list(measures))
+    for batch in batches:
+        rows = pc.index_in(batch.column(batch.schema.get_field_index("i_id")).cast(pa.string()), value_set = attributes.ids)
+        matched = pc.is_valid(rows).to_numpy(zero_copy_only = False)
+        unmatched += int((~matched).sum())
+        rows = rows.to_numpy(zero_copy_only = False)[matched].astype(np.int64)
+        seen[rows] = True
+        columns = dict([(m, batch.column(batch.schema.get_field_index(m)).to_numpy(zero_copy_only = False)
+                         .astype(np.float64)[matched]) for m in measures])
+        add_batch(distributions, scenario, attributes, rows, columns)
+    return distributions, np.packbits(seen), unmatched
+
+def table_measures(path):
+    # numeric columns of an accessibility table other than i_id
+    import pyarrow.parquet as pq
+    if path.lower().endswith(".csv"):
+        import pyarrow.csv as pcsv
+        schema = pcsv.open_csv(path).schema
+    else:
+        schema = pq.read_schema(path)
+    return [f.name for f in schema if f.name != "i_id" and (str(f.type).startswith(("int", "uint", "float", "double")))]
+
+def summarize(tables, attributes, measures = None, thresholds = (), compression = 200, missing_value = 0.0,
+              processes = None, batch_size = None):
+    # tables: {scenario: path or [paths]}; every path is read as a stream in
+    # its own job and the sets of a scenario are merged; record batches are
+    # batch_size rows, from the memory budget by default. returns the merged
+    # DistributionSet and run statistics
+    import numpy as np
+    start = time.time()
+    if batch_size is None:
+        batch_size = scan_rows("summary", 262144)
+    jobs = []
+    for scenario, paths in tables.items():
+        for path in ([paths] if isinstance(paths, str) else paths):
+            jobs.append((path, scenario, list(measures or table_measures(path)), tuple(thresholds), compression, batch_size))
+    if processes is None:
+        processes = access_core.cpu_count(multiprocessing.cpu_count())
+    processes = max(1, min(processes, len(jobs)))
+    if processes == 1:
+        summary_setup(attributes)
+        results = [summarize_table(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(processes = processes, initializer = summary_setup, initargs = (attributes,))
+        results = governed_map(pool, summarize_table, jobs, processes)
+        pool.close()
+        pool.join()
+
+    distributions = DistributionSet(thresholds, compression)
+    seen, unmatched = {}, 0
+    for job, (job_distributions, job_seen, job_unmatched) in zip(jobs, results):
+        distributions.merge(job_distributions)
+        scenario = job[1]
+        seen[scenario] = seen.get(scenario, np.zeros_like(job_seen)) | job_seen
+        unmatched += job_unmatched
+    # origins left out of a table reached nothing there
+    filled = 0
+    if missing_value is not None:
+        scenario_measures = {}
+        for job in jobs:
+            scenario_measures.setdefault(job[1], [])
+            scenario_measures[job[1]] += [m for m in job[2] if m not in scenario_measures[job[1]]]
+        for scenario, bits in seen.items():
+            rows = np.flatnonzero(~np.unpackbits(bits, count = len(attributes)).astype(bool))
+            filled += len(rows)
+            if len(rows):
+                add_batch(distributions, scenario, attributes, rows,
+                          dict([(m, np.full(len(rows), float(missing_value))) for m in scenario_measures[scenario]]))
+    for summary in distributions.summaries.values():
+        summary.digest.compress()
+    stats = {"jobs": len(jobs), "processes": processes, "distributions": len(distributions.summaries),
+             "unmatched_rows": unmatched, "filled_origins": filled, "sketch_mb": distributions.nbytes()/1048576,
+             "seconds": time.time() - start}
+    return distributions, stats
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Weighted distribution summaries of accessibility tables")
+    parser.add_argument("tables", nargs = "+", help = "accessibility tables (parquet or csv), one scenario each, named by file")
+    parser.add_argument("--attributes", required = True, help = "origins table with the id, region and weight fields")
+    parser.add_argument("--id-field", default = "i_id")
+    parser.add_argument("--region")
+    parser.add_argument("--weights", nargs = "*", default = [], help = "one weight field per demographic group")
+    parser.add_argument("--measures", nargs = "*")
+    parser.add_argument("--thresholds", nargs = "*", type = float, default = [])
+    parser.add_argument("--compression", type = int, default = 200)
+    parser.add_argument("--processes", type = int)
+    parser.add_argument("--output", default = "distribution_report.csv")
+    parser.add_argument("--sketches", help = "json of the merged sketches, for merging with later runs")
+    parser.add_argument("--memory-budget", type = float, help = "megabytes for the run, see memory_budget.py")
+    args = parser.parse_args()
+    if args.memory_budget is not None:
+        MemoryBudget(args.memory_budget, args.processes or access_core.cpu_count(multiprocessing.cpu_count())).publish()
+    attributes = read_attributes(args.attributes, args.id_field, args.region, args.weights)
+    tables = dict([(os.path.splitext(os.path.basename(path))[0], path) for path in args.tables])
+    distributions, stats = summarize(tables, attributes, args.measures, args.thresholds, args.compression,
+                                     processes = args.processes)
+    distributions.report().to_csv(args.output, index = False)
+    if args.sketches:
+        distributions.save(args.sketches)
+    print(str(stats["distributions"])+" distributions from "+str(stats["jobs"])+" tables in "+
+          str(round(stats["seconds"], 1))+" s, "+str(round(stats["sketch_mb"], 2))+" MB of sketches, "+
+          str(stats["filled_origins"])+" origins not in a table counted as 0, "+str(stats["unmatched_rows"])+
+          " rows without attributes; report in "+args.output)
@@ -0,0 +1,237 @@
+# Co-located Endpoint Deduplication
+# Christopher D. Higgins
+# Department of Human Geography
+# University of Toronto Scarborough
+# https://higgicd.github.io
+# tool help can be found at https://github.com/higgicd/Accessibility_Toolbox
+
+# origins or destinations that snap to the same network location get the
+# same row or column of the od matrix, so only one of each group needs to be
+# solved. endpoints are grouped by their network location (the fields
+# CalculateLocations writes) or by coordinates within a tolerance; the first
+# endpoint of each group is solved and the results fan back out to every
+# member at accessibility or export time. on the destination side the
+# accessibility calculator sums the opportunities of a group instead, which
+# gives the same A_i. not used when i == j rows are deleted, since that needs
+# the original origin/destination pairs
+#
+# usage: python endpoint_dedup.py  (matrix size reduction on the bundled NYC data)
+
+import os
+import math
+import time
+
+# network location: same edge, same position along it. side of edge only
+# matters with curb approaches, which the tools do not set
+NETWORK_KEY_FIELDS = ["SourceID", "SourceOID", "PosAlong"]
+
+# ----- grouping -----
+
+def network_keys(rows):
+    # rows of (SourceID, SourceOID, PosAlong); unlocated points stay on their own
+    keys = []
+    for k, row in enumerate(rows):
+        if row[0] is None or row[0] < 0:
+            keys.append(("unlocated", k))
+        else:
+            keys.append((row[0], row[1], round(row[2], 6)))
+    return keys
+
+def grid_keys(xy, tolerance):
+    # points in the same tolerance-sized cell are co-located
+    return [(math.floor(x/tolerance), math.floor(y/tolerance)) for x, y in xy]
+
+def group_codes(keys):
+    # group code per endpoint and the index of each group's first endpoint
+    code_of = {}
+    codes = []
+    reps = []
+    for k, key in enumerate(keys):
+        code = code_of.get(key)
+        if code is None:
+            code = code_of[key] = len(reps)
+            reps.append(k)
+        codes.append(code)
+    return codes, reps
+
+def group_members(ids, codes, reps):
+    # {representative id: [member ids, representative first]}
+    members = dict([(ids[k], []) for k in reps])
+    for k, code in enumerate(codes):
+        members[ids[reps[code]]].append(ids[k])
+    return members
+
+def matrix_reduction(n_i, u_i, n_j, u_j):
+    cells = n_i*n_j
+    unique_cells = u_i*u_j
+    return {"origins": n_i, "unique_origins": u_i, "destinations": n_j, "unique_destinations": u_j,
+            "cells": cells, "unique_cells": unique_cells,
+            "reduction": 1 - unique_cells/cells if cells else 0.0}
+
+def format_reduction(stats):
+    return (str(stats["origins"])+" -> "+str(stats["unique_origins"])+" origins, "+
+            str(stats["destinations"])+" -> "+str(stats["unique_destinations"])+" destinations: "+
+            str(stats["cells"])+" -> "+str(stats["unique_cells"])+" od pairs ("+
+            str(round(100*stats["reduction"], 1))+"% smaller)")
+
+# ----- fan out -----
+
+def expand_id_table(path, id_field, members):
+    # a worker's ObjectID -> id lookup with one row per group member, so the
+    # id merge in access_core.read_batch_lines fans the lines out
+    import pandas as pd
+    ids = pd.read_parquet(path)
+    dtype = ids[id_field].dtype
+    ids[id_field] = [members.get(v, [v]) for v in ids[id_field]]
+    ids = ids.explode(id_field, ignore_index = True)
+    ids[id_field] = ids[id_field].astype(dtype)
+    ids.to_parquet(path, index = False)
+    return len(ids)
+
+# ----- arcpy -----
+
+def dedup_features(input_fc, input_type, key_field, mode = "network", value_field = None):
+    # copies the first endpoint of every group to <input_type>_unique and
+    # returns (unique_fc, {representative key_field value: members}, group
+    # sizes by representative). mode is "network" or a distance in the units
+    # of the feature class. value_field (o_j) is summed over each group
+    import arcpy
+    existing = [f.name for f in arcpy.ListFields(input_fc)]
+    if mode == "network":
+        missing = [f for f in NETWORK_KEY_FIELDS if f not in existing]
+        if missing:
+            raise Exception(str(input_type)+" has no network location fields "+str(missing)+" to group by")
+        fields = [key_field] + NETWORK_KEY_FIELDS
+    else:
+        fields = [key_field, "SHAPE@XY"]
+    rows = list(arcpy.da.SearchCursor(input_fc, fields))
+    ids = [r[0] for r in rows]
+    if mode == "network":
+        keys = network_keys([r[1:] for r in rows])
+    else:
+        keys = grid_keys([r[1] for r in rows], float(mode))
+    codes, reps = group_codes(keys)
+    members = group_members(ids, codes, reps)
+
+    # flag the representatives, sum the values of each group into them
+    totals = None
+    if value_field is not None:
+        totals = [0.0]*len(reps)
+        for k, r in enumerate(arcpy.da.SearchCursor(input_fc, [value_field])):
+            totals[codes[k]] += r[0] or 0
+    arcpy.management.AddField(input_fc, "dedup_rep", "SHORT")
+    rep_set = set(reps)
+    update_fields = ["dedup_rep"] + ([value_field] if value_field is not None else [])
+    with arcpy.da.UpdateCursor(input_fc, update_fields) as updateRows:
+        for k, updateRow in enumerate(updateRows):
+            updateRow[0] = 1 if k in rep_set else 0
+            if k in rep_set and value_field is not None:
+                updateRow[1] = totals[codes[k]]
+            updateRows.updateRow(updateRow)
+    arcpy.conversion.FeatureClassToFeatureClass(input_fc, os.path.dirname(input_fc), os.path.basename(input_fc)+"_unique",
+                                                "dedup_rep = 1")
+    arcpy.management.DeleteField(input_fc, "dedup_rep")
+    unique_fc = input_fc+"_unique"
+    arcpy.management.DeleteField(unique_fc, "dedup_rep")
+    sizes = dict([(rep, len(m)) for rep, m in members.items()])
+    arcpy.AddMessage(input_type+": "+str(len(ids))+" endpoints at "+str(len(reps))+" unique locations")
+    return unique_fc, members, sizes
+
+def fan_out_rows(table, key_field, members):
+    # copies every row of a representative to the other members of its group
+    import arcpy
+    fields = [f.name for f in arcpy.ListFields(table) if f.type not in ("OID", "Geometry") and f.editable]
+    key = fields.index(key_field)
+    new_rows = []
+    with arcpy.da.SearchCursor(table, fields) as cursor:
+        for row in cursor:
+            for member in members.get(row[key], [row[key]])[1:]:
+                new_row = list(row)
+                new_row[key] = member
+                new_rows.append(new_row)
+    with arcpy.da.InsertCursor(table, fields) as insertRows:
+        for new_row in new_rows:
+            insertRows.insertRow(new_row)
+    return len(new_rows)
+
+# ----- bundled data -----
+
+def point_xy(wkb):
+    # x, y of 2d wkb points
+    import numpy as np
+    raw = np.frombuffer(b"".join(wkb), dtype = np.uint8).reshape(len(wkb), 21)
+    return raw[:, 5:21].copy().view("<f8")
+
+def nearest_points(xy, targets, chunk = 256):
+    # index of and distance to the nearest target of every point
+    import numpy as np
+    index = np.empty(len(xy), dtype = np.int64)
+    distance = np.empty(len(xy))
+    for start in range(0, len(xy), chunk):
+        d = ((xy[start:start+chunk, None, :] - targets[None, :, :])**2).sum(axis = 2)
+        index[start:start+chunk] = d.argmin(axis = 1)
+        distance[start:start+chunk] = np.sqrt(d.min(axis = 1))
+    return index, distance
+
+def nyc_report(gdb = "data/Accessibility_Toolbox_NYC_Demo.gdb", tolerances = (25, 50, 100, 250), search_tolerance = 5000):
+    # block groups of the NYC demo (origins; destinations have jobs) grouped by
+    # nearest junction of the walking network, which stands in for the
+    # network location without arcpy, and by coordinates within a tolerance
+    import pyogrio
+    meta, fids, geometry, fields = pyogrio.raw.read(gdb, sql = "SELECT GEOID10, EMPTOT, ST_PointOnSurface(Shape) FROM NYC_SmartLocationDB",
+                                                    sql_dialect = "SQLITE")
+    xy = point_xy(geometry)
+    jobs = fields[1] > 0
+    junctions = point_xy(pyogrio.raw.read(gdb, layer = "WalkingNetwork_ND_Junctions")[2])
+    start = time.perf_counter()
+    nearest, distance = nearest_points(xy, junctions)
+    keys = [("unlocated", k) if distance[k] > search_tolerance else int(nearest[k]) for k in range(len(xy))]
+    print("NYC block groups: "+str(len(xy))+" origins, "+str(int(jobs.sum()))+" destinations with jobs, "+
+          str(len(junctions))+" network junctions ("+str(round(time.perf_counter() - start, 1))+" s to snap)")
+    def report(label, keys):
+        u_i = len(set(keys))
+        u_j = len(set([key for key, has_jobs in zip(keys, jobs) if has_jobs]))
+        print(label.ljust(24)+format_reduction(matrix_reduction(len(keys), u_i, int(jobs.sum()), u_j)))
+    report("nearest junction", keys)
+    for tolerance in tolerances:
+        report(str(tolerance)+" m grid", grid_keys(xy.tolist(), tolerance))
+
+def r5_duplicates(od_path = "r5_ttm"):
+    # endpoints of an existing od matrix with identical rows (or columns):
+    # what a solver would have deduplicated
+    import numpy as np
+    import pandas as pd
+    import pyarrow.dataset as ds
+    from incremental_access import od_columns
+    dataset = ds.dataset(od_path, format = "parquet", partitioning = "hive")
+    i, j, t = od_columns(dataset.schema)
+    k1 = np.uint64(0x9E3779B97F4A7C15)
+    k2 = np.uint64(0xC2B2AE3D27D4EB4F)
+    def mix(h, t):
+        # order-independent per-endpoint signature: sum of mixed (other end, time) hashes
+        x = (h ^ (t.astype(np.uint64)*k2))*k1
+        return x ^ (x >> np.uint64(29))
+    origin_parts = []
+    destination_parts = []
+    rows = 0
+    with np.errstate(over = "ignore"):
+        for fragment in dataset.get_fragments():
+            table = fragment.to_table(columns = [i, j, t])
+            from_ids = table.column(i).to_pandas()
+            to_ids = table.column(j).to_pandas()
+            times = table.column(t).to_numpy()
+            from_hash = pd.util.hash_pandas_object(from_ids, index = False).to_numpy()
+            to_hash = pd.util.hash_pandas_object(to_ids, index = False).to_numpy()
+            origin_parts.append(pd.DataFrame({"id": from_ids, "h": mix(to_hash, times)}).groupby("id")["h"].agg(["sum", "size"]))
+            destination_parts.append(pd.DataFrame({"id": to_ids, "h": mix(from_hash, times)}).groupby("id")["h"].agg(["sum", "size"]))
+            rows += table.num_rows
+        origins = pd.concat(origin_parts).groupby(level = 0).sum()
+        destinations = pd.concat(destination_parts).groupby(level = 0).sum()
+    stats = matrix_reduction(len(origins), origins.groupby(["sum", "size"]).ngroups,
+                             len(destinations), destinations.groupby(["sum", "size"]).ngroups)
+    print("r5_ttm identical rows".ljust(24)+format_reduction(stats)+", "+str(rows)+" od rows")
+    return stats
+
+if __name__ == '__main__':
+    nyc_report()
+    r5_duplicates()
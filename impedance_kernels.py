@@ -0,0 +1,420 @@
+# Impedance Measures from Math Expressions
+# Christopher D. Higgins
+# Department of Human Geography
+# University of Toronto Scarborough
+# https://higgicd.github.io
+# tool help can be found at https://github.com/higgicd/Accessibility_Toolbox
+
+# impedance measures defined as restricted math expressions of the travel time
+# t (minutes) in a json file instead of python in parameters.py:
+#   {"measures": {"EXP10_60": {"expression": "exp(-b*t) * (t <= 60)", "parameters": {"b": 0.1}},
+#                 "GAUSS_PEAK": {"expression": "exp(-(t - 10)**2/50)", "monotone": false}}}
+# an expression may only use numbers, t, its parameters, pi and e, the
+# operators + - * / ** and comparisons (true is 1), and/or/not, x if c else y
+# and the functions exp, log, log1p, sqrt, abs, floor, ceil, min, max, where
+# and clip. anything else (names, attributes, subscripts, strings, lambdas)
+# is rejected before the expression is compiled into a numpy kernel over an
+# array of travel times.
+# every kernel is validated once over 0 to 1440 minutes: it must be finite
+# and non-negative, and non-increasing unless "monotone": false; its
+# effective support (where it drops below 1e-6 of its maximum) can replace a
+# cutoff. kernels are cached by the hash of the expression and parameters in
+# memory and as marshalled code in a cache folder, so workers load the
+# compiled code and never parse an expression again.
+# the measures file is measures.json next to this file, or the file named by
+# the ACCESS_MEASURES environment variable (set by load_measures so spawned
+# workers see it). access_core.impedance_array uses a kernel for any measure
+# name defined there, so every tool and helper can use them like the
+# parameters.py measures
+#
+# usage: python impedance_kernels.py [measures.json]  (validates and reports every measure)
+#        python impedance_kernels.py --check           (expressions of the parameters.py measures against it)
+
+import os, sys
+import ast
+import json
+import time
+import marshal
+import hashlib
+import tempfile
+
+MEASURES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "measures.json")
+T_MAX = 1440.0
+T_STEP = 0.01
+SUPPORT_TOLERANCE = 1e-6
+MAX_EXPRESSION_LENGTH = 1000
+FUNCTIONS = {"exp": ("exp", 1), "log": ("log", 1), "log1p": ("log1p", 1), "sqrt": ("sqrt", 1), "abs": ("abs", 1),
+             "floor": ("floor", 1), "ceil": ("ceil", 1), "min": ("minimum", 2), "max": ("maximum", 2),
+             "where": ("where", 3), "clip": ("clip", 3)}
+CONSTANTS = {"pi": 3.141592653589793, "e": 2.718281828459045}
+BINARY_OPS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow)
+COMPARE_OPS = (ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.Eq, ast.NotEq)
+
+# ----- parsing -----
+
+class ExpressionCompiler(ast.NodeTransformer):
+    # rejects every node outside the whitelist, puts in the parameters and
+    # turns comparisons, boolean operators and conditionals into their
+    # elementwise numpy functions
+    def __init__(self, name, parameters):
+        self.name = name
+        self.parameters = parameters
+
+    def fail(self, node, what):
+        raise Exception(self.name+": "+what+" is not allowed in an impedance expression")
+
+    def call(self, function, args):
+        return ast.Call(func = ast.Name(id = "_"+function, ctx = ast.Load()), args = args, keywords = [])
+
+    def generic_visit(self, node):
+        self.fail(node, type(node).__name__)
+
+    def visit_Expression(self, node):
+        node.body = self.visit(node.body)
+        return node
+
+    def visit_Constant(self, node):
+        if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+            self.fail(node, repr(node.value))
+        return ast.Constant(value = float(node.value))
+
+    def visit_Name(self, node):
+        if node.id == "t":
+            return node
+        if node.id in self.parameters:
+            return ast.Constant(value = float(self.parameters[node.id]))
+        if node.id in CONSTANTS:
+            return ast.Constant(value = CONSTANTS[node.id])
+        self.fail(node, "the name "+node.id)
+
+    def visit_BinOp(self, node):
+        if not isinstance(node.op, BINARY_OPS):
+            self.fail(node, "the operator "+type(node.op).__name__)
+        return ast.BinOp(left = self.visit(node.left), op = node.op, right = self.visit(node.right))
+
+    def visit_UnaryOp(self, node):
+        if isinstance(node.op, ast.Not):
+            return self.call("logical_not", [self.visit(node.operand)])
+        if not isinstance(node.op, (ast.USub, ast.UAdd)):
+            self.fail(node, "the operator "+type(node.op).__name__)
+        return ast.UnaryOp(op = node.op, operand = self.visit(node.operand))
+
+    def visit_Compare(self, node):
+        # a < t <= b -> logical_and(a < t, t <= b)
+        terms = [self.visit(node.left)] + [self.visit(c) for c in node.comparators]
+        pairs = []
+        for k, op in enumerate(node.ops):
+            if not isinstance(op, COMPARE_OPS):
+                self.fail(node, "the comparison "+type(op).__name__)
+            pairs.append(ast.Compare(left = terms[k], ops = [op], comparators = [terms[k + 1]]))
+        result = pairs[0]
+        for pair in pairs[1:]:
+            result = self.call("logical_and", [result, pair])
+        return result
+
+    def visit_BoolOp(self, node):
+        function = "logical_and" if isinstance(node.op, ast.And) else "logical_or"
+        values = [self.visit(v) for v in node.values]
+        result = values[0]
+        for value in values[1:]:
+            result = self.call(function, [result, value])
+        return result
+
+    def visit_IfExp(self, node):
+        return self.call("where", [self.visit(node.test), self.visit(node.body), self.visit(node.orelse)])
+
+    def visit_Call(self, node):
+        if not isinstance(node.func, ast.Name) or node.func.id not in FUNCTIONS:
+            self.fail(node, "the function "+(node.func.id if isinstance(node.func, ast.Name) else "call"))
+        function, n_args = FUNCTIONS[node.func.id]
+        if node.keywords or len(node.args) != n_args:
+            raise Exception(self.name+": "+node.func.id+" takes "+str(n_args)+" argument"+("s" if n_args > 1 else ""))
+        return self.call(function, [self.visit(a) for a in node.args])
+
+def kernel_key(expression, parameters = None):
+    # hash of the expression text, its parameters and the python version
+    # (marshalled code only loads in the version that wrote it)
+    text = json.dumps({"expression": " ".join(expression.split()), "parameters": dict(sorted((parameters or {}).items())),
+                       "python": list(sys.version_info[:2])}, sort_keys = True)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:20]
+
+def compile_expression(expression, parameters = None, name = "expression"):
+    # validated code object of a restricted expression
+    parameters = dict(parameters or {})
+    if not isinstance(expression, str) or not expression.strip():
+        raise Exception(name+": the expression must be a non-empty string")
+    if len(expression) > MAX_EXPRESSION_LENGTH:
+        raise Exception(name+": the expression is longer than "+str(MAX_EXPRESSION_LENGTH)+" characters")
+    for p, value in parameters.items():
+        if p == "t" or p in CONSTANTS or p in FUNCTIONS or not p.isidentifier():
+            raise Exception(name+": "+str(p)+" can not be a parameter name")
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise Exception(name+": parameter "+p+" must be a number, not "+repr(value))
+    try:
+        tree = ast.parse(expression.strip(), mode = "eval")
+    except SyntaxError as e:
+        raise Exception(name+": "+str(e.msg)+" in "+repr(expression))
+    tree = ast.fix_missing_locations(ExpressionCompiler(name, parameters).visit(tree))
+    return compile(tree, "<impedance "+name+">", "eval")
+
+# ----- kernels -----
+
+def kernel_globals():
+    import numpy as np
+    functions = dict([("_"+f, getattr(np, f)) for f, n in FUNCTIONS.values()])
+    functions.update({"_logical_and": np.logical_and, "_logical_or": np.logical_or, "_logical_not": np.logical_not,
+                      "__builtins__": {}})
+    return functions
+
+class Kernel(object):
+    # compiled impedance expression; calling it with travel times gives f(t) as float64
+    def __init__(self, name, expression, parameters, key, code, info = None):
+        self.name = name
+        self.expression = expression
+        self.parameters = parameters
+        self.key = key
+        self.code = code
+        self.globals = kernel_globals()
+        self.info = info or {}
+
+    def __call__(self, t_ij):
+        import numpy as np
+        t_ij = np.asarray(t_ij, dtype = np.float64)
+        with np.errstate(all = "ignore"):
+            f = eval(self.code, self.globals, {"t": t_ij})
+        return np.broadcast_to(np.asarray(f, dtype = np.float64), t_ij.shape)
+
+    @property
+    def support(self):
+        return self.info.get("support")
+
+    @property
+    def monotone(self):
+        return self.info.get("monotone")
+
+def validate(kernel, monotone = True):
+    # finite and non-negative over 0 to T_MAX minutes, non-increasing if
+    # monotone, and where it stays above SUPPORT_TOLERANCE of its maximum
+    import numpy as np
+    t = np.round(np.arange(0, T_MAX + T_STEP/2, T_STEP), 6)
+    try:
+        f = np.array(kernel(t), dtype = np.float64)
+    except (OverflowError, ZeroDivisionError, ValueError, TypeError) as e:
+        raise Exception(kernel.name+": "+str(e)+" evaluating "+repr(kernel.expression))
+    bad = ~np.isfinite(f)
+    if bad.any():
+        raise Exception(kernel.name+": not finite at t = "+format(t[bad][0], "g")+" in "+repr(kernel.expression))
+    if (f < 0).any():
+        raise Exception(kernel.name+": negative at t = "+format(t[f < 0][0], "g")+" in "+repr(kernel.expression))
+    f_max = float(f.max())
+    if f_max <= 0:
+        raise Exception(kernel.name+": zero for every travel time in "+repr(kernel.expression))
+    rises = np.flatnonzero(np.diff(f) > 1e-12*f_max)
+    if monotone and len(rises):
+        raise Exception(kernel.name+": increases at t = "+format(t[rises[0] + 1], "g")+"; set \"monotone\": false to allow it")
+    above = np.flatnonzero(f > SUPPORT_TOLERANCE*f_max)
+    support = float(t[above[-1]]) if above[-1] < len(t) - 1 else None
+    return {"f0": float(f[0]), "max": f_max, "monotone": len(rises) == 0, "support": support}
+
+_kernels = {}
+
+def cache_dir():
+    # per user, since cached code is executed when it is loaded
+    user = os.environ.get("USERNAME") or os.environ.get("USER") or "user"
+    return os.environ.get("ACCESS_KERNEL_CACHE", os.path.join(tempfile.gettempdir(), "access_kernels_"+user))
+
+def owned(f):
+    # an open cache file that only this user wrote to; checked before the
+    # file is unmarshalled
+    if not hasattr(os, "getuid"):
+        return True
+    stat = os.fstat(f.fileno())
+    return stat.st_uid == os.getuid() and not stat.st_mode & 0o022
+
+def trusted(code):
+    # code of an expression: only the whitelisted names and float constants
+    allowed = set(["t", "_logical_and", "_logical_or", "_logical_not"] + ["_"+f for f, n in FUNCTIONS.values()])
+    return (set(code.co_names) <= allowed and not code.co_varnames and
+            all([isinstance(c, float) or c is None for c in code.co_consts]))
+
+def kernel(expression, parameters = None, name = "expression", monotone = True):
+    # compiled and validated kernel, from memory, the cache folder or built
+    # here (and then written to the cache folder for the workers)
+    parameters = dict(parameters or {})
+    key = kernel_key(expression, parameters)
+    if key in _kernels:
+        found = _kernels[key]
+        if monotone and not found.monotone:
+            raise Exception(name+": "+repr(expression)+" is not monotone; set \"monotone\": false to allow it")
+        return Kernel(name, found.expression, found.parameters, key, found.code, found.info)
+    path = os.path.join(cache_dir(), key+".kernel")
+    if os.path.exists(path):
+        try:
+            with open(path, "rb") as f:
+                info, code = marshal.loads(f.read()) if owned(f) else (None, None)
+            if code is not None and trusted(code):
+                _kernels[key] = Kernel(name, expression, parameters, key, code, info)
+                return kernel(expression, parameters, name, monotone)
+        except (EOFError, ValueError, TypeError):
+            pass
+    start = time.perf_counter()
+    found = Kernel(name, expression, parameters, key, compile_expression(expression, parameters, name))
+    found.info = validate(found, monotone)
+    found.info["compile_ms"] = (time.perf_counter() - start)*1000
+    _kernels[key] = found
+    try:
+        os.makedirs(cache_dir(), mode = 0o700, exist_ok = True)
+        # written then renamed so a reading worker never sees half a file
+        temp = path+"."+str(os.getpid())
+        with open(temp, "wb") as f:
+            os.chmod(temp, 0o600)
+            f.write(marshal.dumps((found.info, found.code)))
+        os.replace(temp, path)
+    except OSError:
+        pass
+    return found
+
+# ----- measures file -----
+
+_measures = {}
+
+def measures_path():
+    path = os.environ.get("ACCESS_MEASURES")
+    if path:
+        return path
+    return MEASURES_FILE if os.path.exists(MEASURES_FILE) else None
+
+def read_measures(path):
+    # {name: spec} of a measures file
+    import parameters as parameters_py
+    with open(path) as f:
+        config = json.load(f)
+    specs = config.get("measures", config) if isinstance(config, dict) else None
+    if not isinstance(specs, dict):
+        raise Exception(str(path)+" must hold {\"measures\": {name: {\"expression\": ...}}}")
+    for name, spec in specs.items():
+        if not isinstance(spec, dict) or "expression" not in spec:
+            raise Exception(str(path)+": "+str(name)+" needs an expression")
+        try:
+            parameters_py.impedance_f(1.0, name)
+            raise Exception(str(path)+": "+str(name)+" is already a measure in parameters.py")
+        except KeyError:
+            pass
+    return specs
+
+def measures(path = None):
+    # {name: Kernel} of a measures file, loaded once per file version
+    path = path or measures_path()
+    if path is None:
+        return {}
+    stamp = (os.path.abspath(path), os.path.getmtime(path))
+    if stamp not in _measures:
+        _measures[stamp] = dict([(name, kernel(spec["expression"], spec.get("parameters"), name, spec.get("monotone", True)))
+                                 for name, spec in read_measures(path).items()])
+    return _measures[stamp]
+
+def load_measures(path):
+    # validates every measure of the file and makes it the measures file of
+    # this process and of the workers it starts
+    found = measures(path)
+    os.environ["ACCESS_MEASURES"] = os.path.abspath(path)
+    return found
+
+def kernel_for(f_name):
+    # the kernel of a measures file measure, None for anything else
+    if measures_path() is None:
+        return None
+    return measures().get(f_name)
+
+def measure_support(f_name):
+    # effective support of any measure: the kernel's, or from evaluating a
+    # parameters.py measure over the same grid; None if it never drops off
+    import numpy as np
+    import access_core
+    found = kernel_for(f_name)
+    if found is not None:
+        return found.support
+    t = np.round(np.arange(0, T_MAX + T_STEP/2, T_STEP), 6)
+    f = access_core.impedance_array(t, f_name)
+    above = np.flatnonzero(f > SUPPORT_TOLERANCE*f.max())
+    return float(t[above[-1]]) if above[-1] < len(t) - 1 else None
+
+def effective_cutoff(selected_impedance_function):
+    # the smallest cutoff that keeps every measure above its tolerance, None if unbounded
+    supports = [measure_support(f_name) for f_name in selected_impedance_function]
+    return None if None in supports else max(supports)
+
+# ----- versus parameters.py -----
+
+PARAMETERS_EXPRESSIONS = {
+    "power": ("1 if t < 1 else t**-b", "b0"),
+    "neg_exp": ("exp(-b*t)", "b0"),
+    "mgaus": ("exp(-t**2/b)", "b0"),
+    "cumr": ("t <= b", "t_bar"),
+    "cuml": ("where(t <= b, 1 - t/b, 0)", "t_bar")}
+
+def parameters_measures():
+    # expressions equivalent to every parameters.py measure, from its source
+    import inspect
+    import re
+    import parameters as parameters_py
+    source = inspect.getsource(parameters_py.impedance_f)
+    found = {}
+    for name, family, value in re.findall(r'"(\w+)": \{"f": (\w+)\(t_ij, (?:b0|t_bar) = ([\d.]+)\)\}', source):
+        expression, p = PARAMETERS_EXPRESSIONS[family]
+        found[name] = (expression, {"b": float(value)})
+    return found
+
+def check(n = 10000000, seed = 1):
+    import numpy as np
+    import access_core
+    rng = np.random.default_rng(seed)
+    t_minutes = rng.integers(0, 121, n).astype(np.float64)
+    t_arcgis = np.round(rng.uniform(0, 120, n), 2)
+    worst = 0.0
+    for f_name, (expression, parameters) in sorted(parameters_measures().items()):
+        k = kernel(expression, parameters, f_name)
+        grid = np.round(np.arange(0, T_MAX + T_STEP/2, T_STEP), 6)
+        worst = max(worst, float(np.abs(k(grid) - access_core.impedance_array(grid, f_name)).max()))
+    print(str(len(parameters_measures()))+" parameters.py measures as expressions: max difference "+format(worst, ".1e")+
+          " over 0 to "+str(int(T_MAX))+" minutes")
+    for label, t in (("whole minutes (r5r)", t_minutes), ("0.01 minutes (arcgis)", t_arcgis)):
+        for f_name in ("HN1997", "CUMR45", "POW1_0"):
+            expression, parameters = parameters_measures()[f_name]
+            k = kernel(expression, parameters, f_name)
+            start = time.perf_counter()
+            expected = access_core.impedance_array(t, f_name)
+            loop_s = time.perf_counter() - start
+            start = time.perf_counter()
+            f = k(t)
+            kernel_s = time.perf_counter() - start
+            print("  "+label.ljust(22)+f_name.ljust(8)+" impedance_f per unique t "+format(loop_s, ".3f")+" s, kernel "+
+                  format(kernel_s, ".3f")+" s for "+str(n)+" travel times, max difference "+
+                  format(float(np.abs(f - expected).max()), ".1e"))
+    compiled = kernel("exp(-b*t) * (t <= 60)", {"b": 0.1}, "EXP10_60")
+    _kernels.clear()
+    start = time.perf_counter()
+    cached = kernel("exp(-b*t) * (t <= 60)", {"b": 0.1}, "EXP10_60")
+    print("  EXP10_60 compiled and validated in "+format(compiled.info["compile_ms"], ".2f")+" ms, loaded from "+
+          cache_dir()+" in "+format((time.perf_counter() - start)*1000, ".2f")+" ms, support "+format(cached.support, "g")+" min")
+    for expression in ("__import__('os')", "t.real", "(lambda: 1)()", "exp(-t) + open", "[t][0]", "'a'", "t**-1", "t - 10"):
+        try:
+            kernel(expression, name = "bad")
+            print("  NOT rejected: "+expression)
+        except Exception as e:
+            print("  rejected "+expression.ljust(20)+" "+str(e))
+
+def report(path):
+    for name, k in measures(path).items():
+        print(name.ljust(14)+" "+k.expression+("  "+json.dumps(k.parameters) if k.parameters else "")+"\n"+" "*15+
+              " f(0) "+format(k.info["f0"], "g")+", "+("non-increasing" if k.monotone else "not monotone")+
+              ", support "+(format(k.support, "g")+" min" if k.support is not None else "unbounded")+", key "+k.key)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "--check":
+        check()
+    else:
+        path = sys.argv[1] if len(sys.argv) > 1 else measures_path()
+        if path is None:
+            raise Exception("no measures file: pass one or create "+MEASURES_FILE)
+        report(path)
@@ -0,0 +1,330 @@
+# Incremental Accessibility Updates
+# Christopher D. Higgins
+# Department of Human Geography
+# University of Toronto Scarborough
+# https://higgicd.github.io
+# tool help can be found at https://github.com/higgicd/Accessibility_Toolbox
+
+# accessibility is linear in the opportunities, so when only some destination
+# weights change A_i' = A_i + sum_j (o_j' - o_j)*f(t_ij) over the changed
+# destinations only. the od matrix (from the od cost matrix to parquet tool or
+# r5r) is re-sorted once by destination into a destination index; an update
+# then reads just the row groups holding the changed destinations and patches
+# the previous accessibility sums instead of re-solving the network.
+# the od matrix must come from the same network, travel mode, cutoff and
+# departure time as the previous accessibility result
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import access_core
+from memory_budget import scan_options, scan_rows
+from parquet_profiles import ProfileWriter, with_settings
+
+INDEX_FILE = "od_by_destination.parquet"
+ORIGINS_FILE = "origins.parquet"
+DESTINATIONS_FILE = "destinations.parquet"
+
+# ----- od matrix schema -----
+
+def od_columns(schema):
+    # (i, j, t) columns of the arcgis parquet tools or of r5r
+    if "Total_Time" in schema.names:
+        return "i_id", "j_id", "Total_Time"
+    if "travel_time" in schema.names:
+        return "fromId", "toId", "travel_time"
+    raise Exception(str(schema.names)+" is not an od matrix from the parquet tools or r5r")
+
+# ----- destination index -----
+
+def build_destination_index(od_path, index_path, n_buckets = 64, row_group_size = 8192, parquet_profile = None):
+    # streams the od matrix twice: once for the id dictionaries, once to spill
+    # rows into destination-range buckets, then sorts each bucket by
+    # destination into one parquet file with small row groups. memory is
+    # bounded by the largest bucket, not the whole matrix. the index is
+    # encoded with parquet_profile, but keeps its own row groups and the
+    # statistics DestinationIndex reads them by
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+    dataset = ds.dataset(od_path, format = "parquet", partitioning = "hive")
+    i_col, j_col, t_col = od_columns(dataset.schema)
+
+    # ids are kept as text like the i_id_text/j_id_text fields of the tools
+    origins, destinations = set(), set()
+    for batch in dataset.to_batches(columns = [i_col, j_col], **scan_options("scan")):
+        origins.update(pc.unique(batch.column(i_col).cast(pa.string())).to_pylist())
+        destinations.update(pc.unique(batch.column(j_col).cast(pa.string())).to_pylist())
+    origin_ids = pa.array(sorted(origins), pa.string())
+    destination_ids = pa.array(sorted(destinations), pa.string())
+
+    if os.path.exists(index_path):
+        shutil.rmtree(index_path)
+    os.makedirs(index_path)
+    spill_dir = tempfile.mkdtemp(dir = index_path)
+    bucket_width = int(np.ceil(len(destination_ids)/n_buckets))
+    # travel times keep their type (int32 minutes from r5r, double from arcgis)
+    t_type = dataset.schema.field(t_col).type
+    schema = pa.schema([("i", pa.int32()), ("j", pa.int32()), ("t", t_type)])
+    writers = {}
+    rows = 0
+    for batch in dataset.to_batches(columns = [i_col, j_col, t_col], **scan_options("scan")):
+        i_codes = pc.index_in(batch.column(i_col).cast(pa.string()), value_set = origin_ids).to_numpy(zero_copy_only = False)
+        j_codes = pc.index_in(batch.column(j_col).cast(pa.string()), value_set = destination_ids).to_numpy(zero_copy_only = False)
+        t_ij = batch.column(t_col).to_numpy(zero_copy_only = False)
+        buckets = j_codes//bucket_width
+        for bucket in np.unique(buckets):
+            mask = buckets == bucket
+            if bucket not in writers:
+                writers[bucket] = pq.ParquetWriter(os.path.join(spill_dir, "bucket_"+str(bucket)+".parquet"), schema)
+            writers[bucket].write_table(pa.table({"i": pa.array(i_codes[mask].astype(np.int32)),
+                                                  "j": pa.array(j_codes[mask].astype(np.int32)),
+                                                  "t": pa.array(t_ij[mask], type = t_type)}, schema = schema))
+        rows += batch.num_rows
+    for writer in writers.values():
+        writer.close()
+
+    writer = ProfileWriter(os.path.join(index_path, INDEX_FILE), schema, with_settings(parquet_profile, statistics = "all"))
+    for bucket in sorted(writers):
+        table = pq.read_table(os.path.join(spill_dir, "bucket_"+str(bucket)+".parquet"))
+        writer.write_table(table.sort_by([("j", "ascending"), ("i", "ascending")]), row_group_size = row_group_size)
+    writer.close()
+    shutil.rmtree(spill_dir)
+
+    pq.write_table(pa.table({"i_id": origin_ids}), os.path.join(index_path, ORIGINS_FILE))
+    pq.write_table(pa.table({"j_id": destination_ids}), os.path.join(index_path, DESTINATIONS_FILE))
+    with open(os.path.join(index_path, "index.json"), "w") as f:
+        json.dump({"od_path": os.path.abspath(od_path), "rows": rows, "columns": [i_col, j_col, t_col],
+                   "origins": len(origin_ids), "destinations": len(destination_ids),
+                   "row_group_size": row_group_size}, f, indent = 2)
+    return index_path
+
+class DestinationIndex(object):
+    def __init__(self, index_path):
+        import numpy as np
+        import pyarrow.parquet as pq
+        self.index_path = index_path
+        self.parquet_file = pq.ParquetFile(os.path.join(index_path, INDEX_FILE))
+        self.origin_ids = pq.read_table(os.path.join(index_path, ORIGINS_FILE)).column("i_id").combine_chunks()
+        self.destination_ids = pq.read_table(os.path.join(index_path, DESTINATIONS_FILE)).column("j_id").combine_chunks()
+        # destination code range of every row group, from the parquet statistics
+        metadata = self.parquet_file.metadata
+        j_index = self.parquet_file.schema_arrow.get_field_index("j")
+        self.group_min = np.array([metadata.row_group(g).column(j_index).statistics.min for g in range(metadata.num_row_groups)])
+        self.group_max = np.array([metadata.row_group(g).column(j_index).statistics.max for g in range(metadata.num_row_groups)])
+        self.group_rows = np.array([metadata.row_group(g).num_rows for g in range(metadata.num_row_groups)])
+        self.rows = int(self.group_rows.sum())
+        self._i_to_j = None
+
+    def codes(self, ids, dictionary):
+        # codes of ids in a dictionary; -1 where the id is not in the od matrix
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        codes = pc.index_in(pa.array([str(x) for x in ids], pa.string()), value_set = dictionary)
+        return codes.fill_null(-1).to_numpy(zero_copy_only = False).astype("int64")
+
+    def origin_codes(self, i_ids):
+        return self.codes(i_ids, self.origin_ids)
+
+    def destination_codes(self, j_ids):
+        return self.codes(j_ids, self.destination_ids)
+
+    def i_to_j(self):
+        # destination code of each origin's own id, for skipping i == j
+        if self._i_to_j is None:
+            self._i_to_j = self.codes(self.origin_ids.to_pylist(), self.destination_ids)
+        return self._i_to_j
+
+    def row_groups_for(self, j_codes):
+        # row groups whose destination range holds at least one of j_codes
+        import numpy as np
+        j_codes = np.unique(j_codes)
+        first = np.searchsorted(j_codes, self.group_min, side = "left")
+        last = np.searchsorted(j_codes, self.group_max, side = "right")
+        return np.nonzero(last > first)[0].tolist()
+
+    def read_destinations(self, j_codes):
+        # od rows for the given destinations only; returns i, j, t and rows read from disk
+        import numpy as np
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        groups = self.row_groups_for(j_codes)
+        if not groups:
+            empty = np.array([], dtype = np.int64)
+            return empty, empty, np.array([], dtype = np.float64), 0
+        table = self.parquet_file.read_row_groups(groups)
+        table = table.filter(pc.is_in(table.column("j"), value_set = pa.array(np.unique(j_codes).astype(np.int32))))
+        return (table.column("i").to_numpy().astype(np.int64), table.column("j").to_numpy().astype(np.int64),
+                table.column("t").to_numpy().astype(np.float64), int(self.group_rows[groups].sum()))
+
+    def scan(self, batch_size = None):
+        import numpy as np
+        if batch_size is None:
+            batch_size = scan_rows("scan", 1000000)
+        for batch in self.parquet_file.iter_batches(batch_size = batch_size):
+            yield (batch.column(0).to_numpy().astype(np.int64), batch.column(1).to_numpy().astype(np.int64),
+                   batch.column(2).to_numpy().astype(np.float64))
+
+def load_destination_index(index_path):
+    return DestinationIndex(index_path)
+
+# ----- accessibility -----
+
+def opportunity_changes(old_o_j, new_o_j):
+    # {j_id: o_j} before and after -> {j_id: (old, new)} for every destination
+    # whose weight changed; destinations missing on one side count as 0
+    changes = {}
+    old_o_j = dict([(str(k), v or 0) for k, v in old_o_j.items()])
+    new_o_j = dict([(str(k), v or 0) for k, v in new_o_j.items()])
+    for j_id in set(old_o_j) | set(new_o_j):
+        old, new = old_o_j.get(j_id, 0), new_o_j.get(j_id, 0)
+        if old != new:
+            changes[j_id] = (old, new)
+    return changes
+
+def result_frame(index, frequency, sums, selected_impedance_function):
+    # origins that reach at least one opportunity, like the accessibility tool output
+    import numpy as np
+    import pandas as pd
+    keep = np.nonzero(frequency > 0)[0]
+    df = pd.DataFrame({"i_id": index.origin_ids.take(keep).to_pylist(),
+                       "FREQUENCY": frequency[keep].astype(np.int64)})
+    for f_name in selected_impedance_function:
+        df["SUM_Ai_"+f_name] = sums[f_name][keep]
+    return df
+
+def full_accessibility(index, o_j, selected_impedance_function, del_i_eq_j = False):
+    # reference recompute over the whole matrix; only destinations with
+    # o_j > 0 count towards FREQUENCY, as in the accessibility tool
+    import numpy as np
+    o_j_codes = np.zeros(len(index.destination_ids))
+    codes = index.destination_codes(list(o_j.keys()))
+    values = np.array([v or 0 for v in o_j.values()], dtype = np.float64)
+    o_j_codes[codes[codes >= 0]] = values[codes >= 0]
+    n_origins = len(index.origin_ids)
+    frequency = np.zeros(n_origins)
+    sums = dict([(f_name, np.zeros(n_origins)) for f_name in selected_impedance_function])
+    for i_codes, j_codes, t_ij in index.scan():
+        keep = o_j_codes[j_codes] > 0
+        if del_i_eq_j:
+            keep &= index.i_to_j()[i_codes] != j_codes
+        i_codes, j_codes, t_ij = i_codes[keep], j_codes[keep], t_ij[keep]
+        frequency += np.bincount(i_codes, minlength = n_origins)
+        for f_name, values in access_core.accessibility(i_codes, t_ij, o_j_codes[j_codes],
+                                                        selected_impedance_function, n_origins).items():
+            sums[f_name] += values
+    return result_frame(index, frequency, sums, selected_impedance_function)
+
+def update_accessibility(previous, index, changes, selected_impedance_function, del_i_eq_j = False):
+    # previous: data frame with i_id, FREQUENCY and SUM_Ai_<measure> columns
+    # changes: {j_id: (old o_j, new o_j)} from opportunity_changes
+    import numpy as np
+    missing = [c for c in ["i_id", "FREQUENCY"]+["SUM_Ai_"+f for f in selected_impedance_function] if c not in previous.columns]
+    if missing:
+        raise Exception(str(missing)+" not in the previous accessibility result")
+    stats = {"changed_destinations": len(changes), "rows_total": index.rows}
+
+    n_origins = len(index.origin_ids)
+    i_codes_prev = index.origin_codes(previous["i_id"].tolist())
+    if (i_codes_prev < 0).any():
+        raise Exception(str(int((i_codes_prev < 0).sum()))+" origins of the previous result are not in the od matrix")
+    frequency = np.zeros(n_origins)
+    frequency[i_codes_prev] = previous["FREQUENCY"].to_numpy()
+    sums = {}
+    for f_name in selected_impedance_function:
+        sums[f_name] = np.zeros(n_origins)
+        sums[f_name][i_codes_prev] = previous["SUM_Ai_"+f_name].to_numpy()
+
+    # changed destinations -> delta weight and delta count per destination code
+    j_ids = list(changes.keys())
+    j_codes = index.destination_codes(j_ids)
+    unsolved = [j_id for j_id, code in zip(j_ids, j_codes) if code < 0 and changes[j_id][1] > 0]
+    if unsolved:
+        raise Exception(str(len(unsolved))+" changed destinations are not in the od matrix (e.g. "+str(unsolved[:5])+
+                        "); solve them first")
+    delta_o_j = np.zeros(len(index.destination_ids))
+    delta_frequency = np.zeros(len(index.destination_ids))
+    for j_id, code in zip(j_ids, j_codes):
+        if code < 0:
+            continue
+        old, new = changes[j_id]
+        delta_o_j[code] = new - old
+        delta_frequency[code] = int(new > 0) - int(old > 0)
+
+    start = time.perf_counter()
+    i_codes, j_codes_rows, t_ij, rows_read = index.read_destinations(j_codes[j_codes >= 0])
+    stats["read_s"] = time.perf_counter() - start
+    if del_i_eq_j:
+        keep = index.i_to_j()[i_codes] != j_codes_rows
+        i_codes, j_codes_rows, t_ij = i_codes[keep], j_codes_rows[keep], t_ij[keep]
+
+    start = time.perf_counter()
+    frequency += access_core.origin_sums(i_codes, delta_frequency[j_codes_rows], n_origins)
+    for f_name, values in access_core.accessibility(i_codes, t_ij, delta_o_j[j_codes_rows],
+                                                    selected_impedance_function, n_origins).items():
+        sums[f_name] += values
+    stats["patch_s"] = time.perf_counter() - start
+    stats["rows_read"] = rows_read
+    stats["rows_used"] = len(i_codes)
+    stats["origins_touched"] = int(len(np.unique(i_codes)))
+    return result_frame(index, frequency, sums, selected_impedance_function), stats
+
+def max_relative_difference(a, b, selected_impedance_function):
+    # largest difference between two results, relative to the largest value of each measure
+    import numpy as np
+    merged = a.merge(b, on = "i_id", how = "outer", suffixes = ("_a", "_b")).fillna(0)
+    worst = {"FREQUENCY": float(np.abs(merged["FREQUENCY_a"] - merged["FREQUENCY_b"]).max())}
+    for f_name in selected_impedance_function:
+        column = "SUM_Ai_"+f_name
+        scale = max(np.abs(merged[column+"_a"]).max(), 1e-12)
+        worst[column] = float(np.abs(merged[column+"_a"] - merged[column+"_b"]).max()/scale)
+    return worst
+
+# ----- incremental versus full recompute -----
+
+def compare_incremental(od_path = "r5_ttm", index_path = None, fractions = (0.001, 0.01, 0.05, 0.2),
+                        selected_impedance_function = ("CUMR45", "HN1997", "MGAUS180"), seed = 1):
+    import numpy as np
+    from synthetic_ttm import synthetic_opportunities
+    selected_impedance_function = list(selected_impedance_function)
+    if index_path is None:
+        index_path = os.path.join(tempfile.gettempdir(), "access_destination_index")
+    start = time.perf_counter()
+    build_destination_index(od_path, index_path)
+    index = load_destination_index(index_path)
+    print("destination index: "+str(index.rows)+" rows, "+str(len(index.group_rows))+" row groups, built in "+
+          str(round(time.perf_counter() - start, 1))+" s")
+
+    rng = np.random.default_rng(seed)
+    j_ids = index.destination_ids.to_pylist()
+    o_j = dict(zip(j_ids, synthetic_opportunities(len(j_ids), seed)))
+    start = time.perf_counter()
+    previous = full_accessibility(index, o_j, selected_impedance_function)
+    full_s = time.perf_counter() - start
+    print("full recompute: "+str(round(full_s, 2))+" s")
+
+    for fraction in fractions:
+        changed = rng.choice(len(j_ids), max(1, int(fraction*len(j_ids))), replace = False)
+        new_o_j = dict(o_j)
+        for k, code in enumerate(changed):
+            # a mix of growth, decline, closures and new opportunities
+            j_id = j_ids[code]
+            new_o_j[j_id] = [0.0, o_j[j_id]*2, o_j[j_id]*0.5 + 1, 5.0][k % 4] if o_j[j_id] > 0 else 10.0
+        start = time.perf_counter()
+        updated, stats = update_accessibility(previous, index, opportunity_changes(o_j, new_o_j), selected_impedance_function)
+        update_s = time.perf_counter() - start
+        exact = full_accessibility(index, new_o_j, selected_impedance_function)
+        worst = max_relative_difference(updated, exact, selected_impedance_function)
+        print(str(round(100*fraction, 1)).rjust(5)+"% changed ("+str(len(changed))+" destinations): "+
+              str(round(update_s, 2))+" s, "+str(round(full_s/update_s, 1))+"x faster, read "+
+              str(round(100*stats["rows_read"]/stats["rows_total"], 1))+"% of rows, "+
+              "max frequency difference "+str(worst["FREQUENCY"])+", max relative difference "+
+              str(max([v for k, v in worst.items() if k != "FREQUENCY"])))
+    shutil.rmtree(index_path, ignore_errors = True)
+
+if __name__ == '__main__':
+    compare_incremental()
@@ -0,0 +1,459 @@
+# Shared-Folder Job Queue for the Accessibility Toolbox
+# Christopher D. Higgins
+# Department of Human Geography
+# University of Toronto Scarborough
+# https://higgicd.github.io
+# tool help can be found at https://github.com/higgicd/Accessibility_Toolbox
+
+# runs the origin batches of a tool on any number of machines that share a
+# folder. the coordinator (main of a tool given a queue_dir) writes one job
+# per batch and waits; workers on any machine that sees the folder claim
+# jobs, solve them and publish their part of the output dataset:
+#   queue.json              run id, solver ("module:function"), output dataset, lease seconds, attempts
+#   context.pkl             settings shared by every job, pickled once
+#   pending/<job>~<n>.pkl   jobs waiting for their n-th attempt
+#   leased/<job>~<n>~<worker>.pkl
+#                           claimed jobs; the lease's modification time is the last heartbeat
+#   done/<job>.json         finished jobs: worker, attempts, seconds, solver result, published output
+#   errors/<job>~<n>.json   why an attempt failed or its lease expired
+#   failed/<job>~<n>.pkl    jobs out of attempts
+#   workers/<worker>.json   host, pid, state and counts of every worker
+# every change of state is a rename, which is atomic on a local, smb or nfs
+# folder, so exactly one worker wins a claim. a worker heartbeats by touching
+# its lease from a thread; a lease that is not touched for lease_s seconds
+# (measured against a file touched just now, so machine clocks need not
+# agree) goes back to pending, and the job is solved again by whichever
+# worker claims it. a worker that stalled past its lease finds the lease gone
+# and drops its output. jobs are solved into <output>/_staging (which
+# pyarrow skips) and published by renaming their partition folders into the
+# dataset; a partition that exists was published by an earlier attempt of
+# the same job, so retries never duplicate lines; the staged output of a
+# worker that died goes with its lease. solvers that hold the interpreter
+# during a solve also hold up the heartbeat, so lease_s should outlast the
+# longest solve
+#
+# usage:
+#   python job_queue.py work <queue dir> [--workers 4]  (serve a queue from this machine)
+#   python job_queue.py status <queue dir>
+
+import os, sys
+import json
+import time
+import uuid
+import pickle
+import random
+import shutil
+import socket
+import argparse
+import importlib
+import threading
+import traceback
+import multiprocessing
+
+QUEUE_FILE = "queue.json"
+STATES = ["pending", "leased", "done", "errors", "failed", "workers"]
+STAGING = "_staging"
+DEFAULT_LEASE_S = 600
+DEFAULT_ATTEMPTS = 3
+HEARTBEATS = 5 # per lease
+CLAIM_SPREAD = 16
+
+def worker_name():
+    return socket.gethostname().replace("~", "-")+"-"+str(os.getpid())
+
+def write_json(path, obj):
+    # written under a temporary name and renamed, so readers never see half a file
+    tmp_path = path+".tmp_"+uuid.uuid4().hex[:8]
+    with open(tmp_path, "w") as f:
+        json.dump(obj, f, default = str)
+    os.replace(tmp_path, path)
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+def job_parts(file_name):
+    # (job, attempt, worker or None) of a pending, leased or failed job file
+    parts = os.path.splitext(file_name)[0].split("~")
+    return parts[0], int(parts[1]), parts[2] if len(parts) > 2 else None
+
+def solver_spec(solver):
+    # a module level solver function as a worker imports it; the folder of
+    # its module goes on the worker's path
+    module = sys.modules[solver.__module__]
+    module_file = getattr(module, "__file__", None)
+    name = solver.__module__
+    if name == "__main__":
+        if module_file is None:
+            raise Exception("The job queue's solver must be defined in a module file")
+        name = os.path.splitext(os.path.basename(module_file))[0]
+    return {"module": name, "function": solver.__name__,
+            "path": os.path.dirname(os.path.abspath(module_file)) if module_file else None}
+
+def load_solver(spec):
+    if spec.get("path") and os.path.isdir(spec["path"]) and spec["path"] not in sys.path:
+        sys.path.insert(0, spec["path"])
+    return getattr(importlib.import_module(spec["module"]), spec["function"])
+
+class Heartbeat(object):
+    # touches a lease every interval seconds from a thread; lost once the
+    # lease is gone (reclaimed while the worker stalled)
+    def __init__(self, lease, interval):
+        self.lease = lease
+        self.interval = interval
+        self.lost = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target = self.beat)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def beat(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                os.utime(self.lease, None)
+            except OSError:
+                self.lost = True
+                return
+
+    def stop(self):
+        # True if the lease was held throughout
+        self.stopped.set()
+        self.thread.join()
+        return not self.lost and os.path.exists(self.lease)
+
+class JobQueue(object):
+    def __init__(self, queue_dir):
+        self.queue_dir = queue_dir
+
+    def path(self, *parts):
+        return os.path.join(self.queue_dir, *parts)
+
+    def settings(self):
+        return read_json(self.path(QUEUE_FILE))
+
+    def context(self):
+        with open(self.path("context.pkl"), "rb") as f:
+            return pickle.load(f)
+
+    def files(self, state, extension = ".pkl"):
+        try:
+            return sorted([f for f in os.listdir(self.path(state)) if f.endswith(extension)])
+        except OSError:
+            return []
+
+    def counts(self):
+        return {"pending": len(self.files("pending")), "leased": len(self.files("leased")),
+                "done": len(self.files("done", ".json")), "failed": len(self.files("failed")),
+                "errors": len(self.files("errors", ".json"))}
+
+    # ----- coordinator -----
+
+    def create(self, solver, jobs, context = None, output_dir = None, names = None,
+               lease_s = DEFAULT_LEASE_S, max_attempts = DEFAULT_ATTEMPTS):
+        # a fresh queue of jobs for solver(job, context, staging_dir), which
+        # writes its output into staging_dir as it should appear in
+        # output_dir and returns a small picklable result. a queue left in the
+        # folder by an earlier run is removed; any other folder is refused
+        names = [str(name) for name in names] if names is not None else [str(k).zfill(6) for k in range(len(jobs))]
+        if len(set(names)) != len(names) or len(names) != len(jobs):
+            raise Exception("The job queue needs one unique name per job")
+        if [name for name in names if "~" in name or os.sep in name]:
+            raise Exception("Job names can not contain ~ or "+os.sep)
+        if float(lease_s) <= 0 or int(max_attempts) < 1:
+            raise Exception("The job queue needs a positive lease and at least one attempt, not "+
+                            str(lease_s)+" s and "+str(max_attempts))
+        if os.path.exists(self.queue_dir):
+            if os.listdir(self.queue_dir) and not os.path.isfile(self.path(QUEUE_FILE)):
+                raise Exception("The job queue folder "+str(self.queue_dir)+" exists and is not a job queue; "+
+                                "choose a new or empty folder")
+            shutil.rmtree(self.queue_dir)
+        for state in STATES:
+            os.makedirs(self.path(state))
+        with open(self.path("context.pkl"), "wb") as f:
+            pickle.dump(context, f, protocol = pickle.HIGHEST_PROTOCOL)
+        for name, job in zip(names, jobs):
+            with open(self.path("pending", name+"~0.pkl"), "wb") as f:
+                pickle.dump(job, f, protocol = pickle.HIGHEST_PROTOCOL)
+        # last, so a worker waiting for the queue sees every job
+        write_json(self.path(QUEUE_FILE), {"run": uuid.uuid4().hex, "solver": solver_spec(solver),
+                                           "output_dir": os.path.abspath(output_dir) if output_dir else None,
+                                           "jobs": len(jobs), "lease_s": float(lease_s),
+                                           "max_attempts": int(max_attempts), "created": time.time(),
+                                           "coordinator": worker_name()})
+        return self
+
+    def wait(self, poll = 2.0, progress = None, idle_s = None):
+        # reclaims expired leases until every job is done or failed and
+        # returns the summary; progress(counts) whenever the counts change.
+        # raises if jobs are pending and no worker held a lease for idle_s
+        # (the lease time by default)
+        settings = self.settings()
+        idle_s = settings["lease_s"] if idle_s is None else idle_s
+        coordinator = "coordinator-"+worker_name()
+        last, active = None, time.time()
+        while True:
+            self.reclaim(coordinator)
+            counts = self.counts()
+            if counts != last:
+                active = time.time()
+                if progress is not None:
+                    progress(counts)
+                last = counts
+            if counts["pending"] == 0 and counts["leased"] == 0:
+                if settings["output_dir"]:
+                    try:
+                        os.rmdir(os.path.join(settings["output_dir"], STAGING))
+                    except OSError:
+                        pass
+                break
+            if counts["leased"]:
+                active = time.time()
+            elif time.time() - active > idle_s:
+                raise Exception("No worker claimed a job from "+self.queue_dir+" in "+str(round(idle_s, 1))+
+                                " s; start workers with python job_queue.py work "+self.queue_dir)
+            time.sleep(poll)
+        return self.summary()
+
+    def summary(self):
+        done = [read_json(self.path("done", f)) for f in self.files("done", ".json")]
+        errors = [read_json(self.path("errors", f)) for f in self.files("errors", ".json")]
+        workers = [read_json(self.path("workers", f)) for f in self.files("workers", ".json")]
+        failed = [job_parts(f)[0] for f in self.files("failed")]
+        return {"jobs": (self.settings() or {}).get("jobs"), "done": [d for d in done if d is not None],
+                "failed": failed, "errors": [e for e in errors if e is not None],
+                "workers": [w for w in workers if w is not None]}
+
+    # ----- leases -----
+
+    def clock(self, worker):
+        # the time of the shared folder's clock: the modification time of a
+        # file touched just now, comparable with the leases' heartbeats
+        clock_file = self.path("workers", worker+".clock")
+        with open(clock_file, "a"):
+            pass
+        os.utime(clock_file, None)
+        return os.path.getmtime(clock_file)
+
+    def reclaim(self, worker):
+        # leases without a heartbeat for lease_s go back to pending, or to
+        # failed after max_attempts; returns the jobs reclaimed
+        settings = self.settings()
+        if settings is None:
+            return []
+        now = self.clock(worker)
+        reclaimed = []
+        for file_name in self.files("leased"):
+            try:
+                age = now - os.path.getmtime(self.path("leased", file_name))
+            except OSError:
+                continue
+            if age <= settings["lease_s"]:
+                continue
+            name, attempt, holder = job_parts(file_name)
+            if self.release(file_name, settings, {"worker": holder, "reclaimed_by": worker,
+                                                  "error": "lease expired after "+str(round(age, 1))+" s"}):
+                # what a worker that died left staged
+                shutil.rmtree(self.staging_dir(settings, file_name), ignore_errors = True)
+                reclaimed.append(name)
+        return reclaimed
+
+    def release(self, lease_name, settings, error):
+        # a lease back to pending for another attempt, or to failed; False if
+        # another worker moved it first
+        name, attempt, holder = job_parts(lease_name)
+        lease = self.path("leased", lease_name)
+        if os.path.exists(self.path("done", name+".json")):
+            # done, but its worker stopped before removing the lease
+            try:
+                os.remove(lease)
+            except OSError:
+                pass
+            return False
+        if attempt + 1 < settings["max_attempts"]:
+            target = self.path("pending", name+"~"+str(attempt + 1)+".pkl")
+        else:
+            target = self.path("failed", name+"~"+str(attempt)+".pkl")
+        try:
+            os.rename(lease, target)
+        except OSError:
+            return False
+        error = dict(error, job = name, attempt = attempt, time = time.time())
+        write_json(self.path("errors", name+"~"+str(attempt)+".json"), error)
+        return True
+
+    def claim(self, worker):
+        # renames a pending job to a lease of worker; (job, attempt, lease
+        # name) or None when nothing is pending. workers start at different
+        # jobs so they do not all race for the first
+        candidates = self.files("pending")
+        head = candidates[:CLAIM_SPREAD]
+        random.shuffle(head)
+        for file_name in head + candidates[CLAIM_SPREAD:]:
+            name, attempt, holder = job_parts(file_name)
+            lease_name = name+"~"+str(attempt)+"~"+worker+".pkl"
+            try:
+                os.rename(self.path("pending", file_name), self.path("leased", lease_name))
+                # renaming keeps the pending file's time; the first heartbeat
+                os.utime(self.path("leased", lease_name), None)
+            except OSError:
+                continue
+            return name, attempt, lease_name
+        return None
+
+    # ----- workers -----
+
+    def staging_dir(self, settings, lease_name):
+        root = os.path.join(settings["output_dir"], STAGING) if settings["output_dir"] else self.path("staging")
+        return os.path.join(root, os.path.splitext(lease_name)[0])
+
+    def publish(self, staging, output_dir):
+        # renames what a job staged into the output dataset; an entry that
+        # exists was published by an earlier attempt of the same job
+        published = []
+        if output_dir is None:
+            return published
+        for entry in sorted(os.listdir(staging)):
+            target = os.path.join(output_dir, entry)
+            if os.path.exists(target):
+                continue
+            try:
+                os.rename(os.path.join(staging, entry), target)
+            except OSError:
+                if not os.path.exists(target):
+                    raise
+                continue
+            published.append(entry)
+        return published
+
+    def run_job(self, solver, context, worker, name, attempt, lease_name, settings):
+        # solves a claimed job under a heartbeat; "done", "errors" or "lost"
+        lease = self.path("leased", lease_name)
+        with open(lease, "rb") as f:
+            job = pickle.load(f)
+        staging = self.staging_dir(settings, lease_name)
+        if os.path.exists(staging):
+            shutil.rmtree(staging)
+        os.makedirs(staging)
+        heartbeat = Heartbeat(lease, settings["lease_s"]/HEARTBEATS)
+        start = time.time()
+        try:
+            try:
+                result = solver(job, context, staging)
+            except Exception:
+                if not heartbeat.stop():
+                    return "lost"
+                self.release(lease_name, settings, {"worker": worker, "error": traceback.format_exc()})
+                return "errors"
+            if not heartbeat.stop():
+                # the lease expired while this worker stalled; another attempt owns the job
+                return "lost"
+            published = self.publish(staging, settings["output_dir"])
+            write_json(self.path("done", name+".json"), {"job": name, "attempts": attempt + 1, "worker": worker,
+                                                         "seconds": time.time() - start, "result": result,
+                                                         "published": published})
+            try:
+                os.remove(lease)
+            except OSError:
+                pass
+            return "done"
+        finally:
+            heartbeat.stop()
+            shutil.rmtree(staging, ignore_errors = True)
+
+    def report(self, worker, stats):
+        write_json(self.path("workers", worker+".json"), stats)
+
+def wait_for_queue(queue, wait_s, poll):
+    start = time.time()
+    while True:
+        settings = queue.settings()
+        if settings is not None:
+            return settings
+        if time.time() - start > wait_s:
+            raise Exception("No job queue in "+queue.queue_dir+" after "+str(round(wait_s))+" s")
+        time.sleep(poll)
+
+def run_worker(queue_dir, worker = None, poll = 1.0, wait_s = 600, max_jobs = None):
+    # claims and solves jobs until none are pending or leased (or max_jobs
+    # are done); waits up to wait_s for the coordinator to create the queue.
+    # returns the worker's counts
+    queue = JobQueue(queue_dir)
+    worker = (worker or worker_name()).replace("~", "-")
+    settings = wait_for_queue(queue, wait_s, poll)
+    solver = load_solver(settings["solver"])
+    context = queue.context()
+    stats = {"worker": worker, "host": socket.gethostname(), "pid": os.getpid(), "run": settings["run"],
+             "state": "running", "started": time.time(), "last": None, "done": 0, "errors": 0, "lost": 0}
+    queue.report(worker, stats)
+    while max_jobs is None or stats["done"] < max_jobs:
+        current = queue.settings()
+        if current is None or current["run"] != settings["run"]:
+            # a new run replaced this queue
+            break
+        queue.reclaim(worker)
+        claimed = queue.claim(worker)
+        if claimed is None:
+            counts = queue.counts()
+            if counts["pending"] == 0 and counts["leased"] == 0:
+                break
+            # the leases of other workers may still expire
+            time.sleep(poll)
+            continue
+        outcome = queue.run_job(solver, context, worker, *claimed, settings = settings)
+        stats[outcome] += 1
+        stats["last"] = time.time()
+        queue.report(worker, stats)
+    stats["state"] = "finished"
+    stats["finished"] = time.time()
+    queue.report(worker, stats)
+    return stats
+
+def start_workers(queue_dir, processes):
+    # local worker processes, as python job_queue.py work runs them on other machines
+    workers = []
+    for k in range(processes):
+        process = multiprocessing.Process(target = run_worker, args = (queue_dir,))
+        process.start()
+        workers.append(process)
+    return workers
+
+def format_counts(counts):
+    return (str(counts["done"])+" done, "+str(counts["leased"])+" running, "+str(counts["pending"])+" pending, "+
+            str(counts["failed"])+" failed, "+str(counts["errors"])+" retried attempts")
+
+def describe(queue_dir):
+    queue = JobQueue(queue_dir)
+    settings = queue.settings()
+    if settings is None:
+        return "No job queue in "+queue_dir
+    summary = queue.summary()
+    lines = [str(settings["jobs"])+" jobs for "+settings["solver"]["module"]+"."+settings["solver"]["function"]+
+             " into "+str(settings["output_dir"])+", leases of "+str(settings["lease_s"])+" s",
+             format_counts(queue.counts())]
+    for stats in sorted(summary["workers"], key = lambda w: w["worker"]):
+        lines.append("  "+stats["worker"].ljust(32)+stats["state"].ljust(10)+str(stats["done"]).rjust(6)+" done"+
+                     str(stats["errors"]).rjust(4)+" errors"+str(stats["lost"]).rjust(4)+" lost")
+    for error in summary["errors"]:
+        lines.append("  "+error["job"]+" attempt "+str(error["attempt"] + 1)+": "+str(error["error"]).strip().split("\n")[-1])
+    return "\n".join(lines)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Shared-folder job queue for the toolbox's batches")
+    parser.add_argument("command", choices = ["work", "status"])
+    parser.add_argument("queue_dir")
+    parser.add_argument("--workers", type = int, default = 1, help = "worker processes on this machine")
+    parser.add_argument("--worker-id", default = None, help = "name of a single worker, <host>-<pid> by default")
+    parser.add_argument("--wait", type = float, default = 600, help = "seconds to wait for the coordinator's queue")
+    args = parser.parse_args()
+    if args.command == "status":
+        print(describe(args.queue_dir))
+    elif args.workers == 1:
+        print(json.dumps(run_worker(args.queue_dir, args.worker_id, wait_s = args.wait)))
+    else:
+        wait_for_queue(JobQueue(args.queue_dir), args.wait, 1.0)
+        for process in start_workers(args.queue_dir, args.workers):
+            process.join()
+        print(describe(args.queue_dir))
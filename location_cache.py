@@ -0,0 +1,237 @@
+# Network Location Cache
+# Christopher D. Higgins
+# Department of Human Geography
+# University of Toronto Scarborough
+# https://higgicd.github.io
+# tool help can be found at https://github.com/higgicd/Accessibility_Toolbox
+
+# preprocess_x converts the inputs to points, copies them and runs
+# arcpy.nax.CalculateLocations on every run. this keeps the located inputs
+# under a key of the network dataset, travel mode and search tolerance,
+# criteria and query:
+#   prepared/<signature>.npy  the whole preprocessed feature class, keyed by
+#                             a hash of the input ids, geometries and fields;
+#                             an unchanged input skips straight to batching
+#   locations_<sr>.parquet    network locations by point coordinates; a changed
+#                             input only locates its new or moved points
+# the folder can be deleted at any time, the next run rebuilds it
+#
+# usage: python location_cache.py D:/access_multi/location_cache  (lists the entries)
+
+import os, sys
+import json
+import glob
+import time
+import hashlib
+import telemetry
+from odcm_cache import network_signature, rows_hash, settings_text
+
+PREPARE_FORMAT = 1
+# fields arcpy.nax.CalculateLocations writes, with their types
+LOCATION_FIELDS = [("SourceID", "LONG"), ("SourceOID", "LONG"), ("PosAlong", "DOUBLE"), ("SideOfEdge", "LONG"),
+                   ("SnapX", "DOUBLE"), ("SnapY", "DOUBLE"), ("SnapZ", "DOUBLE"),
+                   ("DistanceToNetworkInMeters", "DOUBLE")]
+
+def point_key(xy):
+    return (round(xy[0], 7), round(xy[1], 7))
+
+def replace_file(path, write, mode = "wb"):
+    # write(file) to a temporary name and rename over, so readers never see half a file
+    tmp_path = path+".tmp_"+str(os.getpid())
+    with open(tmp_path, mode) as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+class LocationCache(object):
+    def __init__(self, cache_dir, input_network, travel_mode, search_tolerance, search_criteria, search_query):
+        self.input_network = input_network
+        self.travel_mode = travel_mode
+        self.search_tolerance = search_tolerance
+        self.search_criteria = search_criteria
+        self.search_query = search_query
+        parts = {"network": network_signature(input_network),
+                 "travel_mode": travel_mode,
+                 "search_tolerance": search_tolerance,
+                 "search_criteria": search_criteria,
+                 "search_query": search_query}
+        key = hashlib.sha256(json.dumps(parts, sort_keys = True, default = settings_text).encode()).hexdigest()
+        self.folder = os.path.join(cache_dir, key[:16])
+        os.makedirs(os.path.join(self.folder, "prepared"), exist_ok = True)
+        with open(os.path.join(self.folder, "settings.json"), "w") as f:
+            json.dump(parts, f, indent = 1, default = settings_text)
+
+    # ----- whole preprocessed inputs -----
+
+    def input_signature(self, input_fc, fields, flags = None):
+        # hash of what preprocess_x reads from the input: ids (and o_j),
+        # geometries and the preprocessing flags
+        import arcpy
+        fields = [f for f in fields if f] + ["SHAPE@WKB"]
+        with arcpy.da.SearchCursor(input_fc, fields) as cursor:
+            digest = rows_hash(cursor)
+        parts = {"format": PREPARE_FORMAT, "rows": digest, "fields": fields, "flags": flags}
+        return hashlib.sha256(json.dumps(parts, sort_keys = True, default = settings_text).encode()).hexdigest()
+
+    def prepared_path(self, signature):
+        return os.path.join(self.folder, "prepared", signature)
+
+    def restore(self, signature, out_fc):
+        # rebuilds a preprocessed feature class; False when it is not cached
+        import arcpy
+        import numpy as np
+        path = self.prepared_path(signature)
+        if not os.path.exists(path+".json"):
+            return False
+        with open(path+".json") as f:
+            meta = json.load(f)
+        array = np.load(path+".npy", allow_pickle = False)
+        spatial_reference = arcpy.SpatialReference()
+        spatial_reference.loadFromString(meta["spatial_reference"])
+        if arcpy.Exists(out_fc):
+            arcpy.management.Delete(out_fc)
+        arcpy.da.NumPyArrayToFeatureClass(array, out_fc, ("_x", "_y"), spatial_reference)
+        os.utime(path+".json", None)
+        return True
+
+    def store(self, signature, input_fc, exclude = ("batch_id",)):
+        # keeps the located feature class, without the per-run batching
+        import arcpy
+        import numpy as np
+        numeric = ("SmallInteger", "Integer", "Single", "Double")
+        fields = [f for f in arcpy.ListFields(input_fc)
+                  if f.type not in ("OID", "Geometry") and f.name not in exclude and not f.name.lower().startswith("shape")]
+        array = arcpy.da.FeatureClassToNumPyArray(input_fc, [f.name for f in fields] + ["SHAPE@X", "SHAPE@Y"],
+                                                  null_value = dict([(f.name, 0) for f in fields if f.type in numeric]))
+        array.dtype.names = tuple([f.name for f in fields] + ["_x", "_y"])
+        path = self.prepared_path(signature)
+        replace_file(path+".npy", lambda f: np.save(f, array, allow_pickle = False))
+        meta = {"spatial_reference": arcpy.Describe(input_fc).spatialReference.exportToString(),
+                "rows": len(array), "created": time.time()}
+        replace_file(path+".json", lambda f: json.dump(meta, f), "w")
+
+    # ----- network locations by point -----
+
+    def locations_path(self, input_fc):
+        import arcpy
+        spatial_reference = arcpy.Describe(input_fc).spatialReference.exportToString()
+        return os.path.join(self.folder, "locations_"+hashlib.sha256(spatial_reference.encode()).hexdigest()[:12]+".parquet")
+
+    def apply(self, input_fc):
+        # copies cached locations onto matching points and flags them in
+        # loc_cached; returns (reused, total)
+        import arcpy
+        import pandas as pd
+        path = self.locations_path(input_fc)
+        total = int(arcpy.management.GetCount(input_fc).getOutput(0))
+        if not os.path.exists(path):
+            return 0, total
+        table = pd.read_parquet(path)
+        # unlocated points come back as nan; cursors want None
+        table = table.astype(object).where(table.notna(), None)
+        names = [c for c in table.columns if c not in ("x", "y")]
+        for name, field_type in LOCATION_FIELDS:
+            if name in names and field_type == "LONG":
+                table[name] = [None if v is None else int(v) for v in table[name]]
+        lookup = dict(zip(zip(table["x"], table["y"]), table[names].itertuples(index = False, name = None)))
+        existing = [f.name for f in arcpy.ListFields(input_fc)]
+        for name, field_type in LOCATION_FIELDS:
+            if name in names and name not in existing:
+                arcpy.management.AddField(input_fc, name, field_type)
+        arcpy.management.AddField(input_fc, "loc_cached", "SHORT")
+        reused = 0
+        with arcpy.da.UpdateCursor(input_fc, ["SHAPE@XY", "loc_cached"] + names) as updateRows:
+            for updateRow in updateRows:
+                location = lookup.get(point_key(updateRow[0]))
+                if location is None:
+                    updateRow[1] = 0
+                else:
+                    updateRow[1] = 1
+                    updateRow[2:] = location
+                    reused += 1
+                updateRows.updateRow(updateRow)
+        return reused, total
+
+    def locate(self, input_fc, input_type):
+        # reuses what it can and runs CalculateLocations on the rest only
+        import arcpy
+        reused, total = self.apply(input_fc)
+        if reused < total:
+            arcpy.AddMessage("Calculating "+input_type+" Network Locations for "+str(total - reused)+" of "+str(total)+" features...")
+            features = input_fc
+            if reused > 0:
+                features = arcpy.management.MakeFeatureLayer(input_fc, input_type+"_unlocated", "loc_cached = 0")
+            with telemetry.stage("locations", input_type = input_type, reused = reused) as record:
+                arcpy.nax.CalculateLocations(features, self.input_network,
+                                             search_tolerance = self.search_tolerance,
+                                             search_criteria = self.search_criteria,
+                                             search_query = self.search_query,
+                                             travel_mode = self.travel_mode,
+                                             exclude_restricted_elements = "EXCLUDE")
+                record["rows"] = total - reused
+        else:
+            arcpy.AddMessage("Reused cached network locations for all "+str(total)+" "+input_type)
+        if "loc_cached" in [f.name for f in arcpy.ListFields(input_fc)]:
+            arcpy.management.DeleteField(input_fc, "loc_cached")
+        self.store_locations(input_fc)
+        return reused, total
+
+    def store_locations(self, input_fc):
+        import arcpy
+        import pandas as pd
+        existing = [f.name for f in arcpy.ListFields(input_fc)]
+        names = [name for name, field_type in LOCATION_FIELDS if name in existing]
+        rows = [point_key(r[0]) + tuple(r[1:]) for r in arcpy.da.SearchCursor(input_fc, ["SHAPE@XY"] + names)]
+        table = pd.DataFrame(rows, columns = ["x", "y"] + names)
+        path = self.locations_path(input_fc)
+        if os.path.exists(path):
+            table = pd.concat([pd.read_parquet(path), table], ignore_index = True)
+        table = table.drop_duplicates(["x", "y"], keep = "last")
+        replace_file(path, lambda f: table.to_parquet(f, index = False))
+
+def preprocess_flags(input_type, all_destinations = False):
+    # everything besides the input rows that changes what preprocess_x builds
+    return {"input_type": input_type, "all_destinations": all_destinations}
+
+def restore_preprocessed(location_cache_dir, input_fc, input_type, fields, flags, batch_setup, batch_size,
+                         input_network, travel_mode, search_tolerance, search_criteria, search_query):
+    # the cache lookup at the start of every tool's preprocess_x. returns
+    # (location_cache, signature, output_fc): location_cache is None without
+    # a cache folder and output_fc is None unless the located input came back.
+    # origins come back unbatched and go through the tool's batch_setup
+    # (batch_i_setup) so the batch size can change between runs
+    import arcpy
+    if location_cache_dir is None:
+        return None, None, None
+    stage_start = time.time()
+    location_cache = LocationCache(location_cache_dir, input_network, travel_mode, search_tolerance, search_criteria, search_query)
+    signature = location_cache.input_signature(input_fc, fields, flags)
+    if input_type == "origins_i":
+        if not location_cache.restore(signature, r"in_memory/"+input_type):
+            return location_cache, signature, None
+        output_fc = batch_setup(r"in_memory/"+input_type, batch_size)
+        arcpy.management.Delete(r"in_memory")
+    else:
+        output_fc = os.path.join(arcpy.env.workspace+"/"+input_type)
+        if not location_cache.restore(signature, output_fc):
+            return location_cache, signature, None
+    arcpy.AddMessage("Restored located "+input_type+" from the location cache")
+    telemetry.emit("preprocess", stage_start, time.time(), input_type = input_type, cached = True,
+                   rows = int(arcpy.management.GetCount(output_fc).getOutput(0)))
+    return location_cache, signature, output_fc
+
+def list_entries(cache_dir):
+    for folder in sorted(glob.glob(os.path.join(cache_dir, "*", "settings.json"))):
+        folder = os.path.dirname(folder)
+        with open(os.path.join(folder, "settings.json")) as f:
+            settings = json.load(f)
+        print(os.path.basename(folder)+": "+str(settings.get("travel_mode"))+", tolerance "+str(settings.get("search_tolerance")))
+        for path in sorted(glob.glob(os.path.join(folder, "prepared", "*.json"))):
+            with open(path) as f:
+                meta = json.load(f)
+            print("  prepared "+os.path.basename(path)[:12]+": "+str(meta.get("rows"))+" features, "+
+                  time.strftime("%Y-%m-%d %H:%M", time.localtime(os.path.getmtime(path))))
+        for path in sorted(glob.glob(os.path.join(folder, "locations_*.parquet"))):
+            print("  "+os.path.basename(path)+": "+str(round(os.path.getsize(path)/1048576, 1))+" MB")
+
+if __name__ == '__main__':
+    list_entries(sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.getcwd(), "location_cache"))
@@ -0,0 +1,320 @@
+# Memory Budget for the Accessibility Toolbox
+# Christopher D. Higgins
+# Department of Human Geography
+# University of Toronto Scarborough
+# https://higgicd.github.io
+# tool help can be found at https://github.com/higgicd/Accessibility_Toolbox
+
+# one memory budget in megabytes sizes the work that batch_size_factor and
+# the record batch defaults used to size by trial and error. the budget is
+# split into equal shares for the parent (which finalizes) and each worker:
+#   origin batches  batch_size_factor is capped at the origins whose od lines
+#                   fit a worker's share: share / (destinations x expected
+#                   reachable fraction x bytes per line)
+#   record batches  parquet scans read batches of a quarter of a share
+#   spilling        work found to be larger than a share is not held in
+#                   memory: worker files are finalized in parts, solved lines
+#                   are exported to the worker gdb instead of in_memory and
+#                   scenario diff groups are bucketed on disk
+#   concurrency     the Governor only hands a job to the pool while the
+#                   memory of the parent and its workers leaves room
+#                   for one more and the machine has memory available; jobs
+#                   that are running are never stopped, so a run under
+#                   pressure slows down instead of swapping
+# the budget is published in ACCESS_MEMORY_BUDGET, ACCESS_MEMORY_PROCESSES and
+# ACCESS_MEMORY_REACHABLE so spawned workers size their own scans from it;
+# without a budget every size keeps its default
+#
+# usage: python memory_budget.py --budget 4000 --destinations 60000 [--reachable 0.4] [--processes 4]
+
+import os, sys
+import time
+import functools
+import multiprocessing
+from access_core import cpu_count
+from worker_stats import current_rss_mb, current_pss_mb, available_memory_mb, format_mb
+
+BUDGET_ENV = "ACCESS_MEMORY_BUDGET"
+PROCESSES_ENV = "ACCESS_MEMORY_PROCESSES"
+REACHABLE_ENV = "ACCESS_MEMORY_REACHABLE"
+BUDGET_ENVS = (BUDGET_ENV, PROCESSES_ENV, REACHABLE_ENV)
+
+# peak bytes per row held by each kind of work; finalize, scan and diff are
+# measured (benchmarks/stress_memory_budget.py) with a margin, the solver's
+# in_memory lines can only be estimated outside arcgis
+ROW_BYTES = {"od_lines": 200,  # solved od lines in an in_memory table with the Ai_ fields
+             "finalize": 160,  # worker lines joined to their ids in pandas before writing
+             "scan": 1024,     # a record batch of (i, j, t) with text ids, codes and f(t_ij)
+             "diff": 144,      # both sides of a scenario diff job as sorted keys and times
+             "summary": 128}   # a batch of an accessibility table joined to the origins
+SCAN_SHARE = 0.25
+MIN_SCAN_ROWS = 16384
+MAX_SCAN_ROWS = 4194304
+DEFAULT_RESERVE_MB = 512
+JOB_MARGIN = 1.25
+
+class MemoryBudget(object):
+    # budget_mb over the parent and processes workers; reachable_fraction is
+    # the expected share of destinations an origin reaches within the cutoff
+    # (1 when unknown, the safe side)
+    def __init__(self, budget_mb, processes = 1, reachable_fraction = 1.0):
+        if budget_mb is None or float(budget_mb) <= 0:
+            raise Exception("The memory budget must be a positive number of megabytes, not "+str(budget_mb))
+        if not 0 < float(reachable_fraction) <= 1:
+            raise Exception("The reachable fraction must be in (0, 1], not "+str(reachable_fraction))
+        self.budget_mb = float(budget_mb)
+        self.processes = max(1, int(processes))
+        self.reachable_fraction = float(reachable_fraction)
+
+    def share_mb(self):
+        return self.budget_mb/(self.processes + 1)
+
+    def rows(self, kind, share = 1.0):
+        # rows of a kind of work that fit in share of a process' share
+        return max(1, int(self.share_mb()*share*1048576//ROW_BYTES[kind]))
+
+    def origin_batch_size(self, n_destinations, reachable_fraction = None):
+        fraction = reachable_fraction if reachable_fraction is not None else self.reachable_fraction
+        return max(1, int(self.rows("od_lines")//max(1.0, n_destinations*fraction)))
+
+    def scan_rows(self, kind):
+        return min(max(self.rows(kind, SCAN_SHARE), MIN_SCAN_ROWS), MAX_SCAN_ROWS)
+
+    def publish(self):
+        # for the workers spawned after this
+        os.environ[BUDGET_ENV] = repr(self.budget_mb)
+        os.environ[PROCESSES_ENV] = str(self.processes)
+        os.environ[REACHABLE_ENV] = repr(self.reachable_fraction)
+        return self
+
+    def describe(self, n_destinations = None, reachable_fraction = None):
+        fraction = reachable_fraction if reachable_fraction is not None else self.reachable_fraction
+        text = (format_mb(self.budget_mb)+" over "+str(self.processes)+" workers and the parent ("+
+                format_mb(self.share_mb())+" each)")
+        if n_destinations is not None:
+            text += ", at most "+str(self.origin_batch_size(n_destinations, fraction))+" origins per batch for "+str(n_destinations)+\
+                    " destinations "+str(round(fraction*100))+"% reachable"
+        return text+", scans of "+str(self.scan_rows("scan"))+" rows"
+
+def active_budget(processes = None):
+    # the budget published for this run (or set in the environment), or None;
+    # without a published number of workers it is split like the tools' pool,
+    # without a published reachable fraction every destination is reached
+    if not os.environ.get(BUDGET_ENV):
+        return None
+    if os.environ.get(PROCESSES_ENV):
+        processes = int(os.environ[PROCESSES_ENV])
+    if processes is None:
+        processes = cpu_count(multiprocessing.cpu_count())
+    return MemoryBudget(float(os.environ[BUDGET_ENV]), processes, float(os.environ.get(REACHABLE_ENV) or 1.0))
+
+def clear_budget():
+    for name in BUDGET_ENVS:
+        os.environ.pop(name, None)
+
+def use_budget(memory_budget, processes, reachable_fraction = 1.0):
+    # the start of a tool's main: publishes its budget, or clears one a
+    # previous run in the same session left behind
+    if memory_budget is None:
+        clear_budget()
+        return None
+    return MemoryBudget(memory_budget, processes, reachable_fraction).publish()
+
+def restores_budget(main):
+    # puts back the budget published before a tool's main once it returns
+    # or fails: none after a run of its own, the outer run's for a tool run
+    # inside another (scenario_runner, preview_main)
+    @functools.wraps(main)
+    def run(*args, **kwargs):
+        saved = dict([(name, os.environ.get(name)) for name in BUDGET_ENVS])
+        try:
+            return main(*args, **kwargs)
+        finally:
+            for name, value in saved.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+    return run
+
+def scan_rows(kind, default = None):
+    # record batch rows for a scan: from the budget, else the caller's default
+    budget = active_budget()
+    return budget.scan_rows(kind) if budget is not None else default
+
+def scan_options(kind):
+    # dataset.to_batches options: under the budget, batches of the budget's
+    # rows with little read ahead (pyarrow's defaults keep dozens of batches
+    # of several files in flight); pyarrow's defaults without
+    rows = scan_rows(kind)
+    if rows is None:
+        return {}
+    return {"batch_size": rows, "batch_readahead": 2, "fragment_readahead": 1}
+
+def spill_rows(kind, default = None):
+    # rows one process holds before the work spills: from the budget, else default
+    budget = active_budget()
+    return budget.rows(kind) if budget is not None else default
+
+def fits(rows, kind):
+    # does work of rows rows fit in a share of the budget? always without one
+    budget = active_budget()
+    return budget is None or rows <= budget.rows(kind)
+
+# ----- concurrency -----
+
+def process_mb(pid = None):
+    # memory of a process: its proportional set size where the os reports it,
+    # as forked workers share pages with the parent, else its resident set
+    return current_pss_mb(pid) or current_rss_mb(pid)
+
+def worker_memory_mb():
+    # megabytes of each child process (the pool workers)
+    sizes = [process_mb(child.pid) for child in multiprocessing.active_children()]
+    return [mb for mb in sizes if mb is not None]
+
+def release_memory():
+    # hands memory freed by a finished job back to the os: pyarrow's pool and
+    # glibc both keep freed pages for reuse, so an idle worker would otherwise
+    # stay at the size of its largest job
+    if "pyarrow" in sys.modules:
+        sys.modules["pyarrow"].default_memory_pool().release_unused()
+    if sys.platform.startswith("linux"):
+        try:
+            import ctypes
+            ctypes.CDLL("libc.so.6").malloc_trim(0)
+        except (OSError, AttributeError):
+            pass
+
+class ReleasingJob(object):
+    # a pool job that releases its memory when it returns
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, job):
+        try:
+            return self.func(job)
+        finally:
+            release_memory()
+
+class Governor(object):
+    # runs pool jobs with apply_async, starting one only while the parent and
+    # the workers leave room for it under the budget and the machine keeps
+    # reserve_mb available. the memory a job adds is job_mb, or learned: the
+    # first job runs alone, then the largest growth of a worker over its idle
+    # size, padded by JOB_MARGIN as jobs differ, and at least a share.
+    # running jobs are assumed to grow to it
+    def __init__(self, budget, processes, reserve_mb = DEFAULT_RESERVE_MB, job_mb = None, poll = 0.05):
+        self.budget = budget
+        self.processes = max(1, int(processes))
+        self.reserve_mb = reserve_mb
+        self.job_mb = job_mb
+        self.poll = poll
+        self.idle_mb = None
+        self.learned_mb = 0.0
+        self.stats = {"budget_mb": budget.budget_mb, "peak_mb": 0.0, "jobs": 0, "max_running": 0,
+                      "throttled_seconds": 0.0, "min_running_throttled": None}
+
+    def sample(self):
+        # (megabytes of the parent and its workers, growth of each worker)
+        workers = worker_memory_mb()
+        growth = []
+        if workers:
+            self.idle_mb = min([self.idle_mb or min(workers)] + workers)
+            growth = sorted([mb - self.idle_mb for mb in workers], reverse = True)
+            self.learned_mb = max(self.learned_mb, growth[0])
+        total = (process_mb() or 0.0) + sum(workers)
+        self.stats["peak_mb"] = max(self.stats["peak_mb"], total)
+        return total, growth
+
+    def job_estimate(self):
+        if self.job_mb is not None:
+            return self.job_mb
+        return max(JOB_MARGIN*self.learned_mb, self.budget.share_mb())
+
+    def room(self, projected_mb, estimate_mb):
+        if projected_mb + estimate_mb > self.budget.budget_mb:
+            return False
+        available = available_memory_mb()
+        return available is None or available - estimate_mb >= self.reserve_mb
+
+    def run(self, pool, func, jobs):
+        # yields (job index, result) as jobs complete
+        running, k = [], 0
+        func = ReleasingJob(func)
+        while k < len(jobs) or running:
+            finished = [(index, r) for index, r in running if r.ready()]
+            for item in finished:
+                running.remove(item)
+            self.stats["jobs"] += len(finished)
+            for index, r in finished:
+                yield index, r.get()
+            used, growth = self.sample()
+            estimate = self.job_estimate()
+            # the workers that grew most are taken to be the busy ones
+            projected = used + sum([max(0.0, estimate - g) for g in (growth + [0.0]*len(running))[:len(running)]])
+            while k < len(jobs) and len(running) < self.processes:
+                # one job always runs, so the run finishes even over budget
+                if running and (not self.room(projected, estimate) or (self.job_mb is None and self.stats["jobs"] == 0)):
+                    break
+                running.append((k, pool.apply_async(func, (jobs[k],))))
+                k += 1
+                projected += estimate
+            self.stats["max_running"] = max(self.stats["max_running"], len(running))
+            throttled = k < len(jobs) and len(running) < self.processes
+            wait_start = time.time()
+            if running:
+                running[0][1].wait(self.poll)
+            if throttled:
+                self.stats["throttled_seconds"] += time.time() - wait_start
+                lowest = self.stats["min_running_throttled"]
+                self.stats["min_running_throttled"] = len(running) if lowest is None else min(lowest, len(running))
+
+    def imap_unordered(self, pool, func, jobs):
+        for index, result in self.run(pool, func, jobs):
+            yield result
+
+    def map(self, pool, func, jobs):
+        results = [None]*len(jobs)
+        for index, result in self.run(pool, func, jobs):
+            results[index] = result
+        return results
+
+def governed_map(pool, func, jobs, processes, record = None):
+    # pool.map, governed by the published budget when there is one; the
+    # governor's stats go into record (a telemetry stage record)
+    budget = active_budget(processes)
+    if budget is None:
+        return pool.map(func, jobs)
+    governor = Governor(budget, processes)
+    results = governor.map(pool, func, jobs)
+    if record is not None:
+        record["governor"] = governor.stats
+    return results
+
+def governed_imap_unordered(pool, func, jobs, processes, chunksize = 1, record = None):
+    budget = active_budget(processes)
+    if budget is None:
+        for result in pool.imap_unordered(func, jobs, chunksize):
+            yield result
+        return
+    governor = Governor(budget, processes)
+    for result in governor.imap_unordered(pool, func, jobs):
+        yield result
+    if record is not None:
+        record["governor"] = governor.stats
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description = "Batch and scan sizes from a memory budget")
+    parser.add_argument("--budget", type = float, required = True, help = "megabytes for the whole run")
+    parser.add_argument("--destinations", type = int, required = True)
+    parser.add_argument("--reachable", type = float, default = 1.0, help = "expected share of destinations reached")
+    parser.add_argument("--processes", type = int, default = max(1, multiprocessing.cpu_count() - 1))
+    args = parser.parse_args()
+    budget = MemoryBudget(args.budget, args.processes, args.reachable)
+    print("budget: "+budget.describe(args.destinations))
+    for kind in sorted(ROW_BYTES):
+        print("  "+kind.ljust(10)+str(ROW_BYTES[kind]).rjust(5)+" bytes/row  "+str(budget.rows(kind)).rjust(11)+
+              " rows per share  scans of "+str(budget.scan_rows(kind)))
+    print("available now: "+format_mb(available_memory_mb()))
@@ -0,0 +1,214 @@
+# Multi-Opportunity Accessibility from a Stored OD Matrix
+# Christopher D. Higgins
+# Department of Human Geography
+# University of Toronto Scarborough
+# https://higgicd.github.io
+# tool help can be found at https://github.com/higgicd/Accessibility_Toolbox
+
+# accessibility to several opportunity types at once. the od matrix (from the
+# od cost matrix to parquet tool or r5r) is read once into a sparse origins x
+# destinations matrix in csr order; for each impedance measure the travel
+# times become weights f(t_ij) and one sparse x dense product with the
+# opportunities matrix (one column per type) gives A_i for every type:
+#   A = W_f @ O    (n_i x n_j) @ (n_j x n_types)
+# so n_types x n_measures results cost one matrix read plus n_measures
+# products. scipy.sparse is used when it is installed, otherwise the same
+# product runs on numpy in row blocks
+#
+# usage: python multi_access.py [od_path]  (compares against one pass per type and measure on r5_ttm)
+
+import sys
+import time
+import access_core
+from incremental_access import od_columns
+from memory_budget import scan_options
+
+# ----- od matrix -----
+
+class SparseOD(object):
+    # od matrix as csr arrays: indptr over origins, destination codes and
+    # travel time codes (t_values[t_codes] is the travel time of each row).
+    # with precision "single" the weights are float32
+    def __init__(self, od_path, del_i_eq_j = False, precision = "double"):
+        import numpy as np
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.dataset as ds
+        self.precision = precision
+        dataset = ds.dataset(od_path, format = "parquet", partitioning = "hive")
+        i_col, j_col, t_col = od_columns(dataset.schema)
+
+        # ids are kept as text like the i_id_text/j_id_text fields of the tools
+        origins, destinations = set(), set()
+        for batch in dataset.to_batches(columns = [i_col, j_col], **scan_options("scan")):
+            origins.update(pc.unique(batch.column(i_col).cast(pa.string())).to_pylist())
+            destinations.update(pc.unique(batch.column(j_col).cast(pa.string())).to_pylist())
+        self.origin_ids = pa.array(sorted(origins), pa.string())
+        self.destination_ids = pa.array(sorted(destinations), pa.string())
+
+        i_parts, j_parts, t_parts = [], [], []
+        for batch in dataset.to_batches(columns = [i_col, j_col, t_col], **scan_options("scan")):
+            i_parts.append(pc.index_in(batch.column(i_col).cast(pa.string()), value_set = self.origin_ids)
+                           .to_numpy(zero_copy_only = False).astype(np.int32))
+            j_parts.append(pc.index_in(batch.column(j_col).cast(pa.string()), value_set = self.destination_ids)
+                           .to_numpy(zero_copy_only = False).astype(np.int32))
+            t_parts.append(batch.column(t_col).to_numpy(zero_copy_only = False))
+        i_codes = np.concatenate(i_parts)
+        j_codes = np.concatenate(j_parts)
+        t_ij = np.concatenate(t_parts)
+        del i_parts, j_parts, t_parts
+        if del_i_eq_j:
+            i_to_j = pc.index_in(self.origin_ids, value_set = self.destination_ids).fill_null(-1).to_numpy(zero_copy_only = False)
+            keep = i_to_j[i_codes] != j_codes
+            i_codes, j_codes, t_ij = i_codes[keep], j_codes[keep], t_ij[keep]
+
+        # csr order: rows sorted by origin
+        order = np.argsort(i_codes, kind = "stable")
+        counts = np.bincount(i_codes, minlength = len(self.origin_ids))
+        self.indptr = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        self.indices = j_codes[order]
+        del j_codes
+        # impedance functions only run once per distinct travel time
+        t_ij = t_ij[order]
+        if np.issubdtype(t_ij.dtype, np.integer):
+            t_min = int(t_ij.min()) if len(t_ij) else 0
+            self.t_values = np.arange(t_min, int(t_ij.max()) + 1 if len(t_ij) else 1, dtype = np.float64)
+            self.t_codes = (t_ij - t_min).astype(np.int32)
+        else:
+            self.t_values, t_codes = np.unique(t_ij, return_inverse = True)
+            self.t_codes = t_codes.astype(np.int32)
+        self.nnz = len(self.indices)
+        self.shape = (len(self.origin_ids), len(self.destination_ids))
+
+    def weights(self, f_name):
+        # f(t_ij) for every stored od pair
+        return access_core.impedance_array(self.t_values, f_name, self.precision)[self.t_codes]
+
+    def destination_codes(self, j_ids):
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        codes = pc.index_in(pa.array([str(x) for x in j_ids], pa.string()), value_set = self.destination_ids)
+        return codes.fill_null(-1).to_numpy(zero_copy_only = False).astype("int64")
+
+# ----- opportunities -----
+
+def opportunity_matrix(od, opportunities):
+    # {type: {j_id: o_j}} -> (n_destinations x n_types) matrix in the od's
+    # destination order; destinations the od matrix never reaches are dropped
+    import numpy as np
+    types = list(opportunities.keys())
+    matrix = np.zeros((od.shape[1], len(types)), dtype = access_core.value_dtype(od.precision))
+    for k, type_name in enumerate(types):
+        values = opportunities[type_name]
+        codes = od.destination_codes(list(values.keys()))
+        column = np.array([v or 0 for v in values.values()], dtype = np.float64)
+        matrix[codes[codes >= 0], k] = column[codes >= 0]
+    return types, matrix
+
+# ----- products -----
+
+def sparse_product(od, weights, matrix, block_rows = 4000000):
+    # (n_i x n_j) csr with the given data @ dense (n_j x n_types); the row
+    # products are in the precision of the inputs, the sums always float64
+    import numpy as np
+    try:
+        from scipy.sparse import csr_matrix
+    except ImportError:
+        csr_matrix = None
+    if csr_matrix is not None:
+        return np.asarray(csr_matrix((weights, od.indices, od.indptr), shape = od.shape) @ matrix.astype(np.float64))
+    # numpy: rows are in origin order, so per-origin sums are reduceat over
+    # the row blocks of whole origins
+    result = np.zeros((od.shape[0], matrix.shape[1]))
+    counts = np.diff(od.indptr)
+    start_origin = 0
+    while start_origin < od.shape[0]:
+        end_origin = int(np.searchsorted(od.indptr, od.indptr[start_origin] + block_rows, side = "right")) - 1
+        end_origin = min(max(end_origin, start_origin + 1), od.shape[0])
+        lo, hi = od.indptr[start_origin], od.indptr[end_origin]
+        reached = counts[start_origin:end_origin] > 0
+        if hi > lo:
+            starts = (od.indptr[start_origin:end_origin] - lo)[reached]
+            block_weights = weights[lo:hi]
+            block_matrix = matrix[od.indices[lo:hi]]
+            for k in range(matrix.shape[1]):
+                result[start_origin:end_origin, k][reached] = np.add.reduceat(block_weights*block_matrix[:, k], starts,
+                                                                                         dtype = np.float64)
+        start_origin = end_origin
+    return result
+
+def multi_accessibility(od, opportunities, selected_impedance_function):
+    # wide per-origin table: i_id, FREQUENCY_<type> (destinations with
+    # opportunities of that type within reach) and SUM_Ai_<measure>_<type>
+    import numpy as np
+    import pandas as pd
+    types, matrix = opportunity_matrix(od, opportunities)
+    columns = {"i_id": od.origin_ids.to_pylist()}
+    frequency = sparse_product(od, np.ones(od.nnz, dtype = matrix.dtype), (matrix > 0).astype(matrix.dtype))
+    for k, type_name in enumerate(types):
+        columns["FREQUENCY_"+type_name] = frequency[:, k].astype(np.int64)
+    for f_name in selected_impedance_function:
+        sums = sparse_product(od, od.weights(f_name), matrix)
+        for k, type_name in enumerate(types):
+            columns["SUM_Ai_"+f_name+"_"+type_name] = sums[:, k]
+    df = pd.DataFrame(columns)
+    # origins that reach no opportunity of any type, like the accessibility tool output
+    return df[frequency.sum(axis = 1) > 0].reset_index(drop = True)
+
+# ----- versus one pass per type and measure -----
+
+def compare_passes(od_path = "r5_ttm", n_types = 4, selected_impedance_function = ("CUMR45", "HN1997", "MGAUS180"), seed = 1):
+    import numpy as np
+    import pandas as pd
+    import pyarrow.dataset as ds
+    from synthetic_ttm import synthetic_opportunities
+    selected_impedance_function = list(selected_impedance_function)
+    start = time.perf_counter()
+    od = SparseOD(od_path)
+    read_s = time.perf_counter() - start
+    print("od matrix: "+str(od.nnz)+" rows, "+str(od.shape[0])+" origins x "+str(od.shape[1])+" destinations, read in "+
+          str(round(read_s, 1))+" s")
+    j_ids = od.destination_ids.to_pylist()
+    opportunities = {}
+    for k in range(n_types):
+        values = synthetic_opportunities(len(j_ids), seed + k)
+        # each type only at some destinations
+        values[np.random.default_rng(seed + k).random(len(j_ids)) < 0.5] = 0
+        opportunities["type"+str(k + 1)] = dict(zip(j_ids, values))
+    start = time.perf_counter()
+    wide = multi_accessibility(od, opportunities, selected_impedance_function)
+    multi_s = time.perf_counter() - start
+    print(str(n_types)+" types x "+str(len(selected_impedance_function))+" measures: "+str(round(read_s + multi_s, 1))+
+          " s including the read ("+str(round(multi_s, 1))+" s of products)")
+
+    # the one-type-at-a-time way: a full streaming pass over the matrix for every type
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    origin_ids, destination_ids, n_origins = od.origin_ids, od.destination_ids, od.shape[0]
+    del od
+    dataset = ds.dataset(od_path, format = "parquet", partitioning = "hive")
+    i_col, j_col, t_col = od_columns(dataset.schema)
+    wide = pd.DataFrame({"i_id": origin_ids.to_pylist()}).merge(wide, on = "i_id", how = "left").fillna(0)
+    start = time.perf_counter()
+    worst = 0.0
+    for type_name, values in opportunities.items():
+        o_j_codes = np.array([values[j_id] for j_id in destination_ids.to_pylist()], dtype = np.float64)
+        sums = dict([(f_name, np.zeros(n_origins)) for f_name in selected_impedance_function])
+        for batch in dataset.to_batches(columns = [i_col, j_col, t_col]):
+            i_codes = pc.index_in(batch.column(i_col).cast(pa.string()), value_set = origin_ids).to_numpy(zero_copy_only = False)
+            j_codes = pc.index_in(batch.column(j_col).cast(pa.string()), value_set = destination_ids).to_numpy(zero_copy_only = False)
+            o_j = o_j_codes[j_codes]
+            keep = o_j > 0
+            for f_name, values_f in access_core.accessibility(i_codes[keep], batch.column(t_col).to_numpy()[keep], o_j[keep],
+                                                              selected_impedance_function, n_origins).items():
+                sums[f_name] += values_f
+        for f_name in selected_impedance_function:
+            expected = sums[f_name]
+            got = wide["SUM_Ai_"+f_name+"_"+type_name].to_numpy()
+            worst = max(worst, float(np.abs(got - expected).max()/max(np.abs(expected).max(), 1e-12)))
+    passes_s = time.perf_counter() - start
+    print("one pass per type: "+str(round(passes_s, 1))+" s, "+str(round(passes_s/(read_s + multi_s), 1))+
+          "x slower; max relative difference "+str(worst))
+
+if __name__ == '__main__':
+    compare_passes(sys.argv[1] if len(sys.argv) > 1 else "r5_ttm")
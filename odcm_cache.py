@@ -0,0 +1,329 @@
+# Solved OD Batch Cache
+# Christopher D. Higgins
+# Department of Human Geography
+# University of Toronto Scarborough
+# https://higgicd.github.io
+# tool help can be found at https://github.com/higgicd/Accessibility_Toolbox
+
+# solved batch od matrices are stored on disk under a content address built
+# from everything that determines the solve: the network dataset, travel mode,
+# cutoff, departure time, location search settings and a hash of the batch's
+# origin and destination ids, geometries and network locations. any tool that
+# asks for a batch that was already solved, by itself or by another tool,
+# reads it back instead of solving it again.
+#
+# every entry has the same canonical format whichever tool solved it:
+#   lines.arrow         OriginOID, DestinationOID, DestinationRank, Total_Time
+#   origins.parquet     ObjectID, Name, i_id
+#   destinations.parquet ObjectID, Name, j_id
+#   meta.json           key parts, rows, bytes, created
+# entries are written to a temporary folder and renamed into place, so
+# concurrent workers never see half-written entries. the least recently used
+# entries are evicted once the cache grows past max_bytes.
+#
+# usage: python odcm_cache.py D:/access_multi/odcm_cache  (prints the statistics)
+
+import os, sys
+import json
+import glob
+import time
+import shutil
+import socket
+import hashlib
+import tempfile
+
+CACHE_FORMAT = 1
+LINE_FIELDS = ["OriginOID", "DestinationOID", "DestinationRank", "Total_Time"]
+# fields written by CalculateLocations; they capture the effect of the search settings
+LOCATION_FIELDS = ["SourceID", "SourceOID", "PosAlong", "SideOfEdge", "SnapX", "SnapY", "DistanceToNetworkInMeters"]
+
+# ----- keys -----
+
+def network_signature(input_network):
+    # identity of a network dataset: its path plus the size and modification
+    # time of every file of the geodatabase (or folder) that holds it, so a
+    # rebuilt network gets new keys
+    path = str(input_network)
+    root = path
+    while root and not root.lower().endswith(".gdb") and not os.path.isdir(root):
+        parent = os.path.dirname(root)
+        if parent == root:
+            break
+        root = parent
+    digest = hashlib.sha256(os.path.normcase(os.path.abspath(path)).encode())
+    if root and os.path.isdir(root):
+        for dir_path, dir_names, file_names in os.walk(root):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                if file_name.endswith(".lock"):
+                    continue
+                stat = os.stat(os.path.join(dir_path, file_name))
+                digest.update((file_name+":"+str(stat.st_size)+":"+str(int(stat.st_mtime))).encode())
+    return digest.hexdigest()
+
+def rows_hash(rows):
+    # order-independent hash of feature rows
+    digest = hashlib.sha256()
+    for row in sorted([repr(tuple(r)) for r in rows]):
+        digest.update(row.encode())
+        digest.update(b"\n")
+    return digest.hexdigest()
+
+def feature_hashes(input_fc, id_field, group_field = None):
+    # {group: hash} over id, point geometry and network location fields;
+    # without a group_field the whole feature class is one group (None)
+    import arcpy
+    existing = [f.name for f in arcpy.ListFields(input_fc)]
+    fields = [id_field, "SHAPE@XY"] + [f for f in LOCATION_FIELDS if f in existing]
+    if group_field is not None:
+        fields.append(group_field)
+    groups = {}
+    with arcpy.da.SearchCursor(input_fc, fields) as cursor:
+        for row in cursor:
+            key = row[-1] if group_field is not None else None
+            groups.setdefault(key, []).append(row[:-1] if group_field is not None else row)
+    return dict([(key, rows_hash(rows)) for key, rows in groups.items()])
+
+def settings_text(value):
+    # geoprocessing values (linear units, value tables) by their text form so
+    # keys do not depend on object reprs
+    if hasattr(value, "exportToString"):
+        return value.exportToString()
+    return str(value)
+
+def batch_key(network, travel_mode, cutoff, time_of_day, search_settings, origins_hash, destinations_hash):
+    parts = {"format": CACHE_FORMAT,
+             "network": network,
+             "travel_mode": settings_text(travel_mode),
+             "cutoff": cutoff,
+             "time_of_day": time_of_day,
+             "search_settings": search_settings,
+             "origins": origins_hash,
+             "destinations": destinations_hash}
+    return hashlib.sha256(json.dumps(parts, sort_keys = True, default = settings_text).encode()).hexdigest()
+
+class BatchKeys(object):
+    # parent side: hashes the network and the preprocessed origins (per
+    # batch) and destinations once, then builds the key of any batch
+    def __init__(self, input_network, travel_mode, cutoff, search_settings, origins_i, destinations_j):
+        self.network = network_signature(input_network)
+        self.travel_mode = travel_mode
+        self.cutoff = cutoff
+        self.search_settings = search_settings
+        self.origin_hashes = feature_hashes(origins_i, "i_id", "batch_id")
+        self.destinations_hash = feature_hashes(destinations_j, "j_id").get(None)
+
+    def key(self, batch_id, time_of_day):
+        return batch_key(self.network, self.travel_mode, self.cutoff, time_of_day, self.search_settings,
+                         self.origin_hashes.get(batch_id), self.destinations_hash)
+
+# ----- store -----
+
+class ODCMCache(object):
+    def __init__(self, cache_dir, max_bytes = 20*1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.entries_dir = os.path.join(cache_dir, "entries")
+        self.stats = {"hits": 0, "misses": 0, "puts": 0, "evictions": 0,
+                      "bytes_read": 0, "bytes_written": 0, "bytes_evicted": 0}
+        if not os.path.exists(self.entries_dir):
+            os.makedirs(self.entries_dir, exist_ok = True)
+
+    def entry_path(self, key):
+        return os.path.join(self.entries_dir, key[:2], key)
+
+    def get(self, key):
+        # entry folder, or None; a hit refreshes the entry for lru eviction
+        path = self.entry_path(key)
+        meta_file = os.path.join(path, "meta.json")
+        try:
+            with open(meta_file) as f:
+                meta = json.load(f)
+            os.utime(meta_file, None)
+        except (IOError, OSError, ValueError):
+            self.record("misses")
+            return None
+        self.record("hits", bytes_read = meta.get("bytes", 0))
+        return path
+
+    def put(self, key, write_entry, meta = None):
+        # write_entry(folder) writes the entry files and may return extra
+        # meta fields; returns the entry folder
+        path = self.entry_path(key)
+        if os.path.exists(os.path.join(path, "meta.json")):
+            return path
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        tmp_path = tempfile.mkdtemp(prefix = ".tmp_"+key[:8]+"_", dir = os.path.dirname(path))
+        try:
+            extra = write_entry(tmp_path)
+            meta = dict(meta or {})
+            meta.update(extra or {})
+            meta.update({"key": key, "created": time.time(), "bytes": folder_bytes(tmp_path)})
+            with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+                json.dump(meta, f, default = str)
+            try:
+                os.rename(tmp_path, path)
+            except OSError:
+                # another worker stored the same batch first
+                shutil.rmtree(tmp_path, ignore_errors = True)
+                return path
+        except Exception:
+            shutil.rmtree(tmp_path, ignore_errors = True)
+            raise
+        self.record("puts", bytes_written = meta["bytes"])
+        self.evict(keep = path)
+        return path
+
+    def entries(self):
+        # (last used, bytes, folder) for every complete entry
+        entries = []
+        for meta_file in glob.glob(os.path.join(self.entries_dir, "*", "*", "meta.json")):
+            try:
+                with open(meta_file) as f:
+                    size = json.load(f).get("bytes", 0)
+                entries.append((os.path.getmtime(meta_file), size, os.path.dirname(meta_file)))
+            except (IOError, OSError, ValueError):
+                continue
+        return entries
+
+    def evict(self, keep = None):
+        # least recently used entries go first until the cache fits max_bytes
+        if self.max_bytes is None:
+            return
+        entries = sorted(self.entries())
+        total = sum([e[1] for e in entries])
+        for last_used, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            shutil.rmtree(path, ignore_errors = True)
+            total -= size
+            self.record("evictions", bytes_evicted = size)
+
+    def record(self, counter, **byte_counts):
+        # counters per process in stats_<host>_<pid>.json; cache_stats() adds them up
+        self.stats[counter] += 1
+        for name, value in byte_counts.items():
+            self.stats[name] += value
+        with open(os.path.join(self.cache_dir, "stats_"+socket.gethostname()+"_"+str(os.getpid())+".json"), "w") as f:
+            json.dump(self.stats, f)
+
+def folder_bytes(path):
+    total = 0
+    for dir_path, dir_names, file_names in os.walk(path):
+        total += sum([os.path.getsize(os.path.join(dir_path, f)) for f in file_names])
+    return total
+
+def clear_stats(cache_dir):
+    for stats_file in glob.glob(os.path.join(cache_dir, "stats_*.json")):
+        os.remove(stats_file)
+
+def cache_stats(cache_dir):
+    # hit/miss statistics of every process since the last clear_stats, plus
+    # the current size of the cache
+    totals = {}
+    for stats_file in glob.glob(os.path.join(cache_dir, "stats_*.json")):
+        try:
+            with open(stats_file) as f:
+                for name, value in json.load(f).items():
+                    totals[name] = totals.get(name, 0) + value
+        except (IOError, OSError, ValueError):
+            continue
+    entries = ODCMCache(cache_dir, None).entries()
+    totals["entries"] = len(entries)
+    totals["cache_bytes"] = sum([e[1] for e in entries])
+    lookups = totals.get("hits", 0) + totals.get("misses", 0)
+    totals["hit_rate"] = totals.get("hits", 0)/lookups if lookups else 0.0
+    return totals
+
+def format_stats(stats):
+    return (str(stats.get("hits", 0))+" hits, "+str(stats.get("misses", 0))+" misses ("+
+            str(round(100*stats["hit_rate"], 1))+"% hit rate), "+str(stats.get("evictions", 0))+" evictions, "+
+            str(stats["entries"])+" entries using "+str(round(stats["cache_bytes"]/1048576, 1))+" MB")
+
+# ----- entries from and to the tools -----
+
+def write_rows(rows, fields, path):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    columns = [list(column) for column in zip(*rows)] or [[] for field in fields]
+    pq.write_table(pa.table(dict(zip(fields, [pa.array(column) for column in columns]))), path)
+
+def store_result(cache, key, result, meta = None):
+    # canonical entry from a solved arcpy.nax od cost matrix result
+    import arcpy
+    output_type = arcpy.nax.OriginDestinationCostMatrixOutputDataType
+    def write_entry(path):
+        result.toArrowTable(output_type.Lines, LINE_FIELDS, os.path.join(path, "lines.arrow"))
+        with result.searchCursor(output_type.Origins, ["ObjectID", "Name", "i_id"]) as cursor:
+            write_rows(list(cursor), ["ObjectID", "Name", "i_id"], os.path.join(path, "origins.parquet"))
+        with result.searchCursor(output_type.Destinations, ["ObjectID", "Name", "j_id"]) as cursor:
+            write_rows(list(cursor), ["ObjectID", "Name", "j_id"], os.path.join(path, "destinations.parquet"))
+        return {"rows": result.count(output_type.Lines)}
+    return cache.put(key, write_entry, meta)
+
+def entry_rows(entry):
+    # rows in the entry without opening the lines
+    with open(os.path.join(entry, "meta.json")) as f:
+        return json.load(f).get("rows")
+
+def restore_arrow(entry, arrow_path, i_ids_path, j_ids_path):
+    # the parquet tools' worker outputs: lines with OriginOID, DestinationOID,
+    # Total_Time plus the ObjectID -> i_id/j_id lookups
+    import pyarrow.feather as ft
+    import pyarrow.parquet as pq
+    lines = ft.read_table(os.path.join(entry, "lines.arrow"), columns = ["OriginOID", "DestinationOID", "Total_Time"])
+    ft.write_feather(lines, arrow_path)
+    pq.write_table(pq.read_table(os.path.join(entry, "origins.parquet"), columns = ["ObjectID", "i_id"]), i_ids_path)
+    pq.write_table(pq.read_table(os.path.join(entry, "destinations.parquet"), columns = ["ObjectID", "j_id"]), j_ids_path)
+    return lines.num_rows
+
+def named_lines(entry):
+    # lines with OriginName/DestinationName, as the exported Lines sublayer has them
+    import numpy as np
+    import pyarrow.feather as ft
+    import pyarrow.parquet as pq
+    lines = ft.read_table(os.path.join(entry, "lines.arrow"))
+    origins = pq.read_table(os.path.join(entry, "origins.parquet"))
+    destinations = pq.read_table(os.path.join(entry, "destinations.parquet"))
+    def names(oids, table):
+        lookup = dict(zip(table.column("ObjectID").to_pylist(), table.column("Name").to_pylist()))
+        return np.array([lookup.get(oid) for oid in oids.to_pylist()], dtype = str)
+    origin_names = names(lines.column("OriginOID"), origins)
+    destination_names = names(lines.column("DestinationOID"), destinations)
+    # text fields at least as wide as the tools' 255 character id fields
+    width = str(max(255, origin_names.dtype.itemsize//4, destination_names.dtype.itemsize//4))
+    array = np.zeros(lines.num_rows, dtype = [("OriginOID", "<i4"), ("DestinationOID", "<i4"), ("DestinationRank", "<i4"),
+                                               ("Total_Time", "<f8"),
+                                               ("OriginName", "<U"+width), ("DestinationName", "<U"+width)])
+    for field in LINE_FIELDS:
+        array[field] = lines.column(field).to_numpy()
+    array["OriginName"] = origin_names
+    array["DestinationName"] = destination_names
+    return array
+
+def restore_lines_table(entry, out_table):
+    # access_calc and odcm: the lines as a table with the fields of the Lines sublayer they use
+    import arcpy
+    if arcpy.Exists(out_table):
+        arcpy.management.Delete(out_table)
+    arcpy.da.NumPyArrayToTable(named_lines(entry), out_table)
+    return out_table
+
+def cache_spec(cache_dir, max_cache_gb, batch_keys, batch_id, time_of_day):
+    # what a worker job carries: None when caching is off
+    if cache_dir is None:
+        return None
+    return (cache_dir, int(max_cache_gb*1024**3), batch_keys.key(batch_id, time_of_day))
+
+def open_cache(spec):
+    if spec is None:
+        return None, None
+    return ODCMCache(spec[0], spec[1]), spec[2]
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("usage: python odcm_cache.py <cache_dir>")
+    else:
+        print(format_stats(cache_stats(sys.argv[1])))
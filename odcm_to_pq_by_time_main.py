@@ -11,13 +11,11 @@ import datetime
 import time
 import arcpy
 import multiprocessing
-import pandas as pd
-import pyarrow as pa
-import pyarrow.parquet as pq
-import pyarrow.feather as ft
-import pyarrow.dataset as ds
 from arcpy import env
-from datetime import datetime, timedelta
+import telemetry
+from access_core import cpu_count, batch_plan, unique_in_order, batch_file_parts, finalize_lines, write_id_table, value_dtype, main_arguments, reload_parameters
+from memory_budget import restores_budget
+from datetime import datetime
 env.overwriteOutput = True
 arcpy.CheckOutExtension("Network")
 
@@ -25,6 +23,8 @@ arcpy.CheckOutExtension("Network")
 # open Start Menu > ArcGIS > Python Command Prompt
 # run this: C:\Progra~1\ArcGIS\Pro\bin\Python\scripts\propy.bat D:\access_calc_main.py
 # change file path of the access_calc_main.py in the code above^
+# or pass a json file of main's arguments instead of uncommenting the parameters
+# below, with times as "YYYY-MM-DD HH:MM": propy.bat D:\odcm_to_pq_by_time_main.py D:\parameters.json
 
 # ----- parameters ----- # change all these as you see fit
 # --- origins ---
@@ -45,8 +45,8 @@ arcpy.CheckOutExtension("Network")
 #input_network = r"D:/access_multi/Toronto_Accessibility_GIS.gdb/GTFS/TransitNetwork_ND" # file path to network dataset
 #travel_mode = "Public transit time" # travel mode
 #cutoff = None # travel time cut-off
-#start_time = datetime.datetime.strptime("12/30/2019 8:00:00 AM", '%m/%d/%Y %I:%M:%S %p') # change start datetime for your analysis
-#end_time = datetime.datetime.strptime("12/30/2019 9:00:00 AM", '%m/%d/%Y %I:%M:%S %p') # change start datetime for your analysis
+#start_time = datetime.strptime("12/30/2019 8:00:00 AM", '%m/%d/%Y %I:%M:%S %p') # change start datetime for your analysis
+#end_time = datetime.strptime("12/30/2019 9:00:00 AM", '%m/%d/%Y %I:%M:%S %p') # change start datetime for your analysis
 #time_delta = 5 # minutes
 
 #batch_size_factor = 500 # this controls how many origins are in a single batch
@@ -119,32 +119,26 @@ def field_map_x(input_fc, field_name, output_field_name):
     return field_map_x
 
 def list_unique(input_fc, field):
-    unique_list = []
     with arcpy.da.SearchCursor(input_fc, field) as cursor:
-        for row in cursor:
-            if row[0] not in unique_list:
-                unique_list.append(row[0])
-    return unique_list
-    
-def cpu_count(cpu_tot):
-    if cpu_tot == 1:
-        cpu_num = 1
-    else:
-        cpu_num = cpu_tot - 1
-    return cpu_num
-
-def batch_size_f(input_fc, batch_size_factor):
+        return unique_in_order(row[0] for row in cursor)
+    
+def batch_size_f(input_fc, batch_size_factor, destinations_fc = None, reachable_fraction = 1.0):
+    from memory_budget import active_budget
     cpu_num = cpu_count(multiprocessing.cpu_count())
     arcpy.AddMessage("There are "+str(multiprocessing.cpu_count())+" cpu cores on this machine, using "+str(cpu_num))
     origins_i_count = int(arcpy.management.GetCount(input_fc).getOutput(0))
     
-    if int(math.ceil(origins_i_count/cpu_num)) <= batch_size_factor:
-        batch_size = int(math.ceil(origins_i_count/cpu_num)+1)
-        batch_count = int(math.ceil(origins_i_count/batch_size))
+    # under a memory budget a batch is at most the origins whose od lines fit a worker's share
+    budget = active_budget(cpu_num)
+    if budget is not None:
+        n_destinations = int(arcpy.management.GetCount(destinations_fc).getOutput(0))
+        arcpy.AddMessage("Memory budget: "+budget.describe(n_destinations, reachable_fraction))
+        batch_size_factor = min(batch_size_factor, budget.origin_batch_size(n_destinations, reachable_fraction))
+    
+    batch_size, batch_count, optimized = batch_plan(origins_i_count, cpu_num, batch_size_factor)
+    if optimized:
         arcpy.AddMessage("Batching is optimized with "+str(batch_count)+" chunks of origins")
     else:
-        batch_size = batch_size_factor
-        batch_count = int(math.ceil(origins_i_count/batch_size_factor))
         arcpy.AddMessage("Batching "+str(batch_count)+" chunks of origins")
     return batch_size
 
@@ -164,18 +158,31 @@ def batch_i_setup(input_fc, batch_size):
 def calculate_nax_locations(input_fc, input_type, input_network, search_tolerance, search_criteria, search_query, travel_mode):
     arcpy.AddMessage("Calculating "+input_type+" Network Locations...")
     print("Calculating "+input_type+" Network Locations...")
-    arcpy.nax.CalculateLocations(input_fc, input_network, 
-                                 search_tolerance = search_tolerance, 
-                                 search_criteria = search_criteria, 
-                                 search_query = search_query,
-                                 travel_mode = travel_mode,
-                                 exclude_restricted_elements = "EXCLUDE")
+    with telemetry.stage("locations", input_type = input_type) as record:
+        arcpy.nax.CalculateLocations(input_fc, input_network, 
+                                     search_tolerance = search_tolerance, 
+                                     search_criteria = search_criteria, 
+                                     search_query = search_query,
+                                     travel_mode = travel_mode,
+                                     exclude_restricted_elements = "EXCLUDE")
+        record["rows"] = int(arcpy.management.GetCount(input_fc).getOutput(0))
 
 def create_dict(input_fc, key_field, value_field):
     valueDict = {r[0]:r[1] for r in arcpy.da.SearchCursor(input_fc, [key_field, value_field])}
     return valueDict
 
-def preprocess_x(input_fc, input_type, id_field, input_network, search_tolerance, search_criteria, search_query, travel_mode, batch_size):
+def preprocess_x(input_fc, input_type, id_field, input_network, search_tolerance, search_criteria, search_query, travel_mode, batch_size,
+                 location_cache_dir = None):
+    from location_cache import preprocess_flags, restore_preprocessed
+    stage_start = time.time()
+    
+    # located inputs from an earlier run? skip straight to batching
+    location_cache, signature, output_fc = restore_preprocessed(location_cache_dir, input_fc, input_type, [id_field],
+                                                                preprocess_flags(input_type), batch_i_setup, batch_size,
+                                                                input_network, travel_mode, search_tolerance,
+                                                                search_criteria, search_query)
+    if output_fc is not None:
+        return output_fc
     
     # add field mappings
     if input_type == "origins_i":
@@ -213,17 +220,23 @@ def preprocess_x(input_fc, input_type, id_field, input_network, search_tolerance
         arcpy.conversion.FeatureClassToFeatureClass(layer, arcpy.env.workspace, input_type)
         output_fc = os.path.join(arcpy.env.workspace+"/"+input_type)
     
-    # calculate network locations
-    calculate_nax_locations(output_fc, input_type, input_network, search_tolerance, search_criteria, search_query, travel_mode)
+    telemetry.emit("preprocess", stage_start, time.time(), input_type = input_type,
+                   rows = int(arcpy.management.GetCount(output_fc).getOutput(0)))
+    
+    # calculate network locations; with the cache only for new or moved points
+    if location_cache is not None:
+        location_cache.locate(output_fc, input_type)
+        location_cache.store(signature, output_fc)
+    else:
+        calculate_nax_locations(output_fc, input_type, input_network, search_tolerance, search_criteria, search_query, travel_mode)
     arcpy.AddMessage("Finished pre-processing "+input_type)
     arcpy.management.Delete(r"in_memory")
     return output_fc
 
 def access_multi(jobs):
-    from importlib import reload
-    import parameters
-    reload(parameters)
-    from parameters import impedance_f
+    from odcm_cache import open_cache, store_result, restore_arrow
+    from time_sweep import time_tag
+    reload_parameters()
     
     batch_id = jobs[0]
     scratchworkspace = jobs[1]
@@ -233,6 +246,29 @@ def access_multi(jobs):
     travel_mode = jobs[5]
     cutoff = jobs[6]
     time_of_day = jobs[7]
+    telemetry.setup(jobs[8])
+    cache, cache_key = open_cache(jobs[9])
+    stage_start = time.time()
+    
+    # file names carry the departure time so batches from different times can run side by side
+    file_name = "batch_"+str(batch_id)+"_"+time_tag(time_of_day)
+    arrow_table = os.path.join(scratchworkspace, file_name+".arrow")
+    i_ids_table = os.path.join(scratchworkspace, "i_ids_"+file_name+".parquet")
+    j_ids_table = os.path.join(scratchworkspace, "j_ids_"+file_name+".parquet")
+    
+    # 0 CACHE
+    # batch already solved by an earlier run? restore it and skip the solve
+    if cache is not None:
+        entry = cache.get(cache_key)
+        telemetry.emit("cache", stage_start, time.time(), batch_id = batch_id, time_of_day = time_of_day,
+                       status = "hit" if entry is not None else "miss")
+        if entry is not None:
+            stage_start = time.time()
+            rows = restore_arrow(entry, arrow_table, i_ids_table, j_ids_table)
+            telemetry.emit("export", stage_start, time.time(), batch_id = batch_id, time_of_day = time_of_day,
+                           rows = rows, bytes = os.path.getsize(arrow_table), cached = True)
+            return (time_of_day, arrow_table)
+        stage_start = time.time()
     
     #arcpy.management.CreateFileGDB(scratchworkspace, "batch_"+str(batch_id)+".gdb")
     #worker_gdb = os.path.join(scratchworkspace+"/batch_"+str(batch_id)+".gdb")
@@ -282,10 +318,14 @@ def access_multi(jobs):
               features = origins_i, 
               field_mappings = field_mappings_i, 
               append = False)
+    telemetry.emit("load", stage_start, time.time(), batch_id = batch_id, time_of_day = time_of_day,
+                   rows = odcm.count(arcpy.nax.OriginDestinationCostMatrixInputDataType.Origins))
     
     # 3 SOLVE
     arcpy.AddMessage("Solving OD Matrix...")
-    result = odcm.solve()
+    with telemetry.stage("solve", batch_id = batch_id, time_of_day = time_of_day) as record:
+        result = odcm.solve()
+        record["status"] = "ok" if result.solveSucceeded else "failed"
 
     # 4 EXPORT results to arrow
     # fail? skip
@@ -293,47 +333,114 @@ def access_multi(jobs):
         return
 
     # out fields
+    stage_start = time.time()
     od_fields = ["OriginOID", "DestinationOID", "Total_Time"]
 
     # to arrow on disk
     result.toArrowTable(arcpy.nax.OriginDestinationCostMatrixOutputDataType.Lines,
                         od_fields,
-                        os.path.join(scratchworkspace, "batch_"+str(batch_id)+".arrow"))
-
-    arrow_table = os.path.join(scratchworkspace, "batch_"+str(batch_id)+".arrow")
+                        arrow_table)
 
     ## write extra info
     i_fields = ["ObjectID", "i_id"]
     with result.searchCursor(arcpy.nax.OriginDestinationCostMatrixOutputDataType.Origins, i_fields) as cursor:
-        i_df = pd.DataFrame(cursor, columns = i_fields)
+        i_rows = list(cursor)
     
-    i_df.to_parquet(os.path.join(scratchworkspace, "i_ids_batch_"+str(batch_id)+".parquet"))
+    write_id_table(i_rows, i_fields, i_ids_table)
 
     j_fields = ["ObjectID", "j_id"]
     with result.searchCursor(arcpy.nax.OriginDestinationCostMatrixOutputDataType.Destinations, j_fields) as cursor:
-        j_df = pd.DataFrame(cursor, columns = j_fields)
+        j_rows = list(cursor)
 
-    j_df.to_parquet(os.path.join(scratchworkspace, "j_ids_batch_"+str(batch_id)+".parquet"))
+    write_id_table(j_rows, j_fields, j_ids_table)
+    telemetry.emit("export", stage_start, time.time(), batch_id = batch_id, time_of_day = time_of_day,
+                   rows = result.count(arcpy.nax.OriginDestinationCostMatrixOutputDataType.Lines),
+                   bytes = os.path.getsize(arrow_table))
+    
+    # keep the solved batch for later runs
+    if cache is not None:
+        with telemetry.stage("cache", batch_id = batch_id, time_of_day = time_of_day, status = "put"):
+            store_result(cache, cache_key, result, {"tool": "odcm_to_pq_by_time", "batch_id": batch_id})
         
     arcpy.management.Delete(r"in_memory")
     #return output_table
-    return arrow_table
+    return (time_of_day, arrow_table)
+
+def finalize_batch(result, summarize = False, summary_measure = None, members = None, precision = "double", parquet_profile = None):
+    # runs in the parent as each (time_of_day, batch) job completes
+    from endpoint_dedup import expand_id_table
+    from time_sweep import time_tag
+    time_of_day, file = result
+    stage_start = time.time()
+    
+    dir_name, file_name, batch_num = batch_file_parts(file)
+    if members is not None:
+        # co-located endpoints join to the lines of the ones that were solved
+        expand_id_table(os.path.join(dir_name, "i_ids_"+file_name+".parquet"), "i_id", members[0])
+        expand_id_table(os.path.join(dir_name, "j_ids_"+file_name+".parquet"), "j_id", members[1])
+    partition_dir = os.path.join(dir_name, "start_datetime="+time_tag(time_of_day))
+    bytes_before = telemetry.file_bytes(partition_dir) or 0
+    
+    # per-origin summary used by the adaptive sweep: reachable destinations,
+    # or the sum of an impedance measure over them
+    reduce = None
+    if summarize:
+        if summary_measure is None:
+            reduce = lambda df: df.groupby('i_id').size()
+        else:
+            from access_core import impedance_array
+            # float32 contributions are summed in float64
+            def reduce(df):
+                df['f'] = impedance_array(df['Total_Time'].to_numpy(), summary_measure, precision).astype('float64')
+                return df.groupby('i_id')['f'].sum()
+    rows, summary = finalize_lines(file, ['start_datetime'], precision, reduce, parquet_profile,
+                                   batch_id = batch_num, start_datetime = time_tag(time_of_day))
+    if summarize:
+        summary = summary.to_dict() if summary is not None else {}
+    telemetry.emit("finalize", stage_start, time.time(), batch_id = batch_num, time_of_day = time_of_day,
+                   rows = rows, bytes = (telemetry.file_bytes(partition_dir) or 0) - bytes_before)
+    return (time_of_day, batch_num, summary)
 
 # ----- execute -----
 
+@restores_budget
 def main(input_network, travel_mode, cutoff, start_time, end_time, time_delta,
          origins_i_input, i_id_field, 
          search_tolerance_i, search_criteria_i, search_query_i,
          destinations_j_input, j_id_field,
          search_tolerance_j, search_criteria_j, search_query_j,
-         batch_size_factor, output_dir, output_gdb):
+         batch_size_factor, output_dir, output_gdb,
+         sweep_mode = "fixed", coarse_delta = None, adaptive_tolerance = 0.05,
+         max_solves = None, adaptive_measure = None, telemetry_on = True, profile = None,
+         cache_dir = None, max_cache_gb = 20, location_cache_dir = None, dedup = None,
+         precision = "double",
+         memory_budget = None, reachable_fraction = 1.0, parquet_profile = None):
+    
+    from profiling import check_mode, profile_dir_setup, profiled_worker, maybe_profiled, merge_profiles
+    from parquet_profiles import resolve_profile
+    from memory_budget import use_budget
+    from odcm_cache import BatchKeys, cache_spec, clear_stats, cache_stats, format_stats
+    from endpoint_dedup import dedup_features, matrix_reduction, format_reduction
+    from time_sweep import time_of_day_range, flatten_jobs, run_sweep, adaptive_time_sweep, align_results
     
     # --- setup workspace ---
+    run_start = time.time()
+    check_mode(profile)
+    value_dtype(precision) # unknown precision? fail before any work
+    resolve_profile(parquet_profile) # and the parquet profile
     arcpy.env.workspace = workspace_setup(output_dir, output_gdb)
     arcpy.env.scratchWorkspace = scratchWorkspace_setup(output_dir, output_gdb)
+    telemetry_dir = telemetry.telemetry_dir_setup(output_dir, output_gdb) if telemetry_on else None
+    telemetry.setup(telemetry_dir)
+    telemetry.emit("workspace", run_start, time.time())
+    profile_dir = profile_dir_setup(output_dir, output_gdb) if profile is not None else None
+    
+    # --- memory budget: batch and scan sizes, spilling and pool concurrency (see memory_budget.py) ---
+    use_budget(memory_budget, cpu_count(multiprocessing.cpu_count()), reachable_fraction)
     
     # --- setup batching ---
-    batch_size = batch_size_f(origins_i_input, batch_size_factor)
+    with telemetry.stage("batching"):
+        batch_size = batch_size_f(origins_i_input, batch_size_factor, destinations_j_input, reachable_fraction)
     
     # --- pre-process origins ---
     origins_i = preprocess_x(input_fc = origins_i_input,
@@ -344,7 +451,8 @@ def main(input_network, travel_mode, cutoff, start_time, end_time, time_delta,
                              search_criteria = search_criteria_i,
                              search_query = search_query_i,
                              travel_mode = travel_mode,
-                             batch_size = batch_size)
+                             batch_size = batch_size,
+                             location_cache_dir = location_cache_dir)
     #print(origins_i)
     origins_i_dict = create_dict(origins_i, key_field = "i_id_text", value_field = "i_id")
     
@@ -357,90 +465,116 @@ def main(input_network, travel_mode, cutoff, start_time, end_time, time_delta,
                                   search_criteria = search_criteria_j,
                                   search_query = search_query_j,
                                   travel_mode = travel_mode,
-                                  batch_size = None)
+                                  batch_size = None,
+                                  location_cache_dir = location_cache_dir)
     
     # time iterator
     arcpy.AddMessage("Calculating ODCMs...")
-    time_of_day_list = [start_time]
-    time_of_day = start_time
+    time_of_day_list = time_of_day_range(start_time, end_time, time_delta)
     
-    while time_of_day < end_time:
-        time_of_day += timedelta(minutes=time_delta)
-        time_of_day_list.append(time_of_day)
-
-    for time_of_day in time_of_day_list:
-        # worker iterator
-        batch_list = list_unique(os.path.join(arcpy.env.workspace+"/origins_i"), "batch_id")
-        
-        jobs = []
-        # adds tuples of the parameters that need to be given to the worker function to the jobs list
-        for batch_id in batch_list:
-            jobs.append((batch_id, arcpy.env.scratchWorkspace, 
-                         origins_i, destinations_j, 
-                         input_network, travel_mode, 
-                         cutoff, time_of_day))
-        
-        # multiprocessing
-        multiprocessing.set_executable(os.path.join(sys.exec_prefix, 'pythonw.exe'))
-        #arcpy.AddMessage("Sending batch to multiprocessing pool...")
-        pool = multiprocessing.Pool(processes = cpu_count(multiprocessing.cpu_count()))
-        #result = pool.map(access_multi, jobs)
-        result = [x for x in pool.map(access_multi, jobs) if x is not None]
-        pool.close()
-        pool.join()
-        #arcpy.AddMessage("Multiprocessing complete, joining IDs to parquet files...")
-        #odcm_output = arcpy.management.Merge(result, arcpy.env.workspace+"/output_"+output_gdb)
-        
-        # add back the i_ids and j_ids to the parquet files
-        for file in result:
-            # get attributes
-            dir_name = os.path.dirname(file)
-            base_name = os.path.basename(file)
-            file_name = base_name.split('.')[0]
-            batch_num = file_name.split("_")[1]
-            
-            # read arrow file in to pd df
-            df = ft.read_feather(file)
-
-            # get i and j ids        
-            i_ids = pd.read_parquet(dir_name+"/i_ids_"+file_name+".parquet")
-            i_ids.rename(columns={'ObjectID':'OriginOID'}, inplace=True)
-            
-            j_ids = pd.read_parquet(dir_name+"/j_ids_"+file_name+".parquet")
-            j_ids.rename(columns={'ObjectID':'DestinationOID'}, inplace=True)
-
-            # merge ids into df        
-            df = pd.merge(df, i_ids, how='left', left_on=['OriginOID'], right_on=['OriginOID'])
-            df = pd.merge(df, j_ids, how='left', left_on=['DestinationOID'], right_on=['DestinationOID'])
-            df.drop(columns=['OriginOID', 'DestinationOID'], inplace=True)
-            df['batch_id'] = batch_num
-            df['start_datetime'] = datetime.strftime(time_of_day, format = "%Y_%m_%d")+"-"+datetime.strftime(time_of_day, format = "%H_%M_%S")
-            #df['start_time'] = datetime.strftime(time_of_day, format = "%H_%M_%S")
-
-            # save to parquet
-            #df.to_parquet(file)
-            pq.write_to_dataset(pa.Table.from_pandas(df),
-                                partition_cols = ['start_datetime'],
-                                root_path = dir_name)
-            #df.to_parquet(os.path.join(dir_name, file_name+".parquet")) # for arrow
-            
-            # clean up
-            os.remove(file) # for arrow
-            os.remove(dir_name+"/i_ids_"+file_name+".parquet")
-            os.remove(dir_name+"/j_ids_"+file_name+".parquet")
-
-        arcpy.AddMessage("Finished "+datetime.strftime(time_of_day, format = "%Y-%m-%d %H:%M:%S")+"...")
-        
-        # ----- clean up: this deletes the workers directory. comment-out if you want to keep -----
-        #arcpy.management.Delete(arcpy.env.scratchWorkspace)
+    # worker iterator
+    # --- co-located endpoints: solve each location once ---
+    # dedup is None, "network" (same network location) or a distance in the
+    # units of the inputs; the results fan back out when the batches are written to parquet
+    origins_solve, destinations_solve = origins_i, destinations_j
+    if dedup is not None:
+        with telemetry.stage("dedup") as record:
+            origins_solve, origin_members, origin_sizes = dedup_features(origins_i, "origins_i", "i_id", dedup)
+            destinations_solve, destination_members, destination_sizes = dedup_features(destinations_j, "destinations_j", "j_id", dedup)
+            reduction = matrix_reduction(sum(origin_sizes.values()), len(origin_sizes),
+                                         sum(destination_sizes.values()), len(destination_sizes))
+            record.update(reduction)
+        arcpy.AddMessage("Endpoint deduplication: "+format_reduction(reduction))
+    
+    batch_list = list_unique(origins_solve, "batch_id")
+    
+    # solved batch cache keys; the departure time is part of each key
+    batch_keys = None
+    if cache_dir is not None:
+        with telemetry.stage("cache_keys"):
+            batch_keys = BatchKeys(input_network, travel_mode, cutoff,
+                                   [search_tolerance_i, search_criteria_i, search_query_i,
+                                    search_tolerance_j, search_criteria_j, search_query_j],
+                                   origins_solve, destinations_solve)
+        clear_stats(cache_dir)
+    
+    def make_job(time_of_day, batch_id):
+        return (batch_id, arcpy.env.scratchWorkspace, 
+                origins_solve, destinations_solve, 
+                input_network, travel_mode, 
+                cutoff, time_of_day, telemetry_dir,
+                cache_spec(cache_dir, max_cache_gb, batch_keys, batch_id, time_of_day))
+    
+    # multiprocessing: a single long-lived pool for the whole sweep
+    multiprocessing.set_executable(os.path.join(sys.exec_prefix, 'pythonw.exe'))
+    pool_start = time.time()
+    pool = multiprocessing.Pool(processes = cpu_count(multiprocessing.cpu_count()))
+    
+    # add back the i_ids and j_ids to the parquet files as each job completes
+    summarize = sweep_mode == "adaptive"
+    summaries = {}
+    finished = {}
+    def finalize(result):
+        with maybe_profiled(profile_dir, profile, "finalize"):
+            time_of_day, batch_num, summary = finalize_batch(result, summarize, adaptive_measure,
+                                                             (origin_members, destination_members) if dedup is not None else None,
+                                                             precision, parquet_profile)
+        if summarize:
+            summaries.setdefault(time_of_day, {}).update(summary)
+        finished[time_of_day] = finished.get(time_of_day, 0) + 1
+        if finished[time_of_day] == len(batch_list):
+            arcpy.AddMessage("Finished "+datetime.strftime(time_of_day, format = "%Y-%m-%d %H:%M:%S")+"...")
+        return (time_of_day, batch_num)
+    
+    def solve_round(times):
+        # one flat job set over every (time_of_day, batch_id) pair
+        jobs = flatten_jobs(times, batch_list, make_job)
+        arcpy.AddMessage("Sending "+str(len(jobs))+" jobs ("+str(len(times))+" departure times x "+
+                         str(len(batch_list))+" batches) to multiprocessing pool...")
+        run_sweep(pool, profiled_worker(access_multi, profile_dir, profile), jobs, finalize,
+                  processes = cpu_count(multiprocessing.cpu_count()))
+        if not summarize:
+            return None
+        # origins that reach nothing at a given time count as zero
+        aligned, origins = align_results(dict([(t, summaries.get(t, {})) for t in times]),
+                                         list(origins_i_dict.values()))
+        return aligned
+    
+    if sweep_mode == "adaptive":
+        # solve a coarse set of departure times, then only refine where origin accessibility changes
+        if coarse_delta is None:
+            coarse_delta = 6*time_delta
+        if max_solves is None:
+            max_solves = int(math.ceil(len(time_of_day_list)/2))
+        sweep_report = {}
+        solved = adaptive_time_sweep(solve_round, start_time, end_time, coarse_delta, time_delta,
+                                     adaptive_tolerance, max_solves, report = sweep_report)
+        arcpy.AddMessage("Adaptive sweep solved "+str(len(solved))+" of "+str(len(time_of_day_list))+" departure times, "+
+                         "stopped on "+sweep_report["stopped"]+" (largest change left "+
+                         str(round(100*sweep_report["largest_change"], 2))+"%)")
+        telemetry.emit("adaptive_sweep", pool_start, time.time(), **sweep_report)
+    else:
+        solve_round(time_of_day_list)
+    pool.close()
+    pool.join()
+    # finalization streams inside the pool window, so the pool stage covers both
+    telemetry.emit("pool", pool_start, time.time(), processes = cpu_count(multiprocessing.cpu_count()))
+    
+    # ----- clean up: this deletes the workers directory. comment-out if you want to keep -----
+    #arcpy.management.Delete(arcpy.env.scratchWorkspace)
+    if cache_dir is not None:
+        arcpy.AddMessage("ODCM cache: "+format_stats(cache_stats(cache_dir)))
+    telemetry.emit("run", run_start, time.time(), tool = "odcm_to_pq_by_time")
+    if telemetry_dir is not None:
+        arcpy.AddMessage("Run telemetry written to "+telemetry_dir+"; summarize with telemetry_report.py")
+    if profile_dir is not None:
+        report_path = merge_profiles(profile_dir)
+        if report_path is not None:
+            arcpy.AddMessage("Profile report written to "+report_path)
 
 if __name__ == '__main__':
-    start_time = time.time()
-    main(input_network, travel_mode, cutoff, time_of_day,
-         origins_i_input, i_id_field, 
-         search_tolerance_i, search_criteria_i, search_query_i,
-         destinations_j_input, j_id_field,
-         search_tolerance_j, search_criteria_j, search_query_j,
-         batch_size_factor, output_dir, output_gdb)
-    elapsed_time = time.time() - start_time
+    # start_time is a parameter of this tool
+    tool_start = time.time()
+    main(**main_arguments(main, sys.argv, globals()))
+    elapsed_time = time.time() - tool_start
     arcpy.AddMessage("ODCM calculation took "+str(elapsed_time/60)+" minutes...")
@@ -6,17 +6,14 @@
 # tool help can be found at https://github.com/higgicd/Accessibility_Toolbox
 
 import os, sys
-import math
 import datetime
 import time
 import arcpy
 import multiprocessing
-import pandas as pd
-import pyarrow as pa
-import pyarrow.parquet as pq
-import pyarrow.feather as ft
-import pyarrow.dataset as ds
 from arcpy import env
+import telemetry
+from access_core import cpu_count, batch_plan, unique_in_order, batch_file_parts, finalize_lines, write_id_table, value_dtype, main_arguments, reload_parameters
+from memory_budget import restores_budget
 env.overwriteOutput = True
 arcpy.CheckOutExtension("Network")
 
@@ -24,6 +21,8 @@ arcpy.CheckOutExtension("Network")
 # open Start Menu > ArcGIS > Python Command Prompt
 # run this: C:\Progra~1\ArcGIS\Pro\bin\Python\scripts\propy.bat D:\access_calc_main.py
 # change file path of the access_calc_main.py in the code above^
+# or pass a json file of main's arguments instead of uncommenting the parameters
+# below, with times as "YYYY-MM-DD HH:MM": propy.bat D:\odcm_to_pq_main.py D:\parameters.json
 
 # ----- parameters ----- # change all these as you see fit
 # --- origins ---
@@ -50,6 +49,7 @@ arcpy.CheckOutExtension("Network")
 #batch_size_factor = 500 # this controls how many origins are in a single batch
 #output_dir = r"D:/access_multi" # directory for output and worker files
 #output_gdb = "Access_multi_100" # output geodatabase name
+#queue_dir = None # a shared folder to solve the batches on several machines (see job_queue.py), or None for this machine only
 
 # ----- main -----
 
@@ -117,32 +117,26 @@ def field_map_x(input_fc, field_name, output_field_name):
     return field_map_x
 
 def list_unique(input_fc, field):
-    unique_list = []
     with arcpy.da.SearchCursor(input_fc, field) as cursor:
-        for row in cursor:
-            if row[0] not in unique_list:
-                unique_list.append(row[0])
-    return unique_list
-    
-def cpu_count(cpu_tot):
-    if cpu_tot == 1:
-        cpu_num = 1
-    else:
-        cpu_num = cpu_tot - 1
-    return cpu_num
-
-def batch_size_f(input_fc, batch_size_factor):
+        return unique_in_order(row[0] for row in cursor)
+    
+def batch_size_f(input_fc, batch_size_factor, destinations_fc = None, reachable_fraction = 1.0):
+    from memory_budget import active_budget
     cpu_num = cpu_count(multiprocessing.cpu_count())
     arcpy.AddMessage("There are "+str(multiprocessing.cpu_count())+" cpu cores on this machine, using "+str(cpu_num))
     origins_i_count = int(arcpy.management.GetCount(input_fc).getOutput(0))
     
-    if int(math.ceil(origins_i_count/cpu_num)) <= batch_size_factor:
-        batch_size = int(math.ceil(origins_i_count/cpu_num)+1)
-        batch_count = int(math.ceil(origins_i_count/batch_size))
+    # under a memory budget a batch is at most the origins whose od lines fit a worker's share
+    budget = active_budget(cpu_num)
+    if budget is not None:
+        n_destinations = int(arcpy.management.GetCount(destinations_fc).getOutput(0))
+        arcpy.AddMessage("Memory budget: "+budget.describe(n_destinations, reachable_fraction))
+        batch_size_factor = min(batch_size_factor, budget.origin_batch_size(n_destinations, reachable_fraction))
+    
+    batch_size, batch_count, optimized = batch_plan(origins_i_count, cpu_num, batch_size_factor)
+    if optimized:
         arcpy.AddMessage("Batching is optimized with "+str(batch_count)+" chunks of origins")
     else:
-        batch_size = batch_size_factor
-        batch_count = int(math.ceil(origins_i_count/batch_size_factor))
         arcpy.AddMessage("Batching "+str(batch_count)+" chunks of origins")
     return batch_size
 
@@ -162,18 +156,31 @@ def batch_i_setup(input_fc, batch_size):
 def calculate_nax_locations(input_fc, input_type, input_network, search_tolerance, search_criteria, search_query, travel_mode):
     arcpy.AddMessage("Calculating "+input_type+" Network Locations...")
     print("Calculating "+input_type+" Network Locations...")
-    arcpy.nax.CalculateLocations(input_fc, input_network, 
-                                 search_tolerance = search_tolerance, 
-                                 search_criteria = search_criteria, 
-                                 search_query = search_query,
-                                 travel_mode = travel_mode,
-                                 exclude_restricted_elements = "EXCLUDE")
+    with telemetry.stage("locations", input_type = input_type) as record:
+        arcpy.nax.CalculateLocations(input_fc, input_network, 
+                                     search_tolerance = search_tolerance, 
+                                     search_criteria = search_criteria, 
+                                     search_query = search_query,
+                                     travel_mode = travel_mode,
+                                     exclude_restricted_elements = "EXCLUDE")
+        record["rows"] = int(arcpy.management.GetCount(input_fc).getOutput(0))
 
 def create_dict(input_fc, key_field, value_field):
     valueDict = {r[0]:r[1] for r in arcpy.da.SearchCursor(input_fc, [key_field, value_field])}
     return valueDict
 
-def preprocess_x(input_fc, input_type, id_field, input_network, search_tolerance, search_criteria, search_query, travel_mode, batch_size):
+def preprocess_x(input_fc, input_type, id_field, input_network, search_tolerance, search_criteria, search_query, travel_mode, batch_size,
+                 location_cache_dir = None):
+    from location_cache import preprocess_flags, restore_preprocessed
+    stage_start = time.time()
+    
+    # located inputs from an earlier run? skip straight to batching
+    location_cache, signature, output_fc = restore_preprocessed(location_cache_dir, input_fc, input_type, [id_field],
+                                                                preprocess_flags(input_type), batch_i_setup, batch_size,
+                                                                input_network, travel_mode, search_tolerance,
+                                                                search_criteria, search_query)
+    if output_fc is not None:
+        return output_fc
     
     # add field mappings
     if input_type == "origins_i":
@@ -211,17 +218,22 @@ def preprocess_x(input_fc, input_type, id_field, input_network, search_tolerance
         arcpy.conversion.FeatureClassToFeatureClass(layer, arcpy.env.workspace, input_type)
         output_fc = os.path.join(arcpy.env.workspace+"/"+input_type)
     
-    # calculate network locations
-    calculate_nax_locations(output_fc, input_type, input_network, search_tolerance, search_criteria, search_query, travel_mode)
+    telemetry.emit("preprocess", stage_start, time.time(), input_type = input_type,
+                   rows = int(arcpy.management.GetCount(output_fc).getOutput(0)))
+    
+    # calculate network locations; with the cache only for new or moved points
+    if location_cache is not None:
+        location_cache.locate(output_fc, input_type)
+        location_cache.store(signature, output_fc)
+    else:
+        calculate_nax_locations(output_fc, input_type, input_network, search_tolerance, search_criteria, search_query, travel_mode)
     arcpy.AddMessage("Finished pre-processing "+input_type)
     arcpy.management.Delete(r"in_memory")
     return output_fc
 
 def access_multi(jobs):
-    from importlib import reload
-    import parameters
-    reload(parameters)
-    from parameters import impedance_f
+    from odcm_cache import open_cache, store_result, restore_arrow
+    reload_parameters()
     
     batch_id = jobs[0]
     scratchworkspace = jobs[1]
@@ -231,6 +243,27 @@ def access_multi(jobs):
     travel_mode = jobs[5]
     cutoff = jobs[6]
     time_of_day = jobs[7]
+    telemetry.setup(jobs[8])
+    cache, cache_key = open_cache(jobs[9])
+    stage_start = time.time()
+    
+    arrow_table = os.path.join(scratchworkspace, "batch_"+str(batch_id)+".arrow")
+    i_ids_table = os.path.join(scratchworkspace, "i_ids_batch_"+str(batch_id)+".parquet")
+    j_ids_table = os.path.join(scratchworkspace, "j_ids_batch_"+str(batch_id)+".parquet")
+    
+    # 0 CACHE
+    # batch already solved by an earlier run? restore it and skip the solve
+    if cache is not None:
+        entry = cache.get(cache_key)
+        telemetry.emit("cache", stage_start, time.time(), batch_id = batch_id, time_of_day = time_of_day,
+                       status = "hit" if entry is not None else "miss")
+        if entry is not None:
+            stage_start = time.time()
+            rows = restore_arrow(entry, arrow_table, i_ids_table, j_ids_table)
+            telemetry.emit("export", stage_start, time.time(), batch_id = batch_id, time_of_day = time_of_day,
+                           rows = rows, bytes = os.path.getsize(arrow_table), cached = True)
+            return arrow_table
+        stage_start = time.time()
     
     #arcpy.management.CreateFileGDB(scratchworkspace, "batch_"+str(batch_id)+".gdb")
     #worker_gdb = os.path.join(scratchworkspace+"/batch_"+str(batch_id)+".gdb")
@@ -280,10 +313,14 @@ def access_multi(jobs):
               features = origins_i, 
               field_mappings = field_mappings_i, 
               append = False)
+    telemetry.emit("load", stage_start, time.time(), batch_id = batch_id, time_of_day = time_of_day,
+                   rows = odcm.count(arcpy.nax.OriginDestinationCostMatrixInputDataType.Origins))
     
     # 3 SOLVE
     arcpy.AddMessage("Solving OD Matrix...")
-    result = odcm.solve()
+    with telemetry.stage("solve", batch_id = batch_id, time_of_day = time_of_day) as record:
+        result = odcm.solve()
+        record["status"] = "ok" if result.solveSucceeded else "failed"
 
     # 4 EXPORT results to arrow
     # fail? skip
@@ -291,47 +328,107 @@ def access_multi(jobs):
         return
 
     # out fields
+    stage_start = time.time()
     od_fields = ["OriginOID", "DestinationOID", "Total_Time"]
 
     # to arrow on disk
     result.toArrowTable(arcpy.nax.OriginDestinationCostMatrixOutputDataType.Lines,
                         od_fields,
-                        os.path.join(scratchworkspace, "batch_"+str(batch_id)+".arrow"))
-
-    arrow_table = os.path.join(scratchworkspace, "batch_"+str(batch_id)+".arrow")
+                        arrow_table)
 
     ## write extra info
     i_fields = ["ObjectID", "i_id"]
     with result.searchCursor(arcpy.nax.OriginDestinationCostMatrixOutputDataType.Origins, i_fields) as cursor:
-        i_df = pd.DataFrame(cursor, columns = i_fields)
+        i_rows = list(cursor)
     
-    i_df.to_parquet(os.path.join(scratchworkspace, "i_ids_batch_"+str(batch_id)+".parquet"))
+    write_id_table(i_rows, i_fields, i_ids_table)
 
     j_fields = ["ObjectID", "j_id"]
     with result.searchCursor(arcpy.nax.OriginDestinationCostMatrixOutputDataType.Destinations, j_fields) as cursor:
-        j_df = pd.DataFrame(cursor, columns = j_fields)
+        j_rows = list(cursor)
 
-    j_df.to_parquet(os.path.join(scratchworkspace, "j_ids_batch_"+str(batch_id)+".parquet"))
+    write_id_table(j_rows, j_fields, j_ids_table)
+    telemetry.emit("export", stage_start, time.time(), batch_id = batch_id, time_of_day = time_of_day,
+                   rows = result.count(arcpy.nax.OriginDestinationCostMatrixOutputDataType.Lines),
+                   bytes = os.path.getsize(arrow_table))
+    
+    # keep the solved batch for later runs
+    if cache is not None:
+        with telemetry.stage("cache", batch_id = batch_id, time_of_day = time_of_day, status = "put"):
+            store_result(cache, cache_key, result, {"tool": "odcm_to_pq", "batch_id": batch_id})
         
     arcpy.management.Delete(r"in_memory")
     #return output_table
     return arrow_table
 
+def finalize_result(file, precision, parquet_profile, members = None):
+    # worker arrow file -> batch_id partition of the parquet dataset next to
+    # it; members are the (origin, destination) groups of deduplicated endpoints
+    from endpoint_dedup import expand_id_table
+    stage_start = time.time()
+    dir_name, file_name, batch_num = batch_file_parts(file)
+    if members is not None:
+        # co-located endpoints join to the lines of the ones that were solved
+        expand_id_table(os.path.join(dir_name, "i_ids_"+file_name+".parquet"), "i_id", members[0])
+        expand_id_table(os.path.join(dir_name, "j_ids_"+file_name+".parquet"), "j_id", members[1])
+    rows, reduced = finalize_lines(file, ['batch_id'], precision, profile = parquet_profile, batch_id = batch_num)
+    telemetry.emit("finalize", stage_start, time.time(), batch_id = batch_num, rows = rows,
+                   bytes = telemetry.file_bytes(os.path.join(dir_name, "batch_id="+str(batch_num))))
+    return rows
+
+def queue_job(job, context, staging_dir):
+    # a batch on a job queue worker (job_queue.py): solved and finalized in
+    # the staging folder, from which the queue publishes its partition. the
+    # worker loads the solver by name, so profiling comes with the context
+    # rather than as a profiled_worker, into the run's profile folder
+    from profiling import maybe_profiled
+    profile_dir, profile = context.get("profile_dir"), context.get("profile")
+    with maybe_profiled(profile_dir, profile, "batch_"+str(job[0])):
+        file = access_multi((job[0], staging_dir) + tuple(job[2:]))
+    if file is None:
+        return None
+    with maybe_profiled(profile_dir, profile, "finalize"):
+        return {"rows": finalize_result(file, context["precision"], context["parquet_profile"], context["members"])}
+
 # ----- execute -----
 
+@restores_budget
 def main(input_network, travel_mode, cutoff, time_of_day,
          origins_i_input, i_id_field, 
          search_tolerance_i, search_criteria_i, search_query_i,
          destinations_j_input, j_id_field,
          search_tolerance_j, search_criteria_j, search_query_j,
-         batch_size_factor, output_dir, output_gdb):
+         batch_size_factor, output_dir, output_gdb, telemetry_on = True, profile = None,
+         cache_dir = None, max_cache_gb = 20, location_cache_dir = None, dedup = None,
+         precision = "double",
+         memory_budget = None, reachable_fraction = 1.0, parquet_profile = None,
+         queue_dir = None, queue_workers = None, lease_s = None):
+    
+    from profiling import check_mode, profile_dir_setup, profiled_worker, maybe_profiled, merge_profiles
+    from parquet_profiles import resolve_profile
+    from memory_budget import use_budget, governed_map
+    from odcm_cache import BatchKeys, cache_spec, clear_stats, cache_stats, format_stats
+    from endpoint_dedup import dedup_features, matrix_reduction, format_reduction
+    from job_queue import JobQueue, start_workers, format_counts, DEFAULT_LEASE_S
     
     # --- setup workspace ---
+    run_start = time.time()
+    check_mode(profile)
+    value_dtype(precision) # unknown precision? fail before any work
+    resolve_profile(parquet_profile) # and the parquet profile
     arcpy.env.workspace = workspace_setup(output_dir, output_gdb)
     arcpy.env.scratchWorkspace = scratchWorkspace_setup(output_dir, output_gdb)
+    telemetry_dir = telemetry.telemetry_dir_setup(output_dir, output_gdb) if telemetry_on else None
+    telemetry.setup(telemetry_dir)
+    telemetry.emit("workspace", run_start, time.time())
+    profile_dir = profile_dir_setup(output_dir, output_gdb) if profile is not None else None
+    
+    # --- memory budget: batch and scan sizes, spilling and pool concurrency (see memory_budget.py) ---
+    use_budget(memory_budget, cpu_count(multiprocessing.cpu_count()), reachable_fraction)
     
     # --- setup batching ---
-    batch_size = batch_size_f(origins_i_input, batch_size_factor)
+    with telemetry.stage("batching"):
+        batch_size = batch_size_f(origins_i_input, batch_size_factor, destinations_j_input, reachable_fraction)
     
     # --- pre-process origins ---
     origins_i = preprocess_x(input_fc = origins_i_input,
@@ -342,7 +439,8 @@ def main(input_network, travel_mode, cutoff, time_of_day,
                              search_criteria = search_criteria_i,
                              search_query = search_query_i,
                              travel_mode = travel_mode,
-                             batch_size = batch_size)
+                             batch_size = batch_size,
+                             location_cache_dir = location_cache_dir)
     #print(origins_i)
     origins_i_dict = create_dict(origins_i, key_field = "i_id_text", value_field = "i_id")
     
@@ -355,76 +453,103 @@ def main(input_network, travel_mode, cutoff, time_of_day,
                                   search_criteria = search_criteria_j,
                                   search_query = search_query_j,
                                   travel_mode = travel_mode,
-                                  batch_size = None)
+                                  batch_size = None,
+                                  location_cache_dir = location_cache_dir)
     
     # worker iterator
-    batch_list = list_unique(os.path.join(arcpy.env.workspace+"/origins_i"), "batch_id")
+    # --- co-located endpoints: solve each location once ---
+    # dedup is None, "network" (same network location) or a distance in the
+    # units of the inputs; the results fan back out when the batches are written to parquet
+    origins_solve, destinations_solve = origins_i, destinations_j
+    members = None
+    if dedup is not None:
+        with telemetry.stage("dedup") as record:
+            origins_solve, origin_members, origin_sizes = dedup_features(origins_i, "origins_i", "i_id", dedup)
+            destinations_solve, destination_members, destination_sizes = dedup_features(destinations_j, "destinations_j", "j_id", dedup)
+            reduction = matrix_reduction(sum(origin_sizes.values()), len(origin_sizes),
+                                         sum(destination_sizes.values()), len(destination_sizes))
+            record.update(reduction)
+        members = (origin_members, destination_members)
+        arcpy.AddMessage("Endpoint deduplication: "+format_reduction(reduction))
+    
+    batch_list = list_unique(origins_solve, "batch_id")
+    
+    # solved batch cache keys
+    batch_keys = None
+    if cache_dir is not None:
+        with telemetry.stage("cache_keys"):
+            batch_keys = BatchKeys(input_network, travel_mode, cutoff,
+                                   [search_tolerance_i, search_criteria_i, search_query_i,
+                                    search_tolerance_j, search_criteria_j, search_query_j],
+                                   origins_solve, destinations_solve)
+        clear_stats(cache_dir)
     
     jobs = []
     # adds tuples of the parameters that need to be given to the worker function to the jobs list
     for batch_id in batch_list:
         jobs.append((batch_id, arcpy.env.scratchWorkspace, 
-                     origins_i, destinations_j, 
+                     origins_solve, destinations_solve, 
                      input_network, travel_mode, 
-                     cutoff, time_of_day))
+                     cutoff, time_of_day, telemetry_dir,
+                     cache_spec(cache_dir, max_cache_gb, batch_keys, batch_id, time_of_day)))
     
     # multiprocessing
     multiprocessing.set_executable(os.path.join(sys.exec_prefix, 'pythonw.exe'))
-    arcpy.AddMessage("Sending batch to multiprocessing pool...")
-    pool = multiprocessing.Pool(processes = cpu_count(multiprocessing.cpu_count()))
-    #result = pool.map(access_multi, jobs)
-    result = [x for x in pool.map(access_multi, jobs) if x is not None]
-    pool.close()
-    pool.join()
-    arcpy.AddMessage("Multiprocessing complete, joining IDs to parquet files...")
-    #odcm_output = arcpy.management.Merge(result, arcpy.env.workspace+"/output_"+output_gdb)
-    
-    # add back the i_ids and j_ids to the parquet files
-    for file in result:
-        # get attributes
-        dir_name = os.path.dirname(file)
-        base_name = os.path.basename(file)
-        file_name = base_name.split('.')[0]
-        batch_num = file_name.split("_")[1]
-        
-        # read arrow file in to pd df
-        df = ft.read_feather(file)
-
-        # get i and j ids        
-        i_ids = pd.read_parquet(dir_name+"/i_ids_"+file_name+".parquet")
-        i_ids.rename(columns={'ObjectID':'OriginOID'}, inplace=True)
-        
-        j_ids = pd.read_parquet(dir_name+"/j_ids_"+file_name+".parquet")
-        j_ids.rename(columns={'ObjectID':'DestinationOID'}, inplace=True)
-
-        # merge ids into df        
-        df = pd.merge(df, i_ids, how='left', left_on=['OriginOID'], right_on=['OriginOID'])
-        df = pd.merge(df, j_ids, how='left', left_on=['DestinationOID'], right_on=['DestinationOID'])
-        df.drop(columns=['OriginOID', 'DestinationOID'], inplace=True)
-        df['batch_id'] = batch_num
-
-        # save to parquet
-        #df.to_parquet(file)
-        pq.write_to_dataset(pa.Table.from_pandas(df),
-                            partition_cols = ['batch_id'],
-                            root_path = dir_name)
-        #df.to_parquet(os.path.join(dir_name, file_name+".parquet")) # for arrow
+    if queue_dir is not None:
+        # --- distributed: the batches go to a job queue in a shared folder, served by
+        # queue_workers local processes and by python job_queue.py work <queue_dir> on any
+        # other machine that sees the folder, the output folder and the network dataset.
+        # workers finalize their own batches into the dataset ---
+        local_workers = cpu_count(multiprocessing.cpu_count()) if queue_workers is None else queue_workers
+        arcpy.AddMessage("Sending "+str(len(jobs))+" batches to the job queue in "+queue_dir+"...")
+        with telemetry.stage("queue", processes = local_workers, batches = len(jobs)) as record:
+            queue = JobQueue(queue_dir).create(queue_job, jobs, {"precision": precision, "parquet_profile": parquet_profile,
+                                                                 "members": members, "profile": profile,
+                                                                 "profile_dir": profile_dir},
+                                               arcpy.env.scratchWorkspace, ["batch_"+str(batch_id).zfill(6) for batch_id in batch_list],
+                                               DEFAULT_LEASE_S if lease_s is None else lease_s)
+            workers = start_workers(queue_dir, local_workers)
+            summary = queue.wait(progress = lambda counts: arcpy.AddMessage("Job queue: "+format_counts(counts)))
+            for worker in workers:
+                worker.join()
+            record["workers"] = len(summary["workers"])
+            record["retries"] = len(summary["errors"])
+            record["rows"] = sum([(d["result"] or {}).get("rows", 0) for d in summary["done"]])
+        if summary["failed"]:
+            raise Exception(str(len(summary["failed"]))+" batches failed on the job queue: "+", ".join(summary["failed"])+
+                            "; see python job_queue.py status "+queue_dir)
+        arcpy.AddMessage("Job queue complete: "+str(len(summary["done"]))+" batches on "+str(len(summary["workers"]))+" workers")
+    else:
+        arcpy.AddMessage("Sending batch to multiprocessing pool...")
+        with telemetry.stage("pool", processes = cpu_count(multiprocessing.cpu_count()), batches = len(jobs)) as record:
+            pool = multiprocessing.Pool(processes = cpu_count(multiprocessing.cpu_count()))
+            #result = pool.map(access_multi, jobs)
+            result = [x for x in governed_map(pool, profiled_worker(access_multi, profile_dir, profile), jobs,
+                                              cpu_count(multiprocessing.cpu_count()), record) if x is not None]
+            pool.close()
+            pool.join()
+        arcpy.AddMessage("Multiprocessing complete, joining IDs to parquet files...")
+        #odcm_output = arcpy.management.Merge(result, arcpy.env.workspace+"/output_"+output_gdb)
         
-        # clean up
-        os.remove(file) # for arrow
-        os.remove(dir_name+"/i_ids_"+file_name+".parquet")
-        os.remove(dir_name+"/j_ids_"+file_name+".parquet")
+        # add back the i_ids and j_ids to the parquet files
+        for file in result:
+            with maybe_profiled(profile_dir, profile, "finalize"):
+                finalize_result(file, precision, parquet_profile, members)
     
     # ----- clean up: this deletes the workers directory. comment-out if you want to keep -----
     #arcpy.management.Delete(arcpy.env.scratchWorkspace)
+    if cache_dir is not None:
+        arcpy.AddMessage("ODCM cache: "+format_stats(cache_stats(cache_dir)))
+    telemetry.emit("run", run_start, time.time(), tool = "odcm_to_pq")
+    if telemetry_dir is not None:
+        arcpy.AddMessage("Run telemetry written to "+telemetry_dir+"; summarize with telemetry_report.py")
+    if profile_dir is not None:
+        report_path = merge_profiles(profile_dir)
+        if report_path is not None:
+            arcpy.AddMessage("Profile report written to "+report_path)
 
 if __name__ == '__main__':
     start_time = time.time()
-    main(input_network, travel_mode, cutoff, time_of_day,
-         origins_i_input, i_id_field, 
-         search_tolerance_i, search_criteria_i, search_query_i,
-         destinations_j_input, j_id_field,
-         search_tolerance_j, search_criteria_j, search_query_j,
-         batch_size_factor, output_dir, output_gdb)
+    main(**main_arguments(main, sys.argv, globals()))
     elapsed_time = time.time() - start_time
     arcpy.AddMessage("ODCM calculation took "+str(elapsed_time/60)+" minutes...")
@@ -0,0 +1,147 @@
+# Cumulative Opportunity Curves from a Stored OD Matrix
+# Christopher D. Higgins
+# Department of Human Geography
+# University of Toronto Scarborough
+# https://higgicd.github.io
+# tool help can be found at https://github.com/higgicd/Accessibility_Toolbox
+
+# opportunities reachable within 0, 1, 2, ..., cutoff minutes for every origin
+# from one streaming pass over a parquet od matrix (od cost matrix to parquet
+# tool or r5r). o_j is summed per origin into one-minute bins, bin m holding
+# travel times in (m - 1, m], and the running sum over the bins is the curve
+# C_i(m) = sum_j o_j for t_ij <= m. it is stored as a wide table with one
+# CUM<m> column per minute, uint32 when the opportunities are whole counts.
+# any CUMR measure at a whole minute t_bar is then the column CUM<t_bar>;
+# every other measure, CUML included, is the reduction
+#   A_i = sum_m (C_i(m) - C_i(m - 1))*f(m)
+# which is exact when travel times are whole minutes (r5r) and otherwise
+# evaluates f at each travel time rounded up to the minute
+#
+# usage: python opportunity_curves.py [od_path] [cutoff]  (checks against direct sums on r5_ttm)
+
+import sys
+import time
+import access_core
+from travel_time_metrics import ODScan
+
+def curve_column(minute):
+    return "CUM"+str(minute)
+
+def curve_dtype(o_j, cutoff_total):
+    # uint32 for whole counts that fit, float64 otherwise
+    import numpy as np
+    values = np.array([v for v in o_j.values() if v is not None], dtype = np.float64)
+    if (values == np.floor(values)).all() and cutoff_total < 2**32:
+        return np.dtype(np.uint32)
+    return np.dtype(np.float64)
+
+# ----- streaming pass -----
+
+def opportunity_curves(od_path, o_j, cutoff, del_i_eq_j = False):
+    # wide per-origin table: i_id and CUM0 ... CUM<cutoff>; origins that
+    # reach no opportunity within the cutoff are left out
+    import numpy as np
+    import pandas as pd
+    cutoff = int(cutoff)
+    scan = ODScan(od_path, o_j, del_i_eq_j)
+    n_origins = len(scan.origin_ids)
+    n_bins = cutoff + 1
+    histogram = np.zeros((n_origins, n_bins))
+    rows = 0
+    for i_codes, o_j_rows, t_ij in scan:
+        within = t_ij <= cutoff
+        i_codes, o_j_rows, bins = i_codes[within], o_j_rows[within], np.ceil(t_ij[within]).astype(np.int64)
+        rows += len(i_codes)
+        if len(i_codes) == 0:
+            continue
+        # only the origins of this batch
+        touched, local = np.unique(i_codes, return_inverse = True)
+        histogram[touched] += np.bincount(local*n_bins + bins, weights = o_j_rows,
+                                          minlength = len(touched)*n_bins).reshape(-1, n_bins)
+    curves = np.cumsum(histogram, axis = 1)
+    del histogram
+    keep = np.nonzero(curves[:, -1] > 0)[0]
+    dtype = curve_dtype(o_j, curves[:, -1].max() if len(keep) else 0)
+    if dtype.kind == "u":
+        # float64 sums of whole counts are exact below 2**53
+        curves = np.rint(curves)
+    df = pd.DataFrame(curves[keep].astype(dtype), columns = [curve_column(m) for m in range(n_bins)])
+    df.insert(0, "i_id", scan.origin_ids.take(keep).to_pylist())
+    return df, {"rows": rows, "origins": len(keep), "cutoff": cutoff, "curve_mb": df.memory_usage(index = False).sum()/1048576}
+
+def write_curves(curves, path, parquet_profile = None):
+    import pyarrow as pa
+    from parquet_profiles import write_table
+    return write_table(pa.Table.from_pandas(curves, preserve_index = False), path, parquet_profile)
+
+def read_curves(path):
+    import pandas as pd
+    return pd.read_parquet(path)
+
+# ----- measures from the curves -----
+
+def curve_cutoff(curves):
+    return max([int(c[3:]) for c in curves.columns if c.startswith("CUM")])
+
+def cumr_from_curves(curves, t_bar):
+    # opportunities within t_bar minutes: a column lookup
+    t_bar = min(int(t_bar), curve_cutoff(curves))
+    return curves[curve_column(t_bar)].to_numpy().astype("float64")
+
+def curve_accessibility(curves, selected_impedance_function):
+    # {measure: A_i} from the per-minute increments of the curves and f at
+    # every whole minute; measures that are still above zero past the cutoff
+    # only count opportunities within it
+    import numpy as np
+    cutoff = curve_cutoff(curves)
+    c = curves[[curve_column(m) for m in range(cutoff + 1)]].to_numpy().astype(np.float64)
+    increments = np.diff(c, axis = 1, prepend = 0)
+    minutes = np.arange(cutoff + 1, dtype = np.float64)
+    return dict([(f_name, increments @ access_core.impedance_array(minutes, f_name))
+                 for f_name in selected_impedance_function])
+
+# ----- versus direct sums -----
+
+def compare_direct(od_path = "r5_ttm", cutoff = 60, seed = 1):
+    import numpy as np
+    import pandas as pd
+    import pyarrow.dataset as ds
+    from incremental_access import od_columns
+    from synthetic_ttm import synthetic_opportunities
+    dataset = ds.dataset(od_path, format = "parquet", partitioning = "hive")
+    i_col, j_col, t_col = od_columns(dataset.schema)
+    j_ids = sorted(set(dataset.to_table(columns = [j_col]).column(j_col).cast("string").unique().to_pylist()))
+    o_j = dict(zip(j_ids, synthetic_opportunities(len(j_ids), seed)))
+    measures = ["CUMR05", "CUMR10", "CUMR15", "CUMR20", "CUMR30", "CUMR40", "CUMR45", "CUMR60",
+                "CUML10", "CUML20", "CUML30", "CUML40"]
+
+    start = time.perf_counter()
+    curves, stats = opportunity_curves(od_path, o_j, cutoff)
+    curves_s = time.perf_counter() - start
+    print("curves: "+str(stats["rows"])+" rows, "+str(stats["origins"])+" origins x "+str(cutoff + 1)+" minutes in "+
+          str(round(curves_s, 1))+" s, "+str(round(stats["curve_mb"], 1))+" MB as "+str(curves[curve_column(0)].dtype))
+    start = time.perf_counter()
+    from_curves = curve_accessibility(curves, measures)
+    print(str(len(measures))+" measures from the curves in "+str(round(1000*(time.perf_counter() - start), 1))+" ms")
+
+    # the existing way: every measure summed over a streaming pass
+    scan = ODScan(od_path, o_j)
+    n_origins = len(scan.origin_ids)
+    start = time.perf_counter()
+    sums = dict([(f_name, np.zeros(n_origins)) for f_name in measures])
+    for i_codes, o_j_rows, t_ij in scan:
+        for f_name, values in access_core.accessibility(i_codes, t_ij, o_j_rows, measures, n_origins).items():
+            sums[f_name] += values
+    direct_s = time.perf_counter() - start
+    print("direct pass over the matrix for the same measures: "+str(round(direct_s, 1))+" s")
+    codes = pd.Index(scan.origin_ids.to_pylist()).get_indexer(curves["i_id"])
+    worst = 0.0
+    for f_name in measures:
+        expected = sums[f_name][codes]
+        worst = max(worst, float(np.abs(from_curves[f_name] - expected).max()/max(np.abs(expected).max(), 1e-12)))
+        if f_name.startswith("CUMR"):
+            worst = max(worst, float(np.abs(cumr_from_curves(curves, int(f_name[4:])) - expected).max()))
+    print("max relative difference "+str(worst))
+
+if __name__ == '__main__':
+    compare_direct(sys.argv[1] if len(sys.argv) > 1 else "r5_ttm", int(sys.argv[2]) if len(sys.argv) > 2 else 60)
@@ -0,0 +1,199 @@
+# Parquet Encoding Profiles for the Accessibility Toolbox
+# Christopher D. Higgins
+# Department of Human Geography
+# University of Toronto Scarborough
+# https://higgicd.github.io
+# tool help can be found at https://github.com/higgicd/Accessibility_Toolbox
+
+# named encoding profiles for the parquet files the toolbox writes. od
+# matrices are written once and scanned many times, so the codec, the column
+# encodings, the row group size and the statistics are worth choosing:
+#   default        pyarrow's defaults: snappy, dictionaries and statistics for
+#                  every column, row groups of pyarrow's size
+#   fastest_write  uncompressed and plain, no statistics; for matrices that
+#                  are read once
+#   smallest       zstd level 9, dictionaries for the id columns, byte stream
+#                  split travel times, row groups of 4M rows, statistics on
+#                  the ids only
+#   fastest_scan   lz4, dictionaries and statistics for every column, row
+#                  groups of 1M rows
+# profiles name columns by role, so one profile fits every table: ids are
+# text columns and the od id columns, times are floating point columns and
+# the travel time columns (byte stream split only pays for times with many
+# distinct values). a profile can also be a dict of the keys below
+# over a "base" profile, e.g. {"base": "smallest", "compression_level": 3}.
+# no profile (None) writes exactly as before. python
+# benchmarks/bench_parquet_profiles.py compares the profiles on r5_ttm
+#
+# usage: python parquet_profiles.py [<parquet file or dataset>]
+
+import os
+import argparse
+
+ID_COLUMNS = ["i_id", "j_id", "fromId", "toId", "OriginOID", "DestinationOID", "ObjectID", "i", "j"]
+TIME_COLUMNS = ["Total_Time", "travel_time", "t"]
+
+# compression: codec ("none", "snappy", "lz4", "zstd", "gzip", "brotli");
+# compression_level: None for the codec's default; dictionary, statistics and
+# byte_stream_split: "all", "ids", "times" or "none"; row_group_size: rows,
+# None for pyarrow's default
+PROFILES = {"default": {"compression": "snappy", "compression_level": None, "dictionary": "all",
+                        "byte_stream_split": "none", "row_group_size": None, "statistics": "all"},
+            "fastest_write": {"compression": "none", "dictionary": "none", "statistics": "none"},
+            "smallest": {"compression": "zstd", "compression_level": 9, "dictionary": "ids",
+                         "byte_stream_split": "times", "row_group_size": 4194304, "statistics": "ids"},
+            "fastest_scan": {"compression": "lz4", "dictionary": "all", "row_group_size": 1048576, "statistics": "all"}}
+ROLES = ["all", "ids", "times", "none"]
+# floating point times with fewer distinct values than this share of the rows
+# (rounded minutes) are smaller as a dictionary than byte stream split
+DICTIONARY_SHARE = 0.05
+
+def resolve_profile(profile):
+    # the full settings of a profile name or dict, or None for no profile
+    if profile is None:
+        return None
+    if isinstance(profile, dict):
+        settings = dict(resolve_profile(profile.get("base", "default")))
+        settings.update([(key, value) for key, value in profile.items() if key != "base"])
+    else:
+        name = str(profile).replace("-", "_")
+        if name not in PROFILES:
+            raise Exception("Unknown parquet profile "+str(profile)+", expected one of "+", ".join(sorted(PROFILES)))
+        settings = dict(PROFILES["default"])
+        settings.update(PROFILES[name])
+    unknown = [key for key in settings if key not in PROFILES["default"]]
+    if unknown:
+        raise Exception("Unknown parquet profile settings: "+", ".join(unknown))
+    for key in ("dictionary", "statistics", "byte_stream_split"):
+        if settings[key] not in ROLES:
+            raise Exception("The parquet profile's "+key+" must be one of "+", ".join(ROLES)+", not "+str(settings[key]))
+    return settings
+
+def with_settings(profile, **settings):
+    # a profile with some settings fixed, such as the statistics a reader
+    # relies on; None stays None (pyarrow's defaults)
+    if profile is None:
+        return None
+    fixed = dict(resolve_profile(profile))
+    fixed.update(settings)
+    return fixed
+
+def column_roles(schema, exclude = ()):
+    # (id columns, time columns) of a schema; byte stream split for integer
+    # columns needs pyarrow 17
+    import pyarrow as pa
+    int_split = int(pa.__version__.split(".")[0]) >= 17
+    ids, times = [], []
+    for field in schema:
+        if field.name in exclude:
+            continue
+        if pa.types.is_string(field.type) or pa.types.is_large_string(field.type) or \
+                (field.name in ID_COLUMNS and pa.types.is_integer(field.type)):
+            ids.append(field.name)
+        elif pa.types.is_floating(field.type) or (int_split and field.name in TIME_COLUMNS and pa.types.is_integer(field.type)):
+            times.append(field.name)
+    return ids, times
+
+def write_options(profile, schema, partition_cols = None, table = None):
+    # keyword arguments for pq.write_table (and, less row_group_size,
+    # pq.ParquetWriter), or with partition_cols for pq.write_to_dataset;
+    # {} without a profile. with the table, floating point times with few
+    # distinct values get a dictionary instead of byte stream split
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    settings = resolve_profile(profile)
+    if settings is None:
+        return {}
+    ids, times = column_roles(schema, partition_cols or ())
+    def columns(role):
+        return {"all": True, "ids": ids, "times": times, "none": False}[role]
+    options = {"compression": settings["compression"],
+               "use_dictionary": columns(settings["dictionary"]),
+               "write_statistics": columns(settings["statistics"])}
+    if settings["compression_level"] is not None:
+        options["compression_level"] = settings["compression_level"]
+    split = columns(settings["byte_stream_split"])
+    if split is True:
+        split = times
+    if split and table is not None and table.num_rows:
+        repeated = [name for name in split if pa.types.is_floating(schema.field(name).type) and
+                    pc.count_distinct(table.column(name)).as_py() < DICTIONARY_SHARE*table.num_rows]
+        split = [name for name in split if name not in repeated]
+        if isinstance(options["use_dictionary"], list):
+            options["use_dictionary"] = options["use_dictionary"] + repeated
+    if split:
+        options["use_byte_stream_split"] = split
+    if settings["row_group_size"] is not None:
+        options["row_group_size"] = settings["row_group_size"]
+        if partition_cols is not None:
+            # the dataset writer otherwise writes every incoming batch as a row group
+            options["min_rows_per_group"] = settings["row_group_size"]
+    return options
+
+def write_table(table, path, profile = None):
+    import pyarrow.parquet as pq
+    pq.write_table(table, path, **write_options(profile, table.schema, table = table))
+    return path
+
+def write_to_dataset(table, root_path, partition_cols, profile = None):
+    import pyarrow.parquet as pq
+    pq.write_to_dataset(table, root_path = root_path, partition_cols = partition_cols,
+                        **write_options(profile, table.schema, partition_cols, table))
+    return root_path
+
+class ProfileWriter(object):
+    # pq.ParquetWriter under a profile; row_group_size goes to every
+    # write_table unless the caller gives its own. the file is opened on the
+    # first write_table so the encodings follow that table's times (see
+    # write_options); with no table written, close writes an empty file
+    def __init__(self, path, schema, profile = None):
+        self.path, self.schema, self.profile = path, schema, profile
+        self.row_group_size = None
+        self.writer = None
+
+    def open(self, table = None):
+        import pyarrow.parquet as pq
+        options = write_options(self.profile, self.schema, table = table)
+        self.row_group_size = options.pop("row_group_size", None)
+        self.writer = pq.ParquetWriter(self.path, self.schema, **options)
+
+    def write_table(self, table, row_group_size = None):
+        if self.writer is None:
+            self.open(table)
+        self.writer.write_table(table, row_group_size = row_group_size or self.row_group_size)
+
+    def close(self):
+        if self.writer is None:
+            self.open()
+        self.writer.close()
+
+def describe_file(path):
+    # codec, encodings and statistics per column and the row groups of a file
+    import pyarrow.parquet as pq
+    metadata = pq.ParquetFile(path).metadata
+    lines = [os.path.basename(path)+": "+str(metadata.num_rows)+" rows in "+str(metadata.num_row_groups)+
+             " row groups, "+str(round(os.path.getsize(path)/1048576, 2))+" MB"]
+    if metadata.num_row_groups:
+        row_group = metadata.row_group(0)
+        for k in range(row_group.num_columns):
+            column = row_group.column(k)
+            lines.append("  "+column.path_in_schema.ljust(16)+column.compression.ljust(14)+
+                         "/".join(sorted(set(column.encodings) - set(["RLE", "PLAIN"])) or ["PLAIN"]).ljust(28)+
+                         ("statistics" if column.is_stats_set else "no statistics"))
+    return "\n".join(lines)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Parquet encoding profiles")
+    parser.add_argument("path", nargs = "?", help = "a parquet file or dataset folder to describe")
+    args = parser.parse_args()
+    for name in PROFILES:
+        print(name.ljust(14)+" ".join([key+"="+str(value) for key, value in sorted(resolve_profile(name).items())]))
+    if args.path:
+        files = [args.path]
+        if os.path.isdir(args.path):
+            files = sorted([os.path.join(d, f) for d, dirs, fs in os.walk(args.path) for f in fs if f.endswith(".parquet")])
+        print("")
+        print(describe_file(files[0]))
+        if len(files) > 1:
+            print("  and "+str(len(files) - 1)+" more files, "+
+                  str(round(sum([os.path.getsize(f) for f in files])/1048576, 1))+" MB in all")
@@ -0,0 +1,205 @@
+# Worker Profiling for the Accessibility Toolbox
+# Christopher D. Higgins
+# Department of Human Geography
+# University of Toronto Scarborough
+# https://higgicd.github.io
+# tool help can be found at https://github.com/higgicd/Accessibility_Toolbox
+
+# opt-in profiling of pool workers and parent-side stages. each profiled job
+# writes its own cProfile stats and/or tracemalloc snapshot to the profile
+# folder; merge_profiles() combines them into one hot-spot report.
+# when profiling is off the tools hand the plain worker function to the pool,
+# so nothing here is imported into the job path
+#
+# usage: python profiling.py D:/access_multi/Access_multi_100_profiles [--top 40]
+
+import os
+import io
+import glob
+import shutil
+import pstats
+import argparse
+import cProfile
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+PROFILE_MODES = ("cprofile", "tracemalloc", "both")
+
+# ----- setup -----
+
+def profile_dir_setup(output_dir, output_gdb):
+    # fresh profile folder next to the outputs; it survives the workers clean up
+    profile_dir = os.path.join(output_dir, output_gdb+"_profiles")
+    if os.path.exists(profile_dir):
+        shutil.rmtree(profile_dir)
+    os.makedirs(profile_dir)
+    return profile_dir
+
+def check_mode(profile):
+    if profile is not None and profile not in PROFILE_MODES:
+        raise Exception(str(profile)+" is not a profiling mode, use one of "+str(PROFILE_MODES)+" or None")
+
+# ----- profiling -----
+
+class _PeakSampler(threading.Thread):
+    # tracemalloc only shows what is still allocated when the snapshot is
+    # taken, and a worker frees most of its memory before returning, so keep
+    # the snapshot from the moment traced memory was highest
+    def __init__(self, interval):
+        threading.Thread.__init__(self, daemon = True)
+        self.interval = interval
+        self.peak = 0
+        self.snapshot = None
+        self.stopped = threading.Event()
+
+    def sample(self):
+        current = tracemalloc.get_traced_memory()[0]
+        if current > self.peak:
+            self.peak = current
+            self.snapshot = tracemalloc.take_snapshot()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.sample()
+
+_job_count = 0
+
+@contextmanager
+def profiled(profile_dir, mode, tag):
+    # writes <tag>_<pid>_<n>.prof and/or .tracemalloc to profile_dir
+    global _job_count
+    _job_count += 1
+    base = os.path.join(profile_dir, str(tag)+"_"+str(os.getpid())+"_"+str(_job_count))
+    profiler = None
+    sampler = None
+    if mode in ("tracemalloc", "both"):
+        tracemalloc.start(10)
+        sampler = _PeakSampler(0.25)
+        sampler.start()
+    if mode in ("cprofile", "both"):
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(base+".prof")
+        if sampler is not None:
+            sampler.stop()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            if sampler.snapshot is not None:
+                sampler.snapshot.dump(base+".tracemalloc")
+            with open(base+".peak", "w") as f:
+                f.write(str(peak))
+
+class ProfiledWorker(object):
+    # picklable stand-in for a pool worker: pool.map(ProfiledWorker(access_multi, ...), jobs)
+    def __init__(self, worker, profile_dir, mode):
+        self.worker = worker
+        self.profile_dir = profile_dir
+        self.mode = mode
+
+    def __call__(self, jobs):
+        with profiled(self.profile_dir, self.mode, "batch_"+str(jobs[0])):
+            return self.worker(jobs)
+
+def profiled_worker(worker, profile_dir, profile):
+    # the plain worker when profiling is off
+    if profile is None:
+        return worker
+    return ProfiledWorker(worker, profile_dir, profile)
+
+@contextmanager
+def maybe_profiled(profile_dir, profile, tag):
+    # parent-side stages; does nothing when profiling is off
+    if profile is None:
+        yield
+        return
+    with profiled(profile_dir, profile, tag):
+        yield
+
+# ----- merged report -----
+
+def merge_cprofile(profile_dir, top = 30):
+    files = sorted(glob.glob(os.path.join(profile_dir, "*.prof")))
+    files = [f for f in files if os.path.basename(f) != "merged.prof"]
+    if not files:
+        return None
+    stats = pstats.Stats(files[0], stream = io.StringIO())
+    for file in files[1:]:
+        stats.add(file)
+    stats.dump_stats(os.path.join(profile_dir, "merged.prof"))
+    lines = []
+    for sort_key, title in (("cumulative", "cumulative time"), ("tottime", "own time")):
+        stream = io.StringIO()
+        stats.stream = stream
+        stats.sort_stats(sort_key).print_stats(top)
+        lines.append("Top "+str(top)+" functions by "+title+" ("+str(len(files))+" profiles)")
+        # drop the pstats preamble up to the column header
+        text = stream.getvalue()
+        lines.append(text[text.find("   ncalls"):].rstrip())
+        lines.append("")
+    return "\n".join(lines)
+
+def merge_tracemalloc(profile_dir, top = 30):
+    files = sorted(glob.glob(os.path.join(profile_dir, "*.tracemalloc")))
+    if not files:
+        return None
+    sites = {}
+    for file in files:
+        snapshot = tracemalloc.Snapshot.load(file)
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__),
+                                           tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")])
+        for stat in snapshot.statistics("lineno"):
+            frame = stat.traceback[0]
+            key = (frame.filename, frame.lineno)
+            size, count, jobs = sites.get(key, (0, 0, 0))
+            sites[key] = (size + stat.size, count + stat.count, jobs + 1)
+    peaks = []
+    for file in glob.glob(os.path.join(profile_dir, "*.peak")):
+        with open(file) as f:
+            peaks.append(int(f.read()))
+    lines = ["Top "+str(top)+" allocation sites at each job's peak ("+str(len(files))+" snapshots)"]
+    if peaks:
+        lines.append("peak traced memory per job: max "+str(round(max(peaks)/1048576, 1))+" MB, mean "+
+                     str(round(sum(peaks)/len(peaks)/1048576, 1))+" MB")
+    lines.append("total MB".rjust(10)+"mean MB".rjust(10)+"blocks".rjust(12)+"  site")
+    for (filename, lineno), (size, count, jobs) in sorted(sites.items(), key = lambda kv: kv[1][0], reverse = True)[:top]:
+        lines.append(str(round(size/1048576, 2)).rjust(10)+str(round(size/jobs/1048576, 2)).rjust(10)+
+                     str(count).rjust(12)+"  "+filename+":"+str(lineno))
+    lines.append("")
+    return "\n".join(lines)
+
+def merge_profiles(profile_dir, top = 30):
+    # one report for all workers and parent stages; written to profile_report.txt
+    parts = [part for part in (merge_cprofile(profile_dir, top), merge_tracemalloc(profile_dir, top)) if part]
+    if not parts:
+        return None
+    report = "\n".join(parts)
+    report_path = os.path.join(profile_dir, "profile_report.txt")
+    with open(report_path, "w") as f:
+        f.write(report)
+    return report_path
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Merge Accessibility Toolbox worker profiles")
+    parser.add_argument("profile_dir", help = "profile folder written by a run")
+    parser.add_argument("--top", type = int, default = 30)
+    args = parser.parse_args(argv)
+    report_path = merge_profiles(args.profile_dir, args.top)
+    if report_path is None:
+        print("No profiles found in "+args.profile_dir)
+        return
+    with open(report_path) as f:
+        print(f.read())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,595 @@
+# Scenario Comparison of OD Matrices and Accessibility Results
+# Christopher D. Higgins
+# Department of Human Geography
+# University of Toronto Scarborough
+# https://higgicd.github.io
+# tool help can be found at https://github.com/higgicd/Accessibility_Toolbox
+
+# compares a base and an alternative run (a new bus line, a closed bridge)
+# without loading either into memory. two parquet od matrices (od cost matrix
+# to parquet tool or r5r) are joined on (origin, destination) one group of
+# origins at a time:
+#   aligned     a first pass over the origin ids of every file links the
+#               base and alternative files that share origins; when both are
+#               partitioned the same way (the batch_id partitions of the
+#               tools) every group is one base file and one alternative file
+#   spilled     groups larger than max_job_rows (matrices batched
+#               differently) are spilled into origin buckets on disk first;
+#               under a memory budget (memory_budget.py) max_job_rows is
+#               what fits a worker's share
+# each group is a job for a pool of workers, so memory is bounded by the
+# largest job and the comparison parallelizes across partitions. per origin
+# the output holds FREQUENCY and SUM_Ai_<measure> of both runs and their
+# difference, the pairs and opportunities gained and lost within the cutoff
+# and the travel time change (alternative - base) over the pairs in both. a
+# histogram of every travel time change goes to the summary.
+# two accessibility tables (i_id, FREQUENCY, SUM_Ai_*) only have one row per
+# origin and are joined directly on i_id
+#
+# usage: python scenario_diff.py base alt output.parquet [--opportunities jobs.parquet]
+#                                [--measures HN1997 CUMR45] [--cutoff 45] [--processes 4] [--memory-budget 2000]
+#                                [--parquet-profile smallest]
+#        python scenario_diff.py --check [od_path]  (perturbed copy of r5_ttm against a pandas merge)
+
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+import access_core
+from incremental_access import od_columns
+from memory_budget import MemoryBudget, scan_rows, spill_rows, governed_imap_unordered, release_memory
+from parquet_profiles import ProfileWriter, write_table
+
+DEFAULT_MAX_JOB_ROWS = 10000000
+
+# ----- job planning -----
+
+class DiffPlan(object):
+    # ids of both matrices and the jobs that cover every origin once
+    def __init__(self, base_path, alt_path, max_job_rows = None):
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.dataset as ds
+        self.paths = {"base": base_path, "alt": alt_path}
+        self.datasets = dict([(side, ds.dataset(path, format = "parquet", partitioning = "hive"))
+                              for side, path in self.paths.items()])
+        self.columns = dict([(side, od_columns(dataset.schema)) for side, dataset in self.datasets.items()])
+        self.max_job_rows = max_job_rows or spill_rows("diff", DEFAULT_MAX_JOB_ROWS)
+
+        # one pass over the id columns: the origins of every file, all destinations
+        fragments, file_origins, destinations = [], [], set()
+        for side, dataset in self.datasets.items():
+            i_col, j_col, t_col = self.columns[side]
+            for fragment in dataset.get_fragments():
+                table = fragment.to_table(columns = [i_col, j_col])
+                fragments.append((side, fragment.path, table.num_rows))
+                file_origins.append(pc.unique(table.column(i_col).cast(pa.string())))
+                destinations.update(pc.unique(table.column(j_col).cast(pa.string())).to_pylist())
+        origins = set()
+        for ids in file_origins:
+            origins.update(ids.to_pylist())
+        # ids are kept as text like the i_id_text/j_id_text fields of the tools
+        self.origin_ids = pa.array(sorted(origins), pa.string())
+        self.destination_ids = pa.array(sorted(destinations), pa.string())
+        self.fragments = fragments
+        self.groups = self.link(file_origins)
+
+    def link(self, file_origins):
+        # files that share an origin end up in the same group (union find)
+        import numpy as np
+        import pyarrow.compute as pc
+        parent = list(range(len(file_origins)))
+        def find(k):
+            while parent[k] != k:
+                parent[k] = parent[parent[k]]
+                k = parent[k]
+            return k
+        owner = np.full(len(self.origin_ids), -1)
+        for k, ids in enumerate(file_origins):
+            codes = pc.index_in(ids, value_set = self.origin_ids).to_numpy(zero_copy_only = False)
+            for other in np.unique(owner[codes]):
+                if other >= 0:
+                    parent[find(int(other))] = find(k)
+            owner[codes[owner[codes] < 0]] = k
+        groups = {}
+        for k in range(len(file_origins)):
+            groups.setdefault(find(k), []).append(k)
+        return list(groups.values())
+
+    def rows(self, group):
+        return sum([self.fragments[k][2] for k in group])
+
+    def jobs(self, spill_dir):
+        # ("files", {side: [paths]}) per group that fits, ("codes", {side: [path]})
+        # per bucket of the groups spilled to spill_dir
+        jobs, spilled = [], []
+        for group in self.groups:
+            if self.rows(group) <= self.max_job_rows:
+                jobs.append(("files", dict([(side, [self.fragments[k][1] for k in group if self.fragments[k][0] == side])
+                                            for side in self.paths])))
+            else:
+                spilled += group
+        self.spilled_rows = sum([self.fragments[k][2] for k in spilled])
+        if spilled:
+            n_buckets = int(-(-self.spilled_rows//(self.max_job_rows//2)))
+            for bucket_files in self.spill(spilled, n_buckets, spill_dir):
+                jobs.append(("codes", bucket_files))
+        # largest jobs first so the pool does not end on a long one
+        sizes = [sum([os.path.getsize(path) for paths in job[1].values() for path in paths]) for job in jobs]
+        return [job for size, k, job in sorted(zip(sizes, range(len(jobs)), jobs), reverse = True)]
+
+    def spill(self, fragment_ids, n_buckets, spill_dir):
+        # rows of the given files into origin buckets as (i, j, t) codes
+        import numpy as np
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.parquet as pq
+        schema = pa.schema([("i", pa.int32()), ("j", pa.int32()), ("t", pa.float64())])
+        buckets = [{} for b in range(n_buckets)]
+        for side in self.paths:
+            i_col, j_col, t_col = self.columns[side]
+            writers = {}
+            for k in fragment_ids:
+                if self.fragments[k][0] != side:
+                    continue
+                for batch in pq.ParquetFile(self.fragments[k][1]).iter_batches(batch_size = scan_rows("scan", 65536),
+                                                                                columns = [i_col, j_col, t_col]):
+                    i_codes = pc.index_in(batch.column(0).cast(pa.string()), value_set = self.origin_ids).to_numpy(zero_copy_only = False)
+                    j_codes = pc.index_in(batch.column(1).cast(pa.string()), value_set = self.destination_ids).to_numpy(zero_copy_only = False)
+                    t_ij = batch.column(2).to_numpy(zero_copy_only = False).astype(np.float64)
+                    bucket_of = i_codes % n_buckets
+                    for bucket in np.unique(bucket_of):
+                        mask = bucket_of == bucket
+                        if bucket not in writers:
+                            path = os.path.join(spill_dir, side+"_"+str(bucket)+".parquet")
+                            writers[bucket] = pq.ParquetWriter(path, schema)
+                            buckets[bucket][side] = [path]
+                        writers[bucket].write_table(pa.table({"i": pa.array(i_codes[mask].astype(np.int32)),
+                                                              "j": pa.array(j_codes[mask].astype(np.int32)),
+                                                              "t": pa.array(t_ij[mask])}, schema = schema))
+            for writer in writers.values():
+                writer.close()
+        return [dict([(side, files.get(side, [])) for side in self.paths]) for files in buckets if files]
+
+# ----- workers -----
+
+_context = None
+
+def diff_setup(context):
+    # pool initializer: ids, opportunities and settings shared by every job
+    global _context
+    import numpy as np
+    import pyarrow as pa
+    context = dict(context)
+    context["origin_ids"] = pa.array(context["origin_ids"], pa.string())
+    context["destination_ids"] = pa.array(context["destination_ids"], pa.string())
+    if context["o_j"] is not None:
+        context["o_j"] = np.asarray(context["o_j"], dtype = np.float64)
+    _context = context
+
+def read_side(kind, paths, columns):
+    # (origin codes, destination codes, travel times) of one side of a job,
+    # with i == j and rows beyond the cutoff dropped
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+    c = _context
+    i_parts, j_parts, t_parts = [np.zeros(0, np.int64)], [np.zeros(0, np.int64)], [np.zeros(0)]
+    for path in paths:
+        if kind == "files":
+            table = pq.read_table(path, columns = list(columns))
+            i_codes = pc.index_in(table.column(0).cast(pa.string()), value_set = c["origin_ids"])
+            j_codes = pc.index_in(table.column(1).cast(pa.string()), value_set = c["destination_ids"])
+            t_ij = table.column(2)
+        else:
+            table = pq.read_table(path)
+            i_codes, j_codes, t_ij = table.column("i"), table.column("j"), table.column("t")
+        i_codes = i_codes.to_numpy(zero_copy_only = False).astype(np.int64)
+        j_codes = j_codes.to_numpy(zero_copy_only = False).astype(np.int64)
+        t_ij = t_ij.to_numpy(zero_copy_only = False).astype(np.float64)
+        keep = ~np.isnan(t_ij)
+        if c["cutoff"] is not None:
+            keep &= t_ij <= c["cutoff"]
+        if c["del_i_eq_j"]:
+            keep &= c["i_to_j"][i_codes] != j_codes
+        i_parts.append(i_codes[keep])
+        j_parts.append(j_codes[keep])
+        t_parts.append(t_ij[keep])
+    return np.concatenate(i_parts), np.concatenate(j_parts), np.concatenate(t_parts)
+
+def side_sums(local, j_codes, t_ij, n_local):
+    # FREQUENCY and SUM_Ai_<measure> per local origin for one side
+    import numpy as np
+    c = _context
+    if c["o_j"] is None:
+        o_j = np.ones(len(j_codes))
+    else:
+        o_j = c["o_j"][j_codes]
+    sums = {"FREQUENCY": np.bincount(local, weights = o_j > 0, minlength = n_local)}
+    for f_name, values in access_core.accessibility(local, t_ij, o_j, c["measures"], n_local).items():
+        sums["SUM_Ai_"+f_name] = values
+    return sums, o_j
+
+def diff_job(job):
+    # per-origin comparison of one group of origins plus its travel time
+    # change histogram as (bins, counts)
+    import numpy as np
+    kind, files = job
+    c = _context
+    start = time.time()
+    sides = {}
+    for side in ("base", "alt"):
+        i_codes, j_codes, t_ij = read_side(kind, files[side], c["columns"][side])
+        keys = i_codes*len(c["destination_ids"]) + j_codes
+        order = np.argsort(keys, kind = "stable")
+        keys = keys[order]
+        if len(keys) > 1 and (keys[1:] == keys[:-1]).any():
+            raise Exception("the "+side+" od matrix has more than one row per origin and destination, "+
+                            "compare matrices of one departure time")
+        sides[side] = (i_codes[order], j_codes[order], t_ij[order], keys)
+    (i_b, j_b, t_b, k_b), (i_a, j_a, t_a, k_a) = sides["base"], sides["alt"]
+
+    # local codes for the origins of this job only
+    touched = np.unique(np.concatenate([i_b, i_a]))
+    n_local = len(touched)
+    local_b, local_a = np.searchsorted(touched, i_b), np.searchsorted(touched, i_a)
+    columns = {}
+    sums_b, o_j_b = side_sums(local_b, j_b, t_b, n_local)
+    sums_a, o_j_a = side_sums(local_a, j_a, t_a, n_local)
+    for name in sums_b:
+        columns[name+"_BASE"] = sums_b[name]
+        columns[name+"_ALT"] = sums_a[name]
+        columns["D_"+name] = sums_a[name] - sums_b[name]
+
+    # pairs in both, lost (base only) and gained (alternative only)
+    common, in_b, in_a = np.intersect1d(k_b, k_a, assume_unique = True, return_indices = True)
+    lost = np.ones(len(k_b), dtype = bool)
+    lost[in_b] = False
+    gained = np.ones(len(k_a), dtype = bool)
+    gained[in_a] = False
+    columns["PAIRS_KEPT"] = np.bincount(local_b[in_b], minlength = n_local)
+    columns["PAIRS_LOST"] = np.bincount(local_b[lost], minlength = n_local)
+    columns["PAIRS_GAINED"] = np.bincount(local_a[gained], minlength = n_local)
+    columns["O_J_LOST"] = np.bincount(local_b[lost], weights = o_j_b[lost], minlength = n_local)
+    columns["O_J_GAINED"] = np.bincount(local_a[gained], weights = o_j_a[gained], minlength = n_local)
+
+    # travel time change over the pairs in both
+    dt = t_a[in_a] - t_b[in_b]
+    local = local_b[in_b]
+    kept = columns["PAIRS_KEPT"]
+    columns["PAIRS_FASTER"] = np.bincount(local, weights = dt < 0, minlength = n_local)
+    columns["PAIRS_SLOWER"] = np.bincount(local, weights = dt > 0, minlength = n_local)
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        mean = np.bincount(local, weights = dt, minlength = n_local)/kept
+        columns["DT_MEAN"] = mean
+        columns["DT_SD"] = np.sqrt(np.bincount(local, weights = (dt - mean[local])**2, minlength = n_local)/kept)
+    dt_min, dt_max = np.full(n_local, np.inf), np.full(n_local, -np.inf)
+    np.minimum.at(dt_min, local, dt)
+    np.maximum.at(dt_max, local, dt)
+    columns["DT_MIN"] = np.where(kept > 0, dt_min, np.nan)
+    columns["DT_MAX"] = np.where(kept > 0, dt_max, np.nan)
+    bins, counts = np.unique(np.floor(dt/c["bin_width"]).astype(np.int64), return_counts = True)
+    stats = {"rows_base": len(k_b), "rows_alt": len(k_a), "seconds": time.time() - start}
+    return touched, columns, (bins, counts), stats
+
+# ----- od matrix comparison -----
+
+def i_to_j_codes(origin_ids, destination_ids):
+    # destination code of each origin's own id, -1 if it is not a destination
+    import pyarrow.compute as pc
+    return pc.index_in(origin_ids, value_set = destination_ids).fill_null(-1).to_numpy(zero_copy_only = False).astype("int64")
+
+def histogram_summary(histogram, bin_width):
+    # travel time change histogram with its quantiles at the lower bin edges
+    import numpy as np
+    bins = np.array(sorted(histogram), dtype = np.int64)
+    counts = np.array([histogram[b] for b in bins.tolist()], dtype = np.int64)
+    summary = {"bin_width": bin_width, "bins": (bins*bin_width).tolist(), "counts": counts.tolist()}
+    if len(counts):
+        running = np.cumsum(counts)
+        for q in (5, 25, 50, 75, 95):
+            summary["p"+str(q)] = float(bins[np.searchsorted(running, running[-1]*q/100.0)]*bin_width)
+    return summary
+
+def od_diff(base_path, alt_path, output, o_j = None, selected_impedance_function = (), cutoff = None,
+            del_i_eq_j = False, processes = None, max_job_rows = None, bin_width = 1.0, parquet_profile = None):
+    # writes the per-origin comparison of two parquet od matrices to output
+    # (parquet) and returns the summary. without o_j every destination counts
+    # as one opportunity; with it FREQUENCY only counts destinations with
+    # o_j > 0, as in the accessibility tool, while the pair counts and travel
+    # time changes cover every destination
+    import pyarrow as pa
+    run_start = time.time()
+    selected_impedance_function = list(selected_impedance_function)
+    plan = DiffPlan(base_path, alt_path, max_job_rows)
+    planned = time.time()
+    output_dir = os.path.dirname(os.path.abspath(output))
+    spill_dir = tempfile.mkdtemp(prefix = "diff_spill_", dir = output_dir)
+    try:
+        jobs = plan.jobs(spill_dir)
+        # the id pass leaves freed pages that forked workers would share
+        release_memory()
+        o_j_codes = None
+        if o_j is not None:
+            o_j = dict([(str(k), v) for k, v in o_j.items() if v is not None])
+            o_j_codes = [o_j.get(j_id, 0.0) for j_id in plan.destination_ids.to_pylist()]
+        context = {"origin_ids": plan.origin_ids.to_pylist(), "destination_ids": plan.destination_ids.to_pylist(),
+                   "o_j": o_j_codes, "measures": selected_impedance_function, "cutoff": cutoff,
+                   "del_i_eq_j": del_i_eq_j, "bin_width": bin_width, "columns": plan.columns,
+                   "i_to_j": i_to_j_codes(plan.origin_ids, plan.destination_ids) if del_i_eq_j else None}
+        if processes is None:
+            processes = access_core.cpu_count(multiprocessing.cpu_count())
+        processes = max(1, min(processes, len(jobs)))
+
+        histogram, writer, totals = {}, None, {}
+        job_stats, record = [], {}
+        def collect(result):
+            nonlocal writer
+            touched, columns, (bins, counts), stats = result
+            job_stats.append(stats)
+            for b, n in zip(bins.tolist(), counts.tolist()):
+                histogram[b] = histogram.get(b, 0) + n
+            table = pa.table(dict([("i_id", plan.origin_ids.take(pa.array(touched)))] +
+                                  [(name, pa.array(values)) for name, values in columns.items()]))
+            if writer is None:
+                writer = ProfileWriter(output, table.schema, parquet_profile)
+            writer.write_table(table)
+            for name, values in columns.items():
+                if name.startswith("D_") or name.startswith("PAIRS_") or name.startswith("O_J_"):
+                    total = totals.setdefault(name, {"sum": 0.0, "origins_up": 0, "origins_down": 0})
+                    total["sum"] += float(values.sum())
+                    total["origins_up"] += int((values > 0).sum())
+                    total["origins_down"] += int((values < 0).sum())
+
+        if processes == 1:
+            diff_setup(context)
+            for job in jobs:
+                collect(diff_job(job))
+        else:
+            pool = multiprocessing.Pool(processes = processes, initializer = diff_setup, initargs = (context,))
+            for result in governed_imap_unordered(pool, diff_job, jobs, processes, record = record):
+                collect(result)
+            pool.close()
+            pool.join()
+        if writer is not None:
+            writer.close()
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors = True)
+
+    summary = {"base": os.path.abspath(base_path), "alt": os.path.abspath(alt_path), "output": os.path.abspath(output),
+               "cutoff": cutoff, "measures": selected_impedance_function, "del_i_eq_j": del_i_eq_j,
+               "origins": len(plan.origin_ids), "destinations": len(plan.destination_ids),
+               "rows_base": sum([s["rows_base"] for s in job_stats]), "rows_alt": sum([s["rows_alt"] for s in job_stats]),
+               "jobs": len(jobs), "spilled_rows": plan.spilled_rows, "max_job_rows": plan.max_job_rows, "processes": processes,
+               "largest_job_rows": max([s["rows_base"] + s["rows_alt"] for s in job_stats] + [0]),
+               "plan_seconds": planned - run_start, "seconds": time.time() - run_start, "governor": record.get("governor"),
+               "totals": totals, "dt_histogram": histogram_summary(histogram, bin_width)}
+    return summary
+
+# ----- accessibility table comparison -----
+
+def read_table_frame(path):
+    # accessibility table from parquet or csv with i_id as text
+    import pandas as pd
+    df = pd.read_csv(path) if path.lower().endswith(".csv") else pd.read_parquet(path)
+    if "i_id" not in df.columns:
+        raise Exception(str(path)+" has no i_id column")
+    df["i_id"] = df["i_id"].astype(str)
+    return df
+
+def table_diff(base_path, alt_path, output, parquet_profile = None):
+    # per-origin <column>_BASE, <column>_ALT and D_<column> for every numeric
+    # column of both tables; an origin missing from one table reached nothing
+    # there (the tools leave out origins with FREQUENCY 0), so it counts as 0
+    import numpy as np
+    import pyarrow as pa
+    base, alt = read_table_frame(base_path), read_table_frame(alt_path)
+    compared = [c for c in base.columns if c != "i_id" and c in alt.columns and
+                base[c].dtype.kind in "iuf" and alt[c].dtype.kind in "iuf"]
+    if not compared:
+        raise Exception(str(base_path)+" and "+str(alt_path)+" have no numeric columns in common")
+    merged = base[["i_id"] + compared].merge(alt[["i_id"] + compared], on = "i_id", how = "outer",
+                                              suffixes = ("_BASE", "_ALT"), indicator = True)
+    df = merged[["i_id"]].copy()
+    totals = {}
+    for c in compared:
+        df[c+"_BASE"] = merged[c+"_BASE"].fillna(0).astype(np.float64)
+        df[c+"_ALT"] = merged[c+"_ALT"].fillna(0).astype(np.float64)
+        df["D_"+c] = df[c+"_ALT"] - df[c+"_BASE"]
+        totals["D_"+c] = {"sum": float(df["D_"+c].sum()), "origins_up": int((df["D_"+c] > 0).sum()),
+                          "origins_down": int((df["D_"+c] < 0).sum())}
+    write_table(pa.Table.from_pandas(df, preserve_index = False), output, parquet_profile)
+    return {"base": os.path.abspath(base_path), "alt": os.path.abspath(alt_path), "output": os.path.abspath(output),
+            "origins": len(df), "only_base": int((merged["_merge"] == "left_only").sum()),
+            "only_alt": int((merged["_merge"] == "right_only").sum()), "columns": compared, "totals": totals}
+
+def is_od_matrix(path):
+    # a parquet od matrix is a directory (hive partitions) with od columns
+    import pyarrow.dataset as ds
+    if not os.path.isdir(path):
+        return False
+    od_columns(ds.dataset(path, format = "parquet", partitioning = "hive").schema)
+    return True
+
+def summary_path(output):
+    return os.path.splitext(output)[0]+"_summary.json"
+
+def scenario_diff(base_path, alt_path, output, parquet_profile = None, **od_options):
+    # od matrices or accessibility tables, whichever the inputs are; the
+    # summary is also written next to the output
+    if is_od_matrix(base_path) and is_od_matrix(alt_path):
+        summary = od_diff(base_path, alt_path, output, parquet_profile = parquet_profile, **od_options)
+    else:
+        summary = table_diff(base_path, alt_path, output, parquet_profile)
+    with open(summary_path(output), "w") as f:
+        json.dump(summary, f, indent = 2)
+    return summary
+
+# ----- versus a pandas merge -----
+
+def perturbed_copy(od_path, out_path, batches = None, seed = 1, change_share = 0.2, drop_share = 0.02, add_share = 0.02):
+    # the chosen batches of od_path as <out_path>_base and an alternative at
+    # out_path: some travel times change by up to +/- 10 minutes, some pairs
+    # are dropped and some new pairs appear
+    import numpy as np
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+    rng = np.random.default_rng(seed)
+    dataset = ds.dataset(od_path, format = "parquet", partitioning = "hive")
+    i_col, j_col, t_col = od_columns(dataset.schema)
+    j_ids = np.array(sorted(set(dataset.to_table(columns = [j_col]).column(j_col).cast(pa.string()).unique().to_pylist())))
+    base_path = out_path+"_base"
+    for path in (base_path, out_path):
+        if os.path.exists(path):
+            shutil.rmtree(path)
+    for fragment in dataset.get_fragments():
+        batch = ds.get_partition_keys(fragment.partition_expression).get("batch_id")
+        if batches is not None and batch not in batches:
+            continue
+        df = fragment.to_table(columns = [i_col, j_col, t_col]).to_pandas()
+        df["batch_id"] = batch
+        pq.write_to_dataset(pa.Table.from_pandas(df, preserve_index = False), root_path = base_path, partition_cols = ["batch_id"])
+        changed = rng.random(len(df)) < change_share
+        shifted = np.maximum(df[t_col] + rng.integers(-10, 11, len(df)), 0)
+        df[t_col] = np.where(changed, shifted, df[t_col]).astype(df[t_col].dtype)
+        df = df[rng.random(len(df)) >= drop_share]
+        added = df.sample(frac = add_share, random_state = int(rng.integers(1 << 31)))
+        added = added.assign(**{j_col: rng.choice(j_ids, len(added))})
+        df = pd.concat([df, added]).drop_duplicates([i_col, j_col], keep = "first")
+        pq.write_to_dataset(pa.Table.from_pandas(df, preserve_index = False), root_path = out_path, partition_cols = ["batch_id"])
+    return base_path, out_path
+
+def repartitioned_copy(od_path, out_path, parts = 4):
+    # the same rows dealt round robin into `parts` partitions, so every file
+    # shares origins with every batch of the original
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+    dataset = ds.dataset(od_path, format = "parquet", partitioning = "hive")
+    table = dataset.to_table(columns = list(od_columns(dataset.schema)))
+    if os.path.exists(out_path):
+        shutil.rmtree(out_path)
+    pq.write_to_dataset(table.append_column("part", pa.array(np.arange(table.num_rows) % parts)),
+                        root_path = out_path, partition_cols = ["part"])
+    return out_path
+
+def merge_diff(base_path, alt_path, o_j, selected_impedance_function, cutoff):
+    # reference: both matrices in memory, one outer merge
+    import numpy as np
+    import pandas as pd
+    import pyarrow.dataset as ds
+    frames = []
+    for path in (base_path, alt_path):
+        dataset = ds.dataset(path, format = "parquet", partitioning = "hive")
+        df = dataset.to_table(columns = list(od_columns(dataset.schema))).to_pandas()
+        df.columns = ["i_id", "j_id", "t"]
+        df["i_id"], df["j_id"] = df["i_id"].astype(str), df["j_id"].astype(str)
+        frames.append(df[df["t"] <= cutoff] if cutoff is not None else df)
+    merged = frames[0].merge(frames[1], on = ["i_id", "j_id"], how = "outer", suffixes = ("_b", "_a"))
+    merged["o_j"] = merged["j_id"].map(o_j).fillna(0)
+    result = pd.DataFrame(index = pd.Index(sorted(merged["i_id"].unique()), name = "i_id"))
+    for side in ("b", "a"):
+        rows = merged[merged["t_"+side].notna()]
+        for f_name in selected_impedance_function:
+            f = access_core.impedance_array(rows["t_"+side].to_numpy(np.float64), f_name)
+            result["SUM_Ai_"+f_name+"_"+side] = (rows["o_j"]*f).groupby(rows["i_id"]).sum()
+        result["FREQUENCY_"+side] = (rows["o_j"] > 0).groupby(rows["i_id"]).sum()
+    result = result.fillna(0)
+    for f_name in selected_impedance_function:
+        result["D_SUM_Ai_"+f_name] = result["SUM_Ai_"+f_name+"_a"] - result["SUM_Ai_"+f_name+"_b"]
+    result["D_FREQUENCY"] = result["FREQUENCY_a"] - result["FREQUENCY_b"]
+    result["PAIRS_GAINED"] = merged["t_b"].isna().groupby(merged["i_id"]).sum()
+    result["PAIRS_LOST"] = merged["t_a"].isna().groupby(merged["i_id"]).sum()
+    both = merged[merged["t_b"].notna() & merged["t_a"].notna()]
+    dt = both["t_a"] - both["t_b"]
+    result["DT_MEAN"] = dt.groupby(both["i_id"]).mean()
+    result["DT_MAX"] = dt.groupby(both["i_id"]).max()
+    bins, counts = np.unique(np.floor(dt.to_numpy()).astype(np.int64), return_counts = True)
+    return result, dict(zip(bins.astype(float).tolist(), counts.tolist()))
+
+def check(od_path = "r5_ttm", batches = (1, 2, 3, 4, 5, 6), cutoff = 45):
+    # a perturbed copy, partitioned like the base and re-partitioned, against a pandas merge
+    import numpy as np
+    import pandas as pd
+    import pyarrow.dataset as ds
+    from synthetic_ttm import synthetic_opportunities
+    from worker_stats import current_rss_mb
+    work_dir = tempfile.mkdtemp(prefix = "scenario_diff_")
+    measures = ["HN1997", "CUMR30", "MGAUS180"]
+    dataset = ds.dataset(od_path, format = "parquet", partitioning = "hive")
+    j_col = od_columns(dataset.schema)[1]
+    j_ids = sorted(set(dataset.to_table(columns = [j_col]).column(j_col).cast("string").unique().to_pylist()))
+    o_j = dict(zip(j_ids, synthetic_opportunities(len(j_ids))))
+    base_path, alt_path = perturbed_copy(od_path, os.path.join(work_dir, "alt"), batches)
+    layouts = [("aligned", alt_path, DEFAULT_MAX_JOB_ROWS),
+               ("re-partitioned", repartitioned_copy(alt_path, os.path.join(work_dir, "alt_parts")), 1000000)]
+    exact, exact_histogram = None, None
+    for layout, alt, max_job_rows in layouts:
+        output = os.path.join(work_dir, layout.replace("-", "_")+".parquet")
+        start = time.perf_counter()
+        summary = scenario_diff(base_path, alt, output, o_j = o_j, selected_impedance_function = measures,
+                                cutoff = cutoff, max_job_rows = max_job_rows)
+        print(layout+": "+str(summary["rows_base"])+" + "+str(summary["rows_alt"])+" rows within "+str(cutoff)+
+              " minutes, "+str(summary["jobs"])+" jobs ("+str(summary["spilled_rows"])+" rows spilled, largest job "+
+              str(summary["largest_job_rows"])+" rows) in "+str(round(time.perf_counter() - start, 1))+" s, rss "+
+              str(round(current_rss_mb()))+" MB")
+        if exact is None:
+            start = time.perf_counter()
+            exact, exact_histogram = merge_diff(base_path, alt_path, o_j, measures, cutoff)
+            print("  pandas merge: "+str(round(time.perf_counter() - start, 1))+" s, rss "+str(round(current_rss_mb()))+" MB")
+        streamed = pd.read_parquet(output).set_index("i_id")
+        print("  origins "+str(len(streamed))+" (merge "+str(len(exact))+"), duplicated "+str(int(streamed.index.duplicated().sum())))
+        reference = exact.reindex(streamed.index)
+        pairs = [("D_SUM_Ai_"+f, "D_SUM_Ai_"+f) for f in measures] + [("SUM_Ai_"+f+"_ALT", "SUM_Ai_"+f+"_a") for f in measures]
+        pairs += [("D_FREQUENCY", "D_FREQUENCY"), ("PAIRS_GAINED", "PAIRS_GAINED"), ("PAIRS_LOST", "PAIRS_LOST"),
+                  ("DT_MEAN", "DT_MEAN"), ("DT_MAX", "DT_MAX")]
+        for ours, theirs in pairs:
+            a, b = streamed[ours].to_numpy(np.float64), reference[theirs].to_numpy(np.float64)
+            both = ~np.isnan(a) & ~np.isnan(b)
+            scale = max(float(np.nanmax(np.abs(b))), 1.0)
+            print("  "+ours.ljust(20)+" max difference / max "+format(float(np.abs(a[both] - b[both]).max())/scale, ".1e")+
+                  ", nan on one side "+str(int((np.isnan(a) != np.isnan(b)).sum())))
+        histogram = summary["dt_histogram"]
+        print("  dt histogram matches the merge: "+str(dict(zip(histogram["bins"], histogram["counts"])) == exact_histogram)+
+              ", p5/p50/p95 "+str(histogram["p5"])+"/"+str(histogram["p50"])+"/"+str(histogram["p95"]))
+    shutil.rmtree(work_dir, ignore_errors = True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Compare two parquet od matrices or two accessibility tables")
+    parser.add_argument("base", nargs = "?", default = "r5_ttm")
+    parser.add_argument("alt", nargs = "?")
+    parser.add_argument("output", nargs = "?")
+    parser.add_argument("--opportunities", help = "parquet or csv of j_id and o_j; without it every destination counts 1")
+    parser.add_argument("--measures", nargs = "*", default = [], help = "parameters.py measures")
+    parser.add_argument("--cutoff", type = float)
+    parser.add_argument("--del-i-eq-j", action = "store_true")
+    parser.add_argument("--processes", type = int)
+    parser.add_argument("--max-job-rows", type = int, help = "default from --memory-budget, else "+str(DEFAULT_MAX_JOB_ROWS))
+    parser.add_argument("--memory-budget", type = float, help = "megabytes for the run, see memory_budget.py")
+    parser.add_argument("--bin-width", type = float, default = 1.0)
+    parser.add_argument("--parquet-profile", help = "encoding of the output, see parquet_profiles.py")
+    parser.add_argument("--check", action = "store_true", help = "check against a pandas merge on a perturbed copy of base")
+    args = parser.parse_args()
+    if args.memory_budget is not None:
+        MemoryBudget(args.memory_budget, args.processes or access_core.cpu_count(multiprocessing.cpu_count())).publish()
+    if args.check:
+        check(args.base)
+    else:
+        if args.alt is None or args.output is None:
+            parser.error("base, alt and output are required")
+        if is_od_matrix(args.base):
+            options = {"o_j": access_core.read_opportunities(args.opportunities) if args.opportunities else None,
+                       "selected_impedance_function": args.measures, "cutoff": args.cutoff,
+                       "del_i_eq_j": args.del_i_eq_j, "processes": args.processes,
+                       "max_job_rows": args.max_job_rows, "bin_width": args.bin_width}
+        else:
+            options = {}
+        summary = scenario_diff(args.base, args.alt, args.output, args.parquet_profile, **options)
+        print(json.dumps(dict([(k, v) for k, v in summary.items() if k != "dt_histogram"]), indent = 2))
@@ -0,0 +1,319 @@
+# Headless Multi-Scenario Runner
+# Christopher D. Higgins
+# Department of Human Geography
+# University of Toronto Scarborough
+# https://higgicd.github.io
+# tool help can be found at https://github.com/higgicd/Accessibility_Toolbox
+
+# runs a list of accessibility scenarios from a json config in one process,
+# building everything two scenarios have in common only once:
+#   solves         scenarios with the same network, travel mode, departure
+#                  time, origins, destinations and location settings share
+#                  one od cost matrix to parquet run at their largest cutoff;
+#                  every solve shares one location cache and one batch cache
+#   od matrices    a parquet od matrix is read once into a sparse matrix
+#                  (multi_access.py) for every scenario that uses it
+#   opportunities  an o_j field or file is read once
+#   kernels        f(t)*(t <= cutoff) of a measure and cutoff is evaluated
+#                  once over the distinct travel times of a matrix, and one
+#                  sparse product serves every opportunity set using it
+# each scenario is written to <output_dir>/<name>.parquet (i_id, FREQUENCY,
+# SUM_Ai_<measure>) and the run to <output_dir>/scenario_report.json, with the
+# time of the shared run against the same work done once per scenario.
+#
+# config:
+#   {"output_dir": "D:/access_multi/scenarios",
+#    "defaults": {"input_network": "...", "travel_mode": "Public transit time",
+#                 "origins_i_input": "...", "i_id_field": "OID", ...},
+#    "scenarios": [{"name": "am_jobs_hn", "time_of_day": "2019-12-30 08:00", "cutoff": 60,
+#                   "selected_impedance_function": ["HN1997"], "o_j_field": "EMPTOT"},
+#                  {"name": "r5_jobs", "od_dataset": "r5_ttm", "opportunities": "jobs.parquet",
+#                   "cutoff": 45, "selected_impedance_function": ["CUMR45", "MGAUS180"]}]}
+# a scenario with od_dataset uses that stored matrix, otherwise it is solved
+# with the keys of odcm_to_pq_main.main. opportunities come from o_j_field of
+# destinations_j_input or from a parquet or csv file of j_id and o_j.
+# "measures_file" adds expression measures (impedance_kernels.py) and a
+# "cutoff" of "support" is where the scenario's measures drop off.
+# "memory_budget" (megabytes, see memory_budget.py) sizes the batches and
+# scans of every solve and scan of the run; a scenario's "reachable_fraction"
+# is the share of destinations its origins are expected to reach.
+# "parquet_profile" (see parquet_profiles.py) encodes a scenario's od matrix
+# and output
+#
+# usage: python scenario_runner.py config.json [--independent]
+#        python access_calc_main.py config.json
+
+import os
+import json
+import time
+import hashlib
+import argparse
+import datetime
+import multiprocessing
+import access_core
+from parquet_profiles import resolve_profile, write_table
+
+SOLVE_KEYS = ["input_network", "travel_mode", "time_of_day",
+              "origins_i_input", "i_id_field", "search_tolerance_i", "search_criteria_i", "search_query_i",
+              "destinations_j_input", "j_id_field", "search_tolerance_j", "search_criteria_j", "search_query_j",
+              "batch_size_factor", "dedup", "precision", "parquet_profile"]
+SCENARIO_DEFAULTS = {"cutoff": None, "selected_impedance_function": ["HN1997"], "del_i_eq_j": "false",
+                     "precision": "double", "search_tolerance_i": "5000 Meters", "search_criteria_i": None,
+                     "search_query_i": None, "search_tolerance_j": "5000 Meters", "search_criteria_j": None,
+                     "search_query_j": None, "batch_size_factor": 500, "dedup": None, "time_of_day": None,
+                     "reachable_fraction": 1.0, "parquet_profile": None}
+
+# ----- config -----
+
+def load_config(path):
+    # (output_dir, [scenario dicts with the defaults filled in])
+    with open(path) as f:
+        config = json.load(f)
+    if "output_dir" not in config or not config.get("scenarios"):
+        raise Exception(str(path)+" needs an output_dir and a list of scenarios")
+    if config.get("measures_file") is not None:
+        # expression measures, relative to the config
+        from impedance_kernels import load_measures
+        load_measures(os.path.join(os.path.dirname(os.path.abspath(path)), config["measures_file"]))
+    from memory_budget import use_budget
+    use_budget(config.get("memory_budget"), access_core.cpu_count(multiprocessing.cpu_count()))
+    scenarios = []
+    for k, overrides in enumerate(config["scenarios"]):
+        scenario = dict(SCENARIO_DEFAULTS)
+        scenario.update(config.get("defaults", {}))
+        scenario.update(overrides)
+        scenario.setdefault("name", "scenario_"+str(k + 1))
+        if scenario.get("od_dataset") is None and scenario.get("input_network") is None:
+            raise Exception(scenario["name"]+" has neither an od_dataset nor an input_network to solve")
+        if scenario.get("o_j_field") is None and scenario.get("opportunities") is None:
+            raise Exception(scenario["name"]+" has neither an o_j_field nor an opportunities file")
+        access_core.value_dtype(scenario["precision"])
+        resolve_profile(scenario["parquet_profile"])
+        unknown = [f_name for f_name in scenario["selected_impedance_function"] if not access_core.is_measure(f_name)]
+        if unknown:
+            raise Exception(scenario["name"]+": "+", ".join(unknown)+" not in parameters.py or the measures file")
+        if scenario["cutoff"] == "support":
+            from impedance_kernels import effective_cutoff
+            scenario["cutoff"] = effective_cutoff(scenario["selected_impedance_function"])
+        scenarios.append(scenario)
+    names = [s["name"] for s in scenarios]
+    if len(set(names)) != len(names):
+        raise Exception("scenario names must be unique: "+", ".join(names))
+    return config["output_dir"], scenarios
+
+def parse_time(value):
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    return datetime.datetime.strptime(value, "%Y-%m-%d %H:%M")
+
+def solve_key(scenario):
+    return json.dumps([scenario.get(k) for k in SOLVE_KEYS], sort_keys = True, default = str)
+
+def largest_cutoff(scenarios):
+    # None (no cutoff) wins over any number
+    cutoffs = [s["cutoff"] for s in scenarios]
+    return None if None in cutoffs else max(cutoffs)
+
+# ----- shared builds -----
+
+class Memo(object):
+    # values built once per key, with their build time and the scenarios that
+    # used them; a scenario run on its own would have built each of them
+    def __init__(self):
+        self.values = {}
+        self.seconds = {}
+        self.users = {}
+
+    def get(self, kind, key, scenarios, build):
+        memo_key = (kind, key)
+        if memo_key not in self.values:
+            start = time.perf_counter()
+            self.values[memo_key] = build()
+            self.seconds[memo_key] = time.perf_counter() - start
+        self.users.setdefault(memo_key, set()).update(scenarios)
+        return self.values[memo_key]
+
+    def summary(self):
+        # {kind: {"builds", "seconds", "uses", "independent_seconds"}}
+        kinds = {}
+        for (kind, key), seconds in self.seconds.items():
+            entry = kinds.setdefault(kind, {"builds": 0, "seconds": 0.0, "uses": 0, "independent_seconds": 0.0})
+            uses = len(self.users[(kind, key)])
+            entry["builds"] += 1
+            entry["seconds"] += seconds
+            entry["uses"] += uses
+            entry["independent_seconds"] += seconds*uses
+        return kinds
+
+def read_opportunities_field(destinations_j_input, j_id_field, o_j_field):
+    import arcpy
+    with arcpy.da.SearchCursor(destinations_j_input, [j_id_field, o_j_field]) as cursor:
+        return {str(r[0]):r[1] for r in cursor if r[1] is not None and r[1] > 0}
+
+def opportunity_source(scenario):
+    if scenario.get("opportunities") is not None:
+        return ("file", os.path.abspath(scenario["opportunities"]))
+    return ("field", scenario["destinations_j_input"], scenario["j_id_field"], scenario["o_j_field"])
+
+class ScenarioRunner(object):
+    def __init__(self, output_dir, telemetry_on = False):
+        self.output_dir = output_dir
+        self.telemetry_on = telemetry_on
+        self.memo = Memo()
+        # one location cache and one solved batch cache for every solve
+        self.location_cache_dir = os.path.join(output_dir, "location_cache")
+        self.cache_dir = os.path.join(output_dir, "odcm_cache")
+
+    def solve(self, scenarios):
+        # parquet od matrix of a group of scenarios with the same solve key
+        import odcm_to_pq_main
+        from memory_budget import active_budget
+        s = scenarios[0]
+        # the config's budget, which the solve publishes again for its own run
+        budget = active_budget()
+        gdb = "scenarios_"+hashlib.sha1(solve_key(s).encode("utf-8")).hexdigest()[:10]
+        odcm_to_pq_main.main(s["input_network"], s["travel_mode"], largest_cutoff(scenarios), parse_time(s["time_of_day"]),
+                             s["origins_i_input"], s["i_id_field"],
+                             s["search_tolerance_i"], s["search_criteria_i"], s["search_query_i"],
+                             s["destinations_j_input"], s["j_id_field"],
+                             s["search_tolerance_j"], s["search_criteria_j"], s["search_query_j"],
+                             s["batch_size_factor"], self.output_dir, gdb, telemetry_on = self.telemetry_on,
+                             cache_dir = self.cache_dir, location_cache_dir = self.location_cache_dir,
+                             dedup = s["dedup"], precision = s["precision"], parquet_profile = s["parquet_profile"],
+                             memory_budget = budget.budget_mb if budget is not None else None,
+                             reachable_fraction = max([g["reachable_fraction"] for g in scenarios]))
+        return os.path.join(self.output_dir, gdb+"_output")
+
+    def od_paths(self, scenarios):
+        # {scenario name: od matrix path}, solving each group once
+        groups = {}
+        for s in scenarios:
+            if s.get("od_dataset") is None:
+                groups.setdefault(solve_key(s), []).append(s)
+        paths = dict([(s["name"], s["od_dataset"]) for s in scenarios if s.get("od_dataset") is not None])
+        for key, group in groups.items():
+            path = self.memo.get("solve", key, [s["name"] for s in group], lambda group = group: self.solve(group))
+            for s in group:
+                paths[s["name"]] = path
+        return paths
+
+    def opportunities(self, scenario):
+        source = opportunity_source(scenario)
+        if source[0] == "file":
+            build = lambda: access_core.read_opportunities(source[1])
+        else:
+            build = lambda: read_opportunities_field(*source[1:])
+        return self.memo.get("opportunities", source, [scenario["name"]], build)
+
+    def run(self, scenarios):
+        # runs every scenario; returns {name: output parquet path}
+        import numpy as np
+        import pandas as pd
+        import pyarrow as pa
+        from multi_access import SparseOD, opportunity_matrix, sparse_product
+        os.makedirs(self.output_dir, exist_ok = True)
+        paths = self.od_paths(scenarios)
+        outputs = {}
+        by_od = {}
+        for s in scenarios:
+            by_od.setdefault((paths[s["name"]], s["del_i_eq_j"] == "true", s["precision"]), []).append(s)
+        for (od_path, del_i_eq_j, precision), group in by_od.items():
+            names = [s["name"] for s in group]
+            # the od matrix key is part of every key built from the matrix
+            od_key = (os.path.abspath(od_path), del_i_eq_j, precision)
+            od = self.memo.get("od_matrix", od_key, names, lambda: SparseOD(od_path, del_i_eq_j, precision))
+            # one opportunity column per distinct source
+            sources = []
+            for s in group:
+                if opportunity_source(s) not in sources:
+                    sources.append(opportunity_source(s))
+            o_j = dict([(str(k), self.opportunities(next(s for s in group if opportunity_source(s) == source)))
+                        for k, source in enumerate(sources)])
+            for s in group:
+                self.opportunities(s)
+            types, matrix = opportunity_matrix(od, o_j)
+            column = dict([(s["name"], sources.index(opportunity_source(s))) for s in group])
+            dtype = access_core.value_dtype(precision)
+
+            # kernels: FREQUENCY is the count of destinations with
+            # opportunities within the cutoff
+            kernels = {}
+            for s in group:
+                kernels.setdefault(("FREQUENCY", s["cutoff"]), []).append(s)
+                for f_name in s["selected_impedance_function"]:
+                    kernels.setdefault((f_name, s["cutoff"]), []).append(s)
+            results = dict([(s["name"], {}) for s in group])
+            for (f_name, cutoff), users in kernels.items():
+                user_names = [s["name"] for s in users]
+                def build_kernel(f_name = f_name, cutoff = cutoff):
+                    if f_name == "FREQUENCY":
+                        f = np.ones(len(od.t_values))
+                    else:
+                        f = access_core.impedance_array(od.t_values, f_name)
+                    if cutoff is not None:
+                        f = f*(od.t_values <= cutoff)
+                    return f.astype(dtype)
+                kernel = self.memo.get("kernel", od_key + (f_name, cutoff), user_names, build_kernel)
+                columns = sorted(set([column[name] for name in user_names]))
+                values = matrix[:, columns]
+                if f_name == "FREQUENCY":
+                    values = (values > 0).astype(dtype)
+                # keyed on the opportunity sources, not their column in this group's matrix
+                sums = self.memo.get("product", od_key + (f_name, cutoff, tuple([sources[k] for k in columns])),
+                                     user_names, lambda: sparse_product(od, kernel[od.t_codes], values))
+                for s in users:
+                    results[s["name"]][f_name] = sums[:, columns.index(column[s["name"]])]
+
+            for s in group:
+                frequency = results[s["name"]]["FREQUENCY"]
+                keep = frequency > 0
+                df = pd.DataFrame({"i_id": np.array(od.origin_ids.to_pylist(), dtype = object)[keep],
+                                   "FREQUENCY": frequency[keep].round().astype(np.int64)})
+                for f_name in s["selected_impedance_function"]:
+                    df["SUM_Ai_"+f_name] = results[s["name"]][f_name][keep]
+                outputs[s["name"]] = os.path.join(self.output_dir, s["name"]+".parquet")
+                write_table(pa.Table.from_pandas(df, preserve_index = False), outputs[s["name"]], s["parquet_profile"])
+        return outputs
+
+# ----- reporting -----
+
+def run_config(config_path, independent = False):
+    # runs the scenarios of a config together; with independent, also one
+    # runner per scenario for a measured comparison
+    # load_config publishes the config's memory budget; it ends with the run
+    from memory_budget import clear_budget
+    try:
+        output_dir, scenarios = load_config(config_path)
+        start = time.perf_counter()
+        runner = ScenarioRunner(output_dir)
+        outputs = runner.run(scenarios)
+        shared_s = time.perf_counter() - start
+        summary = runner.memo.summary()
+        estimate_s = shared_s + sum([v["independent_seconds"] - v["seconds"] for v in summary.values()])
+        report = {"scenarios": len(scenarios), "shared_seconds": shared_s, "independent_estimate_seconds": estimate_s,
+                  "builds": summary, "outputs": outputs}
+        print(str(len(scenarios))+" scenarios in "+str(round(shared_s, 1))+" s")
+        for kind, v in summary.items():
+            print("  "+kind.ljust(14)+str(v["builds"]).rjust(4)+" built for "+str(v["uses"]).rjust(4)+" uses in "+
+                  str(round(v["seconds"], 1)).rjust(6)+" s (once per scenario: "+str(round(v["independent_seconds"], 1))+" s)")
+        print("run once per scenario, the same work is an estimated "+str(round(estimate_s, 1))+" s ("+
+              str(round(estimate_s/max(shared_s, 1e-9), 1))+"x)")
+        if independent:
+            start = time.perf_counter()
+            for s in scenarios:
+                ScenarioRunner(os.path.join(output_dir, "independent")).run([s])
+            report["independent_seconds"] = time.perf_counter() - start
+            print("measured one runner per scenario: "+str(round(report["independent_seconds"], 1))+" s ("+
+                  str(round(report["independent_seconds"]/max(shared_s, 1e-9), 1))+"x)")
+        with open(os.path.join(output_dir, "scenario_report.json"), "w") as f:
+            json.dump(report, f, indent = 2, default = str)
+        return report
+    finally:
+        clear_budget()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Run accessibility scenarios from a json config in one process")
+    parser.add_argument("config", help = "json config with output_dir, defaults and scenarios")
+    parser.add_argument("--independent", action = "store_true", help = "also run every scenario on its own and time it")
+    args = parser.parse_args()
+    run_config(args.config, args.independent)
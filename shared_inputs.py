@@ -0,0 +1,199 @@
+# Shared-Memory Inputs for Multiprocessing Workers
+# Christopher D. Higgins
+# Department of Human Geography
+# University of Toronto Scarborough
+# https://higgicd.github.io
+# tool help can be found at https://github.com/higgicd/Accessibility_Toolbox
+
+# large read-only inputs (opportunity weights, id lookup arrays, impedance
+# look-up tables) are published once by the parent process and attached as
+# zero-copy numpy views by every worker instead of being pickled into each job.
+# numpy and shared_memory are imported where they are used so the tools that
+# import this module at the top do not pay for them at start up
+
+# ----- parent side -----
+
+class SharedInputs(object):
+    # owns the shared memory blocks for a run; use as a context manager so the
+    # blocks are unlinked once the pool has finished, even if a batch fails
+    def __init__(self):
+        self.blocks = []
+        self.specs = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def publish_array(self, key, array):
+        import numpy as np
+        from multiprocessing import shared_memory
+        array = np.ascontiguousarray(array)
+        shm = shared_memory.SharedMemory(create = True, size = max(array.nbytes, 1))
+        view = np.ndarray(array.shape, dtype = array.dtype, buffer = shm.buf)
+        view[...] = array
+        self.blocks.append(shm)
+        # the spec is a small picklable tuple that goes into the jobs list
+        self.specs[key] = (shm.name, array.shape, array.dtype.str)
+        return self.specs[key]
+
+    def publish_lookup(self, key, value_dict):
+        # store a dict as sorted utf-8 keys and matching float64 values
+        import numpy as np
+        keys = sorted(str(k).encode("utf-8") for k in value_dict)
+        key_array = np.array(keys, dtype = "S"+str(max([len(k) for k in keys] + [1])))
+        decoded = {str(k).encode("utf-8"): v for k, v in value_dict.items()}
+        value_array = np.array([decoded[k] for k in keys], dtype = np.float64)
+        spec = (self.publish_array(key+"_keys", key_array),
+                self.publish_array(key+"_values", value_array))
+        self.specs[key] = spec
+        return spec
+
+    def nbytes(self):
+        return sum([shm.size for shm in self.blocks])
+
+    def close(self):
+        for shm in self.blocks:
+            shm.close()
+            try:
+                shm.unlink()
+            except FileNotFoundError:
+                pass
+        self.blocks = []
+        self.specs = {}
+
+# ----- worker side -----
+
+# attached blocks are kept for the life of the worker process so batches that
+# land on the same worker reuse the mapping
+_attached = {}
+
+def _attach_block(name):
+    from multiprocessing import shared_memory
+    if name in _attached:
+        return _attached[name]
+    try:
+        # python 3.13+: the parent owns the block, workers only attach
+        shm = shared_memory.SharedMemory(name = name, track = False)
+    except TypeError:
+        # older pythons register with the resource tracker inherited from the
+        # parent, which the parent's unlink clears again
+        shm = shared_memory.SharedMemory(name = name)
+    _attached[name] = shm
+    return shm
+
+def attach_array(spec):
+    import numpy as np
+    name, shape, dtype = spec
+    shm = _attach_block(name)
+    view = np.ndarray(shape, dtype = np.dtype(dtype), buffer = shm.buf)
+    view.flags.writeable = False
+    return view
+
+class SharedLookup(object):
+    # read-only dict-like view over a published lookup
+    def __init__(self, keys, values):
+        self.keys = keys
+        self.values = values
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get(self, key, default = None):
+        import numpy as np
+        key = str(key).encode("utf-8")
+        idx = int(np.searchsorted(self.keys, key))
+        if idx < len(self.keys) and self.keys[idx] == key:
+            return float(self.values[idx])
+        return default
+
+    def lookup(self, keys):
+        # vectorised get; missing keys return nan. keys longer than the
+        # longest stored key are missing: cast to the stored dtype they would
+        # be cut to a stored key ("20401" to "2040")
+        import numpy as np
+        keys = [str(k).encode("utf-8") for k in keys]
+        fits = np.array([len(k) <= self.keys.dtype.itemsize for k in keys], dtype = bool)
+        keys = np.array([k if f else b"" for k, f in zip(keys, fits)], dtype = self.keys.dtype)
+        idx = np.searchsorted(self.keys, keys)
+        idx[idx >= len(self.keys)] = 0
+        found = fits & (self.keys[idx] == keys)
+        return np.where(found, self.values[idx], np.nan)
+
+def batch_lookup(lookup, keys):
+    # {key: value} for the keys of a batch found in a lookup (shared or a
+    # plain dict): one vectorised search instead of a search per cursor row
+    keys = list(keys)
+    if isinstance(lookup, dict):
+        return dict([(key, lookup[key]) for key in keys if key in lookup])
+    import numpy as np
+    values = lookup.lookup(keys)
+    return dict([(key, float(value)) for key, value in zip(keys, values) if not np.isnan(value)])
+
+def attach_lookup(spec):
+    # plain dicts are passed through so callers work with or without sharing
+    if isinstance(spec, dict):
+        return spec
+    keys_spec, values_spec = spec
+    return SharedLookup(attach_array(keys_spec), attach_array(values_spec))
+
+# ----- checks -----
+
+def check_lookup():
+    # a shared lookup gives the same batch values as the dict it was published
+    # from, for ids of mixed lengths, prefixes of stored ids and longer ids
+    # that start with one
+    o_j_dict = {"101": 1.0, "2040": 5.0, "7": 2.0, "36085000001": 3.0, "": 4.0}
+    keys = ["2040", "20401", "204", "101", "1010", "7", "70", "36085000001", "360850000012", "", "\u00e9", "9"]
+    with SharedInputs() as shared:
+        lookup = attach_lookup(shared.publish_lookup("o_j", o_j_dict))
+        shared_values = batch_lookup(lookup, keys)
+        get_values = dict([(key, lookup.get(key)) for key in keys if lookup.get(key) is not None])
+    expected = batch_lookup(o_j_dict, keys)
+    if shared_values != expected or get_values != expected:
+        raise Exception("Shared lookup mismatch: "+str(shared_values)+" and "+str(get_values)+", expected "+str(expected))
+    print("shared lookup matches its dict for "+str(len(keys))+" ids of mixed lengths")
+
+# ----- before/after measurement -----
+
+def _measure_worker(jobs):
+    from worker_stats import current_rss_mb
+    o_j = attach_lookup(jobs[1])
+    total = 0.0
+    for key in jobs[2]:
+        total += o_j.get(key, 0.0)
+    return current_rss_mb()
+
+def compare_footprint(n_destinations = 300000, n_batches = 75, processes = 4):
+    # compares pickling o_j_dict into every job against a shared lookup
+    import multiprocessing
+    from worker_stats import pickled_size, current_rss_mb, format_mb
+    o_j_dict = {str(360850000000000 + j): float(j % 977) for j in range(n_destinations)}
+    sample = list(o_j_dict)[::max(1, n_destinations // 1000)]
+
+    pool = multiprocessing.Pool(processes = processes)
+    jobs = [(batch_id, o_j_dict, sample) for batch_id in range(n_batches)]
+    dict_job = pickled_size(jobs[0])
+    dict_rss = max(pool.map(_measure_worker, jobs))
+    pool.close()
+    pool.join()
+    print("pickled o_j_dict:   "+str(round(dict_job/1048576, 2))+" MB per job, "+
+          str(round(dict_job*n_batches/1048576, 1))+" MB for "+str(n_batches)+" batches, worker RSS "+format_mb(dict_rss))
+
+    with SharedInputs() as shared:
+        spec = shared.publish_lookup("o_j", o_j_dict)
+        pool = multiprocessing.Pool(processes = processes)
+        jobs = [(batch_id, spec, sample) for batch_id in range(n_batches)]
+        shared_job = pickled_size(jobs[0])
+        shared_rss = max(pool.map(_measure_worker, jobs))
+        pool.close()
+        pool.join()
+        print("shared lookup:      "+str(round(shared_job/1048576, 4))+" MB per job, "+
+              format_mb(shared.nbytes()/1048576)+" published once, worker RSS "+format_mb(shared_rss))
+    print("parent RSS: "+format_mb(current_rss_mb()))
+
+if __name__ == '__main__':
+    check_lookup()
+    compare_footprint()
@@ -0,0 +1,179 @@
+# Synthetic Travel Time Matrices
+# Christopher D. Higgins
+# Department of Human Geography
+# University of Toronto Scarborough
+# https://higgicd.github.io
+# tool help can be found at https://github.com/higgicd/Accessibility_Toolbox
+
+# generates transit-like travel time matrices without a network dataset so the
+# sweep, accessibility and storage code can be exercised on any machine
+
+import numpy as np
+from datetime import datetime
+
+# ----- static od matrices at any scale -----
+
+SCHEMAS = ("r5", "arcgis")
+TIME_DISTRIBUTIONS = ("uniform", "lognormal", "distance")
+
+def synthetic_travel_times(n, time_distribution, max_time, rng, distance = None):
+    if time_distribution == "uniform":
+        t = rng.uniform(0, max_time, size = n)
+    elif time_distribution == "lognormal":
+        # right-skewed like real matrices: few very short trips, most near the middle
+        t = rng.lognormal(np.log(max_time/2), 0.45, size = n)
+    elif time_distribution == "distance":
+        # grows with straight-line distance plus access and wait noise
+        t = distance/distance.max()*max_time*0.9 + rng.exponential(3, size = n)
+    else:
+        raise Exception(str(time_distribution)+" is not one of "+str(TIME_DISTRIBUTIONS))
+    return np.clip(t, 0, max_time)
+
+def synthetic_od(n_origins = 2000, n_destinations = 5000, density = 0.1, time_distribution = "lognormal",
+                 max_time = 60, schema = "r5", batch_size = 500, seed = 1):
+    # long-format od matrix as a pyarrow table. density is the share of all
+    # origin-destination pairs that are reachable; origins are split into
+    # batches of batch_size like the tools do. schema "r5" matches the bundled
+    # r5_ttm dataset (fromId, toId, travel_time int32), schema "arcgis" matches
+    # the parquet tools (Total_Time, i_id, j_id)
+    import pyarrow as pa
+    if schema not in SCHEMAS:
+        raise Exception(str(schema)+" is not one of "+str(SCHEMAS))
+    rng = np.random.default_rng(seed)
+    xy_i = rng.uniform(0, 20, size = (n_origins, 2))
+    xy_j = rng.uniform(0, 20, size = (n_destinations, 2))
+
+    # draw the reachable pairs block by block to bound memory
+    i_parts, j_parts, t_parts = [], [], []
+    block = max(1, int(2000000/max(n_destinations, 1)))
+    for first in range(0, n_origins, block):
+        last = min(n_origins, first + block)
+        i_codes, j_codes = np.nonzero(rng.random((last - first, n_destinations)) < density)
+        i_codes = i_codes + first
+        distance = None
+        if time_distribution == "distance":
+            distance = np.sqrt(((xy_i[i_codes] - xy_j[j_codes])**2).sum(axis = 1))
+        t_parts.append(synthetic_travel_times(len(i_codes), time_distribution, max_time, rng, distance))
+        i_parts.append(i_codes)
+        j_parts.append(j_codes)
+    i_codes = np.concatenate(i_parts)
+    j_codes = np.concatenate(j_parts)
+    t_ij = np.concatenate(t_parts)
+    batch_id = (i_codes//batch_size + 1).astype(np.int32)
+
+    if schema == "r5":
+        # census-style string ids, like the r5r output
+        i_ids = pa.array([str(360000000000000 + i) for i in range(n_origins)])
+        j_ids = pa.array([str(360000000000000 + j) for j in range(n_destinations)])
+        return pa.table({"fromId": i_ids.take(pa.array(i_codes)),
+                         "toId": j_ids.take(pa.array(j_codes)),
+                         "travel_time": pa.array(np.round(t_ij).astype(np.int32)),
+                         "batch_id": pa.array(batch_id)})
+    return pa.table({"Total_Time": pa.array(t_ij.astype(np.float64)),
+                     "i_id": pa.array(i_codes.astype(np.int64) + 1),
+                     "j_id": pa.array(j_codes.astype(np.int64) + 1),
+                     "batch_id": pa.array(batch_id)})
+
+def synthetic_opportunities(n_destinations, seed = 1):
+    # skewed opportunity counts, most destinations small and a few very large
+    rng = np.random.default_rng(seed)
+    return np.floor(rng.lognormal(3, 1.2, size = n_destinations))
+
+def write_od_dataset(table, root_path, parquet_profile = None):
+    # hive-partitioned by batch_id like r5_ttm and the parquet tools
+    from parquet_profiles import write_to_dataset
+    return write_to_dataset(table, root_path, ['batch_id'], parquet_profile)
+
+# ----- time-varying transit matrix -----
+
+class TimeVaryingTTM(object):
+    # each origin is served by a few routes; the travel time to a destination
+    # is walk + wait for the next departure of the best route + ride. headways
+    # change with the schedule, so accessibility is flat off-peak and moves
+    # quickly around the schedule changes
+    def __init__(self, n_origins = 400, n_destinations = 600, routes_per_origin = 8,
+                 schedule = None, cutoff = 60, seed = 1):
+        rng = np.random.default_rng(seed)
+        self.n_origins = n_origins
+        self.n_destinations = n_destinations
+        self.cutoff = cutoff
+        # schedule: list of (start hour, headway minutes)
+        self.schedule = schedule or [(0, 30), (6.5, 15), (7, 6), (9, 12), (10, 30)]
+
+        xy_i = rng.uniform(0, 20, size = (n_origins, 2))
+        xy_j = rng.uniform(0, 20, size = (n_destinations, 2))
+        distance = np.sqrt(((xy_i[:, None, :] - xy_j[None, :, :])**2).sum(axis = 2))
+
+        self.walk = rng.uniform(1, 10, size = (n_origins, routes_per_origin))
+        self.offset = rng.uniform(0, 60, size = (n_origins, routes_per_origin))
+        # ride time per route: routes differ in directness
+        directness = rng.uniform(1.0, 1.6, size = (n_origins, routes_per_origin))
+        self.ride = distance[:, None, :]*directness[:, :, None]*2.5
+        self.o_j = np.floor(rng.lognormal(3, 1.2, size = n_destinations))
+
+    def headway(self, time_of_day):
+        hour = time_of_day.hour + time_of_day.minute/60
+        current = self.schedule[0][1]
+        for start, headway in self.schedule:
+            if hour >= start:
+                current = headway
+        return current
+
+    def travel_times(self, time_of_day):
+        # dense origins x destinations matrix of travel times in minutes
+        minute = time_of_day.hour*60 + time_of_day.minute + time_of_day.second/60
+        headway = self.headway(time_of_day)
+        wait = np.mod(self.offset - minute - self.walk, headway)
+        total = (self.walk + wait)[:, :, None] + self.ride
+        return np.round(total.min(axis = 1), 1)
+
+    def od_pairs(self, time_of_day):
+        # long-format pairs within the cutoff, as an od matrix tool would export them
+        t = self.travel_times(time_of_day)
+        i_codes, j_codes = np.nonzero(t <= self.cutoff)
+        return i_codes, j_codes, t[i_codes, j_codes]
+
+    def accessibility(self, time_of_day, f_name = "CUMR45"):
+        from access_core import accessibility
+        i_codes, j_codes, t_ij = self.od_pairs(time_of_day)
+        return accessibility(i_codes, t_ij, self.o_j[j_codes], [f_name], self.n_origins)[f_name]
+
+# ----- adaptive versus dense sweep -----
+
+def compare_adaptive_sweep(start_time = datetime(2019, 12, 30, 5, 0), end_time = datetime(2019, 12, 30, 11, 0),
+                           coarse_delta = 30, min_delta = 1, tolerance = 0.05, max_solves = 90,
+                           f_name = "CUMR45", percentiles = (10, 50, 90), stop_tolerance = 0.2):
+    # the dense min_delta sweep against two adaptive ones: one without a solve
+    # budget that refines until no neighbouring times differ by more than
+    # stop_tolerance, and one at tolerance capped at max_solves. the schedule
+    # changes move accessibility by up to 17% between neighbouring minutes, so
+    # a tolerance below that is only stopped by the grid or the budget
+    from time_sweep import time_of_day_range, adaptive_time_sweep, temporal_percentiles, percentile_error
+    ttm = TimeVaryingTTM()
+
+    def solve_round(times):
+        return {time_of_day: ttm.accessibility(time_of_day, f_name) for time_of_day in times}
+
+    dense_times = time_of_day_range(start_time, end_time, min_delta)
+    dense = solve_round(dense_times)
+    exact = temporal_percentiles(dense, start_time, end_time, percentiles)
+    scale = np.vstack(list(dense.values())).mean(axis = 0)
+    print("dense sweep:    "+str(len(dense))+" solves")
+    sweeps = {}
+    for sweep_tolerance, budget in ((stop_tolerance, None), (tolerance, max_solves)):
+        report = {}
+        adaptive = adaptive_time_sweep(solve_round, start_time, end_time, coarse_delta, min_delta,
+                                       sweep_tolerance, budget, seed = 1, report = report)
+        sweeps[(sweep_tolerance, budget)] = adaptive
+        estimate = temporal_percentiles(adaptive, start_time, end_time, percentiles)
+        print("adaptive sweep: "+str(len(adaptive))+" solves (tolerance "+str(sweep_tolerance)+", "+
+              ("no solve budget" if budget is None else "budget "+str(budget))+") stopped on "+report["stopped"]+
+              " after "+str(report["rounds"])+" rounds, largest change left "+str(round(100*report["largest_change"], 2))+"%")
+        for q in percentiles:
+            error = percentile_error(estimate[q], exact[q], scale)
+            print("  p"+str(q)+": mean error "+str(round(100*error["mean"], 2))+"%, "+
+                  "95th pct error "+str(round(100*error["p95"], 2))+"%, max error "+str(round(100*error["max"], 2))+"% of mean accessibility")
+    return dense, sweeps
+
+if __name__ == '__main__':
+    compare_adaptive_sweep()
@@ -0,0 +1,109 @@
+# Run Telemetry for the Accessibility Toolbox
+# Christopher D. Higgins
+# Department of Human Geography
+# University of Toronto Scarborough
+# https://higgicd.github.io
+# tool help can be found at https://github.com/higgicd/Accessibility_Toolbox
+
+# every stage of a run appends one json line per event to
+# <telemetry dir>/events_<host>_<pid>.jsonl; one file per process keeps
+# concurrent workers, on this or other machines, from interleaving writes.
+# telemetry_report.py turns the events into a per-stage breakdown and a
+# timeline
+
+import os
+import json
+import glob
+import time
+import socket
+from contextlib import contextmanager
+from worker_stats import peak_rss_mb
+
+_log_dir = None
+_log_file = None
+
+# ----- setup -----
+
+def telemetry_dir_setup(output_dir, output_gdb):
+    # parent side: fresh telemetry folder next to the output gdb
+    log_dir = os.path.join(output_dir, output_gdb+"_telemetry")
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+    for old_file in glob.glob(os.path.join(log_dir, "events_*.jsonl")):
+        os.remove(old_file)
+    return log_dir
+
+def setup(log_dir):
+    # called by the parent and at the start of every worker job; None disables
+    global _log_dir, _log_file
+    if log_dir == _log_dir:
+        return
+    if _log_file is not None:
+        _log_file.close()
+        _log_file = None
+    _log_dir = log_dir
+
+def enabled():
+    return _log_dir is not None
+
+def current():
+    # the folder events go to, for callers that must put it back after a
+    # nested tool run changes it
+    return _log_dir
+
+# ----- events -----
+
+def emit(stage_name, start, end, **fields):
+    global _log_file
+    if _log_dir is None:
+        return
+    if _log_file is None:
+        _log_file = open(os.path.join(_log_dir, "events_"+socket.gethostname()+"_"+str(os.getpid())+".jsonl"), "a", buffering = 1)
+    event = {"stage": stage_name,
+             "start": start,
+             "end": end,
+             "wall_s": end - start,
+             "pid": os.getpid(),
+             "host": socket.gethostname(),
+             "peak_rss_mb": peak_rss_mb()}
+    event.update(fields)
+    _log_file.write(json.dumps(event, default = str)+"\n")
+
+@contextmanager
+def stage(stage_name, **fields):
+    # times the block; rows, bytes or any other counters can be added to the
+    # yielded dict before the block ends
+    record = dict(fields)
+    if _log_dir is None:
+        yield record
+        return
+    start = time.time()
+    try:
+        yield record
+    except Exception as e:
+        record["status"] = "error: "+str(e)
+        raise
+    finally:
+        emit(stage_name, start, time.time(), **record)
+
+def file_bytes(path):
+    # size of a file or of every file below a folder (file gdbs are folders)
+    if path is None or not os.path.exists(path):
+        return None
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, dirs, files in os.walk(path):
+        total += sum([os.path.getsize(os.path.join(root, f)) for f in files])
+    return total
+
+def load_events(log_dir):
+    events = []
+    for path in sorted(glob.glob(os.path.join(log_dir, "events_*.jsonl"))):
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    events.append(json.loads(line))
+    events.sort(key = lambda e: e["start"])
+    return events
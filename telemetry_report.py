@@ -0,0 +1,221 @@
+# Run Telemetry Report
+# Christopher D. Higgins
+# Department of Human Geography
+# University of Toronto Scarborough
+# https://higgicd.github.io
+# tool help can be found at https://github.com/higgicd/Accessibility_Toolbox
+
+# usage: python telemetry_report.py D:/access_multi/Access_multi_100_telemetry [--svg timeline.svg]
+
+import argparse
+from telemetry import load_events
+
+# stages grouped by what dominates them
+STAGE_KIND = {
+    "solve": "solve",
+    "load": "io", "export": "io", "finalize": "io", "merge": "io", "join_ids": "io",
+    "join_back": "io", "cache": "io",
+    "accessibility": "compute", "delete_i_eq_j": "compute", "summary": "compute",
+    "preprocess": "setup", "locations": "setup", "workspace": "setup", "batching": "setup"}
+
+KIND_CHAR = {"solve": "#", "io": "=", "compute": "+", "setup": "s", "other": "."}
+KIND_COLOUR = {"solve": "#d62728", "io": "#1f77b4", "compute": "#2ca02c", "setup": "#9467bd", "other": "#7f7f7f"}
+
+# stages that wrap other stages and are not counted as busy time
+WRAPPERS = ("run", "pool", "queue", "batch")
+
+def stage_kind(stage_name):
+    return STAGE_KIND.get(stage_name, "other")
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    idx = min(len(values) - 1, int(round(q/100*(len(values) - 1))))
+    return values[idx]
+
+# ----- breakdowns -----
+
+def stage_breakdown(events):
+    stages = {}
+    for e in events:
+        s = stages.setdefault(e["stage"], {"count": 0, "walls": [], "rows": 0, "bytes": 0, "peak_rss_mb": 0})
+        s["count"] += 1
+        s["walls"].append(e["wall_s"])
+        s["rows"] += e.get("rows") or 0
+        s["bytes"] += e.get("bytes") or 0
+        s["peak_rss_mb"] = max(s["peak_rss_mb"], e.get("peak_rss_mb") or 0)
+    for s in stages.values():
+        s["total_s"] = sum(s["walls"])
+        s["mean_s"] = s["total_s"]/s["count"]
+        s["p95_s"] = percentile(s["walls"], 95)
+        s["max_s"] = max(s["walls"])
+    return stages
+
+def batch_breakdown(events):
+    batches = {}
+    for e in events:
+        if e.get("batch_id") is None or e["stage"] in WRAPPERS or e["stage"] == "finalize":
+            continue
+        key = (str(e.get("time_of_day") or ""), str(e["batch_id"]))
+        b = batches.setdefault(key, {"total_s": 0.0, "pid": e["pid"], "start": e["start"], "end": e["end"]})
+        b["total_s"] += e["wall_s"]
+        b["start"] = min(b["start"], e["start"])
+        b["end"] = max(b["end"], e["end"])
+    return batches
+
+def stragglers(batches, factor = 1.5):
+    # batches taking more than factor x the median batch time
+    median = percentile([b["total_s"] for b in batches.values()], 50)
+    return sorted([(key, b) for key, b in batches.items() if median > 0 and b["total_s"] > factor*median],
+                  key = lambda kb: kb[1]["total_s"], reverse = True)
+
+def utilisation(events):
+    # busy time of the worker processes against the pool window(s)
+    pools = [e for e in events if e["stage"] == "pool"]
+    parent_pids = set([e["pid"] for e in pools])
+    worker_events = [e for e in events if e["pid"] not in parent_pids and e["stage"] not in WRAPPERS]
+    if not pools or not worker_events:
+        return None
+    window = sum([p["wall_s"] for p in pools])
+    processes = max([p.get("processes") or 1 for p in pools])
+    busy = sum([e["wall_s"] for e in worker_events])
+    return {"processes": processes,
+            "workers_seen": len(set([e["pid"] for e in worker_events])),
+            "window_s": window,
+            "busy_s": busy,
+            "busy_share": busy/(processes*window) if window > 0 else 0.0,
+            "idle_core_s": max(0.0, processes*window - busy)}
+
+def kind_shares(events):
+    totals = {}
+    for e in events:
+        if e["stage"] in WRAPPERS:
+            continue
+        kind = stage_kind(e["stage"])
+        totals[kind] = totals.get(kind, 0.0) + e["wall_s"]
+    grand = sum(totals.values()) or 1.0
+    return dict([(k, (v, v/grand)) for k, v in totals.items()])
+
+# ----- timeline -----
+
+def lanes(events):
+    # one lane per process, parent first
+    order = []
+    for e in events:
+        if e["pid"] not in order:
+            order.append(e["pid"])
+    return order
+
+def ascii_timeline(events, width = 100):
+    events = [e for e in events if e["stage"] not in WRAPPERS]
+    if not events:
+        return ""
+    t0 = min([e["start"] for e in events])
+    t1 = max([e["end"] for e in events])
+    scale = width/max(t1 - t0, 1e-9)
+    rows = []
+    for pid in lanes(events):
+        row = [" "]*width
+        for e in [e for e in events if e["pid"] == pid]:
+            a = int((e["start"] - t0)*scale)
+            b = max(a + 1, int((e["end"] - t0)*scale))
+            for x in range(a, min(b, width)):
+                row[x] = KIND_CHAR[stage_kind(e["stage"])]
+        rows.append(str(pid).rjust(8)+" |"+"".join(row)+"|")
+    legend = "  ".join([c+" "+k for k, c in KIND_CHAR.items()])
+    rows.append(" "*10+"0 s"+" "*(width - 10)+str(round(t1 - t0, 1))+" s")
+    rows.append(" "*10+legend)
+    return "\n".join(rows)
+
+def svg_timeline(events, path, width = 1200, lane_height = 18):
+    events = [e for e in events if e["stage"] not in WRAPPERS]
+    if not events:
+        return
+    t0 = min([e["start"] for e in events])
+    t1 = max([e["end"] for e in events])
+    pids = lanes(events)
+    scale = (width - 90)/max(t1 - t0, 1e-9)
+    height = lane_height*(len(pids) + 2)
+    parts = ['<svg xmlns="http://www.w3.org/2000/svg" width="'+str(width)+'" height="'+str(height)+'" font-family="sans-serif" font-size="10">']
+    for row, pid in enumerate(pids):
+        y = row*lane_height + 4
+        parts.append('<text x="2" y="'+str(y + 12)+'">'+str(pid)+'</text>')
+        for e in [e for e in events if e["pid"] == pid]:
+            x = 80 + (e["start"] - t0)*scale
+            w = max(0.5, e["wall_s"]*scale)
+            title = e["stage"]+" batch "+str(e.get("batch_id"))+" "+str(round(e["wall_s"], 2))+" s"
+            parts.append('<rect x="'+str(round(x, 2))+'" y="'+str(y)+'" width="'+str(round(w, 2))+'" height="'+str(lane_height - 4)+
+                         '" fill="'+KIND_COLOUR[stage_kind(e["stage"])]+'"><title>'+title+'</title></rect>')
+    y = len(pids)*lane_height + 14
+    x = 80
+    for kind, colour in KIND_COLOUR.items():
+        parts.append('<rect x="'+str(x)+'" y="'+str(y - 9)+'" width="10" height="10" fill="'+colour+'"/>')
+        parts.append('<text x="'+str(x + 14)+'" y="'+str(y)+'">'+kind+'</text>')
+        x += 80
+    parts.append('<text x="'+str(width - 80)+'" y="'+str(y)+'">'+str(round(t1 - t0, 1))+' s</text>')
+    parts.append('</svg>')
+    with open(path, "w") as f:
+        f.write("\n".join(parts))
+
+# ----- report -----
+
+def report(events, width = 100, straggler_factor = 1.5):
+    lines = []
+    run = [e for e in events if e["stage"] == "run"]
+    if run:
+        lines.append("Run: "+str(round(run[0]["wall_s"]/60, 2))+" minutes ("+str(run[0].get("tool", ""))+")")
+
+    lines.append("")
+    lines.append("Stage".ljust(16)+"count".rjust(7)+"total s".rjust(11)+"mean s".rjust(9)+"p95 s".rjust(9)+
+                 "max s".rjust(9)+"rows".rjust(13)+"MB".rjust(10)+"peak RSS MB".rjust(13))
+    for name, s in sorted(stage_breakdown(events).items(), key = lambda kv: kv[1]["total_s"], reverse = True):
+        lines.append(name.ljust(16)+str(s["count"]).rjust(7)+str(round(s["total_s"], 1)).rjust(11)+
+                     str(round(s["mean_s"], 2)).rjust(9)+str(round(s["p95_s"], 2)).rjust(9)+
+                     str(round(s["max_s"], 2)).rjust(9)+str(s["rows"]).rjust(13)+
+                     str(round(s["bytes"]/1048576, 1)).rjust(10)+str(round(s["peak_rss_mb"], 1)).rjust(13))
+
+    lines.append("")
+    for kind, (total, share) in sorted(kind_shares(events).items(), key = lambda kv: kv[1][0], reverse = True):
+        lines.append(kind.ljust(10)+str(round(total, 1)).rjust(10)+" s "+str(round(100*share, 1)).rjust(6)+"%")
+
+    u = utilisation(events)
+    if u is not None:
+        lines.append("")
+        lines.append("Pool: "+str(u["processes"])+" processes ("+str(u["workers_seen"])+" seen), "+
+                     str(round(u["window_s"], 1))+" s window, "+str(round(100*u["busy_share"], 1))+"% busy, "+
+                     str(round(u["idle_core_s"], 1))+" idle core-seconds")
+
+    batches = batch_breakdown(events)
+    slow = stragglers(batches, straggler_factor)
+    if batches:
+        lines.append("")
+        lines.append("Batches: "+str(len(batches))+", median "+str(round(percentile([b["total_s"] for b in batches.values()], 50), 2))+
+                     " s, "+str(len(slow))+" stragglers (> "+str(straggler_factor)+"x median)")
+        for (time_of_day, batch_id), b in slow[:10]:
+            lines.append("  batch "+batch_id+(" @ "+time_of_day if time_of_day else "")+": "+
+                         str(round(b["total_s"], 2))+" s on pid "+str(b["pid"]))
+
+    lines.append("")
+    lines.append(ascii_timeline(events, width))
+    return "\n".join(lines)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Summarize Accessibility Toolbox run telemetry")
+    parser.add_argument("log_dir", help = "telemetry folder written by a run")
+    parser.add_argument("--svg", help = "write a Gantt-style timeline to this svg file")
+    parser.add_argument("--width", type = int, default = 100, help = "width of the text timeline")
+    parser.add_argument("--straggler-factor", type = float, default = 1.5)
+    args = parser.parse_args(argv)
+
+    events = load_events(args.log_dir)
+    if not events:
+        print("No telemetry events found in "+args.log_dir)
+        return
+    print(report(events, args.width, args.straggler_factor))
+    if args.svg:
+        svg_timeline(events, args.svg)
+        print("Timeline written to "+args.svg)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+# Departure Time Sweep Scheduler
+# Christopher D. Higgins
+# Department of Human Geography
+# University of Toronto Scarborough
+# https://higgicd.github.io
+# tool help can be found at https://github.com/higgicd/Accessibility_Toolbox
+
+# runs every (time_of_day, batch_id) pair as one flat job set on a single
+# long-lived pool and hands each result to the parent as soon as it is ready,
+# so no departure time waits on the slowest batch of the previous one. the
+# adaptive sweep only solves extra departure times where accessibility moves.
+# numpy is only imported by the adaptive sampling helpers that use it
+
+import time
+import random
+import multiprocessing
+from datetime import datetime, timedelta
+
+# ----- job graph -----
+
+def time_of_day_range(start_time, end_time, time_delta):
+    # same stepping as the original tool: start, start + delta, ... until end is passed
+    time_of_day_list = [start_time]
+    time_of_day = start_time
+
+    while time_of_day < end_time:
+        time_of_day += timedelta(minutes=time_delta)
+        time_of_day_list.append(time_of_day)
+    return time_of_day_list
+
+def time_tag(time_of_day):
+    # partition value used for the start_datetime column and worker file names
+    return datetime.strftime(time_of_day, format = "%Y_%m_%d")+"-"+datetime.strftime(time_of_day, format = "%H_%M_%S")
+
+def flatten_jobs(time_of_day_list, batch_list, make_job):
+    # interleave batches across times so early results cover every departure time
+    jobs = []
+    for batch_id in batch_list:
+        for time_of_day in time_of_day_list:
+            jobs.append(make_job(time_of_day, batch_id))
+    return jobs
+
+# ----- scheduler -----
+
+def run_sweep(pool, worker, jobs, finalize = None, chunksize = 1, processes = None):
+    # results stream back in completion order; finalize runs in the parent
+    # while the pool keeps working on the remaining jobs. given the pool's
+    # processes, jobs are started under the memory budget if one is set
+    from memory_budget import governed_imap_unordered
+    if processes is None:
+        results = pool.imap_unordered(worker, jobs, chunksize)
+    else:
+        results = governed_imap_unordered(pool, worker, jobs, processes, chunksize)
+    finalized = []
+    for result in results:
+        if result is None:
+            continue
+        if finalize is not None:
+            result = finalize(result)
+        finalized.append(result)
+    return finalized
+
+# ----- adaptive sampling -----
+
+def accessibility_change(a, b):
+    # relative l1 change in origin accessibility between two departure times
+    import numpy as np
+    a = np.asarray(a, dtype = np.float64)
+    b = np.asarray(b, dtype = np.float64)
+    scale = 0.5*(np.abs(a).sum() + np.abs(b).sum())
+    if scale == 0:
+        return 0.0
+    return float(np.abs(a - b).sum()/scale)
+
+def adaptive_time_sweep(solve_round, start_time, end_time, coarse_delta, min_delta, tolerance, max_solves,
+                        seed = None, report = None):
+    # solve_round(times) returns {time_of_day: per-origin accessibility array}.
+    # start from the coarse grid, then repeatedly split the neighbouring pairs
+    # whose accessibility changes by more than tolerance, largest change first,
+    # until nothing exceeds the tolerance, the min_delta grid is reached or the
+    # solve budget is spent. each round is handed to solve_round as one list so
+    # the caller can run it as a single flat job set.
+    # transit schedules are periodic, so a regular grid (and exact midpoints of
+    # it) can alias with the headways; the new time inside each interval is drawn
+    # at random on the min_delta grid, which keeps the sample representative.
+    # max_solves None leaves only the tolerance and the grid; report (a dict)
+    # gets why the sweep stopped ("tolerance", "min_delta" or "max_solves"),
+    # the refinement rounds and the largest change left between neighbours
+    rng = random.Random(seed)
+    n_steps = int(round((end_time - start_time).total_seconds()/60/min_delta))
+    if max_solves is None:
+        max_solves = n_steps + 1
+    coarse_steps = max(1, int(round(coarse_delta/min_delta)))
+    
+    def at(step):
+        return start_time + timedelta(minutes = step*min_delta)
+    
+    steps = [0] + [min(n_steps, s + rng.randrange(coarse_steps)) for s in range(coarse_steps, n_steps, coarse_steps)] + [n_steps]
+    steps = sorted(set(steps))
+    results = solve_round([at(step) for step in steps][:max_solves])
+    sampled_steps = {at(step): step for step in steps}
+
+    stopped, rounds, largest = "max_solves", 0, None
+    while True:
+        sampled = sorted(results)
+        candidates, largest = [], 0.0
+        for t0, t1 in zip(sampled[:-1], sampled[1:]):
+            s0, s1 = sampled_steps[t0], sampled_steps[t1]
+            change = accessibility_change(results[t0], results[t1])
+            largest = max(largest, change)
+            if s1 - s0 < 2:
+                continue
+            if change > tolerance:
+                candidates.append((change*(s1 - s0), rng.randrange(s0 + 1, s1)))
+        if not candidates:
+            stopped = "tolerance" if largest <= tolerance else "min_delta"
+            break
+        if len(results) >= max_solves:
+            break
+        rounds += 1
+        candidates.sort(key = lambda c: c[0], reverse = True)
+        budget = max_solves - len(results)
+        new_steps = [c[1] for c in candidates[:budget]]
+        for step in new_steps:
+            sampled_steps[at(step)] = step
+        results.update(solve_round([at(step) for step in new_steps]))
+    if report is not None:
+        report.update({"stopped": stopped, "rounds": rounds, "solves": len(results), "largest_change": largest})
+    return results
+
+def align_results(results, origins = None):
+    # {time_of_day: {origin: value}} -> {time_of_day: array}, origins
+    import numpy as np
+    if origins is None:
+        origins = sorted(set().union(*[set(r) for r in results.values()]))
+    aligned = {}
+    for time_of_day, values in results.items():
+        aligned[time_of_day] = np.array([values.get(o, 0.0) for o in origins], dtype = np.float64)
+    return aligned, origins
+
+def temporal_weights(sampled_times, start_time, end_time):
+    # each sampled time stands for the half-gaps on either side of it
+    import numpy as np
+    x = np.array([(t - start_time).total_seconds() for t in sampled_times])
+    edges = np.concatenate([[x[0]], (x[:-1] + x[1:])/2, [(end_time - start_time).total_seconds()]])
+    weights = np.diff(edges)
+    # the sample at start_time covers a point, not an interval
+    weights[weights <= 0] = 0
+    if weights.sum() == 0:
+        weights[:] = 1
+    return weights
+
+def temporal_percentiles(results, start_time, end_time, percentiles):
+    # per-origin duration-weighted percentiles over the sampled departure times;
+    # a dense sweep gets equal weights and reduces to ordinary percentiles
+    import numpy as np
+    sampled = sorted(results)
+    y = np.vstack([results[t] for t in sampled])
+    weights = temporal_weights(sampled, start_time, end_time)
+    order = np.argsort(y, axis = 0)
+    sorted_y = np.take_along_axis(y, order, axis = 0)
+    cum_w = np.cumsum(weights[order], axis = 0)
+    cum_w = cum_w/cum_w[-1]
+    stats = {}
+    for q in percentiles:
+        idx = (cum_w < q/100).sum(axis = 0)
+        idx = np.minimum(idx, len(sampled) - 1)
+        stats[q] = sorted_y[idx, np.arange(y.shape[1])]
+    return stats
+
+def percentile_error(estimate, exact, scale):
+    # error relative to each origin's scale, e.g. its mean accessibility over the dense sweep
+    import numpy as np
+    mask = scale > 0
+    error = np.abs(estimate - exact)[mask]/scale[mask]
+    if len(error) == 0:
+        return {"mean": 0.0, "p95": 0.0, "max": 0.0}
+    return {"mean": float(error.mean()), "p95": float(np.percentile(error, 95)), "max": float(error.max())}
+
+# ----- stub solver for testing without arcpy -----
+
+def stub_solver(jobs):
+    # stands in for access_multi: jobs = (batch_id, time_of_day, seconds)
+    batch_id, time_of_day, seconds = jobs[0], jobs[1], jobs[2]
+    start = time.time()
+    time.sleep(seconds)
+    return (time_of_day, batch_id, start, time.time())
+
+def utilisation(results, processes, wall):
+    busy = sum([r[3] - r[2] for r in results])
+    return busy/(processes*wall)
+
+def compare_schedules(n_times = 6, n_batches = 7, processes = 4, seed = 1):
+    # per-time pools (the original loop) against one flat job set
+    rng = random.Random(seed)
+    durations = {(t, b): rng.choice([0.05, 0.05, 0.1, 0.4]) for t in range(n_times) for b in range(n_batches)}
+
+    start = time.time()
+    results = []
+    for t in range(n_times):
+        pool = multiprocessing.Pool(processes = processes)
+        results += pool.map(stub_solver, [(b, t, durations[(t, b)]) for b in range(n_batches)])
+        pool.close()
+        pool.join()
+    per_time_wall = time.time() - start
+    print("per-time pools: "+str(round(per_time_wall, 2))+" s, "+
+          str(round(100*utilisation(results, processes, per_time_wall)))+"% busy")
+
+    start = time.time()
+    pool = multiprocessing.Pool(processes = processes)
+    jobs = flatten_jobs(range(n_times), range(n_batches), lambda t, b: (b, t, durations[(t, b)]))
+    results = run_sweep(pool, stub_solver, jobs)
+    pool.close()
+    pool.join()
+    flat_wall = time.time() - start
+    print("flat job set:   "+str(round(flat_wall, 2))+" s, "+
+          str(round(100*utilisation(results, processes, flat_wall)))+"% busy")
+
+if __name__ == '__main__':
+    compare_schedules()
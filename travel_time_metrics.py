@@ -0,0 +1,330 @@
+# Travel Time Metrics from a Stored OD Matrix
+# Christopher D. Higgins
+# Department of Human Geography
+# University of Toronto Scarborough
+# https://higgicd.github.io
+# tool help can be found at https://github.com/higgicd/Accessibility_Toolbox
+
+# travel time to the nearest destination with opportunities, to the k-th such
+# destination and until the first N opportunities are within reach, plus the
+# mean travel time weighted by opportunities, all computed in the same
+# streaming pass over a parquet od matrix (od cost matrix to parquet tool or
+# r5r) as FREQUENCY and the SUM_Ai_<measure> sums.
+# every origin keeps a bounded buffer of its `capacity` closest destinations
+# (a sorted run of travel times). each record batch is sorted by origin and
+# travel time and the first `capacity` rows of every origin are merged into its
+# run, so memory is origins x capacity whatever the size of the matrix and the
+# k-th travel time is a column of the buffer.
+# opportunities are also summed per origin into travel time bins of
+# `bin_width` minutes, origins x bins. the bin where the running sum reaches N
+# gives the time to N opportunities: exactly when travel times are whole
+# minutes (r5r), otherwise one more pass sorts just the rows of that bin
+#
+# usage: python travel_time_metrics.py [od_path]  (checks against a full sort of r5_ttm)
+
+import sys
+import time
+import access_core
+from incremental_access import od_columns
+from memory_budget import scan_options
+
+def threshold_name(n):
+    # T_OPP1000, T_OPP2_5
+    return "T_OPP"+(str(int(n)) if float(n).is_integer() else str(n).replace(".", "_"))
+
+def metric_columns(k_values, thresholds):
+    return ["T_K"+str(k) for k in k_values] + [threshold_name(n) for n in thresholds] + ["T_MEAN_OJ"]
+
+# ----- per-origin buffers -----
+
+class NearestBuffer(object):
+    # the `capacity` closest destinations of each buffered origin, sorted by
+    # travel time; rows maps od origin codes to buffer rows (-1: not buffered)
+    def __init__(self, rows, n_buffered, capacity, dtype):
+        import numpy as np
+        self.rows = rows
+        self.capacity = capacity
+        self.t = np.full((n_buffered, capacity), np.inf, dtype = dtype)
+        self.o_j = np.zeros((n_buffered, capacity), dtype = dtype)
+
+    def nbytes(self):
+        return self.t.nbytes + self.o_j.nbytes
+
+    def merge(self, i_codes, t_ij, o_j):
+        import numpy as np
+        rows = self.rows[i_codes]
+        buffered = rows >= 0
+        rows, t_ij, o_j = rows[buffered], t_ij[buffered], o_j[buffered]
+        if len(rows) == 0:
+            return
+        order = np.lexsort((t_ij, rows))
+        rows, t_ij, o_j = rows[order], t_ij[order], o_j[order]
+        # rank of every row within its origin; only the first `capacity` can enter the buffer
+        starts = np.flatnonzero(np.concatenate([[True], rows[1:] != rows[:-1]]))
+        group = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, len(rows))))
+        rank = np.arange(len(rows)) - starts[group]
+        keep = rank < self.capacity
+        touched = rows[starts]
+        batch_t = np.full((len(touched), self.capacity), np.inf, dtype = self.t.dtype)
+        batch_o_j = np.zeros((len(touched), self.capacity), dtype = self.o_j.dtype)
+        batch_t[group[keep], rank[keep]] = t_ij[keep]
+        batch_o_j[group[keep], rank[keep]] = o_j[keep]
+        # two sorted runs per origin -> the `capacity` smallest
+        all_t = np.concatenate([self.t[touched], batch_t], axis = 1)
+        all_o_j = np.concatenate([self.o_j[touched], batch_o_j], axis = 1)
+        pick = np.argsort(all_t, axis = 1, kind = "stable")[:, :self.capacity]
+        self.t[touched] = np.take_along_axis(all_t, pick, axis = 1)
+        self.o_j[touched] = np.take_along_axis(all_o_j, pick, axis = 1)
+
+    def kth_time(self, k):
+        # nan where fewer than k destinations are reached
+        import numpy as np
+        t = self.t[:, k - 1].astype(np.float64)
+        t[np.isinf(t)] = np.nan
+        return t
+
+    def threshold_time(self, n, offset):
+        # time the running o_j, starting from offset, reaches n
+        import numpy as np
+        reached = offset[:, None] + np.cumsum(self.o_j, axis = 1, dtype = np.float64) >= n
+        found = reached.any(axis = 1)
+        t = np.full(len(self.t), np.nan)
+        t[found] = self.t[found, reached[found].argmax(axis = 1)]
+        return t
+
+class OpportunityHistogram(object):
+    # o_j and destination counts per origin and travel time bin; bins are
+    # added as longer travel times show up
+    def __init__(self, n_origins, bin_width = 1.0):
+        import numpy as np
+        self.bin_width = bin_width
+        self.o_j = np.zeros((n_origins, 0))
+        self.counts = np.zeros((n_origins, 0), dtype = np.int32)
+        self.whole_minutes = True
+
+    def nbytes(self):
+        return self.o_j.nbytes + self.counts.nbytes
+
+    def bins(self, t_ij):
+        import numpy as np
+        return np.floor(t_ij/self.bin_width).astype(np.int64)
+
+    def add(self, i_codes, t_ij, o_j):
+        import numpy as np
+        if len(i_codes) == 0:
+            return
+        self.whole_minutes = self.whole_minutes and bool((t_ij == np.floor(t_ij)).all())
+        bins = self.bins(t_ij)
+        n_bins = max(int(bins.max()) + 1, self.o_j.shape[1])
+        if n_bins > self.o_j.shape[1]:
+            grow = n_bins - self.o_j.shape[1]
+            self.o_j = np.pad(self.o_j, ((0, 0), (0, grow)))
+            self.counts = np.pad(self.counts, ((0, 0), (0, grow)))
+        # only the origins of this batch
+        touched, local = np.unique(i_codes, return_inverse = True)
+        cells = local*n_bins + bins
+        self.o_j[touched] += np.bincount(cells, weights = o_j, minlength = len(touched)*n_bins).reshape(-1, n_bins)
+        self.counts[touched] += np.bincount(cells, minlength = len(touched)*n_bins).reshape(-1, n_bins).astype(np.int32)
+
+    def crossing(self, n):
+        # (bin where the running o_j reaches n or -1, o_j of the bins before it)
+        import numpy as np
+        running = np.cumsum(self.o_j, axis = 1)
+        reached = running >= n
+        found = reached.any(axis = 1)
+        bins = np.where(found, reached.argmax(axis = 1), -1)
+        before = np.zeros(len(bins))
+        inside = found & (bins > 0)
+        before[inside] = running[inside, bins[inside] - 1]
+        return bins, before
+
+# ----- streaming pass -----
+
+class ODScan(object):
+    # record batches of a parquet od matrix as (origin codes, o_j, travel times),
+    # keeping only rows to destinations with opportunities
+    def __init__(self, od_path, o_j, del_i_eq_j = False, precision = "double"):
+        import numpy as np
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.dataset as ds
+        if isinstance(od_path, (list, tuple)):
+            # several od matrices of the same origins, e.g. solved in parts
+            self.dataset = ds.dataset([ds.dataset(path, format = "parquet", partitioning = "hive") for path in od_path])
+        else:
+            self.dataset = ds.dataset(od_path, format = "parquet", partitioning = "hive")
+        self.columns = od_columns(self.dataset.schema)
+        self.del_i_eq_j = del_i_eq_j
+        self.dtype = access_core.value_dtype(precision)
+        o_j = dict([(str(k), v) for k, v in o_j.items() if v is not None and v > 0])
+        self.destination_ids = pa.array(list(o_j.keys()), pa.string())
+        self.o_j_codes = np.array(list(o_j.values()), dtype = self.dtype)
+        # ids are kept as text like the i_id_text field of the tools
+        i_col = self.columns[0]
+        origins = set()
+        for batch in self.dataset.to_batches(columns = [i_col], **scan_options("scan")):
+            origins.update(pc.unique(batch.column(i_col).cast(pa.string())).to_pylist())
+        self.origin_ids = pa.array(sorted(origins), pa.string())
+
+    def __iter__(self):
+        for i_codes, j_codes, t_ij in self.rows():
+            yield i_codes, self.o_j_codes[j_codes], t_ij
+
+    def rows(self):
+        # (origin codes, codes into destination_ids, travel times)
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        i_col, j_col, t_col = self.columns
+        for batch in self.dataset.to_batches(columns = [i_col, j_col, t_col], **scan_options("scan")):
+            i_ids = batch.column(i_col).cast(pa.string())
+            j_ids = batch.column(j_col).cast(pa.string())
+            j_codes = pc.index_in(j_ids, value_set = self.destination_ids)
+            keep = pc.is_valid(j_codes)
+            if self.del_i_eq_j:
+                keep = pc.and_(keep, pc.not_equal(i_ids, j_ids))
+            i_codes = pc.index_in(i_ids.filter(keep), value_set = self.origin_ids).to_numpy(zero_copy_only = False)
+            j_codes = j_codes.filter(keep).to_numpy(zero_copy_only = False)
+            t_ij = batch.column(t_col).filter(keep).to_numpy(zero_copy_only = False).astype(self.dtype)
+            yield i_codes, j_codes, t_ij
+
+def travel_time_metrics(od_path, o_j, selected_impedance_function = (), k_values = (1,), thresholds = (),
+                        del_i_eq_j = False, precision = "double", capacity = None, bin_width = 1.0):
+    # per-origin table: i_id, FREQUENCY, SUM_Ai_<measure>, T_K<k> (travel time
+    # to the k-th destination with opportunities, T_K1 is the nearest),
+    # T_OPP<n> (travel time until n opportunities are within reach) and
+    # T_MEAN_OJ (mean travel time weighted by o_j); nan where never reached
+    import numpy as np
+    import pandas as pd
+    selected_impedance_function = list(selected_impedance_function)
+    k_values, thresholds = sorted(set(k_values)), sorted(set(thresholds))
+    if capacity is None:
+        capacity = max(k_values + [1])
+    if k_values and max(k_values) > capacity:
+        raise Exception("k = "+str(max(k_values))+" is larger than the buffer capacity "+str(capacity))
+    scan = ODScan(od_path, o_j, del_i_eq_j, precision)
+    n_origins = len(scan.origin_ids)
+    stats = {"origins": n_origins, "passes": 1, "capacity": capacity}
+
+    frequency = np.zeros(n_origins)
+    sum_o_j = np.zeros(n_origins)
+    sum_o_j_t = np.zeros(n_origins)
+    sums = dict([(f_name, np.zeros(n_origins)) for f_name in selected_impedance_function])
+    nearest = NearestBuffer(np.arange(n_origins), n_origins, capacity, scan.dtype) if k_values else None
+    histogram = OpportunityHistogram(n_origins, bin_width) if thresholds else None
+    rows = 0
+    for i_codes, o_j_rows, t_ij in scan:
+        rows += len(i_codes)
+        frequency += np.bincount(i_codes, minlength = n_origins)
+        sum_o_j += access_core.origin_sums(i_codes, o_j_rows, n_origins)
+        sum_o_j_t += access_core.origin_sums(i_codes, o_j_rows*t_ij, n_origins)
+        for f_name, values in access_core.accessibility(i_codes, t_ij, o_j_rows, selected_impedance_function,
+                                                        n_origins, precision).items():
+            sums[f_name] += values
+        if nearest is not None:
+            nearest.merge(i_codes, t_ij, o_j_rows)
+        if histogram is not None:
+            histogram.add(i_codes, t_ij, o_j_rows)
+    stats["rows"] = rows
+    stats["buffer_mb"] = ((nearest.nbytes() if nearest is not None else 0) +
+                          (histogram.nbytes() if histogram is not None else 0))/1048576
+
+    columns = {"FREQUENCY": frequency.astype(np.int64)}
+    for f_name in selected_impedance_function:
+        columns["SUM_Ai_"+f_name] = sums[f_name]
+    for k in k_values:
+        columns["T_K"+str(k)] = nearest.kth_time(k)
+    crossings = dict([(n, histogram.crossing(n)) for n in thresholds])
+    if thresholds and histogram.whole_minutes and histogram.bin_width == 1:
+        # every bin holds one travel time
+        for n in thresholds:
+            bins = crossings[n][0]
+            columns[threshold_name(n)] = np.where(bins >= 0, bins, np.nan).astype(np.float64)
+    elif thresholds:
+        # one more pass: per threshold, a sorted run of just the rows in the
+        # crossing bin of each origin, sized by the largest such bin
+        refine = {}
+        for n in thresholds:
+            bins = crossings[n][0]
+            codes = np.flatnonzero(bins >= 0)
+            buffer_rows = np.full(n_origins, -1)
+            buffer_rows[codes] = np.arange(len(codes))
+            bin_capacity = int(histogram.counts[codes, bins[codes]].max()) if len(codes) else 1
+            refine[n] = NearestBuffer(buffer_rows, len(codes), bin_capacity, scan.dtype)
+        del histogram.counts
+        for i_codes, o_j_rows, t_ij in scan:
+            row_bins = histogram.bins(t_ij)
+            for n, buffer in refine.items():
+                in_bin = row_bins == crossings[n][0][i_codes]
+                buffer.merge(i_codes[in_bin], t_ij[in_bin], o_j_rows[in_bin])
+        stats["passes"] += 1
+        stats["buffer_mb"] += sum([buffer.nbytes() for buffer in refine.values()])/1048576
+        for n, buffer in refine.items():
+            bins, before = crossings[n]
+            codes = np.flatnonzero(bins >= 0)
+            t = np.full(n_origins, np.nan)
+            t[codes] = buffer.threshold_time(n, before[codes])
+            columns[threshold_name(n)] = t
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        columns["T_MEAN_OJ"] = sum_o_j_t/sum_o_j
+
+    keep = np.nonzero(frequency > 0)[0]
+    df = pd.DataFrame({"i_id": scan.origin_ids.take(keep).to_pylist()})
+    for name, values in columns.items():
+        df[name] = values[keep]
+    return df, stats
+
+# ----- versus a full sort -----
+
+def full_sort_metrics(od_path, o_j, k_values, thresholds):
+    # reference: the whole matrix in memory, sorted by origin and travel time
+    import numpy as np
+    import pandas as pd
+    import pyarrow.dataset as ds
+    dataset = ds.dataset(od_path, format = "parquet", partitioning = "hive")
+    i_col, j_col, t_col = od_columns(dataset.schema)
+    df = dataset.to_table(columns = [i_col, j_col, t_col]).to_pandas()
+    df.columns = ["i_id", "j_id", "t"]
+    df["i_id"] = df["i_id"].astype(str)
+    df["o_j"] = df["j_id"].astype(str).map(dict([(str(k), v) for k, v in o_j.items()])).fillna(0)
+    df = df[df["o_j"] > 0].sort_values(["i_id", "t"], kind = "stable")
+    grouped = df.groupby("i_id", sort = True)
+    result = pd.DataFrame({"FREQUENCY": grouped.size()})
+    rank = grouped.cumcount() + 1
+    for k in k_values:
+        result["T_K"+str(k)] = df[rank == k].set_index("i_id")["t"].astype(np.float64)
+    running = grouped["o_j"].cumsum()
+    for n in thresholds:
+        result[threshold_name(n)] = df[running >= n].groupby("i_id")["t"].first().astype(np.float64)
+    result["T_MEAN_OJ"] = (df["o_j"]*df["t"]).groupby(df["i_id"]).sum()/grouped["o_j"].sum()
+    return result.reset_index()
+
+def compare_full_sort(od_path = "r5_ttm", k_values = (1, 5, 10), thresholds = (1000, 10000, 100000), seed = 1):
+    import numpy as np
+    import pyarrow.dataset as ds
+    from worker_stats import current_rss_mb
+    from synthetic_ttm import synthetic_opportunities
+    i_col, j_col, t_col = od_columns(ds.dataset(od_path, format = "parquet", partitioning = "hive").schema)
+    j_ids = sorted(set(ds.dataset(od_path, format = "parquet", partitioning = "hive").to_table(columns = [j_col])
+                       .column(j_col).cast("string").unique().to_pylist()))
+    o_j = dict(zip(j_ids, synthetic_opportunities(len(j_ids), seed)))
+
+    start = time.perf_counter()
+    streamed, stats = travel_time_metrics(od_path, o_j, ["CUMR45"], k_values, thresholds)
+    stream_s = time.perf_counter() - start
+    print("streaming: "+str(stats["rows"])+" rows, "+str(stats["origins"])+" origins in "+str(round(stream_s, 1))+" s, "+
+          str(stats["passes"])+" passes, buffers "+str(round(stats["buffer_mb"], 1))+" MB (k capacity "+
+          str(stats["capacity"])+"), process rss "+str(round(current_rss_mb()))+" MB")
+
+    start = time.perf_counter()
+    exact = full_sort_metrics(od_path, o_j, k_values, thresholds)
+    print("full sort: "+str(round(time.perf_counter() - start, 1))+" s, process rss "+str(round(current_rss_mb()))+" MB")
+    merged = streamed.merge(exact, on = "i_id", how = "outer", suffixes = ("", "_exact"))
+    for column in ["FREQUENCY"] + metric_columns(k_values, thresholds):
+        a, b = merged[column].to_numpy(np.float64), merged[column+"_exact"].to_numpy(np.float64)
+        both = ~np.isnan(a) & ~np.isnan(b)
+        mismatched_nan = int((np.isnan(a) != np.isnan(b)).sum())
+        worst = float(np.abs(a[both] - b[both]).max()) if both.any() else 0.0
+        print("  "+column.ljust(12)+" max difference "+format(worst, ".2e")+", missing on one side "+str(mismatched_nan))
+
+if __name__ == '__main__':
+    compare_full_sort(sys.argv[1] if len(sys.argv) > 1 else "r5_ttm")
@@ -0,0 +1,95 @@
+# Worker Statistics for the Accessibility Toolbox
+# Christopher D. Higgins
+# Department of Human Geography
+# University of Toronto Scarborough
+# https://higgicd.github.io
+# tool help can be found at https://github.com/higgicd/Accessibility_Toolbox
+
+import os, sys
+import pickle
+
+# psutil ships with the ArcGIS Pro python environment; fall back to the
+# resource module on other platforms and report None if neither is available
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# ----- memory and payload measurements -----
+
+def pickled_size(obj):
+    # bytes sent to a worker when obj is passed through multiprocessing
+    return len(pickle.dumps(obj, protocol = pickle.HIGHEST_PROTOCOL))
+
+def current_rss_mb(pid = None):
+    # resident set size of a process in megabytes
+    if psutil is not None:
+        try:
+            return psutil.Process(pid or os.getpid()).memory_info().rss/1048576
+        except psutil.Error:
+            return None
+    statm_path = "/proc/"+(str(pid) if pid is not None else "self")+"/statm"
+    if os.path.exists(statm_path):
+        try:
+            with open(statm_path) as statm:
+                pages = int(statm.read().split()[1])
+        except (OSError, IndexError, ValueError):
+            # the process ended between the check and the read
+            return None
+        return pages*os.sysconf("SC_PAGE_SIZE")/1048576
+    return None
+
+def current_pss_mb(pid = None):
+    # proportional set size in megabytes: pages shared with other processes
+    # (a forked worker and its parent) count in part, so the sizes of a
+    # process tree add up. None where the os does not report it
+    if psutil is not None:
+        try:
+            return getattr(psutil.Process(pid or os.getpid()).memory_full_info(), "pss", 0)/1048576 or None
+        except (psutil.Error, AttributeError):
+            return None
+    rollup_path = "/proc/"+(str(pid) if pid is not None else "self")+"/smaps_rollup"
+    try:
+        with open(rollup_path) as rollup:
+            for line in rollup:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1])/1024
+    except (OSError, IndexError, ValueError):
+        pass
+    return None
+
+def available_memory_mb():
+    # memory the machine can still hand out without swapping, in megabytes
+    if psutil is not None:
+        return psutil.virtual_memory().available/1048576
+    if os.path.exists("/proc/meminfo"):
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1])/1024
+    return None
+
+def peak_rss_mb():
+    # peak resident set size of the current process in megabytes
+    if psutil is not None:
+        memory_info = psutil.Process().memory_info()
+        # windows reports the peak working set directly
+        if hasattr(memory_info, "peak_wset"):
+            return memory_info.peak_wset/1048576
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # linux reports kilobytes, macos reports bytes
+        if sys.platform == "darwin":
+            return peak/1048576
+        return peak/1024
+    return current_rss_mb()
+
+def format_mb(value):
+    if value is None:
+        return "n/a"
+    return str(round(value, 1))+" MB"